@@ -92,6 +92,16 @@ export class MainStack extends cdk.Stack {
       }),
     );
 
+    // コールドスタートでSlackへの応答やRagの作成が遅れないよう、定期的にウォームアップ用のイベントで呼び出す
+    new cdk.aws_events.Rule(this, "SlackBotFnWarmUpRule", {
+      schedule: cdk.aws_events.Schedule.rate(cdk.Duration.minutes(5)),
+      targets: [
+        new cdk.aws_events_targets.LambdaFunction(slackBotFn, {
+          event: cdk.aws_events.RuleTargetInput.fromObject({ warmup: true }),
+        }),
+      ],
+    });
+
     ragDocstoreBucket.grantRead(slackBotFn);
   }
 }
@@ -0,0 +1,215 @@
+"""
+DocumentIndexerがチャンクを埋め込んで格納する速度を、従来相当の方法とバッチを並行に書き込む方法で比較するベンチマーク
+
+ページを模したチャンクを以下の設定で索引に格納し、所要時間と1秒あたりに格納したチャンクの数を表示する。
+- 従来相当: すべてのチャンクを1つのバッチとして埋め込んでベクトルストアに書き込み、その後にドキュメントストアに書き込む
+- IndexWriteConfigのデフォルト: バッチに分けて並行に埋め込み、溜めたチャンクのドキュメントストアへの書き込みを次のバッチの埋め込みと重ねる
+
+また、埋め込みが途中で失敗した索引作成を再実行し、チェックポイントから再開して残りのチャンクのみを書き込むことを確認する。
+
+埋め込みはModelCallSchedulerで1件ずつ並行に呼び出す、遅延のあるClusteredFakeEmbeddingsを使用する。
+S3はmotoでプロセス内に再現してPutObjectに遅延を加え、ベクトルストアはupsertに遅延のあるFakePineconeを使用する。
+
+例:
+    poetry run python scripts/benchmark_document_indexer.py --pages 400 --chunks-per-page 5
+"""
+
+import argparse
+import tempfile
+import time
+from typing import Optional
+
+import boto3
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from moto import mock_aws
+
+from server.rag.index_config import IndexConfig
+from server.rag.ingestion.document_indexer import DocumentIndexer, IndexWriteConfig
+from server.rag.ingestion.index_manifest import create_index_manifest_store
+from server.rag.ingestion.model_call_scheduler import (
+    ModelCallScheduler,
+    ScheduledEmbeddings,
+)
+from server.rag.ingestion.pinecone_index import PineconeIndexResolver
+from server.testing.fakes import ClusteredFakeEmbeddings, FakePinecone
+
+BUCKET_NAME = "benchmark-bucket"
+RESUME_BUCKET_NAME = "benchmark-resume"
+
+LEGACY_CONFIG = IndexWriteConfig(
+    batch_size=10**9,
+    embedding_workers=1,
+    docstore_batch_size=10**9,
+    upsert_batch_size=32,
+)
+"""従来のindexと同じく、1回のadd_documentsと1回のmsetですべてのチャンクを格納する設定"""
+
+
+class FailingEmbeddings(Embeddings):
+    """fail_after件のテキストを埋め込んだ後、以降の呼び出しで失敗するEmbeddings"""
+
+    def __init__(self, embedding: Embeddings, fail_after: int):
+        self._embedding = embedding
+        self._remaining = fail_after
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if self._remaining < len(texts):
+            raise RuntimeError("埋め込みモデルの呼び出しに失敗しました")
+        self._remaining -= len(texts)
+        return self._embedding.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embedding.embed_query(text)
+
+
+def create_chunks(page_count: int, chunks_per_page: int) -> list[Document]:
+    return [
+        Document(
+            page_content=f"ページ{page}の{chunk}番目のチャンク。" * 40,
+            metadata={
+                "url": f"https://example.com/{page}",
+                "title": f"ページ{page}",
+                "modality": "text",
+                "start_index": chunk * 1000,
+            },
+        )
+        for page in range(page_count)
+        for chunk in range(chunks_per_page)
+    ]
+
+
+def main(
+    page_count: int,
+    chunks_per_page: int,
+    embedding_latency_seconds: float,
+    upsert_latency_seconds: float,
+    put_latency_seconds: float,
+) -> None:
+    # motoのモックより先に呼び出されるよう、S3のクライアントを作成する前に遅延を登録する
+    boto3.setup_default_session()
+    boto3.DEFAULT_SESSION.events.register(  # type: ignore
+        "before-send.s3.PutObject",
+        lambda **_: time.sleep(put_latency_seconds),
+    )
+    docs = create_chunks(page_count, chunks_per_page)
+
+    with mock_aws():
+        for bucket_name in [BUCKET_NAME, RESUME_BUCKET_NAME]:
+            boto3.client("s3").create_bucket(Bucket=bucket_name)
+        client = FakePinecone(
+            control_plane_latency_seconds=0.0,
+            data_plane_latency_seconds=upsert_latency_seconds,
+        )
+        cache_path = tempfile.mktemp(suffix=".json")
+
+        def create_indexer(
+            config: IndexWriteConfig,
+            bucket_name: str = BUCKET_NAME,
+            refresh: bool = True,
+            fail_after: Optional[int] = None,
+        ) -> DocumentIndexer:
+            embedding: Embeddings = ScheduledEmbeddings(
+                ClusteredFakeEmbeddings(
+                    size=64, latency_seconds=embedding_latency_seconds
+                ),
+                ModelCallScheduler(),
+            )
+            if fail_after is not None:
+                embedding = FailingEmbeddings(embedding, fail_after)
+            return DocumentIndexer(
+                index_config=IndexConfig(name="benchmark", dimension=64),
+                bucket_name=bucket_name,
+                embedding=embedding,
+                refresh=refresh,
+                force_create_index=True,
+                index_resolver=PineconeIndexResolver(
+                    lambda: client, cache_path=cache_path
+                ),
+                write_config=config,
+            )
+
+        for label, config in [
+            ("従来相当", LEGACY_CONFIG),
+            ("IndexWriteConfigのデフォルト", IndexWriteConfig()),
+        ]:
+            indexer = create_indexer(config)
+            start = time.perf_counter()
+            with indexer.begin() as session:
+                session.add(docs)
+                diff = session.commit()
+            elapsed = time.perf_counter() - start
+            stats = session.stats
+            assert len(diff.added) == len(docs) and stats.written == len(docs)
+            print(
+                f"{label}: {stats.written}チャンク, {elapsed:.2f}秒, "
+                f"{len(docs) / elapsed:.1f}チャンク/秒 "
+                f"(埋め込みとベクトルストア {stats.vectorstore_seconds:.2f}秒, "
+                f"ドキュメントストア {stats.docstore_seconds:.2f}秒, "
+                f"{stats.batches}バッチ, ドキュメントストアへの書き込み {stats.docstore_writes}回)"
+            )
+
+        # 半分のチャンクを埋め込んだところで失敗させ、再実行でチェックポイントから再開する
+        config = IndexWriteConfig(checkpoint_interval_seconds=0)
+        manifest_store = create_index_manifest_store(RESUME_BUCKET_NAME)
+        try:
+            create_indexer(config, RESUME_BUCKET_NAME, fail_after=len(docs) // 2).index(
+                docs
+            )
+            raise AssertionError("索引作成が失敗していません")
+        except RuntimeError as e:
+            print(f"中断: {e}")
+        assert manifest_store.load() is None
+        checkpoint = manifest_store.load_checkpoint()
+        assert checkpoint is not None
+
+        indexer = create_indexer(config, RESUME_BUCKET_NAME, refresh=False)
+        start = time.perf_counter()
+        with indexer.begin() as session:
+            session.add(docs)
+            diff = session.commit()
+        elapsed = time.perf_counter() - start
+        stats = session.stats
+        assert stats.resumed == len(checkpoint.written)
+        assert stats.resumed + stats.written == len(docs)
+        assert len(diff.added) == len(docs)
+        manifest = manifest_store.load()
+        assert manifest is not None and len(manifest.entries) == len(docs)
+        assert manifest_store.load_checkpoint() is None
+        print(
+            f"再開: 格納済み {stats.resumed}チャンクを省略し、残りの{stats.written}チャンクを"
+            f"{elapsed:.2f}秒で格納しました"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=400)
+    parser.add_argument("--chunks-per-page", type=int, default=5)
+    parser.add_argument(
+        "--embedding-latency",
+        type=float,
+        default=0.1,
+        help="埋め込みの1回の呼び出しの遅延(秒)",
+    )
+    parser.add_argument(
+        "--upsert-latency",
+        type=float,
+        default=0.05,
+        help="Pineconeへの1回のupsertの遅延(秒)",
+    )
+    parser.add_argument(
+        "--put-latency",
+        type=float,
+        default=0.03,
+        help="S3への1回のPutObjectの遅延(秒)",
+    )
+    args = parser.parse_args()
+
+    main(
+        args.pages,
+        args.chunks_per_page,
+        args.embedding_latency,
+        args.upsert_latency,
+        args.put_latency,
+    )
@@ -0,0 +1,129 @@
+"""
+DocumentTransformPoolによるMarkdownへの変換・画像URLの抽出・チャンクへの分割の高速化を、プロセス数ごとに確認するベンチマーク
+
+見出し・段落・リスト・表・リンク・画像を含むHTMLのページを作成し、以下の所要時間を表示する。
+- 従来の方法: MarkdownifyTransformer・正規表現・RecursiveCharacterTextSplitterで1プロセスで順に変換する
+- DocumentTransformPool: 指定したプロセス数のプロセスプールで並列に変換する(プロセスの起動は含まない)
+
+いずれのプロセス数でも、変換結果が従来の方法と同一であることも確認する。
+高速化の上限はCPU数で決まるため、CPU数を超えるプロセス数では速くならない。
+
+例:
+    poetry run python scripts/benchmark_document_transform.py --pages 100 --workers 1 2 4 8
+"""
+
+import argparse
+import os
+import random
+import time
+
+from langchain_community.document_transformers import MarkdownifyTransformer
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from server.rag.context_packer import estimate_tokens
+from server.rag.ingestion.document_transform_pool import (
+    DocumentTransformConfig,
+    DocumentTransformPool,
+)
+from server.rag.ingestion.extract_image_converter import extract_image_urls
+
+
+def create_page(rng: random.Random, page: int, sections: int) -> Document:
+    """ドキュメントのサイトのページを模したHTMLを作成する"""
+    body = []
+    for section in range(sections):
+        body.append(f"<h2>ページ{page}の{section}番目の節</h2>")
+        for i in range(rng.randint(2, 6)):
+            body.append(
+                f"<p>{section}番目の節の{i}番目の段落では、"
+                f"<a href='https://example.com/docs/{rng.randrange(1000)}'>製品の設定手順</a>"
+                f"を<strong>順に</strong>説明します。" * rng.randint(1, 4) + "</p>"
+            )
+        if rng.random() < 0.3:
+            body.append(
+                f"<img src='https://example.com/images/{rng.randrange(500)}.png' "
+                f"alt='図{section}'>"
+            )
+        if rng.random() < 0.3:
+            items = "".join(f"<li>手順{i}を実行します</li>" for i in range(5))
+            body.append(f"<ul>{items}</ul>")
+        if rng.random() < 0.2:
+            rows = "".join(
+                f"<tr><td>項目{i}</td><td>{rng.randrange(100)}</td></tr>"
+                for i in range(5)
+            )
+            body.append(f"<table><tr><th>項目</th><th>値</th></tr>{rows}</table>")
+    return Document(
+        page_content=f"<html><body>{''.join(body)}</body></html>",
+        metadata={
+            "source": f"https://example.com/pages/{page}",
+            "title": f"ページ{page}",
+        },
+    )
+
+
+def transform_serially(
+    transformer: MarkdownifyTransformer,
+    text_splitter: RecursiveCharacterTextSplitter,
+    html_docs: list[Document],
+) -> tuple[list[Document], list[list[str]], list[Document]]:
+    """DocumentPreprocessorの従来の方法と同じく、1プロセスで順に変換する"""
+    markdown_docs = list(transformer.transform_documents(html_docs))
+    image_urls = [extract_image_urls(doc.page_content) for doc in markdown_docs]
+    chunks = text_splitter.split_documents(markdown_docs)
+    for chunk in chunks:
+        chunk.metadata["token_count"] = estimate_tokens(chunk.page_content)
+    return markdown_docs, image_urls, chunks
+
+
+def main(page_count: int, sections: int, workers: list[int]) -> None:
+    rng = random.Random(0)
+    html_docs = [create_page(rng, page, sections) for page in range(page_count)]
+    transformer = MarkdownifyTransformer()
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=1000, chunk_overlap=200, add_start_index=True
+    )
+
+    start = time.perf_counter()
+    expected = transform_serially(transformer, text_splitter, html_docs)
+    serial_seconds = time.perf_counter() - start
+    html_bytes = sum(len(doc.page_content.encode("utf-8")) for doc in html_docs)
+    print(
+        f"{page_count}ページ ({html_bytes / 1024 / 1024:.1f}MiB), "
+        f"{len(expected[2])}チャンク, CPU数 {os.cpu_count()}"
+    )
+    print(f"従来の方法: {serial_seconds:.2f}秒")
+
+    for max_workers in workers:
+        config = DocumentTransformConfig(max_workers=max_workers)
+        with DocumentTransformPool(transformer, text_splitter, config) as pool:
+            start = time.perf_counter()
+            markdown_docs = pool.to_markdown(html_docs)
+            image_urls = pool.extract_image_urls(markdown_docs)
+            chunks = pool.split(markdown_docs)
+            elapsed = time.perf_counter() - start
+        assert (markdown_docs, image_urls, chunks) == expected
+        print(
+            f"DocumentTransformPool ({max_workers}プロセス): {elapsed:.2f}秒, "
+            f"{serial_seconds / elapsed:.2f}倍"
+        )
+    print("いずれのプロセス数でも、変換結果は従来の方法と同一でした")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=100)
+    parser.add_argument(
+        "--sections", type=int, default=30, help="1ページあたりの節の数"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=sorted({1, 2, 4, os.cpu_count() or 1}),
+        help="比較するプロセス数",
+    )
+    args = parser.parse_args()
+
+    main(args.pages, args.sections, args.workers)
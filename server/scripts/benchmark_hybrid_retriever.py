@@ -0,0 +1,123 @@
+"""
+HybridRetrieverによる語彙検索の併用で増える1クエリあたりのレイテンシと、完全一致の語の取りこぼしを比較するベンチマーク
+
+各ドキュメントに固有の製品名(カタカナ語と英数字の型番)を含め、その製品名で質問したときに
+該当ドキュメントが上位k件に含まれる割合を計測する。
+埋め込みベクトルは意味を持たないフェイクであるため、ベクトル検索のみでは製品名を手がかりにできない状況を再現している。
+
+例:
+    poetry run python scripts/benchmark_hybrid_retriever.py --docs 5000 --queries 200
+"""
+
+import argparse
+import random
+import statistics
+import tempfile
+import time
+
+from langchain.storage import InMemoryStore
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from server.rag.hybrid_retriever import HybridRetriever
+from server.rag.ingestion.lexical_index import LexicalIndex
+from server.rag.ingestion.local_vectorstore import LocalVectorStore
+from server.rag.reranking_retriever import RerankingRetriever
+from server.testing.fakes import ClusteredFakeEmbeddings
+
+_KATAKANA = (
+    "アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモラリルレロ"
+)
+
+
+def create_documents(count: int, seed: int) -> list[Document]:
+    rng = random.Random(seed)
+    docs = []
+    for i in range(count):
+        product_name = "".join(rng.choices(_KATAKANA, k=5)) + f"-{i:05d}"
+        docs.append(
+            Document(
+                page_content=(
+                    f"{product_name}は生成AIを活用した業務改善サービスです。"
+                    "導入支援から運用まで一貫してサポートします。" * 5
+                ),
+                metadata={"doc_id": str(i), "product_name": product_name},
+            )
+        )
+    return docs
+
+
+def measure(
+    retriever: BaseRetriever, queries: list[tuple[str, str]]
+) -> tuple[list[float], float]:
+    latencies: list[float] = []
+    hits = 0
+    for query, expected_id in queries:
+        start = time.perf_counter()
+        docs = retriever.invoke(query)
+        latencies.append(time.perf_counter() - start)
+        hits += any(doc.metadata["doc_id"] == expected_id for doc in docs)
+    return latencies, hits / len(queries)
+
+
+def main(doc_count: int, query_count: int, k: int, seed: int) -> None:
+    docs = create_documents(doc_count, seed)
+    embedding = ClusteredFakeEmbeddings(size=256)
+
+    vectorstore = LocalVectorStore(embedding, tempfile.mkdtemp())
+    vectorstore.add_documents(docs)
+    docstore = InMemoryStore()
+    docstore.mset([(doc.metadata["doc_id"], doc) for doc in docs])
+
+    start = time.perf_counter()
+    lexical_index = LexicalIndex()
+    lexical_index.add(
+        [doc.metadata["doc_id"] for doc in docs], [doc.page_content for doc in docs]
+    )
+    lexical_index.commit()
+    build_seconds = time.perf_counter() - start
+    print(
+        f"LexicalIndex: 構築 {build_seconds:.2f}s, "
+        f"シリアライズ後 {len(lexical_index.to_bytes()) / 1024:.0f}KB"
+    )
+
+    queries = [
+        (
+            f"{doc.metadata['product_name']}の料金を教えてください",
+            doc.metadata["doc_id"],
+        )
+        for doc in random.Random(seed + 1).sample(docs, query_count)
+    ]
+    retrievers: dict[str, BaseRetriever] = {
+        "ベクトル検索のみ": RerankingRetriever(
+            vectorstore=vectorstore, docstore=docstore, search_kwargs={"k": k}
+        ),
+        "ハイブリッド検索": HybridRetriever(
+            vectorstore=vectorstore,
+            docstore=docstore,
+            search_kwargs={"k": k},
+            lexical_index=lexical_index,
+        ),
+    }
+
+    medians: list[float] = []
+    for label, retriever in retrievers.items():
+        latencies, hit_rate = measure(retriever, queries)
+        medians.append(statistics.median(latencies))
+        print(
+            f"{label}: 中央値 {medians[-1] * 1000:.2f}ms, "
+            f"p95 {statistics.quantiles(latencies, n=20)[-1] * 1000:.2f}ms, "
+            f"製品名のドキュメントが上位{k}件に含まれる割合 {hit_rate:.1%}"
+        )
+    print(f"1クエリあたりの増加: {(medians[1] - medians[0]) * 1000:.2f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    main(args.docs, args.queries, args.k, args.seed)
@@ -0,0 +1,122 @@
+"""
+ImageFetcherによる画像の並行ダウンロードと、従来の1件ずつのダウンロードを比較するベンチマーク
+
+LocalSiteServerで画像をローカルに配信し(一部は最初のリクエストに503を返す)、以下を比較する。
+- 従来相当: 画像ごとにrequests.getで新しい接続を作り、1件ずつダウンロードする
+- ImageFetcher (キャッシュなし): 接続を再利用するセッションで、ホストごとの上限まで並行にダウンロードする
+- ImageFetcher (再実行): 前回のキャッシュを条件付きリクエストで再検証する
+- ImageFetcher (一部を更新): 一部の画像の内容を変えてから再実行する
+
+キャッシュはLocalFileStoreで一時ディレクトリに保存する(本番ではS3ByteStoreを使用する)。
+
+例:
+    poetry run python scripts/benchmark_image_fetcher.py --images 200 --latency 0.05
+"""
+
+import argparse
+import tempfile
+import time
+
+import requests
+from langchain.storage import LocalFileStore
+
+from server.rag.ingestion.image_fetcher import (
+    ImageFetchCache,
+    ImageFetchConfig,
+    ImageFetcher,
+)
+from server.testing.fakes import LocalSiteServer
+
+
+def fetch_serially(urls: list[str], max_attempts: int) -> tuple[int, int]:
+    """従来のExtractImageConvertorと同じく1件ずつダウンロードし、成功数とリトライ回数を返す"""
+    succeeded = 0
+    retries = 0
+    for url in urls:
+        for attempt in range(max_attempts):
+            response = requests.get(url, timeout=10)
+            if response.ok:
+                succeeded += 1
+                break
+            if attempt + 1 < max_attempts:
+                retries += 1
+                time.sleep(0.1)
+    return succeeded, retries
+
+
+def main(
+    image_count: int,
+    latency_seconds: float,
+    failure_rate: float,
+    per_host_concurrency: int,
+    modified_count: int,
+) -> None:
+    with LocalSiteServer(
+        pages=0,
+        latency_seconds=latency_seconds,
+        images=image_count,
+        failure_rate=failure_rate,
+    ) as server:
+        urls = [server.image_url(i) for i in range(image_count)]
+        # 同じ画像が複数のページに含まれる場合を模して、重複したURLも渡す
+        requested_urls = urls + urls[: image_count // 4]
+
+        start = time.perf_counter()
+        succeeded, retries = fetch_serially(list(dict.fromkeys(requested_urls)), 3)
+        elapsed = time.perf_counter() - start
+        print(
+            f"従来相当: {succeeded}/{image_count}件, {elapsed:.2f}秒, "
+            f"{image_count / elapsed:.1f}件/秒, リトライ {retries}回, "
+            f"接続数 {server.connections}"
+        )
+
+        fetcher = ImageFetcher(
+            ImageFetchConfig(
+                per_host_concurrency=per_host_concurrency,
+                retry_wait_min_seconds=0.1,
+                retry_wait_max_seconds=0.1,
+            ),
+            ImageFetchCache(LocalFileStore(tempfile.mkdtemp())),
+        )
+        for label in ["キャッシュなし", "再実行", "一部を更新"]:
+            if label == "一部を更新":
+                for image in range(modified_count):
+                    server.modify_image(image)
+            server.reset_counters()
+            results = fetcher.fetch_all(requested_urls)
+            stats = fetcher.stats
+            print(
+                f"ImageFetcher ({label}): "
+                f"{sum(data is not None for data in results.values())}/{stats.requested}件, "
+                f"{stats.elapsed_seconds:.2f}秒, {stats.images_per_second:.1f}件/秒, "
+                f"{stats.bytes_downloaded / 1024:.0f}KiB, 未更新 {stats.not_modified}件, "
+                f"リトライ {stats.retries}回, 失敗 {stats.failed}件, "
+                f"接続数 {server.connections}, 同時リクエスト数 最大 {server.max_in_flight}"
+            )
+            assert all(data is not None for data in results.values())
+            assert server.max_in_flight <= per_host_concurrency
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="1リクエストの遅延(秒)"
+    )
+    parser.add_argument(
+        "--failure-rate",
+        type=float,
+        default=0.05,
+        help="最初のリクエストが503となる割合",
+    )
+    parser.add_argument("--per-host-concurrency", type=int, default=8)
+    parser.add_argument("--modified", type=int, default=10, help="更新する画像の数")
+    args = parser.parse_args()
+
+    main(
+        args.images,
+        args.latency,
+        args.failure_rate,
+        args.per_host_concurrency,
+        args.modified,
+    )
@@ -0,0 +1,138 @@
+"""
+マニフェストによる差分の索引作成と、従来のすべてを作り直す索引作成の埋め込み回数と所要時間を比較するベンチマーク
+
+ページを模したチャンクを索引に格納した後、以下の場合の埋め込んだチャンク数・差分・所要時間を表示する。
+- 変更なしで再実行する
+- 一部のページの内容を変更し、ページの追加と削除も行って再実行する
+- 従来相当(refresh=True)ですべてを作り直す
+
+差分の反映後のベクトルストア・ドキュメントストア・語彙検索用のインデックスが、
+今回のチャンクのみを過不足なく含むことも確認する。
+S3はmotoでプロセス内に再現し、ベクトルストアはFakePinecone(--vectorstore local の場合はLocalVectorStore)を使用する。
+
+例:
+    poetry run python scripts/benchmark_incremental_index.py --pages 200 --changed 10
+"""
+
+import argparse
+import tempfile
+import time
+from typing import cast
+
+import boto3
+from langchain_core.documents import Document
+from moto import mock_aws
+
+from server.rag.index_config import IndexConfig
+from server.rag.ingestion.document_indexer import DocumentIndexer
+from server.rag.ingestion.index_manifest import create_index_manifest_store
+from server.rag.ingestion.lexical_index import create_lexical_index_store
+from server.rag.ingestion.pinecone_index import PineconeIndexResolver
+from server.rag.retriever import VectorstoreBackend
+from server.testing.fakes import ClusteredFakeEmbeddings, FakePinecone
+
+BUCKET_NAME = "benchmark-bucket"
+
+
+def create_chunks(
+    page_count: int, chunks_per_page: int, revisions: dict[int, int]
+) -> list[Document]:
+    return [
+        Document(
+            page_content=f"ページ{page}の{chunk}番目のチャンク(版{revisions.get(page, 0)})。"
+            * 40,
+            metadata={
+                "url": f"https://example.com/{page}",
+                "title": f"ページ{page}",
+                "modality": "text",
+                "start_index": chunk * 1000,
+            },
+        )
+        for page in range(page_count)
+        for chunk in range(chunks_per_page)
+    ]
+
+
+def main(
+    vectorstore_backend: VectorstoreBackend,
+    page_count: int,
+    chunks_per_page: int,
+    changed_count: int,
+) -> None:
+    with mock_aws():
+        boto3.client("s3").create_bucket(Bucket=BUCKET_NAME)
+        embedding = ClusteredFakeEmbeddings(size=64)
+        client = FakePinecone(control_plane_latency_seconds=0.0)
+        cache_path = tempfile.mktemp(suffix=".json")
+
+        def create_indexer(refresh: bool) -> DocumentIndexer:
+            return DocumentIndexer(
+                index_config=IndexConfig(name="benchmark", dimension=64),
+                bucket_name=BUCKET_NAME,
+                embedding=embedding,
+                refresh=refresh,
+                force_create_index=True,
+                vectorstore_backend=vectorstore_backend,
+                index_resolver=PineconeIndexResolver(
+                    lambda: client, cache_path=cache_path
+                ),
+            )
+
+        def run(label: str, docs: list[Document], refresh: bool = False) -> None:
+            embedded_before = embedding.embedded_texts
+            start = time.perf_counter()
+            indexer = create_indexer(refresh)
+            diff = indexer.index(docs)
+            elapsed = time.perf_counter() - start
+            print(
+                f"{label}: 埋め込み {embedding.embedded_texts - embedded_before}件, "
+                f"{elapsed * 1000:.0f}ms, {diff.summary()}"
+            )
+
+            # 差分を反映した結果が、今回のチャンクのみを過不足なく含むことを確認する
+            manifest = create_index_manifest_store(BUCKET_NAME).load()
+            assert manifest is not None and len(manifest.entries) == len(docs)
+            retriever = indexer._retriever
+            doc_ids = [
+                key
+                for key in retriever.docstore.yield_keys()
+                if key in manifest.entries
+            ]
+            assert len(doc_ids) == len(docs)
+            lexical_index = create_lexical_index_store(BUCKET_NAME).load()
+            assert lexical_index is not None and len(lexical_index) == len(docs)
+            results = retriever.vectorstore.similarity_search(
+                docs[-1].page_content, k=1
+            )
+            assert results[0].metadata["doc_id"] in manifest.entries
+
+        revisions: dict[int, int] = {}
+        run("初回", create_chunks(page_count, chunks_per_page, revisions))
+        run("変更なしで再実行", create_chunks(page_count, chunks_per_page, revisions))
+
+        for page in range(changed_count):
+            revisions[page] = 1
+        # 最初のページを削除し、新しいページを1つ追加する
+        changed_docs = create_chunks(page_count + 1, chunks_per_page, revisions)[
+            chunks_per_page:
+        ]
+        run(f"{changed_count}ページを変更・追加・削除して再実行", changed_docs)
+        run("従来相当(refresh=True)", changed_docs, refresh=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--vectorstore", choices=["pinecone", "local"], default="pinecone"
+    )
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--chunks-per-page", type=int, default=5)
+    parser.add_argument("--changed", type=int, default=10)
+    args = parser.parse_args()
+
+    main(
+        cast(VectorstoreBackend, args.vectorstore),
+        args.pages,
+        args.chunks_per_page,
+        args.changed,
+    )
@@ -0,0 +1,220 @@
+"""
+IngestionPipelineと従来の方法(preprocessでサイト全体を前処理してからindexで格納する)の、
+所要時間と最大常駐メモリを比較するベンチマーク
+
+LocalSiteServerが配信するページをクローリングし、チャンクに分割して埋め込み、格納するまでを以下の方法で行う。
+- 従来の方法: DocumentPreprocessor.preprocessですべてのチャンクを作成してから、DocumentIndexer.indexで格納する
+- IngestionPipeline: 各段階を上限のあるキューでつなぎ、並行に実行する
+
+最大常駐メモリはプロセスの起動時からの最大値のため、方法ごとに別のプロセスで実行する。
+いずれの方法でも、索引に格納されるチャンクのIDが一致することも確認する。
+格納したチャンクが常駐メモリに含まれないよう、S3はmotoのサーバーモードを別のプロセスで起動し(要 `pip install "moto[server]"`)、
+ベクトルストアはメタデータを保持しないFakePineconeを使用する。
+
+NOTE: 画像の抽出はhttpsのURLのみを対象とするため、LocalSiteServerのページでは画像の段階は空のまま通過する
+
+例:
+    poetry run python scripts/benchmark_ingestion_pipeline.py --pages 300 --paragraphs 1000
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import boto3
+
+from server.rag.index_config import IndexConfig
+from server.rag.ingestion.document_indexer import DocumentIndexer
+from server.rag.ingestion.document_preprocessor import DocumentPreprocessor
+from server.rag.ingestion.index_manifest import create_index_manifest_store
+from server.rag.ingestion.ingestion_pipeline import (
+    IngestionPipeline,
+    _peak_rss_bytes,
+)
+from server.rag.ingestion.pinecone_index import PineconeIndexResolver
+from server.rag.ingestion.web_crawler import CrawlerConfig
+from server.testing.fakes import ClusteredFakeEmbeddings, FakePinecone, LocalSiteServer
+
+MODES = ["legacy", "pipeline"]
+
+
+def run(
+    mode: str,
+    port: int,
+    page_count: int,
+    paragraphs: int,
+    page_latency_seconds: float,
+    embedding_latency_seconds: float,
+) -> dict:
+    """1つの方法で索引を作成し、結果をdictで返す"""
+    with LocalSiteServer(
+        pages=page_count,
+        latency_seconds=page_latency_seconds,
+        paragraphs=paragraphs,
+        port=port,
+    ) as site:
+        bucket_name = f"benchmark-{mode}"
+        boto3.client("s3").create_bucket(Bucket=bucket_name)
+        client = FakePinecone(control_plane_latency_seconds=0.0, keep_metadata=False)
+        indexer = DocumentIndexer(
+            index_config=IndexConfig(name="benchmark", dimension=64),
+            bucket_name=bucket_name,
+            embedding=ClusteredFakeEmbeddings(
+                size=64, latency_seconds=embedding_latency_seconds
+            ),
+            refresh=True,
+            force_create_index=True,
+            index_resolver=PineconeIndexResolver(
+                lambda: client, cache_path=tempfile.mktemp(suffix=".json")
+            ),
+        )
+        preprocessor = DocumentPreprocessor(
+            [site.root_url],
+            CrawlerConfig(max_depth=page_count, politeness_delay_seconds=0.0),
+        )
+        baseline_rss = _peak_rss_bytes() or 0
+
+        start = time.perf_counter()
+        stages = []
+        if mode == "legacy":
+            docs = preprocessor.preprocess()
+            diff = indexer.index(docs, keep_urls=preprocessor.crawl_stats.failed_urls)
+        else:
+            pipeline = IngestionPipeline(preprocessor, indexer)
+            diff = pipeline.run()
+            stages = [
+                f"{stage.name}: {stage.items_out}件, {stage.items_per_second:.1f}件/秒 "
+                f"(処理 {stage.busy_seconds:.2f}秒, 入力待ち {stage.input_wait_seconds:.2f}秒, "
+                f"出力待ち {stage.output_wait_seconds:.2f}秒)"
+                for stage in pipeline.stats.stages
+            ]
+        elapsed = time.perf_counter() - start
+
+        manifest = create_index_manifest_store(bucket_name).load()
+        assert manifest is not None
+        return {
+            "pages": preprocessor.crawl_stats.pages,
+            "chunks": len(diff.added),
+            "elapsed": elapsed,
+            "baseline_rss": baseline_rss,
+            "peak_rss": _peak_rss_bytes() or 0,
+            "manifest_digest": hashlib.sha256(
+                "\n".join(sorted(manifest.entries)).encode("utf-8")
+            ).hexdigest(),
+            "stages": stages,
+        }
+
+
+def find_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_s3_server() -> tuple[subprocess.Popen, str]:
+    """motoのサーバーモードを別のプロセスで起動し、プロセスとエンドポイントのURLを返す"""
+    port = find_free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "moto.server", "-p", str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server, f"http://127.0.0.1:{port}"
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("motoのサーバーを起動できません")
+
+
+def main(args: argparse.Namespace) -> None:
+    # チャンクのIDは出典のURLから決まるため、両方の方法で同じポートを使用する
+    port = find_free_port()
+    s3_server, endpoint_url = start_s3_server()
+    env = {
+        **os.environ,
+        "AWS_ENDPOINT_URL_S3": endpoint_url,
+        "AWS_ACCESS_KEY_ID": "benchmark",
+        "AWS_SECRET_ACCESS_KEY": "benchmark",
+        "AWS_DEFAULT_REGION": "us-east-1",
+    }
+
+    results = {}
+    try:
+        for mode in MODES:
+            completed = subprocess.run(
+                [sys.executable, __file__, "--mode", mode]
+                + [
+                    f"--port={port}",
+                    f"--pages={args.pages}",
+                    f"--paragraphs={args.paragraphs}",
+                    f"--page-latency={args.page_latency}",
+                    f"--embedding-latency={args.embedding_latency}",
+                ],
+                check=True,
+                capture_output=True,
+                text=True,
+                env=env,
+            )
+            result = results[mode] = json.loads(completed.stdout.splitlines()[-1])
+            growth = (result["peak_rss"] - result["baseline_rss"]) / 1024 / 1024
+            print(
+                f"{'従来の方法' if mode == 'legacy' else 'IngestionPipeline'}: "
+                f"{result['pages']}ページ, {result['chunks']}チャンク, {result['elapsed']:.2f}秒, "
+                f"{result['chunks'] / result['elapsed']:.1f}チャンク/秒, "
+                f"最大常駐メモリ {result['peak_rss'] / 1024 / 1024:.0f}MiB "
+                f"(初期化後から +{growth:.0f}MiB)"
+            )
+            for stage in result["stages"]:
+                print(f"  {stage}")
+
+    finally:
+        s3_server.terminate()
+    assert (
+        results["legacy"]["manifest_digest"] == results["pipeline"]["manifest_digest"]
+    )
+    print("索引に格納されたチャンクのIDは一致しました")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=300)
+    parser.add_argument(
+        "--paragraphs", type=int, default=1000, help="1ページあたりの段落の数"
+    )
+    parser.add_argument(
+        "--page-latency", type=float, default=0.05, help="ページの応答の遅延(秒)"
+    )
+    parser.add_argument(
+        "--embedding-latency",
+        type=float,
+        default=0.05,
+        help="埋め込みの1回の呼び出しの遅延(秒)",
+    )
+    parser.add_argument("--mode", choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode is None:
+        main(args)
+    else:
+        print(
+            json.dumps(
+                run(
+                    args.mode,
+                    args.port,
+                    args.pages,
+                    args.paragraphs,
+                    args.page_latency,
+                    args.embedding_latency,
+                )
+            )
+        )
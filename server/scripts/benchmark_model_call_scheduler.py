@@ -0,0 +1,168 @@
+"""
+ModelCallSchedulerによる、スロットリングされるモデルの呼び出しのスループットと失敗数を確認するベンチマーク
+
+同時呼び出し数の上限を超えるとThrottlingExceptionを送出するFakeBedrockQuotaを使用して、以下を比較する。
+- 画像の説明の生成
+  - 従来の方法: Runnable.batchで上限を設けずに並行に呼び出す(リトライしない)
+  - ModelCallScheduler: AIMDで同時呼び出し数を調整し、スロットリングされた呼び出しをリトライする
+- 埋め込み
+  - 従来相当: BedrockEmbeddingsと同じく1件ずつ順に埋め込む
+  - ModelCallScheduler: 画像の説明の生成と同じスケジューラで並行に埋め込む
+
+一部の画像はリトライしても成功しないエラーとなり、その画像のみが除外されることも確認する。
+
+例:
+    poetry run python scripts/benchmark_model_call_scheduler.py --images 200 --texts 500 --quota 4
+"""
+
+import argparse
+import base64
+import random
+import time
+
+from langchain_core.stores import InMemoryByteStore
+
+from server.rag.cached_embeddings import CachedEmbeddings
+from server.rag.ingestion.image_describer import ImageDescriber
+from server.rag.ingestion.model import _ImageMetadata
+from server.rag.ingestion.model_call_scheduler import (
+    ModelCallScheduler,
+    ModelCallSchedulerConfig,
+    ScheduledEmbeddings,
+)
+from server.testing.fakes import (
+    ClusteredFakeEmbeddings,
+    FakeBedrockQuota,
+    FakeVisionChatModel,
+)
+
+
+def create_images(count: int) -> list[_ImageMetadata]:
+    rng = random.Random(0)
+    return [
+        _ImageMetadata(
+            url=f"https://example.com/images/{i}.png",
+            mime_type="image/png",
+            base64=base64.b64encode(rng.randbytes(2_000)).decode("utf-8"),
+        )
+        for i in range(count)
+    ]
+
+
+def main(
+    image_count: int,
+    text_count: int,
+    quota_concurrency: int,
+    latency_seconds: float,
+    invalid_rate: float,
+) -> None:
+    images = create_images(image_count)
+    texts = [f"チャンク{i}の本文" for i in range(text_count)]
+
+    # 従来の方法はスロットリングを考慮せずにRunnable.batchのデフォルトの並列数(CPU数+4)で呼び出すため、
+    # クォータを超えた呼び出しがそのまま失敗する
+    quota = FakeBedrockQuota(quota_concurrency)
+    llm = FakeVisionChatModel(latency_seconds=latency_seconds, quota=quota)
+    start = time.perf_counter()
+    results = llm.batch(
+        [f"画像{i}を説明してください" for i in range(image_count)],
+        return_exceptions=True,
+    )
+    elapsed = time.perf_counter() - start
+    failed = sum(isinstance(result, Exception) for result in results)
+    print(
+        f"画像の説明 (従来の方法): 成功 {image_count - failed}/{image_count}件, "
+        f"{elapsed:.2f}秒, スロットリング {quota.throttled}回"
+        + (" (Runnable.batchは失敗が1件でもあると例外を送出する)" if failed > 0 else "")
+    )
+
+    config = ModelCallSchedulerConfig(
+        initial_concurrency=4,
+        max_concurrency=32,
+        retry_wait_initial_seconds=0.05,
+        retry_wait_max_seconds=1,
+        progress_interval_seconds=1,
+    )
+    scheduler = ModelCallScheduler(config)
+    quota = FakeBedrockQuota(quota_concurrency)
+    llm = FakeVisionChatModel(
+        latency_seconds=latency_seconds, quota=quota, invalid_rate=invalid_rate
+    )
+    describer = ImageDescriber(llm=llm, model_id="fake", scheduler=scheduler)
+    start = time.perf_counter()
+    docs = describer.describe(images)
+    elapsed = time.perf_counter() - start
+    stats = scheduler.stats
+    print(
+        f"画像の説明 (ModelCallScheduler): 成功 {len(docs)}/{image_count}件, "
+        f"{elapsed:.2f}秒, {image_count / elapsed:.1f}件/秒, "
+        f"スロットリング {stats.throttled}回, リトライ {stats.retries}回, "
+        f"失敗 {describer.stats.failed}件, 同時呼び出し数 {int(stats.concurrency_limit)} "
+        f"(最大 {stats.peak_in_flight})"
+    )
+    assert describer.stats.failed == image_count - len(docs)
+    assert describer.stats.failed < image_count * invalid_rate * 2 + 1
+
+    serial = CachedEmbeddings(
+        ScheduledEmbeddings(
+            ClusteredFakeEmbeddings(size=64, latency_seconds=latency_seconds / 4),
+            ModelCallScheduler(
+                ModelCallSchedulerConfig(initial_concurrency=1, max_concurrency=1)
+            ),
+        ),
+        InMemoryByteStore(),
+        model_id="fake",
+    )
+    start = time.perf_counter()
+    expected = serial.embed_documents(texts)
+    elapsed = time.perf_counter() - start
+    print(
+        f"埋め込み (従来相当): {text_count}件, {elapsed:.2f}秒, "
+        f"{text_count / elapsed:.1f}件/秒"
+    )
+
+    quota = FakeBedrockQuota(quota_concurrency)
+    scheduled = CachedEmbeddings(
+        ScheduledEmbeddings(
+            ClusteredFakeEmbeddings(
+                size=64, latency_seconds=latency_seconds / 4, quota=quota
+            ),
+            scheduler,
+        ),
+        InMemoryByteStore(),
+        model_id="fake",
+        batch_size=1000,
+    )
+    throttled_before = scheduler.stats.throttled
+    start = time.perf_counter()
+    vectors = scheduled.embed_documents(texts)
+    elapsed = time.perf_counter() - start
+    stats = scheduler.stats
+    print(
+        f"埋め込み (ModelCallScheduler): {text_count}件, {elapsed:.2f}秒, "
+        f"{text_count / elapsed:.1f}件/秒, "
+        f"スロットリング {stats.throttled - throttled_before}回, "
+        f"同時呼び出し数 {int(stats.concurrency_limit)}"
+    )
+    assert vectors == expected
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--texts", type=int, default=500)
+    parser.add_argument(
+        "--quota", type=int, default=4, help="スロットリングされない同時呼び出し数"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.1, help="画像の説明の1回の呼び出しの遅延(秒)"
+    )
+    parser.add_argument(
+        "--invalid-rate",
+        type=float,
+        default=0.02,
+        help="リトライしても成功しない画像の割合",
+    )
+    args = parser.parse_args()
+
+    main(args.images, args.texts, args.quota, args.latency, args.invalid_rate)
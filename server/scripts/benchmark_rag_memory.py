@@ -0,0 +1,198 @@
+"""
+画像データの遅延取得による、Rag.invoke 1回あたりのピークメモリと所要時間を比較するベンチマーク
+
+画像データをメタデータに埋め込んだ旧形式のドキュメントをドキュメントストアに格納し、以下を比較する。
+- 従来相当: 検索結果のドキュメントを画像データごと取得し、すべての画像を元の大きさで添付する
+- 遅延取得: 検索結果は画像データを除いたドキュメントとして扱い、
+  プロンプトに添付する画像のみをImageBlobStoreから縮小版で取得する
+- 遅延取得(移行済み): 遅延取得に加え、ドキュメントストアを画像データのキーのみを持つ形式に移行した場合
+
+S3はmotoでプロセス内に再現し、LLMと埋め込みモデルはフェイクを使用する。Pillowが必要である。
+
+例:
+    poetry run python scripts/benchmark_rag_memory.py --questions 20
+"""
+
+import argparse
+import base64
+import io
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import boto3
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from moto import mock_aws
+from PIL import Image
+
+from server.rag import AnswerStatement, CitedAnswer, IndexConfig, Rag
+from server.rag.image_selector import ImageBudget
+from server.rag.ingestion.image_blob_store import (
+    ImageBlobOffloadingStore,
+    create_image_blob_store,
+)
+from server.rag.ingestion.local_vectorstore import LocalVectorStore
+from server.rag.ingestion.s3_store import S3Store
+from server.rag.reranking_retriever import RerankingRetriever
+from server.testing.fakes import FakeToolCallingChatModel
+
+BUCKET_NAME = "benchmark-bucket"
+MIGRATED_BUCKET_NAME = "benchmark-migrated-bucket"
+
+
+def create_photo(rng: random.Random) -> bytes:
+    """圧縮が効きにくい写真を模したPNG画像を作成する"""
+    width = rng.randint(1500, 3000)
+    image = Image.effect_noise((width, width * 2 // 3), rng.randint(20, 60))
+    buffer = io.BytesIO()
+    image.convert("RGB").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def create_documents(
+    text_count: int, image_count: int, seed: int
+) -> list[tuple[str, Document]]:
+    """テキストのドキュメントと、画像データを埋め込んだ旧形式の画像ドキュメントを作成する"""
+    rng = random.Random(seed)
+    docs = [
+        (
+            f"text-{i}",
+            Document(
+                page_content=f"ページ{i}の本文です。" * 80,
+                metadata={
+                    "url": f"https://example.com/{i}",
+                    "title": f"ページ{i}",
+                    "modality": "text",
+                },
+            ),
+        )
+        for i in range(text_count)
+    ]
+    docs += [
+        (
+            f"image-{i}",
+            Document(
+                page_content=f"画像{i}の説明です。" * 20,
+                metadata={
+                    "url": f"https://example.com/{i}.png",
+                    "title": "画像",
+                    "modality": "image",
+                    "mime_type": "image/png",
+                    "base64": base64.b64encode(create_photo(rng)).decode("utf-8"),
+                },
+            ),
+        )
+        for i in range(image_count)
+    ]
+    return docs
+
+
+def create_rag(lazy: bool, bucket_name: str, vectorstore: LocalVectorStore) -> Rag:
+    docstore = S3Store(bucket_name=bucket_name)
+    retriever = RerankingRetriever(
+        vectorstore=vectorstore,
+        docstore=(
+            ImageBlobOffloadingStore(docstore, create_image_blob_store(bucket_name))
+            if lazy
+            else docstore
+        ),
+        search_kwargs={"k": 8},
+    )
+    return Rag(
+        index_config=IndexConfig(name="benchmark"),
+        bucket_name=bucket_name,
+        llm=FakeToolCallingChatModel(
+            output=CitedAnswer(
+                statements=[AnswerStatement(statement="回答です。", citations=[0])]
+            ),
+            first_token_latency_seconds=0.0,
+            seconds_per_chunk=0.0,
+        ),
+        embedding=DeterministicFakeEmbedding(size=64),
+        langfuse_secret_key="",
+        langfuse_public_key="",
+        langfuse_host="http://localhost",
+        retriever=retriever,
+        langfuse_enabled=False,
+        image_budget=(
+            ImageBudget()
+            if lazy
+            else ImageBudget(max_images=1000, max_total_bytes=2**40, max_long_edge=None)
+        ),
+    )
+
+
+def measure(rag: Rag, questions: list[str]) -> tuple[list[float], list[float]]:
+    """1回あたりの所要時間と、ピークメモリ(呼び出し前からの増分, MiB)を計測する"""
+    rag.invoke(questions[0])  # 縮小版の作成などの初回のみの処理を除く
+
+    latencies: list[float] = []
+    for question in questions:
+        start = time.perf_counter()
+        rag.invoke(question)
+        latencies.append(time.perf_counter() - start)
+
+    peaks: list[float] = []
+    tracemalloc.start()
+    for question in questions:
+        baseline, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        rag.invoke(question)
+        _, peak = tracemalloc.get_traced_memory()
+        peaks.append((peak - baseline) / 1024 / 1024)
+    tracemalloc.stop()
+    return latencies, peaks
+
+
+def main(text_count: int, image_count: int, question_count: int, seed: int) -> None:
+    with mock_aws():
+        s3_client = boto3.client("s3")
+        s3_client.create_bucket(Bucket=BUCKET_NAME)
+        s3_client.create_bucket(Bucket=MIGRATED_BUCKET_NAME)
+        docs = create_documents(text_count, image_count, seed)
+        S3Store(bucket_name=BUCKET_NAME).mset(docs)
+        ImageBlobOffloadingStore(
+            S3Store(bucket_name=MIGRATED_BUCKET_NAME),
+            create_image_blob_store(MIGRATED_BUCKET_NAME),
+        ).mset(docs)
+
+        vectorstore = LocalVectorStore(
+            DeterministicFakeEmbedding(size=64), tempfile.mkdtemp()
+        )
+        vectorstore.add_documents(
+            [
+                Document(
+                    page_content=doc.page_content,
+                    metadata={"doc_id": key, "url": doc.metadata["url"]},
+                )
+                for key, doc in docs
+            ]
+        )
+        questions = [f"質問{i}" for i in range(question_count)]
+
+        for label, lazy, bucket_name in [
+            ("従来相当", False, BUCKET_NAME),
+            ("遅延取得", True, BUCKET_NAME),
+            ("遅延取得(移行済み)", True, MIGRATED_BUCKET_NAME),
+        ]:
+            rag = create_rag(lazy, bucket_name, vectorstore)
+            latencies, peaks = measure(rag, questions)
+            print(
+                f"{label}: 所要時間 中央値 {statistics.median(latencies) * 1000:.1f}ms, "
+                f"ピークメモリ 中央値 {statistics.median(peaks):.1f}MiB, "
+                f"最大 {max(peaks):.1f}MiB"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--texts", type=int, default=20)
+    parser.add_argument("--images", type=int, default=20)
+    parser.add_argument("--questions", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    main(args.texts, args.images, args.questions, args.seed)
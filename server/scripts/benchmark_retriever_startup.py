@@ -0,0 +1,149 @@
+"""
+Pineconeのインデックスの接続先のキャッシュによる、create_retrieverの所要時間とコントロールプレーンの呼び出し回数を比較するベンチマーク
+
+コントロールプレーンの呼び出しに遅延を入れたFakePineconeを使用し、以下を比較する。
+- 従来相当: 作成のたびに list_indexes と名前を指定したIndex(describe_index)を呼び出す
+- キャッシュなし: /tmpのファイルもない状態(初回のコールドスタート)
+- ファイルのキャッシュ: 同じ実行環境で新しいプロセスが起動した場合(PineconeIndexResolverを作り直す)
+- メモリのキャッシュ: 同じプロセスでRetrieverを作り直した場合
+
+あわせてDocumentIndexerで名前空間を指定して索引を作成し、同じIndexConfigを使用したRetrieverで
+コントロールプレーンを呼び出さずに検索できることを確認する。S3はmotoでプロセス内に再現する。
+
+例:
+    poetry run python scripts/benchmark_retriever_startup.py --latency 0.3 --repeat 5
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from typing import Callable
+
+import boto3
+from moto import mock_aws
+
+from server.rag.index_config import IndexConfig
+from server.rag.ingestion.document_indexer import DocumentIndexer
+from server.rag.ingestion.pinecone_index import PineconeIndexResolver
+from server.rag.retriever import create_retriever
+from server.testing.fakes import (
+    ClusteredFakeEmbeddings,
+    FakePinecone,
+    create_text_documents,
+)
+
+BUCKET_NAME = "benchmark-bucket"
+
+
+def measure(
+    client: FakePinecone, create: Callable[[], object], repeat: int
+) -> tuple[float, float]:
+    """1回あたりの所要時間の中央値と、コントロールプレーンの呼び出し回数の平均を返す"""
+    latencies: list[float] = []
+    calls_before = client.control_plane_calls
+    for _ in range(repeat):
+        start = time.perf_counter()
+        create()
+        latencies.append(time.perf_counter() - start)
+    return (
+        statistics.median(latencies),
+        (client.control_plane_calls - calls_before) / repeat,
+    )
+
+
+def main(latency_seconds: float, repeat: int, doc_count: int) -> None:
+    with mock_aws():
+        boto3.client("s3").create_bucket(Bucket=BUCKET_NAME)
+        client = FakePinecone(control_plane_latency_seconds=latency_seconds)
+        embedding = ClusteredFakeEmbeddings(size=64)
+        index_config = IndexConfig(name="benchmark", dimension=64, namespace="docs")
+        cache_path = os.path.join(tempfile.mkdtemp(), "rag-pinecone-index.json")
+
+        indexer = DocumentIndexer(
+            index_config=index_config,
+            bucket_name=BUCKET_NAME,
+            embedding=embedding,
+            force_create_index=True,
+            index_resolver=PineconeIndexResolver(lambda: client, cache_path=None),
+        )
+        docs = create_text_documents(doc_count)
+        indexer.index(docs)
+
+        def create_legacy() -> None:
+            # PineconeVectorStore.from_existing_index と同じ呼び出し
+            [index_info["name"] for index_info in client.list_indexes()]
+            client.Index(name=index_config.name)
+
+        def create_with(resolver: PineconeIndexResolver) -> None:
+            create_retriever(
+                index_config=index_config,
+                bucket_name=BUCKET_NAME,
+                embedding=embedding,
+                index_resolver=resolver,
+            )
+
+        def create_cold() -> None:
+            if os.path.exists(cache_path):
+                os.remove(cache_path)
+            create_with(PineconeIndexResolver(lambda: client, cache_path=cache_path))
+
+        warm_resolver = PineconeIndexResolver(lambda: client, cache_path=cache_path)
+        for label, create in [
+            ("従来相当", create_legacy),
+            ("キャッシュなし", create_cold),
+            (
+                "ファイルのキャッシュ",
+                lambda: create_with(
+                    PineconeIndexResolver(lambda: client, cache_path=cache_path)
+                ),
+            ),
+            ("メモリのキャッシュ", lambda: create_with(warm_resolver)),
+        ]:
+            median_seconds, calls = measure(client, create, repeat)
+            print(
+                f"{label}: 所要時間 中央値 {median_seconds * 1000:.1f}ms, "
+                f"コントロールプレーンの呼び出し {calls:.1f}回/作成"
+            )
+
+        calls_before = client.control_plane_calls
+        retriever = create_retriever(
+            index_config=index_config,
+            bucket_name=BUCKET_NAME,
+            embedding=embedding,
+            index_resolver=PineconeIndexResolver(lambda: client, cache_path=cache_path),
+        )
+        results = retriever.invoke(docs[0].page_content)
+        assert client.control_plane_calls == calls_before
+        assert len(results) == min(index_config.k, doc_count)
+        assert results[0].metadata["url"] == docs[0].metadata["url"]
+
+        other_namespace = index_config.model_copy(update={"namespace": "other"})
+        assert (
+            create_retriever(
+                index_config=other_namespace,
+                bucket_name=BUCKET_NAME,
+                embedding=embedding,
+                index_resolver=PineconeIndexResolver(
+                    lambda: client, cache_path=cache_path
+                ),
+            ).invoke(docs[0].page_content)
+            == []
+        )
+        print(
+            f"検索の確認: 名前空間 {index_config.namespace} から{len(results)}件を取得し、"
+            "コントロールプレーンの呼び出しはありませんでした"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--latency", type=float, default=0.3, help="コントロールプレーンの遅延(秒)"
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--docs", type=int, default=50)
+    args = parser.parse_args()
+
+    main(args.latency, args.repeat, args.docs)
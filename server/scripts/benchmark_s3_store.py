@@ -0,0 +1,167 @@
+"""
+S3Store.mget / S3Store.mset のバッチサイズごとのレイテンシを計測するベンチマーク
+
+ローカルのS3互換サーバーに対して、逐次実行(max_concurrency=1)と並行実行の結果を比較する。
+--endpoint-url を省略した場合は moto のサーバーモードをプロセス内で起動する(要 `pip install "moto[server]"`)。
+MinIOなどを使う場合は --endpoint-url を指定する。
+
+ローカルサーバーはネットワーク遅延がほぼゼロのため、--latency-ms で1リクエストあたりの遅延を擬似的に付与する。
+
+例:
+    poetry run python scripts/benchmark_s3_store.py --latency-ms 20
+"""
+
+import argparse
+import logging
+import statistics
+import time
+import uuid
+from typing import Optional
+
+import boto3
+from botocore.config import Config
+from langchain_core.documents import Document
+
+from server.rag.ingestion.s3_store import S3Store
+
+BENCHMARK_BUCKET_NAME = "rag-docstore-benchmark"
+
+
+def start_local_s3_server() -> str:
+    try:
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        raise ImportError(
+            "motoライブラリがインストールされていません。"
+            '`pip install "moto[server]"` を実行するか、--endpoint-url を指定してください。'
+        )
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = ThreadedMotoServer(port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    return f"http://{host}:{port}"
+
+
+def create_client(endpoint_url: str, max_concurrency: int, latency_ms: float):
+    client = boto3.client(
+        "s3",
+        endpoint_url=endpoint_url,
+        region_name="us-east-1",
+        aws_access_key_id="benchmark",
+        aws_secret_access_key="benchmark",
+        config=Config(
+            max_pool_connections=max_concurrency,
+            retries={"mode": "adaptive", "max_attempts": 5},
+        ),
+    )
+
+    if latency_ms > 0:
+        # リクエスト送信前にスリープすることで、S3までの往復遅延を擬似的に再現する
+        def _simulate_latency(**kwargs):
+            time.sleep(latency_ms / 1000)
+
+        client.meta.events.register("before-send.s3.*", _simulate_latency)
+
+    return client
+
+
+def create_document(size: int) -> Document:
+    return Document(
+        page_content="あ" * size,
+        metadata={"url": "https://example.com/", "title": "ベンチマーク"},
+    )
+
+
+def measure(fn, repeat: int) -> float:
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed.append(time.perf_counter() - start)
+    return statistics.median(elapsed) * 1000
+
+
+def main(
+    endpoint_url: Optional[str],
+    batch_sizes: list[int],
+    max_concurrency: int,
+    latency_ms: float,
+    doc_size: int,
+    repeat: int,
+) -> None:
+    endpoint_url = endpoint_url or start_local_s3_server()
+
+    setup_client = create_client(endpoint_url, max_concurrency, latency_ms=0)
+    setup_client.create_bucket(Bucket=BENCHMARK_BUCKET_NAME)
+
+    stores = {
+        "sequential": S3Store(
+            BENCHMARK_BUCKET_NAME,
+            max_concurrency=1,
+            client=create_client(endpoint_url, 1, latency_ms),
+        ),
+        "concurrent": S3Store(
+            BENCHMARK_BUCKET_NAME,
+            max_concurrency=max_concurrency,
+            client=create_client(endpoint_url, max_concurrency, latency_ms),
+        ),
+    }
+
+    print(
+        f"endpoint={endpoint_url} max_concurrency={max_concurrency} "
+        f"latency_ms={latency_ms} doc_size={doc_size} repeat={repeat}"
+    )
+    print(
+        f"{'batch':>6} | {'mget seq[ms]':>12} {'mget conc[ms]':>13} {'speedup':>7} |"
+        f" {'mset seq[ms]':>12} {'mset conc[ms]':>13} {'speedup':>7}"
+    )
+
+    for batch_size in batch_sizes:
+        pairs = [
+            (str(uuid.uuid4()), create_document(doc_size)) for _ in range(batch_size)
+        ]
+        keys = [key for key, _ in pairs]
+        # 存在しないキーがNoneとして返ることも合わせて確認する
+        keys_with_missing = keys + ["missing-key"]
+
+        results: dict[str, dict[str, float]] = {}
+        for name, store in stores.items():
+            mset_ms = measure(lambda: store.mset(pairs), repeat)
+            mget_ms = measure(lambda: store.mget(keys_with_missing), repeat)
+
+            docs = store.mget(keys_with_missing)
+            assert [doc.page_content if doc else None for doc in docs] == [
+                doc.page_content for _, doc in pairs
+            ] + [None], "mgetの結果の順序が入力と一致しません"
+
+            results[name] = {"mget": mget_ms, "mset": mset_ms}
+
+        seq, conc = results["sequential"], results["concurrent"]
+        print(
+            f"{batch_size:>6} |"
+            f" {seq['mget']:>12.1f} {conc['mget']:>13.1f} {seq['mget'] / conc['mget']:>6.1f}x |"
+            f" {seq['mset']:>12.1f} {conc['mset']:>13.1f} {seq['mset'] / conc['mset']:>6.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--endpoint-url", default=None)
+    parser.add_argument(
+        "--batch-sizes", type=int, nargs="+", default=[1, 5, 10, 50, 100, 500]
+    )
+    parser.add_argument("--max-concurrency", type=int, default=16)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--doc-size", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    main(
+        endpoint_url=args.endpoint_url,
+        batch_sizes=args.batch_sizes,
+        max_concurrency=args.max_concurrency,
+        latency_ms=args.latency_ms,
+        doc_size=args.doc_size,
+        repeat=args.repeat,
+    )
@@ -0,0 +1,110 @@
+"""
+SemanticCacheの有無によるRag.invokeの応答時間とヒット率を比較するベンチマーク
+
+少数の質問が表記ゆれ(全角・半角、空白、末尾の記号)を伴って繰り返し投稿される状況を再現する。
+フェイクのLLM・Retriever・埋め込みモデルを使用するため、外部サービスには接続しない。
+
+例:
+    poetry run python scripts/benchmark_semantic_cache.py --requests 200 --distinct-questions 10
+"""
+
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from typing import Optional
+
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from server.rag import AnswerStatement, CitedAnswer, IndexConfig, Rag
+from server.rag.semantic_cache import SemanticCache, SQLiteSemanticCacheBackend
+from server.testing.fakes import (
+    FakeRetriever,
+    FakeToolCallingChatModel,
+    create_text_documents,
+)
+
+
+def create_questions(
+    request_count: int, distinct_question_count: int, seed: int
+) -> list[str]:
+    """表記ゆれを含む質問をランダムに並べたリストを作成する"""
+    rng = random.Random(seed)
+    base_questions = [
+        f"サービス{i}の料金プランについて教えてください"
+        for i in range(distinct_question_count)
+    ]
+    variants = [
+        lambda q: q,
+        lambda q: q + "？",
+        lambda q: q.replace("サービス", "サービス "),
+        lambda q: q.translate(str.maketrans("0123456789", "０１２３４５６７８９")),
+    ]
+    return [
+        rng.choice(variants)(rng.choice(base_questions)) for _ in range(request_count)
+    ]
+
+
+def run(questions: list[str], semantic_cache: Optional[SemanticCache]) -> list[float]:
+    rag = Rag(
+        index_config=IndexConfig(name="benchmark"),
+        bucket_name="benchmark",
+        llm=FakeToolCallingChatModel(
+            output=CitedAnswer(
+                statements=[AnswerStatement(statement="回答です。", citations=[0])]
+            ),
+            first_token_latency_seconds=0.05,
+            seconds_per_chunk=0.001,
+        ),
+        embedding=DeterministicFakeEmbedding(size=1024),
+        langfuse_secret_key="",
+        langfuse_public_key="",
+        langfuse_host="http://localhost",
+        retriever=FakeRetriever(docs=create_text_documents(5), latency_seconds=0.02),
+        langfuse_enabled=False,
+        semantic_cache=semantic_cache,
+    )
+
+    latencies: list[float] = []
+    for question in questions:
+        start = time.perf_counter()
+        rag.invoke(question)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main(request_count: int, distinct_question_count: int, seed: int) -> None:
+    questions = create_questions(request_count, distinct_question_count, seed)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        semantic_cache = SemanticCache(
+            embedding=DeterministicFakeEmbedding(size=1024),
+            backend=SQLiteSemanticCacheBackend(
+                os.path.join(tmp_dir, "semantic-cache.sqlite3")
+            ),
+        )
+        results = {
+            "キャッシュなし": run(questions, None),
+            "キャッシュあり": run(questions, semantic_cache),
+        }
+
+    for label, latencies in results.items():
+        print(
+            f"{label}: 合計 {sum(latencies):.2f}s, "
+            f"中央値 {statistics.median(latencies) * 1000:.1f}ms, "
+            f"最大 {max(latencies) * 1000:.1f}ms"
+        )
+    stats = semantic_cache.stats
+    print(f"ヒット: {stats.hits}, ミス: {stats.misses}, ヒット率: {stats.hit_rate:.1%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--distinct-questions", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    main(args.requests, args.distinct_questions, args.seed)
@@ -0,0 +1,109 @@
+"""
+Rag.invoke と Rag.stream で最初の回答文が得られるまでの時間を比較するベンチマーク
+
+回答文をツール呼び出しの引数として少しずつ出力するフェイクのLLMと、
+固定のドキュメントを返すフェイクのRetrieverを使用するため、外部サービスには接続しない。
+
+例:
+    poetry run python scripts/benchmark_streaming.py --statements 5 --seconds-per-chunk 0.02
+"""
+
+import argparse
+import statistics
+import time
+
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from server.rag import AnswerStatement, CitedAnswer, IndexConfig, Rag
+from server.testing.fakes import (
+    FakeRetriever,
+    FakeToolCallingChatModel,
+    create_text_documents,
+)
+
+
+def create_answer(statement_count: int) -> CitedAnswer:
+    return CitedAnswer(
+        statements=[
+            AnswerStatement(
+                statement=f"これは{i}番目の回答文です。生成AIに関するサービスについて説明します。",
+                citations=[i % 5],
+            )
+            for i in range(statement_count)
+        ]
+    )
+
+
+def main(
+    statement_count: int,
+    first_token_latency: float,
+    seconds_per_chunk: float,
+    repeat: int,
+) -> None:
+    answer = create_answer(statement_count)
+    rag = Rag(
+        index_config=IndexConfig(name="benchmark"),
+        bucket_name="benchmark",
+        llm=FakeToolCallingChatModel(
+            output=answer,
+            first_token_latency_seconds=first_token_latency,
+            seconds_per_chunk=seconds_per_chunk,
+        ),
+        embedding=DeterministicFakeEmbedding(size=1024),
+        langfuse_secret_key="",
+        langfuse_public_key="",
+        langfuse_host="http://localhost",
+        retriever=FakeRetriever(docs=create_text_documents(5)),
+        langfuse_enabled=False,
+    )
+
+    invoke_totals: list[float] = []
+    stream_firsts: list[float] = []
+    stream_totals: list[float] = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = rag.invoke("生成AIのサービスについて教えてください")
+        invoke_totals.append(time.perf_counter() - start)
+        assert result["answer"] == answer
+
+        start = time.perf_counter()
+        first = None
+        statements = []
+        for chunk in rag.stream("生成AIのサービスについて教えてください"):
+            if isinstance(chunk, AnswerStatement):
+                if first is None:
+                    first = time.perf_counter() - start
+                statements.append(chunk)
+        stream_totals.append(time.perf_counter() - start)
+        stream_firsts.append(first or 0.0)
+        assert statements == answer.statements
+
+    invoke_ms = statistics.median(invoke_totals) * 1000
+    stream_first_ms = statistics.median(stream_firsts) * 1000
+    stream_total_ms = statistics.median(stream_totals) * 1000
+    print(
+        f"statements={statement_count} first_token_latency={first_token_latency}s "
+        f"seconds_per_chunk={seconds_per_chunk}s repeat={repeat}"
+    )
+    print(f"invoke: 最初の回答文まで {invoke_ms:.0f}ms (全体 {invoke_ms:.0f}ms)")
+    print(
+        f"stream: 最初の回答文まで {stream_first_ms:.0f}ms (全体 {stream_total_ms:.0f}ms)"
+    )
+    print(f"最初の回答文までの時間の短縮: {invoke_ms - stream_first_ms:.0f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--statements", type=int, default=5)
+    parser.add_argument("--first-token-latency", type=float, default=0.5)
+    parser.add_argument("--seconds-per-chunk", type=float, default=0.02)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    main(
+        statement_count=args.statements,
+        first_token_latency=args.first_token_latency,
+        seconds_per_chunk=args.seconds_per_chunk,
+        repeat=args.repeat,
+    )
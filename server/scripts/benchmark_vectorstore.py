@@ -0,0 +1,138 @@
+"""
+LocalVectorStoreの検索レイテンシと近似最近傍探索の再現率を計測するベンチマーク
+
+全件検索(float32/float16)と近似最近傍探索(IVF)を比較する。
+--pinecone-index を指定した場合は、既存のPineconeインデックスに対する検索レイテンシも計測する
+(PINECONE_API_KEYが必要。インデックスの次元数は--dimensionと一致させること)。
+埋め込みモデルの呼び出し時間を除くため、いずれもベクトルを直接渡して検索する。
+
+例:
+    poetry run python scripts/benchmark_vectorstore.py --docs 5000 --queries 200
+"""
+
+import argparse
+import statistics
+import tempfile
+import time
+from typing import Callable, Optional
+
+from langchain_core.documents import Document
+
+from server.rag.ingestion.local_vectorstore import LocalVectorStore, VectorDType
+from server.testing.fakes import ClusteredFakeEmbeddings
+
+
+def measure(
+    search: Callable[[list[float]], list[Document]],
+    queries: list[list[float]],
+) -> tuple[list[float], list[list[Document]]]:
+    latencies: list[float] = []
+    results: list[list[Document]] = []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(search(query))
+        latencies.append(time.perf_counter() - start)
+    return latencies, results
+
+
+def recall(expected: list[list[Document]], actual: list[list[Document]]) -> float:
+    hits = sum(
+        len({doc.id for doc in e} & {doc.id for doc in a})
+        for e, a in zip(expected, actual)
+    )
+    total = sum(len(e) for e in expected)
+    return hits / total if total > 0 else 0.0
+
+
+def build_store(
+    embedding: ClusteredFakeEmbeddings,
+    texts: list[str],
+    dtype: VectorDType,
+    ann_lists: Optional[int],
+    ann_probes: int,
+) -> LocalVectorStore:
+    start = time.perf_counter()
+    store = LocalVectorStore(
+        embedding,
+        tempfile.mkdtemp(),
+        dtype=dtype,
+        ann_lists=ann_lists,
+        ann_probes=ann_probes,
+    )
+    store.add_texts(texts, ids=[str(i) for i in range(len(texts))])
+    print(f"  構築: {time.perf_counter() - start:.2f}s")
+    return store
+
+
+def main(
+    doc_count: int,
+    query_count: int,
+    dimension: int,
+    k: int,
+    ann_lists: int,
+    ann_probes: int,
+    pinecone_index: Optional[str],
+) -> None:
+    embedding = ClusteredFakeEmbeddings(size=dimension)
+    texts = [f"ドキュメント{i}" for i in range(doc_count)]
+    queries = embedding.embed_documents([f"質問{i}" for i in range(query_count)])
+
+    variants: list[tuple[str, VectorDType, Optional[int]]] = [
+        ("全件検索 float32", "float32", None),
+        ("全件検索 float16", "float16", None),
+        (f"IVF float32 (lists={ann_lists}, probes={ann_probes})", "float32", ann_lists),
+        (f"IVF float16 (lists={ann_lists}, probes={ann_probes})", "float16", ann_lists),
+    ]
+
+    baseline: Optional[list[list[Document]]] = None
+    for label, dtype, lists in variants:
+        print(f"{label}:")
+        store = build_store(embedding, texts, dtype, lists, ann_probes)
+        latencies, results = measure(
+            lambda query: store.similarity_search_by_vector(query, k=k), queries
+        )
+        if baseline is None:
+            baseline = results
+        print(
+            f"  中央値 {statistics.median(latencies) * 1000:.2f}ms, "
+            f"p95 {statistics.quantiles(latencies, n=20)[-1] * 1000:.2f}ms, "
+            f"recall@{k} {recall(baseline, results):.3f}"
+        )
+
+    if pinecone_index is not None:
+        from langchain_pinecone import PineconeVectorStore
+
+        pinecone_store = PineconeVectorStore.from_existing_index(
+            index_name=pinecone_index, embedding=embedding
+        )
+        latencies, _ = measure(
+            lambda query: pinecone_store.similarity_search_by_vector(query, k=k),
+            queries,
+        )
+        print(
+            f"Pinecone ({pinecone_index}): "
+            f"中央値 {statistics.median(latencies) * 1000:.2f}ms, "
+            f"p95 {statistics.quantiles(latencies, n=20)[-1] * 1000:.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--dimension", type=int, default=1024)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--ann-lists", type=int, default=64)
+    parser.add_argument("--ann-probes", type=int, default=8)
+    parser.add_argument("--pinecone-index", default=None)
+    args = parser.parse_args()
+
+    main(
+        args.docs,
+        args.queries,
+        args.dimension,
+        args.k,
+        args.ann_lists,
+        args.ann_probes,
+        args.pinecone_index,
+    )
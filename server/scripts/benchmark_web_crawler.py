@@ -0,0 +1,110 @@
+"""
+AsyncWebCrawlerとRecursiveUrlLoaderのクローリングの所要時間とダウンロード量を比較するベンチマーク
+
+LocalSiteServerでリンクでつながったページをローカルに配信し、以下を比較する。
+- RecursiveUrlLoader: 1ページずつ順に取得する(従来のDocumentPreprocessor)
+- AsyncWebCrawler (キャッシュなし): ホストごとの同時リクエスト数と間隔を制限して並行に取得する
+- AsyncWebCrawler (再実行): 前回のHTTPキャッシュを条件付きリクエストで再検証する
+- AsyncWebCrawler (一部を更新): 一部のページの内容を変えてから再実行する
+
+RecursiveUrlLoaderが取得したページをすべて取得し、メタデータが一致することもあわせて確認する。
+RecursiveUrlLoaderは深さ優先でたどり、深い位置で先に訪れたページのリンクを打ち切るため、
+幅優先でたどるAsyncWebCrawlerの方が同じmax_depthでも多くのページを取得することがある。
+
+例:
+    poetry run python scripts/benchmark_web_crawler.py --pages 200 --latency 0.05
+"""
+
+import argparse
+import tempfile
+import time
+
+from langchain_community.document_loaders import RecursiveUrlLoader
+
+from server.rag.ingestion.web_crawler import AsyncWebCrawler, CrawlerConfig
+from server.testing.fakes import LocalSiteServer
+
+
+def main(
+    page_count: int,
+    latency_seconds: float,
+    max_depth: int,
+    per_host_concurrency: int,
+    politeness_delay_seconds: float,
+    modified_count: int,
+) -> None:
+    with LocalSiteServer(pages=page_count, latency_seconds=latency_seconds) as server:
+        start = time.perf_counter()
+        baseline_docs = list(
+            RecursiveUrlLoader(
+                url=server.root_url, max_depth=max_depth, prevent_outside=True
+            ).lazy_load()
+        )
+        elapsed = time.perf_counter() - start
+        print(
+            f"RecursiveUrlLoader: {len(baseline_docs)}ページ, {elapsed:.2f}秒, "
+            f"{len(baseline_docs) / elapsed:.1f}ページ/秒, "
+            f"{sum(len(d.page_content.encode('utf-8')) for d in baseline_docs) / 1024:.0f}KiB"
+        )
+        baseline = {doc.metadata["source"]: doc.metadata for doc in baseline_docs}
+
+        crawler = AsyncWebCrawler(
+            [server.root_url],
+            CrawlerConfig(
+                max_depth=max_depth,
+                per_host_concurrency=per_host_concurrency,
+                politeness_delay_seconds=politeness_delay_seconds,
+                cache_dir=tempfile.mkdtemp(),
+            ),
+        )
+        for label in ["キャッシュなし", "再実行", "一部を更新"]:
+            if label == "一部を更新":
+                for page in range(modified_count):
+                    server.modify(page)
+            server.max_in_flight = 0
+            first_doc_seconds = None
+            start = time.perf_counter()
+            docs = []
+            for doc in crawler.lazy_load():
+                if first_doc_seconds is None:
+                    first_doc_seconds = time.perf_counter() - start
+                docs.append(doc)
+            stats = crawler.stats
+            print(
+                f"AsyncWebCrawler ({label}): {stats.pages}ページ, "
+                f"{stats.elapsed_seconds:.2f}秒, {stats.pages_per_second:.1f}ページ/秒, "
+                f"{stats.bytes_downloaded / 1024:.0f}KiB, 未更新 {stats.not_modified}ページ, "
+                f"最初のページまで {(first_doc_seconds or 0) * 1000:.0f}ms, "
+                f"サーバーの同時リクエスト数 最大 {server.max_in_flight}"
+            )
+
+            crawled = {doc.metadata["source"]: doc.metadata for doc in docs}
+            assert crawled.keys() >= baseline.keys(), "取得していないページがあります"
+            assert all(
+                crawled[url]["title"] == baseline[url]["title"]
+                and crawled[url]["description"] == baseline[url]["description"]
+                for url in baseline
+            ), "メタデータが一致しません"
+            assert server.max_in_flight <= per_host_concurrency
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="1リクエストの遅延(秒)"
+    )
+    parser.add_argument("--max-depth", type=int, default=8)
+    parser.add_argument("--per-host-concurrency", type=int, default=4)
+    parser.add_argument("--politeness-delay", type=float, default=0.01)
+    parser.add_argument("--modified", type=int, default=10, help="更新するページの数")
+    args = parser.parse_args()
+
+    main(
+        args.pages,
+        args.latency,
+        args.max_depth,
+        args.per_host_concurrency,
+        args.politeness_delay,
+        args.modified,
+    )
@@ -1,41 +1,155 @@
+import os
+from typing import cast
 
 from dotenv import load_dotenv
 from langchain_aws import BedrockEmbeddings
 
+from server.rag.cached_embeddings import (
+    EMBEDDING_CACHE_PREFIX,
+    create_cached_bedrock_embeddings,
+)
+from server.rag.index_config import IndexConfig
 from server.rag.ingestion.document_indexer import DocumentIndexer
 from server.rag.ingestion.document_preprocessor import DocumentPreprocessor
+from server.rag.ingestion.image_describer import create_image_description_cache
+from server.rag.ingestion.image_fetcher import create_image_fetch_cache
+from server.rag.ingestion.index_manifest import create_index_manifest_store
+from server.rag.ingestion.ingestion_pipeline import IngestionPipeline
+from server.rag.ingestion.model_call_scheduler import ModelCallScheduler
+from server.rag.ingestion.s3_store import S3ByteStore
+from server.rag.ingestion.web_crawler import CrawlerConfig
+from server.rag.retriever import DocstoreBackend, VectorstoreBackend
 from server.utils.env import getenv_or_raise
 
 print("Initializing...")
 
 load_dotenv()
-PINECONE_INDEX_NAME = getenv_or_raise("PINECONE_INDEX_NAME")
+INDEX_CONFIG = IndexConfig.from_env()
 RAG_DOCSTORE_BUCKET_NAME = getenv_or_raise("RAG_DOCSTORE_BUCKET_NAME")
+RAG_DOCSTORE_BACKEND = cast(DocstoreBackend, os.getenv("RAG_DOCSTORE_BACKEND", "s3"))
+RAG_VECTORSTORE_BACKEND = cast(
+    VectorstoreBackend, os.getenv("RAG_VECTORSTORE_BACKEND", "pinecone")
+)
+# 通常は前回からの差分のみを反映する
+# マニフェストがない場合(差分の反映に対応する前に作成したインデックスを含む)は、すべて作り直す
+# ただし、初回の索引作成が中断してチェックポイントのみがある場合は、作り直さずに再開する
+manifest_store = create_index_manifest_store(RAG_DOCSTORE_BUCKET_NAME)
+RAG_FULL_REINDEX = os.getenv("RAG_FULL_REINDEX", "false").lower() == "true" or (
+    manifest_store.load() is None and manifest_store.load_checkpoint() is None
+)
+
+# 画像の説明の生成と埋め込みでBedrockの呼び出しの並列数を共有し、スロットリングされた場合は並列数を減らす
+model_call_scheduler = ModelCallScheduler()
 
 crawling_root_urls = [
     "https://classmethod.jp/services/generative-ai/"
     # クローリング対象を増やす場合はここに追加する
 ]
-preprocessor = DocumentPreprocessor(crawling_root_urls)
+# 前回の実行時から変わっていないページは条件付きリクエストで確認し、ダウンロードし直さない
+preprocessor = DocumentPreprocessor(
+    crawling_root_urls,
+    CrawlerConfig(cache_dir=os.getenv("RAG_CRAWLER_CACHE_DIR", ".crawler-cache")),
+    # 画像はCIなど実行環境が変わっても再利用できるよう、ドキュメントストアのバケットにキャッシュする
+    create_image_fetch_cache(RAG_DOCSTORE_BUCKET_NAME),
+    # 画像の説明は内容が同じであれば再利用し、新しい画像のみモデルで生成する
+    create_image_description_cache(RAG_DOCSTORE_BUCKET_NAME),
+    model_call_scheduler,
+)
 
-embedding = BedrockEmbeddings(
-    model_id="amazon.titan-embed-text-v2:0", region_name="us-east-1", client=None
+# 内容が変わっていないチャンクは前回の実行時の埋め込みベクトルを再利用する
+embedding = create_cached_bedrock_embeddings(
+    BedrockEmbeddings(
+        model_id="amazon.titan-embed-text-v2:0", region_name="us-east-1", client=None
+    ),
+    S3ByteStore(bucket_name=RAG_DOCSTORE_BUCKET_NAME, prefix=EMBEDDING_CACHE_PREFIX),
+    model_call_scheduler,
 )
 indexer = DocumentIndexer(
-    index_name=PINECONE_INDEX_NAME,
+    index_config=INDEX_CONFIG,
     bucket_name=RAG_DOCSTORE_BUCKET_NAME,
     embedding=embedding,
-    refresh=True,
+    refresh=RAG_FULL_REINDEX,
+    force_create_index=True,
+    docstore_backend=RAG_DOCSTORE_BACKEND,
+    vectorstore_backend=RAG_VECTORSTORE_BACKEND,
 )
 
 print("Initialization completed!")
 
 
-print("Document ingestion started...")
-docs = preprocessor.preprocess()
-print("Document ingestion completed!")
-
-
-print("Indexing started...")
-indexer.index(docs)
+print("Indexing started..." + (" (full reindex)" if RAG_FULL_REINDEX else ""))
+# クローリングから索引の作成までの各段階を並行に実行し、処理済みのページやチャンクはメモリに保持しない
+# 取得に失敗したページは一時的なエラーの可能性があるため、前回のチャンクを残す
+pipeline = IngestionPipeline(preprocessor, indexer)
+diff = pipeline.run()
 print("Indexing completed!")
+crawl_stats = preprocessor.crawl_stats
+print(
+    f"Crawling: {crawl_stats.pages} pages ({crawl_stats.not_modified} not modified, "
+    f"{crawl_stats.errors} errors), {crawl_stats.bytes_downloaded / 1024:.0f} KiB downloaded, "
+    f"{crawl_stats.pages_per_second:.1f} pages/sec"
+)
+image_stats = preprocessor.image_fetch_stats
+print(
+    f"Images: {image_stats.requested} images ({image_stats.downloaded} downloaded, "
+    f"{image_stats.not_modified} not modified, {image_stats.failed} failed, "
+    f"{image_stats.retries} retries), {image_stats.bytes_downloaded / 1024:.0f} KiB downloaded, "
+    f"{image_stats.images_per_second:.1f} images/sec"
+)
+normalization_stats = preprocessor.image_normalization_stats
+print(
+    f"Image normalization: {normalization_stats.normalized}/{normalization_stats.images} "
+    f"images normalized ({normalization_stats.rescued} rescued from the size limit, "
+    f"{normalization_stats.failed} failed), "
+    f"{normalization_stats.bytes_saved / 1024:.0f} KiB saved"
+)
+description_stats = preprocessor.image_description_stats
+print(
+    f"Image descriptions: {description_stats.requested} images "
+    f"({description_stats.duplicates} duplicates, {description_stats.hits} cache hits, "
+    f"{description_stats.described} described, {description_stats.failed} failed), "
+    f"{description_stats.saved_calls} model calls saved"
+)
+print(
+    f"Diff: {len(diff.added)} chunks added, {len(diff.removed)} removed, "
+    f"{diff.unchanged} unchanged / pages: {len(diff.added_urls)} added, "
+    f"{len(diff.changed_urls)} changed, {len(diff.removed_urls)} removed"
+)
+for label, urls in [
+    ("added", diff.added_urls),
+    ("changed", diff.changed_urls),
+    ("removed", diff.removed_urls),
+]:
+    for url in urls:
+        print(f"  {label}: {url}")
+pipeline_stats = pipeline.stats
+print(f"Pipeline: {pipeline_stats.elapsed_seconds:.1f} sec")
+for stage in pipeline_stats.stages:
+    print(
+        f"  {stage.name}: {stage.items_in} in, {stage.items_out} out, "
+        f"{stage.items_per_second:.1f} items/sec "
+        f"(busy {stage.busy_seconds:.1f} sec, waiting for input {stage.input_wait_seconds:.1f} sec, "
+        f"for output {stage.output_wait_seconds:.1f} sec)"
+    )
+write_stats = pipeline_stats.write
+print(
+    f"Index writes: {write_stats.written} chunks written "
+    f"({write_stats.resumed} skipped by resuming from the checkpoint) "
+    f"in {write_stats.batches} batches, {write_stats.chunks_per_second:.1f} chunks/sec "
+    f"(embedding and vectorstore {write_stats.vectorstore_seconds:.1f} sec, "
+    f"docstore {write_stats.docstore_seconds:.1f} sec)"
+)
+if pipeline_stats.peak_rss_bytes is not None:
+    print(f"Peak RSS: {pipeline_stats.peak_rss_bytes / 1024 / 1024:.0f} MiB")
+print(
+    f"Embedding cache: {embedding.stats.hits}/{embedding.stats.requested_texts} hits, "
+    f"{embedding.stats.saved_calls} embedding calls saved"
+)
+scheduler_stats = model_call_scheduler.stats
+print(
+    f"Bedrock calls: {scheduler_stats.calls} calls ({scheduler_stats.throttled} throttled, "
+    f"{scheduler_stats.retries} retries, {scheduler_stats.failed} failed), "
+    f"concurrency {int(scheduler_stats.concurrency_limit)} "
+    f"(peak {scheduler_stats.peak_in_flight}), "
+    f"{scheduler_stats.items_per_second:.1f} items/sec"
+)
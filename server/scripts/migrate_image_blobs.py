@@ -0,0 +1,135 @@
+"""
+既存のドキュメントストアを、画像データをドキュメントに埋め込む旧形式から
+ImageBlobStoreに格納してキーで参照する形式へ移行するスクリプト
+
+移行前後のドキュメントストアの合計サイズと、画像ドキュメントの取得にかかる時間を比較して表示する。
+
+例:
+    poetry run python scripts/migrate_image_blobs.py --dry-run
+    poetry run python scripts/migrate_image_blobs.py
+"""
+
+import argparse
+import base64
+import time
+
+from dotenv import load_dotenv
+from langchain_core.documents import Document
+
+from server.rag.ingestion.image_blob_store import create_image_blob_store
+from server.rag.ingestion.s3_store import S3Store
+from server.rag.retriever import NON_DOCUMENT_PREFIXES
+from server.utils.env import getenv_or_raise
+
+BATCH_SIZE = 100
+
+
+def document_size(doc: Document) -> int:
+    return len(doc.json().encode("utf-8"))
+
+
+def measure_ms(fn) -> float:
+    start = time.perf_counter()
+    fn()
+    return (time.perf_counter() - start) * 1000
+
+
+def main(dry_run: bool, sample_size: int) -> None:
+    load_dotenv()
+    bucket_name = getenv_or_raise("RAG_DOCSTORE_BUCKET_NAME")
+
+    docstore = S3Store(bucket_name=bucket_name)
+    image_blob_store = create_image_blob_store(bucket_name)
+
+    # 画像データ・キャッシュ・インデックスなど、同じバケットにあるドキュメント以外のオブジェクトは対象外とする
+    doc_keys = [
+        key
+        for key in docstore.yield_keys()
+        if not key.startswith(NON_DOCUMENT_PREFIXES)
+    ]
+    print(f"対象のドキュメント数: {len(doc_keys)}")
+
+    size_before = 0
+    size_after = 0
+    blob_sizes: dict[str, int] = {}
+    migrated_keys: list[str] = []
+
+    for i in range(0, len(doc_keys), BATCH_SIZE):
+        batch_keys = doc_keys[i : i + BATCH_SIZE]
+        migrated_pairs: list[tuple[str, Document]] = []
+
+        for key, doc in zip(batch_keys, docstore.mget(batch_keys)):
+            if doc is None:
+                continue
+
+            size_before += document_size(doc)
+            image_base64 = doc.metadata.get("base64")
+            if image_base64 is None:
+                size_after += document_size(doc)
+                continue
+
+            if dry_run:
+                image_data = base64.b64decode(image_base64)
+                blob_sizes[image_blob_store.blob_key(image_data)] = len(image_data)
+                metadata = {k: v for k, v in doc.metadata.items() if k != "base64"}
+                migrated_doc = doc.model_copy(update={"metadata": metadata})
+            else:
+                migrated_doc = image_blob_store.offload(doc)
+                blob_sizes[migrated_doc.metadata["blob_key"]] = len(
+                    base64.b64decode(image_base64)
+                )
+
+            size_after += document_size(migrated_doc)
+            migrated_pairs.append((key, migrated_doc))
+
+        # 移行前の取得時間を計測するため、最初に見つかった画像ドキュメントで書き込み前に計測する
+        # 移行後も同じキーで計測して比較する
+        if len(migrated_keys) == 0 and len(migrated_pairs) > 0:
+            sample_keys = [key for key, _ in migrated_pairs][:sample_size]
+            before_ms = measure_ms(lambda: docstore.mget(sample_keys))
+            print(
+                f"移行前の画像ドキュメント{len(sample_keys)}件の取得: {before_ms:.1f}ms"
+            )
+
+        if not dry_run and len(migrated_pairs) > 0:
+            docstore.mset(migrated_pairs)
+        migrated_keys.extend(key for key, _ in migrated_pairs)
+
+        print(f"{min(i + BATCH_SIZE, len(doc_keys))}/{len(doc_keys)} 件を処理しました")
+
+    total_after = size_after + sum(blob_sizes.values())
+    print(f"移行対象の画像ドキュメント数: {len(migrated_keys)}")
+    print(f"ユニークな画像数: {len(blob_sizes)}")
+    print(f"移行前のドキュメントの合計サイズ: {size_before:,} bytes")
+    print(
+        f"移行後の合計サイズ: {total_after:,} bytes "
+        f"(ドキュメント {size_after:,} bytes + 画像 {sum(blob_sizes.values()):,} bytes)"
+    )
+    if size_before > 0:
+        print(f"削減率: {(1 - total_after / size_before) * 100:.1f}%")
+
+    if dry_run or len(migrated_keys) == 0:
+        return
+
+    sample_keys = migrated_keys[:sample_size]
+    sample_docs = docstore.mget(sample_keys)
+    metadata_only_ms = measure_ms(lambda: docstore.mget(sample_keys))
+    blob_keys = list(
+        {doc.metadata["blob_key"]: None for doc in sample_docs if doc is not None}
+    )
+    with_images_ms = metadata_only_ms + measure_ms(
+        lambda: image_blob_store.mget_base64(blob_keys)
+    )
+    print(
+        f"移行後の画像ドキュメント{len(sample_keys)}件の取得: "
+        f"{metadata_only_ms:.1f}ms (画像データを含む場合 {with_images_ms:.1f}ms)"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--sample-size", type=int, default=5)
+    args = parser.parse_args()
+
+    main(dry_run=args.dry_run, sample_size=args.sample_size)
@@ -0,0 +1,143 @@
+"""
+Lambdaのコールドスタート時のモジュール読み込み時間を計測し、履歴として記録するレポート
+
+`python -X importtime` で以下の経路の読み込み時間を計測する。
+- ack: Slackへの応答までに読み込むモジュール(slack_bot_handler)
+- answer: 回答の生成までに読み込むモジュール(Ragの作成に必要なモジュールを含む)
+
+計測結果は --history で指定したJSON Lines形式のファイルに追記し、過去の計測結果と並べて表示する。
+コミットごとに実行することで、コールドスタート時間の推移を追跡できる。
+ネットワークにはアクセスせず、Slackのトークンなどにはダミーの値を使用する。
+
+例:
+    poetry run python scripts/profile_cold_start.py --repeat 5
+"""
+
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import NamedTuple, Optional
+
+TARGETS = {
+    "ack": "import slack_bot_handler",
+    "answer": (
+        "import slack_bot_handler\n"
+        "import langchain.storage, langchain_aws\n"
+        "import server.rag.rag, server.rag.semantic_cache, server.rag.cached_embeddings"
+    ),
+}
+
+_DUMMY_ENV = {
+    "SLACK_BOT_TOKEN": "xoxb-dummy",
+    "SLACK_SIGNING_SECRET": "dummy",
+    "AWS_DEFAULT_REGION": "us-east-1",
+}
+
+
+class ImportProfile(NamedTuple):
+    total_ms: float
+    modules_ms: dict[str, float]  # トップレベルのパッケージ -> 読み込み時間の合計
+
+
+def profile_import(code: str) -> ImportProfile:
+    """新しいPythonプロセスでcodeを実行し、-X importtimeの出力を集計する"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        env={**os.environ, **_DUMMY_ENV},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    packages_us: dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or line.count("|") != 2:
+            continue
+        self_time, _, name = line.removeprefix("import time:").split("|")
+        if not self_time.strip().isdigit():
+            continue  # ヘッダ行
+        # モジュールごとの読み込み時間(自身の分のみ)をトップレベルのパッケージごとに合計する
+        package = name.strip().split(".")[0]
+        packages_us[package] = packages_us.get(package, 0) + int(self_time)
+
+    return ImportProfile(
+        total_ms=sum(packages_us.values()) / 1000,
+        modules_ms={name: us / 1000 for name, us in packages_us.items()},
+    )
+
+
+def current_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(repeat: int, top: int, history_path: str, show_history: int) -> None:
+    record: dict = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": current_commit(),
+        "python": sys.version.split()[0],
+        "targets": {},
+    }
+    for target, code in TARGETS.items():
+        # ディスクキャッシュの影響を除くため、初回の計測は捨てて中央値をとる
+        profile_import(code)
+        profiles = [profile_import(code) for _ in range(repeat)]
+        median_profile = sorted(profiles, key=lambda p: p.total_ms)[len(profiles) // 2]
+        record["targets"][target] = {
+            "total_ms": round(statistics.median(p.total_ms for p in profiles), 1),
+            "top_modules_ms": {
+                name: round(ms, 1)
+                for name, ms in sorted(
+                    median_profile.modules_ms.items(), key=lambda item: -item[1]
+                )[:top]
+            },
+        }
+
+        print(
+            f"[{target}] 読み込み時間 中央値 {record['targets'][target]['total_ms']:.0f}ms"
+        )
+        for name, ms in record["targets"][target]["top_modules_ms"].items():
+            print(f"  {name}: {ms:.0f}ms")
+
+    history: list[dict] = []
+    if os.path.exists(history_path):
+        with open(history_path, encoding="utf-8") as f:
+            history = [json.loads(line) for line in f if line.strip() != ""]
+    with open(history_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    history.append(record)
+
+    print(f"\n直近の計測結果 ({history_path}):")
+    print("日時                 コミット  " + "  ".join(f"{t:>10}" for t in TARGETS))
+    for entry in history[-show_history:]:
+        totals = [
+            f"{entry['targets'][t]['total_ms']:>8.0f}ms"
+            if t in entry["targets"]
+            else f"{'-':>10}"
+            for t in TARGETS
+        ]
+        print(
+            f"{entry['timestamp']}  {entry['commit'] or '-':>8}  " + "  ".join(totals)
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=8, help="表示するパッケージの数")
+    parser.add_argument("--history", default="cold_start_history.jsonl")
+    parser.add_argument("--show-history", type=int, default=10)
+    args = parser.parse_args()
+
+    main(args.repeat, args.top, args.history, args.show_history)
@@ -0,0 +1,164 @@
+"""
+ContextPackerによるプロンプトの大きさの削減を確認するレポート
+
+長さの異なるページをインデックス作成時と同じ設定でチャンクに分割したコーパスを作成し、
+回答時と同じRerankingRetrieverで検索した結果をContextPackerで詰め直す。
+ベクトルストアはLocalVectorStore、埋め込みベクトルはフェイクを使用する。
+検索結果をすべてプロンプトに含めた場合と、モデルごとの予算で詰め直した場合の
+プロンプトの大きさ(トークン数の見積もりと文字数)を比較する。
+
+例:
+    poetry run python scripts/report_context_packing.py --questions 200 --k 8
+"""
+
+import argparse
+import random
+import statistics
+import tempfile
+
+from langchain.storage import InMemoryStore
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from server.rag.context_packer import (
+    MODEL_CONTEXT_BUDGETS,
+    ContextBudget,
+    ContextPacker,
+    estimate_tokens,
+)
+from server.rag.ingestion.local_vectorstore import LocalVectorStore
+from server.rag.reranking_retriever import RerankingRetriever
+from server.testing.fakes import ClusteredFakeEmbeddings
+
+
+def create_chunks(page_count: int, seed: int) -> list[Document]:
+    """長さの異なるページと画像の説明をチャンクに分割したコーパスを作成する"""
+    rng = random.Random(seed)
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=1000, chunk_overlap=200, add_start_index=True
+    )
+    pages = []
+    for page in range(page_count):
+        sentences = [
+            f"ページ{page}の{i}番目の段落では製品の設定手順を説明します。"
+            for i in range(rng.randint(5, 250))
+        ]
+        pages.append(
+            Document(
+                page_content="\n".join(sentences),
+                metadata={
+                    "url": f"https://example.com/{page}",
+                    "title": f"ページ{page}",
+                    "modality": "text",
+                },
+            )
+        )
+        if rng.random() < 0.3:
+            pages.append(
+                Document(
+                    page_content=f"ページ{page}の設定画面のスクリーンショット。" * 5,
+                    metadata={
+                        "url": f"https://example.com/{page}/image.png",
+                        "title": "画像",
+                        "modality": "image",
+                        "mime_type": "image/png",
+                    },
+                )
+            )
+
+    chunks = splitter.split_documents(pages)
+    for i, chunk in enumerate(chunks):
+        chunk.metadata["doc_id"] = str(i)
+        chunk.metadata["token_count"] = estimate_tokens(chunk.page_content)
+    return chunks
+
+
+def create_retriever(chunks: list[Document], k: int) -> RerankingRetriever:
+    """回答時と同じく、候補を出典ごとにまとめて上位k件を返すRetrieverを作成する"""
+    vectorstore = LocalVectorStore(
+        ClusteredFakeEmbeddings(size=256), tempfile.mkdtemp()
+    )
+    vectorstore.add_documents(
+        chunks, ids=[chunk.metadata["doc_id"] for chunk in chunks]
+    )
+    docstore = InMemoryStore()
+    docstore.mset([(chunk.metadata["doc_id"], chunk) for chunk in chunks])
+    return RerankingRetriever(
+        vectorstore=vectorstore, docstore=docstore, search_kwargs={"k": k}
+    )
+
+
+def create_questions(
+    chunks: list[Document], count: int, rng: random.Random
+) -> list[str]:
+    """チャンクの一文を言い換えた質問を作成する"""
+    questions = []
+    for chunk in rng.sample(chunks, count):
+        sentence = chunk.page_content.split("\n")[0].split("。")[0]
+        questions.append(f"{sentence}について教えてください")
+    return questions
+
+
+def prompt_size(docs: list[Document], budget: ContextBudget) -> tuple[int, int]:
+    """プロンプトに含まれる検索結果のトークン数の見積もりと文字数を返す"""
+    tokens = sum(
+        estimate_tokens(doc.page_content)
+        + (budget.image_tokens if doc.metadata["modality"] == "image" else 0)
+        for doc in docs
+    )
+    return tokens, sum(len(doc.page_content) for doc in docs)
+
+
+def summarize(label: str, tokens: list[int], chars: list[int]) -> None:
+    quantiles = statistics.quantiles(tokens, n=20)
+    print(
+        f"{label}: トークン数 平均 {statistics.mean(tokens):.0f}, "
+        f"p50 {statistics.median(tokens):.0f}, p95 {quantiles[-1]:.0f}, "
+        f"最大 {max(tokens)}, 標準偏差 {statistics.pstdev(tokens):.0f}, "
+        f"文字数 平均 {statistics.mean(chars):.0f}"
+    )
+
+
+def main(page_count: int, question_count: int, k: int, seed: int) -> None:
+    chunks = create_chunks(page_count, seed)
+    retriever = create_retriever(chunks, k)
+    questions = create_questions(chunks, question_count, random.Random(seed))
+    results = [retriever.invoke(question) for question in questions]
+    print(f"チャンク数: {len(chunks)}, 質問数: {question_count}, 検索件数: {k}")
+
+    default_budget = ContextBudget()
+    sizes = [prompt_size(docs, default_budget) for docs in results]
+    summarize("詰め直しなし", [t for t, _ in sizes], [c for _, c in sizes])
+
+    for model_prefix, budget in MODEL_CONTEXT_BUDGETS.items():
+        packer = ContextPacker(budget)
+        packed_sizes: list[tuple[int, int]] = []
+        truncated = dropped = 0
+        for docs in results:
+            packed, stats = packer.pack_with_stats(docs)
+            packed_sizes.append(prompt_size(packed, budget))
+            truncated += stats.truncated_docs
+            dropped += stats.dropped_docs
+
+        tokens = [t for t, _ in packed_sizes]
+        summarize(
+            f"{model_prefix} (予算 {budget.max_tokens})",
+            tokens,
+            [c for _, c in packed_sizes],
+        )
+        reduction = 1 - sum(tokens) / sum(t for t, _ in sizes)
+        print(
+            f"  削減率 {reduction:.1%}, 質問あたり "
+            f"切り詰め {truncated / question_count:.2f}件, 除外 {dropped / question_count:.2f}件"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=300)
+    parser.add_argument("--questions", type=int, default=200)
+    parser.add_argument("--k", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    main(args.pages, args.questions, args.k, args.seed)
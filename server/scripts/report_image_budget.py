@@ -0,0 +1,119 @@
+"""
+ImageSelectorによる、プロンプトに添付する画像データの削減量を確認するレポート
+
+スクリーンショットを模した大きさの異なる画像をImageBlobStoreに保存し、
+各質問の検索結果に含まれる画像を以下の方法で添付した場合の合計バイト数と所要時間を比較する。
+- 従来の方法(検索結果のすべての画像を元の大きさで添付する)
+- ImageBudgetによる選択(縮小版がない状態から読み込み時に作成する場合と、作成済みの場合)
+
+Pillowが必要である。
+
+例:
+    poetry run python scripts/report_image_budget.py --images 40 --questions 50
+"""
+
+import argparse
+import io
+import random
+import statistics
+import time
+
+from langchain_core.stores import InMemoryByteStore
+from PIL import Image, ImageDraw
+
+from server.rag.image_selector import ImageBudget, ImageSelector
+from server.rag.ingestion.image_blob_store import ImageBlobStore
+from server.rag.ingestion.model import ImageDocumentMetadata
+from server.rag.model import MetadataTypedDocument
+
+
+def create_screenshot(rng: random.Random) -> bytes:
+    """ウィンドウや文字列の並ぶスクリーンショットを模したPNG画像を作成する"""
+    width = rng.randint(800, 3840)
+    height = int(width * rng.uniform(0.5, 0.8))
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x, y = rng.randrange(width), rng.randrange(height)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.rectangle(
+            (x, y, x + rng.randint(50, 600), y + rng.randint(20, 300)), fill=color
+        )
+    for line in range(0, height, 24):
+        draw.text((20, line), f"設定項目 {line} " * 8, fill="black")
+    # 写真やグラデーションのように圧縮が効きにくい領域を含める
+    photo = Image.effect_noise((width // 3, height // 3), rng.randint(20, 80))
+    image.paste(
+        photo.convert("RGB"), (rng.randrange(width // 2), rng.randrange(height // 2))
+    )
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def main(
+    image_count: int, question_count: int, images_per_question: int, seed: int
+) -> None:
+    rng = random.Random(seed)
+    store = InMemoryByteStore()
+    image_blob_store = ImageBlobStore(store)
+    docs = []
+    for i in range(image_count):
+        key = image_blob_store.put(create_screenshot(rng))
+        docs.append(
+            MetadataTypedDocument(
+                page_content=f"画像{i}の説明",
+                metadata=ImageDocumentMetadata(
+                    url=f"https://example.com/{i}.png",
+                    title="画像",
+                    mime_type="image/png",
+                    blob_key=key,
+                ),
+            )
+        )
+    questions = [rng.sample(docs, images_per_question) for _ in range(question_count)]
+
+    original_bytes = [
+        sum(
+            len(data or b"")
+            for data in image_blob_store.mget(
+                [d.metadata.blob_key or "" for d in retrieved]
+            )
+        )
+        for retrieved in questions
+    ]
+    print(
+        f"従来 (すべて元の大きさ): 平均 {statistics.mean(original_bytes) / 1024:.0f}KiB/質問, "
+        f"最大 {max(original_bytes) / 1024:.0f}KiB, 画像 {images_per_question}枚/質問"
+    )
+
+    selector = ImageSelector(image_blob_store, ImageBudget())
+    for label in ["縮小版を読み込み時に作成", "縮小版を作成済み"]:
+        included_bytes: list[int] = []
+        included_counts: list[int] = []
+        latencies: list[float] = []
+        for retrieved in questions:
+            start = time.perf_counter()
+            selection = selector.select(retrieved)
+            latencies.append(time.perf_counter() - start)
+            included_bytes.append(sum(image.size_bytes for image in selection.included))
+            included_counts.append(len(selection.included))
+        print(
+            f"ImageBudget ({label}): 平均 {statistics.mean(included_bytes) / 1024:.0f}KiB/質問, "
+            f"最大 {max(included_bytes) / 1024:.0f}KiB, "
+            f"画像 {statistics.mean(included_counts):.1f}枚/質問, "
+            f"選択の所要時間 平均 {statistics.mean(latencies) * 1000:.1f}ms, "
+            f"中央値 {statistics.median(latencies) * 1000:.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=40)
+    parser.add_argument("--questions", type=int, default=50)
+    parser.add_argument("--images-per-question", type=int, default=6)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    main(args.images, args.questions, args.images_per_question, args.seed)
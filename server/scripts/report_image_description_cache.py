@@ -0,0 +1,108 @@
+"""
+ImageDescriberのキャッシュと重複排除によって省略できた、画像の説明の生成の回数を確認するレポート
+
+同じ画像が複数のURLで配信されている状態を模した画像の一覧に対して、以下の場合のモデルの呼び出し回数と所要時間を表示する。
+- 従来の方法(すべての画像についてモデルを呼び出す)
+- ImageDescriber (キャッシュなし): 内容が同じ画像は1回だけ説明を生成する
+- ImageDescriber (再実行): 前回生成した説明をキャッシュから取得する
+- ImageDescriber (新しい画像を追加): 追加した画像のみ説明を生成する
+- ImageDescriber (モデルを変更): モデルIDが異なるため、キャッシュを使用せずに説明を生成し直す
+
+キャッシュはLocalFileStoreで一時ディレクトリに保存する(本番ではS3ByteStoreを使用する)。
+モデルは一定時間待ってから説明を返すFakeVisionChatModelを使用する。
+
+例:
+    poetry run python scripts/report_image_description_cache.py --images 100 --duplicate-rate 0.3
+"""
+
+import argparse
+import base64
+import random
+import tempfile
+import time
+
+from langchain.storage import LocalFileStore
+
+from server.rag.ingestion.image_describer import ImageDescriber, ImageDescriptionCache
+from server.rag.ingestion.model import _ImageMetadata
+from server.testing.fakes import FakeVisionChatModel
+
+
+def create_images(
+    rng: random.Random, count: int, duplicate_rate: float, start: int = 0
+) -> list[_ImageMetadata]:
+    """duplicate_rateの割合で、それまでの画像と同じ内容を別のURLで配信する画像の一覧を作成する"""
+    contents: list[bytes] = []
+    images = []
+    for i in range(start, start + count):
+        if len(contents) > 0 and rng.random() < duplicate_rate:
+            content = rng.choice(contents)
+        else:
+            content = rng.randbytes(2_000)
+            contents.append(content)
+        images.append(
+            _ImageMetadata(
+                url=f"https://example.com/images/{i}.png",
+                mime_type="image/png",
+                base64=base64.b64encode(content).decode("utf-8"),
+            )
+        )
+    return images
+
+
+def main(
+    image_count: int, duplicate_rate: float, added_count: int, latency_seconds: float
+) -> None:
+    rng = random.Random(0)
+    images = create_images(rng, image_count, duplicate_rate)
+    added_images = images + create_images(rng, added_count, 0.0, start=image_count)
+
+    # 従来の方法は実行のたびに、重複を除く前の画像の数だけモデルを呼び出す
+    print(f"従来の方法: 呼び出し {len(images)}回 (実行のたび)")
+
+    cache = ImageDescriptionCache(LocalFileStore(tempfile.mkdtemp()))
+    runs = [
+        ("キャッシュなし", images, "fake"),
+        ("再実行", images, "fake"),
+        (f"{added_count}枚の新しい画像を追加", added_images, "fake"),
+        ("モデルを変更", added_images, "fake-v2"),
+    ]
+    previous_descriptions = None
+    for label, target_images, model_id in runs:
+        llm = FakeVisionChatModel(latency_seconds=latency_seconds)
+        describer = ImageDescriber(cache=cache, llm=llm, model_id=model_id)
+        start = time.perf_counter()
+        docs = describer.describe(target_images)
+        elapsed = time.perf_counter() - start
+        stats = describer.stats
+        print(
+            f"ImageDescriber ({label}): 呼び出し {llm.calls}回, {elapsed:.2f}秒, "
+            f"重複 {stats.duplicates}, キャッシュ {stats.hits}, 生成 {stats.described}, "
+            f"省略した呼び出し {stats.saved_calls}回"
+        )
+        assert llm.calls == stats.described
+        assert [doc.metadata for doc in docs] == target_images
+
+        # キャッシュから取得した説明が、前回生成した説明と一致することを確認する
+        descriptions = [doc.page_content for doc in docs]
+        if previous_descriptions is not None and model_id == "fake":
+            assert descriptions[: len(previous_descriptions)] == previous_descriptions
+        previous_descriptions = descriptions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=100)
+    parser.add_argument(
+        "--duplicate-rate",
+        type=float,
+        default=0.3,
+        help="他のURLの画像と内容が同じ画像の割合",
+    )
+    parser.add_argument("--added", type=int, default=10, help="追加する画像の数")
+    parser.add_argument(
+        "--latency", type=float, default=0.2, help="1回の呼び出しの遅延(秒)"
+    )
+    args = parser.parse_args()
+
+    main(args.images, args.duplicate_rate, args.added, args.latency)
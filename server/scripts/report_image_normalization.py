@@ -0,0 +1,131 @@
+"""
+ImageNormalizerによって説明を生成できるようになった画像の数と、削減できたバイト数を確認するレポート
+
+Webページに含まれる画像を模して、小さなアイコン・スクリーンショット・写真(Base64エンコード後に5MBを超えるものを含む)を作成し、
+以下を表示する。
+- 従来の方法で説明の生成から除外される画像の数と、格納される画像の合計バイト数
+- ImageNormalizerで正規化した後に除外される画像の数と、格納される画像の合計バイト数
+- 1プロセスで正規化した場合と、プロセスプールで正規化した場合の所要時間
+
+Pillowが必要である。
+
+例:
+    poetry run python scripts/report_image_normalization.py --images 40 --large-rate 0.2
+"""
+
+import argparse
+import base64
+import io
+import os
+import random
+import time
+
+from PIL import Image, ImageDraw
+
+from server.rag.ingestion.image_normalizer import (
+    MAX_MODEL_IMAGE_BASE64_SIZE,
+    ImageNormalizationConfig,
+    ImageNormalizer,
+)
+from server.rag.ingestion.model import _ImageMetadata
+
+
+def create_photo(rng: random.Random, width: int, height: int) -> bytes:
+    """ノイズの多い写真を模したPNG画像を作成する。圧縮が効きにくいため大きくなる"""
+    channels = [
+        Image.effect_noise((width, height), rng.uniform(40, 80)) for _ in range(3)
+    ]
+    buffer = io.BytesIO()
+    Image.merge("RGB", channels).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def create_screenshot(rng: random.Random, width: int, height: int) -> bytes:
+    """ウィンドウや文字列の並ぶスクリーンショットを模したPNG画像を作成する"""
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x, y = rng.randrange(width), rng.randrange(height)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.rectangle(
+            (x, y, x + rng.randint(50, 600), y + rng.randint(20, 300)), fill=color
+        )
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def create_images(
+    rng: random.Random, count: int, large_rate: float
+) -> list[_ImageMetadata]:
+    images = []
+    for i in range(count):
+        kind = rng.random()
+        if kind < large_rate:
+            data = create_photo(rng, rng.randint(2400, 3200), rng.randint(1800, 2400))
+        elif kind < 0.6:
+            data = create_screenshot(
+                rng, rng.randint(800, 3840), rng.randint(600, 2160)
+            )
+        else:
+            data = create_screenshot(rng, rng.randint(32, 400), rng.randint(32, 400))
+        images.append(
+            _ImageMetadata(
+                url=f"https://example.com/images/{i}.png",
+                mime_type="image/png",
+                base64=base64.b64encode(data).decode("utf-8"),
+            )
+        )
+    return images
+
+
+def summarize(label: str, images: list[_ImageMetadata]) -> None:
+    dropped = sum(len(image.base64) >= MAX_MODEL_IMAGE_BASE64_SIZE for image in images)
+    total_bytes = sum(len(base64.b64decode(image.base64)) for image in images)
+    print(
+        f"{label}: 説明の生成から除外される画像 {dropped}/{len(images)}件, "
+        f"格納される画像の合計 {total_bytes / 1024 / 1024:.1f}MiB"
+    )
+
+
+def main(image_count: int, large_rate: float, max_workers: int) -> None:
+    images = create_images(random.Random(0), image_count, large_rate)
+    summarize("従来の方法", images)
+
+    serial = ImageNormalizer(ImageNormalizationConfig(max_workers=1))
+    start = time.perf_counter()
+    expected = serial.normalize_all(images)
+    serial_seconds = time.perf_counter() - start
+
+    parallel = ImageNormalizer(ImageNormalizationConfig(max_workers=max_workers))
+    start = time.perf_counter()
+    normalized = parallel.normalize_all(images)
+    parallel_seconds = time.perf_counter() - start
+    assert normalized == expected
+
+    summarize("ImageNormalizer", normalized)
+    stats = parallel.stats
+    print(
+        f"正規化 {stats.normalized}件, 送信可能になった画像 {stats.rescued}件, "
+        f"失敗 {stats.failed}件, 削減できたバイト数 {stats.bytes_saved / 1024 / 1024:.1f}MiB"
+    )
+    print(
+        f"所要時間: 1プロセス {serial_seconds:.2f}秒, "
+        f"{max_workers}プロセス {parallel_seconds:.2f}秒 "
+        f"(プロセスの起動を含む, CPU数 {os.cpu_count()})"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=40)
+    parser.add_argument(
+        "--large-rate",
+        type=float,
+        default=0.2,
+        help="Base64エンコード後に5MBを超える写真の割合",
+    )
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    main(args.images, args.large_rate, args.workers)
@@ -0,0 +1,118 @@
+"""
+RerankingRetrieverによる出典の重複排除と、ドキュメントストアからの読み込み量を比較するレポート
+
+1ページを複数のチャンクに分割したコーパスを作成し、以下を比較する。
+- 従来の検索(MultiVectorRetriever, k=5)
+- 多めに取得してからドキュメントストアを読む素朴な方法(MultiVectorRetriever, k=30)
+- 多めに取得し、再ランキングしてから上位5件のみを読む方法(RerankingRetriever)
+
+同じページのチャンクは似た埋め込みベクトルを持つようにしているため、
+従来の検索では上位の枠を同じページのチャンクが占めやすい。
+
+例:
+    poetry run python scripts/report_reranking.py --pages 500 --chunks-per-page 6
+"""
+
+import argparse
+import re
+import statistics
+import tempfile
+from typing import List, Optional, Sequence
+
+import numpy as np
+from langchain.retrievers.multi_vector import MultiVectorRetriever
+from langchain.storage import InMemoryStore
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+
+from server.rag.ingestion.local_vectorstore import LocalVectorStore
+from server.rag.reranking_retriever import RerankingRetriever
+
+
+class PageEmbeddings(Embeddings):
+    """テキスト中の[page:N]に応じて、同じページのテキストが近くに配置される埋め込みベクトルを返す"""
+
+    def __init__(self, page_count: int, size: int = 128):
+        self._centers = np.random.default_rng(0).standard_normal((page_count, size))
+        self._rng = np.random.default_rng(1)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self._embed(text, noise=0.3) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embed(text, noise=0.8)
+
+    def _embed(self, text: str, noise: float) -> list[float]:
+        match = re.search(r"\[page:(\d+)\]", text)
+        page = int(match.group(1)) if match is not None else 0
+        center = self._centers[page]
+        return (center + noise * self._rng.standard_normal(len(center))).tolist()
+
+
+class CountingStore(InMemoryStore):
+    """mgetで読み込んだキーの数と文字数を数えるドキュメントストア"""
+
+    read_keys: int = 0
+    read_chars: int = 0
+
+    def mget(self, keys: Sequence[str]) -> List[Optional[Document]]:
+        docs = super().mget(keys)
+        self.read_keys += len(keys)
+        self.read_chars += sum(len(d.page_content) for d in docs if d is not None)
+        return docs
+
+
+def main(page_count: int, chunks_per_page: int, query_count: int) -> None:
+    embedding = PageEmbeddings(page_count)
+    docs = [
+        Document(
+            page_content=f"[page:{page}] ページ{page}のチャンク{chunk}です。" * 20,
+            metadata={
+                "doc_id": f"{page}-{chunk}",
+                "url": f"https://example.com/{page}",
+            },
+        )
+        for page in range(page_count)
+        for chunk in range(chunks_per_page)
+    ]
+    vectorstore = LocalVectorStore(embedding, tempfile.mkdtemp())
+    vectorstore.add_documents(docs)
+
+    queries = [f"[page:{i % page_count}] について教えて" for i in range(query_count)]
+    configs: dict[str, tuple[BaseRetriever, CountingStore]] = {}
+    for label, k, reranking in [
+        ("従来 (k=5)", 5, False),
+        ("多めに取得してそのまま読む (k=30)", 30, False),
+        ("再ランキング (候補30件 -> 5件)", 5, True),
+    ]:
+        docstore = CountingStore()
+        docstore.mset([(doc.metadata["doc_id"], doc) for doc in docs])
+        retriever_cls = RerankingRetriever if reranking else MultiVectorRetriever
+        configs[label] = (
+            retriever_cls(
+                vectorstore=vectorstore, docstore=docstore, search_kwargs={"k": k}
+            ),
+            docstore,
+        )
+
+    for label, (retriever, docstore) in configs.items():
+        distinct_sources = [
+            len({doc.metadata["url"] for doc in retriever.invoke(query)})
+            for query in queries
+        ]
+        print(
+            f"{label}: 出典の種類数 平均 {statistics.mean(distinct_sources):.2f}, "
+            f"ドキュメントストアの読み込み {docstore.read_keys / query_count:.1f}件/クエリ, "
+            f"{docstore.read_chars / query_count:.0f}文字/クエリ"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=500)
+    parser.add_argument("--chunks-per-page", type=int, default=6)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    main(args.pages, args.chunks_per_page, args.queries)
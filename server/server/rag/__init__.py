@@ -1,3 +1,4 @@
+from .index_config import IndexConfig
 from .ingestion.model import DocumentMetadata
 from .model import (
     AnswerStatement,
@@ -12,6 +13,7 @@ __all__ = [
     "CitedAnswer",
     "MetadataTypedDocument",
     "DocumentMetadata",
+    "IndexConfig",
     "RagResult",
     "Rag",
 ]
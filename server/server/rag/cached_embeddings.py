@@ -0,0 +1,238 @@
+import hashlib
+import re
+import threading
+from typing import Literal, Optional
+
+import numpy as np
+from langchain_aws import BedrockEmbeddings
+from langchain_core.embeddings import Embeddings
+from langchain_core.stores import ByteStore
+from pydantic import BaseModel
+
+from server.rag.ingestion.model_call_scheduler import (
+    ModelCallScheduler,
+    ScheduledEmbeddings,
+)
+
+EMBEDDING_CACHE_PREFIX = "embeddings/"
+"""ドキュメントストアと同じバケット内で埋め込みベクトルのキャッシュを格納するプレフィックス"""
+
+_EmbeddingKind = Literal["document", "query"]
+
+
+class EmbeddingCacheStats(BaseModel):
+    """CachedEmbeddingsのヒット・ミスの回数"""
+
+    requested_texts: int = 0
+    """埋め込みを要求されたテキストの数"""
+
+    hits: int = 0
+    """キャッシュから取得できたテキストの数"""
+
+    embedded_texts: int = 0
+    """埋め込みモデルで実際に埋め込んだテキストの数"""
+
+    @property
+    def saved_calls(self) -> int:
+        """キャッシュと重複排除によって省略できた埋め込みの回数"""
+        return self.requested_texts - self.embedded_texts
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.requested_texts if self.requested_texts > 0 else 0.0
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    埋め込みベクトルをテキストの内容をキーとしてキャッシュするEmbeddings
+
+    キーは(モデルID, 次元数, 用途, テキストのSHA-256)から作成するため、
+    モデルや次元数を変更した場合に古いベクトルが使用されることはない。
+    キャッシュにないテキストは重複を除いてからbatch_size件ずつまとめて埋め込む。
+    """
+
+    _embedding: Embeddings
+    _store: ByteStore
+    _model_id: str
+    _dimension: Optional[int]
+    _batch_size: int
+    _stats: EmbeddingCacheStats
+    _lock: threading.Lock
+
+    def __init__(
+        self,
+        embedding: Embeddings,
+        store: ByteStore,
+        *,
+        model_id: str,
+        dimension: Optional[int] = None,
+        batch_size: int = 64,
+    ):
+        """
+        CachedEmbeddingsを初期化します。
+
+        Args:
+            embedding (Embeddings): キャッシュ対象の埋め込みモデル
+            store (ByteStore): 埋め込みベクトルを格納するストア(S3ByteStoreやLocalFileStoreなど)
+            model_id (str): 埋め込みモデルのID
+            dimension (Optional[int]): 埋め込みベクトルの次元数。Noneの場合はモデルのデフォルト
+            batch_size (int): 埋め込みモデルに一度に渡すテキストの最大数
+        """
+        self._embedding = embedding
+        self._store = store
+        self._model_id = model_id
+        self._dimension = dimension
+        self._batch_size = batch_size
+        self._stats = EmbeddingCacheStats()
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self) -> EmbeddingCacheStats:
+        """キャッシュのヒット・ミスの回数を返します"""
+        with self._lock:
+            return self._stats.model_copy()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        """ドキュメントを埋め込みます。キャッシュにないもののみ埋め込みモデルを呼び出します"""
+        keys = [self._key(text, "document") for text in texts]
+        cached = self._store.mget(keys)
+        missed = self._collect_missed(texts, keys, cached)
+
+        embedded: list[list[float]] = []
+        for batch in self._batches(list(missed.values())):
+            embedded.extend(self._embedding.embed_documents(batch))
+
+        embedded_by_key = dict(zip(missed.keys(), embedded))
+        if len(embedded_by_key) > 0:
+            self._store.mset(self._encode_pairs(embedded_by_key))
+        return self._merge(keys, cached, embedded_by_key)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        """embed_documentsの非同期版"""
+        keys = [self._key(text, "document") for text in texts]
+        cached = await self._store.amget(keys)
+        missed = self._collect_missed(texts, keys, cached)
+
+        embedded: list[list[float]] = []
+        for batch in self._batches(list(missed.values())):
+            embedded.extend(await self._embedding.aembed_documents(batch))
+
+        embedded_by_key = dict(zip(missed.keys(), embedded))
+        if len(embedded_by_key) > 0:
+            await self._store.amset(self._encode_pairs(embedded_by_key))
+        return self._merge(keys, cached, embedded_by_key)
+
+    def embed_query(self, text: str) -> list[float]:
+        """質問を埋め込みます。同じ質問はキャッシュから返します"""
+        key = self._key(text, "query")
+        [data] = self._store.mget([key])
+        self._collect_missed([text], [key], [data])
+        if data is not None:
+            return self._decode(data)
+
+        vector = self._embedding.embed_query(text)
+        self._store.mset([(key, self._encode(vector))])
+        return vector
+
+    async def aembed_query(self, text: str) -> list[float]:
+        """embed_queryの非同期版"""
+        key = self._key(text, "query")
+        [data] = await self._store.amget([key])
+        self._collect_missed([text], [key], [data])
+        if data is not None:
+            return self._decode(data)
+
+        vector = await self._embedding.aembed_query(text)
+        await self._store.amset([(key, self._encode(vector))])
+        return vector
+
+    def _collect_missed(
+        self,
+        texts: list[str],
+        keys: list[str],
+        cached: list[Optional[bytes]],
+    ) -> dict[str, str]:
+        """キャッシュになかったテキストを、重複を除いてキーと対応付けて返します"""
+        missed: dict[str, str] = {}
+        for text, key, data in zip(texts, keys, cached):
+            if data is None:
+                missed.setdefault(key, text)
+
+        with self._lock:
+            self._stats.requested_texts += len(texts)
+            self._stats.hits += sum(1 for data in cached if data is not None)
+            self._stats.embedded_texts += len(missed)
+        return missed
+
+    def _merge(
+        self,
+        keys: list[str],
+        cached: list[Optional[bytes]],
+        embedded_by_key: dict[str, list[float]],
+    ) -> list[list[float]]:
+        """キャッシュから取得したベクトルと新たに埋め込んだベクトルを入力の順序で返します"""
+        return [
+            self._decode(data) if data is not None else embedded_by_key[key]
+            for key, data in zip(keys, cached)
+        ]
+
+    def _encode_pairs(
+        self, embedded_by_key: dict[str, list[float]]
+    ) -> list[tuple[str, bytes]]:
+        return [(key, self._encode(vector)) for key, vector in embedded_by_key.items()]
+
+    def _batches(self, texts: list[str]) -> list[list[str]]:
+        return [
+            texts[i : i + self._batch_size]
+            for i in range(0, len(texts), self._batch_size)
+        ]
+
+    def _key(self, text: str, kind: _EmbeddingKind) -> str:
+        # モデルによっては質問とドキュメントで埋め込み方が異なるため、用途もキーに含める
+        # LocalFileStoreではキーに使用できる文字が制限されているため、モデルIDの記号を置き換える
+        model_id = re.sub(r"[^a-zA-Z0-9_.\-]", "_", self._model_id)
+        dimension = self._dimension if self._dimension is not None else "default"
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return f"{model_id}/{dimension}/{kind}/{digest}"
+
+    def _encode(self, vector: list[float]) -> bytes:
+        return np.asarray(vector, dtype=np.float64).tobytes()
+
+    def _decode(self, data: bytes) -> list[float]:
+        return np.frombuffer(data, dtype=np.float64).tolist()
+
+
+def create_cached_bedrock_embeddings(
+    embedding: BedrockEmbeddings,
+    store: ByteStore,
+    scheduler: Optional[ModelCallScheduler] = None,
+) -> CachedEmbeddings:
+    """
+    BedrockEmbeddingsのモデルIDと次元数をキーに含めるCachedEmbeddingsを作成します
+
+    Args:
+        embedding (BedrockEmbeddings): キャッシュ対象の埋め込みモデル
+        store (ByteStore): 埋め込みベクトルを格納するストア
+        scheduler (Optional[ModelCallScheduler]): キャッシュにないテキストの埋め込みに使用するスケジューラ。
+            Noneの場合は1件ずつ順に埋め込む
+
+    Returns:
+        CachedEmbeddings: 作成したCachedEmbeddings
+    """
+    model_kwargs = embedding.model_kwargs or {}
+    if scheduler is None:
+        return CachedEmbeddings(
+            embedding,
+            store,
+            model_id=embedding.model_id,
+            dimension=model_kwargs.get("dimensions"),
+        )
+    # スケジューラは渡されたテキストをまとめて並行に埋め込むため、
+    # 小さなバッチに分けると、バッチごとに最後の呼び出しを待つ間の並列数が下がる
+    return CachedEmbeddings(
+        ScheduledEmbeddings(embedding, scheduler),
+        store,
+        model_id=embedding.model_id,
+        dimension=model_kwargs.get("dimensions"),
+        batch_size=1000,
+    )
@@ -0,0 +1,174 @@
+import logging
+import math
+from typing import NamedTuple, Optional
+
+from langchain_core.documents import Document
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    テキストのトークン数を見積もります
+
+    Claudeのトークナイザーはローカルで利用できないため、英数字は4文字で1トークン、
+    日本語などそれ以外の文字は1文字で1トークンとして多めに見積もる。
+    """
+    ascii_chars = len(text.encode("ascii", errors="ignore"))
+    return math.ceil(ascii_chars / 4 + (len(text) - ascii_chars))
+
+
+class ContextBudget(BaseModel):
+    """プロンプトに含める検索結果の予算"""
+
+    max_tokens: int = 4000
+    """検索結果のテキストと画像に使用できるトークン数の上限"""
+
+    image_tokens: int = 1600
+    """画像1枚あたりのトークン数の見積もり。Claude 3は約1.15メガピクセルの画像で約1600トークンを消費する"""
+
+    min_truncated_tokens: int = 200
+    """予算に収まらないチャンクを切り詰めて含める場合の最小トークン数。これを下回る場合はチャンクを含めない"""
+
+    @staticmethod
+    def for_model(model_id: str) -> "ContextBudget":
+        """モデルごとの予算を返します。未知のモデルにはデフォルトの予算を返します"""
+        for prefix, budget in MODEL_CONTEXT_BUDGETS.items():
+            if model_id.startswith(prefix):
+                return budget
+        return ContextBudget()
+
+
+MODEL_CONTEXT_BUDGETS: dict[str, ContextBudget] = {
+    # 応答速度を優先するモデルは小さめの予算にする
+    "anthropic.claude-3-haiku": ContextBudget(max_tokens=4000),
+    "anthropic.claude-3-5-sonnet": ContextBudget(max_tokens=8000),
+    "anthropic.claude-3-sonnet": ContextBudget(max_tokens=8000),
+    "anthropic.claude-3-opus": ContextBudget(max_tokens=12000),
+}
+"""モデルIDの接頭辞ごとの予算"""
+
+
+class PackingStats(BaseModel):
+    """ContextPackerによる検索結果の圧縮の結果"""
+
+    input_docs: int = 0
+    output_docs: int = 0
+    truncated_docs: int = 0
+    dropped_docs: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+
+
+class _Item(NamedTuple):
+    rank: int  # 検索結果での順位(小さいほど価値が高い)
+    doc: Document
+    tokens: int
+
+
+class ContextPacker:
+    """
+    検索結果を予算内に収まるように詰め直す
+
+    1. 検索結果の順位が高いものから予算に収まる限り含め、残りは順位の低いものから捨てる
+    2. 予算に収まらないチャンクは、残りの予算がmin_truncated_tokens以上あれば切り詰めて含める
+
+    NOTE: RerankingRetrieverが出典(URL)ごとに1つのチャンクのみを返すため、
+    同じページの隣接するチャンクをまとめる処理は行わない
+
+    チャンクのトークン数はインデックス作成時にメタデータのtoken_countに記録したものを使用し、
+    記録がない場合はその場で見積もる。
+    """
+
+    _budget: ContextBudget
+
+    def __init__(self, budget: ContextBudget):
+        """
+        ContextPackerを初期化します。
+
+        Args:
+            budget (ContextBudget): プロンプトに含める検索結果の予算
+        """
+        self._budget = budget
+
+    def pack(self, docs: list[Document]) -> list[Document]:
+        """検索結果を予算内に詰め直し、元の順位の順に返します"""
+        packed, stats = self.pack_with_stats(docs)
+        logger.info(f"検索結果を予算内に詰め直しました: {stats}")
+        return packed
+
+    def pack_with_stats(
+        self, docs: list[Document]
+    ) -> tuple[list[Document], PackingStats]:
+        """
+        検索結果を予算内に詰め直し、その結果の統計とともに返します
+
+        Args:
+            docs (list[Document]): 順位の順に並んだ検索結果
+
+        Returns:
+            tuple[list[Document], PackingStats]: 詰め直した検索結果と統計
+        """
+        items = [_Item(rank, doc, self._cost(doc)) for rank, doc in enumerate(docs)]
+        stats = PackingStats(
+            input_docs=len(items), input_tokens=sum(item.tokens for item in items)
+        )
+
+        remaining = self._budget.max_tokens
+        selected: list[_Item] = []
+        for item in items:
+            if item.tokens <= remaining:
+                selected.append(item)
+                remaining -= item.tokens
+                continue
+
+            truncated = self._truncate(item, remaining)
+            if truncated is None:
+                stats.dropped_docs += 1
+                continue
+            selected.append(truncated)
+            remaining -= truncated.tokens
+            stats.truncated_docs += 1
+
+        stats.output_docs = len(selected)
+        stats.output_tokens = sum(item.tokens for item in selected)
+        return [item.doc for item in sorted(selected, key=lambda i: i.rank)], stats
+
+    def _cost(self, doc: Document) -> int:
+        token_count = doc.metadata.get("token_count")
+        tokens = (
+            token_count
+            if isinstance(token_count, int)
+            else estimate_tokens(doc.page_content)
+        )
+        if doc.metadata.get("modality") == "image":
+            tokens += self._budget.image_tokens
+        return tokens
+
+    def _truncate(self, item: _Item, remaining_tokens: int) -> Optional[_Item]:
+        """チャンクを残りの予算に収まるよう末尾から切り詰めます。画像は切り詰めません"""
+        if (
+            item.doc.metadata.get("modality") == "image"
+            or remaining_tokens < self._budget.min_truncated_tokens
+        ):
+            return None
+
+        content = item.doc.page_content
+        # 見積もりは文字数に対しておおむね線形であるため、比率で切り詰めてから超過分を調整する
+        length = int(len(content) * remaining_tokens / max(item.tokens, 1))
+        while length > 0 and estimate_tokens(content[:length]) > remaining_tokens:
+            length = int(length * 0.9)
+        if length == 0:
+            return None
+
+        truncated = content[:length]
+        tokens = estimate_tokens(truncated)
+        return _Item(
+            rank=item.rank,
+            doc=Document(
+                page_content=truncated,
+                metadata={**item.doc.metadata, "token_count": tokens},
+            ),
+            tokens=tokens,
+        )
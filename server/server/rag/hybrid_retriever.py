@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Optional
+
+from langchain_core.documents import Document
+
+from server.rag.ingestion.lexical_index import LexicalIndex, LexicalIndexStore
+from server.rag.reranker import RetrievalCandidate
+from server.rag.reranking_retriever import RerankingRetriever
+from server.utils.concurrency import submit_in_background
+
+logger = logging.getLogger(__name__)
+
+
+class HybridRetriever(RerankingRetriever):
+    """
+    ベクトル検索と語彙検索(LexicalIndexによるBM25)の結果をReciprocal Rank Fusionで統合するRetriever
+
+    2つの検索を並行して実行し、統合した候補を再ランキングしてから上位k件(search_kwargsのk)のみを
+    ドキュメントストアから取得する。
+    語彙検索がlexical_budget_secondsを超えた場合は、待たずにベクトル検索の結果のみを使用する。
+    """
+
+    lexical_index: LexicalIndex
+    lexical_index_store: Optional[LexicalIndexStore] = None
+    """指定した場合は、更新を確認しながらこのストアのLexicalIndexを使用する。存在しない場合はlexical_indexを使用する"""
+    rrf_k: int = 60
+    """RRFのスコア 1 / (rrf_k + 順位) の定数"""
+    lexical_budget_seconds: float = 0.2
+    """検索の開始から語彙検索の完了を待つ最大の時間(秒)"""
+
+    def _search_candidates(self, query: str) -> list[RetrievalCandidate]:
+        started_at = time.perf_counter()
+        lexical_future = submit_in_background(self._lexical_search, query)
+
+        sub_docs = self.vectorstore.similarity_search(query, **self._search_kwargs())
+
+        lexical_results: Optional[list[tuple[str, float]]]
+        try:
+            lexical_results = lexical_future.result(
+                timeout=self._remaining_budget(started_at)
+            )
+        except FutureTimeoutError:
+            lexical_results = None
+
+        return self._fuse(sub_docs, lexical_results)
+
+    async def _asearch_candidates(self, query: str) -> list[RetrievalCandidate]:
+        started_at = time.perf_counter()
+        lexical_task = asyncio.wrap_future(
+            submit_in_background(self._lexical_search, query)
+        )
+
+        sub_docs = await self.vectorstore.asimilarity_search(
+            query, **self._search_kwargs()
+        )
+
+        lexical_results: Optional[list[tuple[str, float]]]
+        try:
+            lexical_results = await asyncio.wait_for(
+                lexical_task, timeout=self._remaining_budget(started_at)
+            )
+        except asyncio.TimeoutError:
+            lexical_results = None
+
+        return self._fuse(sub_docs, lexical_results)
+
+    def _lexical_search(self, query: str) -> list[tuple[str, float]]:
+        # NOTE: LexicalIndexの読み込み直しもlexical_budget_secondsの対象とするため、バックグラウンドで実行する
+        return self._current_lexical_index().search(query, self.candidate_k)
+
+    def _current_lexical_index(self) -> LexicalIndex:
+        if self.lexical_index_store is None:
+            return self.lexical_index
+        return self.lexical_index_store.current() or self.lexical_index
+
+    def _remaining_budget(self, started_at: float) -> float:
+        return max(
+            0.0, self.lexical_budget_seconds - (time.perf_counter() - started_at)
+        )
+
+    def _fuse(
+        self,
+        sub_docs: list[Document],
+        lexical_results: Optional[list[tuple[str, float]]],
+    ) -> list[RetrievalCandidate]:
+        """ベクトル検索と語彙検索の順位をRRFで統合し、統合後の順位の順に候補を返します"""
+        vector_docs = self._unique_sub_docs(sub_docs)
+
+        if lexical_results is None:
+            logger.warning(
+                f"語彙検索が{self.lexical_budget_seconds}秒以内に完了しなかったため、ベクトル検索の結果のみを使用します"
+            )
+            lexical_results = []
+        max_lexical_score = max((score for _, score in lexical_results), default=0.0)
+        lexical_scores = {
+            doc_id: score / max_lexical_score for doc_id, score in lexical_results
+        }
+
+        rrf_scores: dict[str, float] = {}
+        for ranked_ids in (list(vector_docs), list(lexical_scores)):
+            for rank, doc_id in enumerate(ranked_ids, start=1):
+                rrf_scores[doc_id] = rrf_scores.get(doc_id, 0.0) + 1 / (
+                    self.rrf_k + rank
+                )
+        fused_ids = sorted(
+            rrf_scores, key=lambda doc_id: rrf_scores[doc_id], reverse=True
+        )
+
+        candidates: list[RetrievalCandidate] = []
+        for rank, doc_id in enumerate(fused_ids):
+            sub_doc = vector_docs.get(doc_id)
+            source = (
+                sub_doc.metadata.get("url")
+                if sub_doc is not None
+                else self._current_lexical_index().source(doc_id)
+            )
+            candidates.append(
+                RetrievalCandidate(
+                    doc_id=doc_id,
+                    source=source or doc_id,
+                    text=sub_doc.page_content if sub_doc is not None else None,
+                    first_stage_score=self._rank_score(rank, len(fused_ids)),
+                    lexical_score=lexical_scores.get(doc_id),
+                )
+            )
+        return candidates
@@ -0,0 +1,207 @@
+import base64
+import logging
+from typing import Literal, NamedTuple, Optional, Sequence
+
+from pydantic import BaseModel, Field
+
+from server.rag.ingestion.image_blob_store import (
+    DEFAULT_VARIANT_LONG_EDGE,
+    ImageBlobStore,
+    downscale_image,
+)
+from server.rag.ingestion.model import DocumentMetadata, ImageDocumentMetadata
+from server.rag.model import MetadataTypedDocument
+
+logger = logging.getLogger(__name__)
+
+
+class ImageBudget(BaseModel):
+    """プロンプトに添付する画像の予算"""
+
+    max_images: int = 3
+    """添付する画像の最大数"""
+
+    max_total_bytes: int = 3 * 1024 * 1024
+    """添付する画像データの合計バイト数(Base64エンコード前)の上限"""
+
+    max_long_edge: Optional[int] = DEFAULT_VARIANT_LONG_EDGE
+    """添付する画像の長辺のピクセル数の上限。Noneの場合は元の大きさの画像を添付する"""
+
+
+class SelectedImage(BaseModel):
+    """プロンプトに添付する画像"""
+
+    rank: int
+    """検索結果での順位(Source ID)"""
+
+    url: str
+    mime_type: str
+    size_bytes: int
+
+    # NOTE: トレースに画像データ自体が記録されないよう、シリアライズの対象から除外する
+    base64: str = Field(exclude=True, repr=False)
+
+
+class SkippedImage(BaseModel):
+    """予算などの理由でプロンプトに添付しなかった画像"""
+
+    rank: int
+    url: str
+    reason: Literal["duplicate", "max_images", "max_total_bytes", "not_found"]
+
+
+class ImageSelection(BaseModel):
+    """検索結果の画像のうち、プロンプトに添付するものと添付しないもの"""
+
+    included: list[SelectedImage] = []
+    skipped: list[SkippedImage] = []
+
+
+class _Candidate(NamedTuple):
+    rank: int
+    metadata: ImageDocumentMetadata
+
+
+class ImageSelector:
+    """
+    検索結果の画像から、予算内でプロンプトに添付するものを選ぶ
+
+    画像は検索結果の順位が高いものから選び、max_images件を超えるものや、
+    合計バイト数がmax_total_bytesを超えるものは添付しない。
+    画像データはImageBlobStoreの縮小版を使用し、候補となったmax_images件のみをまとめて並行に取得する。
+    """
+
+    _image_blob_store: ImageBlobStore
+    _budget: ImageBudget
+
+    def __init__(self, image_blob_store: ImageBlobStore, budget: ImageBudget):
+        """
+        ImageSelectorを初期化します。
+
+        Args:
+            image_blob_store (ImageBlobStore): 画像データを格納するストア
+            budget (ImageBudget): プロンプトに添付する画像の予算
+        """
+        self._image_blob_store = image_blob_store
+        self._budget = budget
+
+    def select(
+        self, docs: list[MetadataTypedDocument[DocumentMetadata]]
+    ) -> ImageSelection:
+        """
+        検索結果からプロンプトに添付する画像を選びます
+
+        Args:
+            docs (list[MetadataTypedDocument[DocumentMetadata]]): 順位の順に並んだ検索結果
+
+        Returns:
+            ImageSelection: 添付する画像と添付しない画像
+        """
+        selection, candidates = self._collect_candidates(docs)
+        blob_keys = self._blob_keys(candidates)
+        loaded = (
+            self._image_blob_store.mget_variants(blob_keys, self._budget.max_long_edge)
+            if self._budget.max_long_edge is not None
+            else self._image_blob_store.mget(blob_keys)
+        )
+        return self._fill_selection(selection, candidates, dict(zip(blob_keys, loaded)))
+
+    async def aselect(
+        self, docs: list[MetadataTypedDocument[DocumentMetadata]]
+    ) -> ImageSelection:
+        """selectの非同期版"""
+        selection, candidates = self._collect_candidates(docs)
+        blob_keys = self._blob_keys(candidates)
+        loaded = (
+            await self._image_blob_store.amget_variants(
+                blob_keys, self._budget.max_long_edge
+            )
+            if self._budget.max_long_edge is not None
+            else await self._image_blob_store.amget(blob_keys)
+        )
+        return self._fill_selection(selection, candidates, dict(zip(blob_keys, loaded)))
+
+    def _collect_candidates(
+        self, docs: list[MetadataTypedDocument[DocumentMetadata]]
+    ) -> tuple[ImageSelection, list[_Candidate]]:
+        """画像の検索結果を順位の順に重複を除いて並べ、上位max_images件を候補とします"""
+        selection = ImageSelection()
+        candidates: list[_Candidate] = []
+        seen: set[str] = set()
+        for rank, doc in enumerate(docs):
+            metadata = doc.metadata
+            if not isinstance(metadata, ImageDocumentMetadata):
+                continue
+            identity = metadata.blob_key or metadata.url
+            if identity in seen:
+                selection.skipped.append(
+                    SkippedImage(rank=rank, url=metadata.url, reason="duplicate")
+                )
+                continue
+            seen.add(identity)
+
+            if len(candidates) >= self._budget.max_images:
+                selection.skipped.append(
+                    SkippedImage(rank=rank, url=metadata.url, reason="max_images")
+                )
+                continue
+            candidates.append(_Candidate(rank, metadata))
+        return selection, candidates
+
+    def _blob_keys(self, candidates: list[_Candidate]) -> list[str]:
+        return [
+            candidate.metadata.blob_key
+            for candidate in candidates
+            if candidate.metadata.base64 is None
+            and candidate.metadata.blob_key is not None
+        ]
+
+    def _fill_selection(
+        self,
+        selection: ImageSelection,
+        candidates: Sequence[_Candidate],
+        loaded: dict[str, Optional[bytes]],
+    ) -> ImageSelection:
+        total_bytes = 0
+        for rank, metadata in candidates:
+            data = self._image_data(metadata, loaded)
+            if data is None:
+                selection.skipped.append(
+                    SkippedImage(rank=rank, url=metadata.url, reason="not_found")
+                )
+                continue
+            if total_bytes + len(data) > self._budget.max_total_bytes:
+                # 順位の低い画像でも小さければ予算に収まる可能性があるため、打ち切らずに続ける
+                selection.skipped.append(
+                    SkippedImage(rank=rank, url=metadata.url, reason="max_total_bytes")
+                )
+                continue
+
+            total_bytes += len(data)
+            selection.included.append(
+                SelectedImage(
+                    rank=rank,
+                    url=metadata.url,
+                    mime_type=metadata.mime_type,
+                    size_bytes=len(data),
+                    base64=base64.b64encode(data).decode("utf-8"),
+                )
+            )
+
+        selection.skipped.sort(key=lambda image: image.rank)
+        logger.info(
+            f"プロンプトに添付する画像を選びました: 添付 {len(selection.included)}件 "
+            f"({total_bytes}バイト), 除外 {len(selection.skipped)}件"
+        )
+        return selection
+
+    def _image_data(
+        self, metadata: ImageDocumentMetadata, loaded: dict[str, Optional[bytes]]
+    ) -> Optional[bytes]:
+        # 旧形式のドキュメントのようにメタデータへ画像データが埋め込まれている場合はそれを使用する
+        if metadata.base64 is not None:
+            data = base64.b64decode(metadata.base64)
+            if self._budget.max_long_edge is None:
+                return data
+            return downscale_image(data, self._budget.max_long_edge)
+        return loaded.get(metadata.blob_key or "")
@@ -0,0 +1,49 @@
+import os
+from typing import Literal, Optional
+
+from pydantic import BaseModel
+
+from server.utils.env import getenv_or_raise
+
+
+class IndexConfig(BaseModel):
+    """
+    ベクトルストアのインデックスの設定
+
+    DocumentIndexer(インデックスの作成)とRag(検索)で同じ設定を共有し、
+    埋め込みベクトルの次元数や検索する名前空間が食い違わないようにする。
+    """
+
+    name: str
+    """インデックス名"""
+
+    dimension: int = 1024
+    """埋め込みベクトルの次元数。埋め込みモデルの出力と一致させる"""
+
+    metric: Literal["cosine", "euclidean", "dotproduct"] = "cosine"
+    """類似度の指標"""
+
+    k: int = 5
+    """検索結果としてドキュメントストアから取得するドキュメントの数"""
+
+    namespace: Optional[str] = None
+    """Pineconeの名前空間。Noneの場合はデフォルトの名前空間を使用する"""
+
+    cloud: str = "aws"
+    """サーバーレスインデックスを作成するクラウド"""
+
+    region: str = "us-east-1"
+    """サーバーレスインデックスを作成するリージョン"""
+
+    @staticmethod
+    def from_env() -> "IndexConfig":
+        """
+        環境変数からインデックスの設定を作成します
+
+        PINECONE_INDEX_NAMEは必須で、PINECONE_NAMESPACEとRAG_RETRIEVER_Kは省略できます。
+        """
+        return IndexConfig(
+            name=getenv_or_raise("PINECONE_INDEX_NAME"),
+            namespace=os.environ.get("PINECONE_NAMESPACE") or None,
+            k=int(os.environ.get("RAG_RETRIEVER_K", "5")),
+        )
@@ -0,0 +1,369 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+from langchain_core.documents import Document
+from langchain_core.stores import BaseStore
+from pydantic import BaseModel
+
+
+class DocstoreCacheConfig(BaseModel):
+    """CachedStoreの設定"""
+
+    memory_max_bytes: int = 64 * 1024 * 1024
+    """メモリ上のLRUキャッシュに保持する最大バイト数"""
+
+    disk_dir: Optional[str] = None
+    """ディスクキャッシュを配置するディレクトリ。Noneの場合はディスクキャッシュを使用しない"""
+
+    disk_max_bytes: int = 256 * 1024 * 1024
+    """ディスクキャッシュに保持する最大バイト数"""
+
+    ttl_seconds: Optional[float] = 60 * 60
+    """キャッシュの有効期間(秒)。期限切れのエントリは元のストアから再取得される。Noneの場合は無期限"""
+
+
+class CacheStats(BaseModel):
+    """CachedStoreのヒット・ミス・追い出しの回数"""
+
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    expirations: int = 0
+    memory_evictions: int = 0
+    disk_evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.memory_hits + self.disk_hits + self.misses
+        return (self.memory_hits + self.disk_hits) / total if total > 0 else 0.0
+
+
+class _MemoryCache:
+    """バイト数で容量を制限したLRUキャッシュ"""
+
+    _entries: "OrderedDict[str, Tuple[bytes, float]]"
+    _max_bytes: int
+    _current_bytes: int
+
+    def __init__(self, max_bytes: int):
+        self._entries = OrderedDict()
+        self._max_bytes = max_bytes
+        self._current_bytes = 0
+
+    def get(self, key: str) -> Optional[Tuple[bytes, float]]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def set(self, key: str, data: bytes, stored_at: float) -> int:
+        """エントリを追加し、追い出したエントリ数を返す"""
+        self.delete(key)
+        if len(data) > self._max_bytes:
+            return 0
+
+        self._entries[key] = (data, stored_at)
+        self._current_bytes += len(data)
+
+        evictions = 0
+        while self._current_bytes > self._max_bytes:
+            _, (evicted, _) = self._entries.popitem(last=False)
+            self._current_bytes -= len(evicted)
+            evictions += 1
+        return evictions
+
+    def delete(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._current_bytes -= len(entry[0])
+
+
+class _DiskCache:
+    """
+    ローカルディスク(Lambdaの/tmpなど)上のキャッシュ
+
+    ファイルの更新日時を保存日時として扱い、容量を超えた場合は古いものから削除する。
+    ファイルの読み書きはロックの外で行い、ロックは合計バイト数の管理にのみ使用する。
+    """
+
+    _dir: str
+    _max_bytes: int
+    _current_bytes: int
+    _evicting: bool
+    """他のスレッドが追い出しを行っているかどうか"""
+
+    _lock: threading.Lock
+
+    def __init__(self, directory: str, max_bytes: int):
+        os.makedirs(directory, exist_ok=True)
+        self._dir = directory
+        self._max_bytes = max_bytes
+        # ウォームスタート時は前回の呼び出しで作成されたファイルが残っている
+        self._current_bytes = sum(
+            entry.stat().st_size for entry in os.scandir(directory) if entry.is_file()
+        )
+        self._evicting = False
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Tuple[bytes, float]]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            stored_at = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return None
+        return data, stored_at
+
+    def set(self, key: str, data: bytes) -> int:
+        """エントリを追加し、追い出したエントリ数を返す"""
+        if len(data) > self._max_bytes:
+            return 0
+
+        path = self._path(key)
+        replaced_bytes = self._file_size(path)
+        # 書き込み途中のファイルを読み込まないよう、一時ファイルに書き込んでから置き換える
+        fd, tmp_path = tempfile.mkstemp(dir=self._dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._current_bytes += len(data) - replaced_bytes
+            if self._current_bytes <= self._max_bytes or self._evicting:
+                return 0
+            self._evicting = True
+        try:
+            return self._evict()
+        finally:
+            with self._lock:
+                self._evicting = False
+
+    def delete(self, key: str) -> None:
+        path = self._path(key)
+        try:
+            size = os.stat(path).st_size
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self._current_bytes -= size
+
+    def _evict(self) -> int:
+        entries: list[Tuple[float, int, str]] = []
+        total_bytes = 0
+        for entry in os.scandir(self._dir):
+            try:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_bytes += stat.st_size
+        entries.sort()
+
+        evictions = 0
+        for _, size, path in entries:
+            if total_bytes <= self._max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            total_bytes -= size
+            evictions += 1
+
+        # 他のスレッドの書き込みと重なって合計バイト数がずれた場合も、ここで実際の値に合わせる
+        with self._lock:
+            self._current_bytes = total_bytes
+        return evictions
+
+    def _file_size(self, path: str) -> int:
+        try:
+            return os.stat(path).st_size
+        except FileNotFoundError:
+            return 0
+
+    def _path(self, key: str) -> str:
+        # キーにはファイル名に使えない文字が含まれ得るため、ハッシュ値をファイル名にする
+        return os.path.join(self._dir, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+
+class CachedStore(BaseStore[str, Document]):
+    """
+    別のBaseStoreの前段に置く読み込みキャッシュ
+
+    1段目にメモリ上のLRUキャッシュ、2段目にローカルディスクのキャッシュを持ち、
+    どちらにもない場合のみ元のストアから取得する。
+    書き込みと削除は元のストアとキャッシュの両方に反映される。
+    ロックはメモリ上のキャッシュと統計の更新にのみ使用し、ディスクの読み書きは他のスレッドを待たせずに行う。
+    """
+
+    _store: BaseStore[str, Document]
+    _config: DocstoreCacheConfig
+    _memory_cache: _MemoryCache
+    _disk_cache: Optional[_DiskCache]
+    _stats: CacheStats
+    _lock: threading.Lock
+
+    def __init__(
+        self,
+        store: BaseStore[str, Document],
+        config: Optional[DocstoreCacheConfig] = None,
+    ):
+        """
+        CachedStoreを初期化します。
+
+        Args:
+            store (BaseStore[str, Document]): キャッシュ対象のストア
+            config (Optional[DocstoreCacheConfig]): キャッシュの設定
+        """
+        self._store = store
+        self._config = config or DocstoreCacheConfig()
+        self._memory_cache = _MemoryCache(self._config.memory_max_bytes)
+        self._disk_cache = (
+            _DiskCache(self._config.disk_dir, self._config.disk_max_bytes)
+            if self._config.disk_dir is not None
+            else None
+        )
+        self._stats = CacheStats()
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self) -> CacheStats:
+        """キャッシュのヒット・ミス・追い出しの回数を返します"""
+        with self._lock:
+            return self._stats.model_copy()
+
+    def mget(self, keys: Sequence[str]) -> List[Optional[Document]]:
+        """指定されたキーに関連付けられた値を、キャッシュを優先して取得します"""
+        results, missed_indices = self._mget_cached(keys)
+        if len(missed_indices) > 0:
+            fetched_docs = self._store.mget([keys[i] for i in missed_indices])
+            self._fill_missed(keys, results, missed_indices, fetched_docs)
+        return results
+
+    async def amget(self, keys: Sequence[str]) -> List[Optional[Document]]:
+        """指定されたキーに関連付けられた値を、キャッシュを優先して非同期に取得します"""
+        results, missed_indices = self._mget_cached(keys)
+        if len(missed_indices) > 0:
+            fetched_docs = await self._store.amget([keys[i] for i in missed_indices])
+            self._fill_missed(keys, results, missed_indices, fetched_docs)
+        return results
+
+    def mset(self, key_value_pairs: Sequence[Tuple[str, Document]]) -> None:
+        """指定されたキーと値のペアを元のストアとキャッシュに設定します"""
+        self._store.mset(key_value_pairs)
+        self._set_cached_many(key_value_pairs)
+
+    async def amset(self, key_value_pairs: Sequence[Tuple[str, Document]]) -> None:
+        """指定されたキーと値のペアを元のストアとキャッシュに非同期に設定します"""
+        await self._store.amset(key_value_pairs)
+        self._set_cached_many(key_value_pairs)
+
+    def mdelete(self, keys: Sequence[str]) -> None:
+        """指定されたキーを元のストアとキャッシュから削除します"""
+        self._store.mdelete(keys)
+        self._delete_cached(keys)
+
+    async def amdelete(self, keys: Sequence[str]) -> None:
+        """指定されたキーを元のストアとキャッシュから非同期に削除します"""
+        await self._store.amdelete(keys)
+        self._delete_cached(keys)
+
+    def yield_keys(self, *, prefix: Optional[str] = None) -> Iterator[str]:
+        """指定されたプレフィックスに一致するキーのイテレータを元のストアから取得します"""
+        return self._store.yield_keys(prefix=prefix)
+
+    def _mget_cached(
+        self, keys: Sequence[str]
+    ) -> Tuple[List[Optional[Document]], list[int]]:
+        """キャッシュから取得した結果と、キャッシュにない要素の位置を返します"""
+        results: List[Optional[Document]] = [None] * len(keys)
+        missed_indices: list[int] = []
+
+        for i, key in enumerate(keys):
+            data = self._get_cached(key)
+            if data is None:
+                missed_indices.append(i)
+            else:
+                results[i] = self._deserialize(data)
+
+        return results, missed_indices
+
+    def _fill_missed(
+        self,
+        keys: Sequence[str],
+        results: List[Optional[Document]],
+        missed_indices: list[int],
+        fetched_docs: List[Optional[Document]],
+    ) -> None:
+        """元のストアから取得した結果をresultsに反映し、キャッシュに追加します"""
+        for i, doc in zip(missed_indices, fetched_docs):
+            results[i] = doc
+            if doc is not None:
+                self._set_cached(keys[i], self._serialize(doc))
+
+    def _get_cached(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._memory_cache.get(key)
+            if entry is not None and not self._is_expired(entry[1]):
+                self._stats.memory_hits += 1
+                return entry[0]
+
+        if self._disk_cache is not None:
+            entry = self._disk_cache.get(key)
+            if entry is not None and not self._is_expired(entry[1]):
+                with self._lock:
+                    self._stats.disk_hits += 1
+                    # ディスクでヒットしたものはメモリに昇格させる
+                    self._stats.memory_evictions += self._memory_cache.set(
+                        key, entry[0], entry[1]
+                    )
+                return entry[0]
+
+        with self._lock:
+            if entry is not None:
+                self._stats.expirations += 1
+            self._stats.misses += 1
+        return None
+
+    def _set_cached(self, key: str, data: bytes) -> None:
+        with self._lock:
+            self._stats.memory_evictions += self._memory_cache.set(
+                key, data, time.time()
+            )
+        if self._disk_cache is not None:
+            disk_evictions = self._disk_cache.set(key, data)
+            with self._lock:
+                self._stats.disk_evictions += disk_evictions
+
+    def _set_cached_many(self, key_value_pairs: Sequence[Tuple[str, Document]]) -> None:
+        for key, doc in key_value_pairs:
+            self._set_cached(key, self._serialize(doc))
+
+    def _delete_cached(self, keys: Sequence[str]) -> None:
+        with self._lock:
+            for key in keys:
+                self._memory_cache.delete(key)
+        if self._disk_cache is not None:
+            for key in keys:
+                self._disk_cache.delete(key)
+
+    def _is_expired(self, stored_at: float) -> bool:
+        if self._config.ttl_seconds is None:
+            return False
+        return time.time() - stored_at > self._config.ttl_seconds
+
+    def _serialize(self, doc: Document) -> bytes:
+        return doc.json().encode("utf-8")
+
+    def _deserialize(self, data: bytes) -> Document:
+        return Document(**json.loads(data.decode("utf-8")))
@@ -1,50 +1,215 @@
-import uuid
-from typing import Any
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import ExitStack
+from typing import Any, Optional, Sequence
 
 from langchain.retrievers.multi_vector import MultiVectorRetriever
 from langchain_core.documents import Document
 from langchain_core.embeddings import Embeddings
+from pydantic import BaseModel
 
-from server.rag.retriever import create_retriever
+from server.rag.index_config import IndexConfig
+from server.rag.ingestion.image_blob_store import create_image_blob_store
+from server.rag.ingestion.index_manifest import (
+    IndexCheckpoint,
+    IndexingDiff,
+    IndexManifest,
+    IndexManifestStore,
+    ManifestEntry,
+    assign_doc_ids,
+    create_index_manifest_store,
+    diff_manifest,
+    manifest_digest,
+)
+from server.rag.ingestion.index_version import (
+    IndexVersionStore,
+    create_index_version_store,
+)
+from server.rag.ingestion.lexical_index import (
+    LexicalIndex,
+    LexicalIndexStore,
+    create_lexical_index_store,
+)
+from server.rag.ingestion.local_vectorstore import LocalVectorStore
+from server.rag.ingestion.pinecone_index import PineconeIndexResolver
+from server.rag.retriever import (
+    DocstoreBackend,
+    VectorstoreBackend,
+    create_retriever,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class IndexWriteConfig(BaseModel):
+    """DocumentIndexerがチャンクを埋め込んで格納する際の設定"""
+
+    batch_size: int = 128
+    """まとめて埋め込み、ベクトルストアとドキュメントストアに書き込むチャンクの数"""
+
+    embedding_workers: int = 4
+    """並行に埋め込んでベクトルストアに書き込むバッチの数"""
+
+    upsert_batch_size: int = 64
+    """
+    Pineconeへの1回のupsertに含めるベクトルの数
+
+    1つのバッチのupsertは、この件数ずつPineconeのクライアントのスレッドプールで並行に行われる
+    """
+
+    docstore_batch_size: int = 512
+    """
+    ドキュメントストアにまとめて書き込むチャンクの数
+
+    PackedS3Storeは1回のmsetで新しいシャードを作成してインデックスを書き直すため、
+    埋め込みのバッチごとに書き込むとシャードが小さくなり、インデックスの書き直しも増える。
+    ドキュメントストアへの書き込みは1つのスレッドで順に行う
+    """
+
+    checkpoint_interval_seconds: float = 30
+    """格納済みのチャンクをチェックポイントとして保存する間隔(秒)"""
+
+
+class IndexWriteStats(BaseModel):
+    """IndexingSessionで埋め込んで格納したチャンクの数と所要時間"""
+
+    written: int = 0
+    """埋め込んでベクトルストアとドキュメントストアに格納したチャンクの数"""
+
+    resumed: int = 0
+    """中断した前回の実行で格納済みのため、チェックポイントから再開して書き込みを省略したチャンクの数"""
+
+    batches: int = 0
+    """埋め込んでベクトルストアに書き込んだバッチの数"""
+
+    docstore_writes: int = 0
+    """ドキュメントストアへの書き込み(msetの呼び出し)の回数"""
+
+    vectorstore_seconds: float = 0.0
+    """埋め込みとベクトルストアへの書き込みにかかった時間の合計(秒)"""
+
+    docstore_seconds: float = 0.0
+    """ドキュメントストアへの書き込みにかかった時間の合計(秒)"""
+
+    elapsed_seconds: float = 0.0
+    """最初のチャンクを追加してから、すべての書き込みが完了するまでの時間(秒)"""
+
+    @property
+    def chunks_per_second(self) -> float:
+        return self.written / self.elapsed_seconds if self.elapsed_seconds > 0 else 0.0
 
 
 class DocumentIndexer:
-    _index_name: str
+    """
+    ドキュメントをベクトルストア・ドキュメントストア・語彙検索用のインデックスに格納する
+
+    チャンクには出典のURLと内容から決定的なIDを割り当て、格納したチャンクの一覧をマニフェストとして保存する。
+    次回以降は前回のマニフェストと比較し、追加・変更されたチャンクのみを埋め込んで格納し、
+    なくなったチャンクを削除する。
+    """
+
+    _index_config: IndexConfig
     _bucket_name: str
     _embedding: Embeddings
     _id_key: str = "doc_id"  # TODO: 外部から指定できるようにするか検討
     _retriever: MultiVectorRetriever
+    _index_version_store: IndexVersionStore
+    _lexical_index_store: LexicalIndexStore
+    _lexical_index: LexicalIndex
+    _manifest_store: IndexManifestStore
+    _manifest: IndexManifest
+    _checkpoint: Optional[IndexCheckpoint]
+    _write_config: IndexWriteConfig
 
     def __init__(
         self,
         *,
-        index_name: str,
+        index_config: IndexConfig,
         bucket_name: str,
         embedding: Embeddings,
         refresh: bool = False,
         force_create_index: bool = False,
+        docstore_backend: DocstoreBackend = "s3",
+        vectorstore_backend: VectorstoreBackend = "pinecone",
+        index_resolver: Optional[PineconeIndexResolver] = None,
+        write_config: Optional[IndexWriteConfig] = None,
     ):
-        self._index_name = index_name
+        self._index_config = index_config
+        self._write_config = write_config or IndexWriteConfig()
         self._bucket_name = bucket_name
         self._embedding = embedding
 
         self._retriever = create_retriever(
-            index_name=self._index_name,
+            index_config=self._index_config,
             bucket_name=self._bucket_name,
             embedding=self._embedding,
             id_key=self._id_key,
             refresh=refresh,
             force_create_index=force_create_index,
+            image_blob_store=create_image_blob_store(self._bucket_name),
+            docstore_backend=docstore_backend,
+            vectorstore_backend=vectorstore_backend,
+            index_resolver=index_resolver,
         )
+        self._index_version_store = create_index_version_store(self._bucket_name)
+
+        # 語彙検索用のインデックスはベクトルストアと同じドキュメントを対象に、追記して更新する
+        self._lexical_index_store = create_lexical_index_store(self._bucket_name)
+        self._lexical_index = (
+            None if refresh else self._lexical_index_store.load()
+        ) or LexicalIndex()
+
+        # refreshの場合は格納済みのデータを削除したため、前回のマニフェストは使用しない
+        self._manifest_store = create_index_manifest_store(self._bucket_name)
+        self._manifest = (
+            None if refresh else self._manifest_store.load()
+        ) or IndexManifest()
+        # 前回の実行が中断していた場合は、格納済みのチャンクを書き込み直さずに再開する
+        self._checkpoint = None if refresh else self._manifest_store.load_checkpoint()
+        if self._checkpoint is not None and self._checkpoint.base_manifest != (
+            manifest_digest(self._manifest)
+        ):
+            logger.info(
+                "マニフェストが更新されているため、チェックポイントを使用しません"
+            )
+            self._checkpoint = None
+
+    def index(
+        self, documents: list[Document], keep_urls: Sequence[str] = ()
+    ) -> IndexingDiff:
+        """
+        前回の索引作成時との差分のみをインデックスに反映します
+
+        Args:
+            documents (list[Document]): 今回の索引作成の対象となるすべてのチャンク
+            keep_urls (Sequence[str]): 一時的に取得できなかったページなど、documentsに含まれなくても
+                前回のチャンクを削除せずに残すURL
 
-    def index(self, documents: list[Document]) -> None:
-        doc_ids = [str(uuid.uuid4()) for _ in documents]
-        id_doc_pairs = list(zip(doc_ids, documents))
+        Returns:
+            IndexingDiff: 前回の索引作成時からの差分
+        """
+        with self.begin() as session:
+            session.add(documents)
+            return session.commit(keep_urls)
 
-        # 各ドキュメントをベクトルDBとドキュメントストアそれぞれに格納
+    def begin(self) -> "IndexingSession":
+        """
+        チャンクを少しずつ追加して索引を作成するIndexingSessionを開始します
+
+        すべてのチャンクを一度に渡すindexと異なり、前処理が済んだチャンクから順に埋め込んで格納できるため、
+        コーパス全体をメモリに保持する必要がありません。
+
+        Returns:
+            IndexingSession: 今回の索引作成のセッション。withブロックで使用する
+        """
+        return IndexingSession(self, self._write_config, self._checkpoint)
+
+    def _write_vectors(self, id_doc_pairs: list[tuple[str, Document]]) -> None:
         # ベクトルDBにはドキュメントに対する埋め込みベクトルを作成して格納
-        # ドキュメントストアには生のドキュメントを格納
-        # ベクトルDBのデータとドキュメントストアのデータは doc_id で紐づけられる
+        # ベクトルDBのデータとドキュメントストアのデータは doc_id で紐づけられ、
+        # 差分の削除のためにベクトルのIDにも doc_id を使用する
         self._retriever.vectorstore.add_documents(
             [
                 Document(
@@ -55,10 +220,74 @@ class DocumentIndexer:
                     },
                 )
                 for doc_id, doc in id_doc_pairs
-            ]
+            ],
+            ids=[doc_id for doc_id, _ in id_doc_pairs],
+            batch_size=self._write_config.upsert_batch_size,
         )
+
+    def _write_documents(self, id_doc_pairs: list[tuple[str, Document]]) -> None:
+        # ドキュメントストアには生のドキュメントを格納
         self._retriever.docstore.mset(id_doc_pairs)
 
+    def _add_lexical(self, id_doc_pairs: list[tuple[str, Document]]) -> None:
+        self._lexical_index.add(
+            [doc_id for doc_id, _ in id_doc_pairs],
+            [doc.page_content for _, doc in id_doc_pairs],
+            [doc.metadata.get("url", doc_id) for doc_id, doc in id_doc_pairs],
+        )
+
+    def _delete(self, ids: list[str]) -> None:
+        self._retriever.vectorstore.delete(ids=ids)
+        self._retriever.docstore.mdelete(ids)
+        self._lexical_index.delete(ids)
+
+    def _save_checkpoint(self, written: list[str]) -> None:
+        self._manifest_store.save_checkpoint(
+            IndexCheckpoint(
+                base_manifest=manifest_digest(self._manifest), written=written
+            )
+        )
+
+    def _commit(
+        self,
+        entries: dict[str, ManifestEntry],
+        keep_urls: Sequence[str],
+        stale_ids: Sequence[str] = (),
+    ) -> IndexingDiff:
+        kept_urls = set(keep_urls)
+        manifest = IndexManifest(
+            entries={
+                **{
+                    doc_id: entry
+                    for doc_id, entry in self._manifest.entries.items()
+                    if entry.url in kept_urls
+                },
+                **entries,
+            }
+        )
+        diff = diff_manifest(self._manifest, manifest)
+        logger.info(f"前回の索引作成時からの差分: {diff.summary()}")
+        # 中断した前回の実行で格納したが、今回は対象とならなかったチャンクはマニフェストに含まれないため個別に削除する
+        if len(stale_ids) > 0:
+            self._delete(list(stale_ids))
+        if not diff.has_changes and len(stale_ids) == 0:
+            self._manifest_store.delete_checkpoint()
+            return diff
+
+        if len(diff.removed) > 0:
+            self._delete(diff.removed)
+        self._lexical_index_store.save(self._lexical_index)
+
+        # マニフェストはすべての書き込みが完了してから保存し、途中で失敗した場合は次回に再試行する
+        self._manifest_store.save(manifest)
+        self._manifest = manifest
+        self._manifest_store.delete_checkpoint()
+        self._checkpoint = None
+
+        # インデックスの内容が変わったため、検索結果に依存するキャッシュを無効にする
+        self._index_version_store.bump()
+        return diff
+
     def _shrink_metadata(self, metadata: dict[str, Any]) -> dict[str, Any]:
         # NOTE: Pineconeのメタデータの最大サイズは40KBである
         # base64の値はサイズが大きく、メタデータの最大サイズを超えることがあるため除外する
@@ -67,3 +296,256 @@ class DocumentIndexer:
             key: value for key, value in metadata.items() if key != "base64"
         }
         return new_metadata
+
+
+class IndexingSession:
+    """
+    DocumentIndexerにチャンクを少しずつ追加し、最後に差分をまとめて反映する1回の索引作成
+
+    addでは前回のマニフェストに含まれないチャンクのみをバッチに分け、スレッドプールで並行に埋め込んで
+    ベクトルストアに書き込む。ベクトルストアに書き込んだバッチはdocstore_batch_size件まで溜めてから、
+    1つのスレッドでドキュメントストアにまとめて書き込み、その間に次のバッチの埋め込みを進める。
+    PackedS3Storeのインデックスの更新は読み込み・変更・書き込みで行うため、ドキュメントストアへの書き込みは並行に行わない。
+    書き込み中のバッチの数には上限があり、上限に達するとaddは待つ。
+    commitで今回のマニフェストを前回と比較し、なくなったチャンクの削除とマニフェストの保存を行う。
+    チャンクのIDはaddの呼び出しをまたいで割り当てるため、indexにすべてのチャンクを渡した場合と同じになる。
+
+    格納済みのチャンクのIDは一定の間隔でチェックポイントとして保存し、
+    途中で失敗した場合は次回の実行で格納済みのチャンクを書き込み直さずに再開する。
+    """
+
+    _indexer: DocumentIndexer
+    _config: IndexWriteConfig
+    _entries: dict[str, ManifestEntry]
+    _occurrences: dict[tuple[str, str], int]
+    _resumed: set[str]
+    """チェックポイントに記録されていた、格納済みのチャンクのID"""
+
+    _written: list[str]
+    _pending_documents: list[tuple[str, Document]]
+    """ベクトルストアに書き込み済みで、ドキュメントストアへの書き込みを待っているチャンク"""
+
+    _lock: threading.Lock
+    _checkpoint_lock: threading.Lock
+    _last_checkpoint_at: float
+    _in_flight: threading.Semaphore
+    _vectorstore_executor: ThreadPoolExecutor
+    _docstore_executor: ThreadPoolExecutor
+    _futures: list[Future]
+    _exit_stack: ExitStack
+    _started_at: Optional[float]
+    _committed: bool
+    stats: IndexWriteStats
+
+    def __init__(
+        self,
+        indexer: DocumentIndexer,
+        config: IndexWriteConfig,
+        checkpoint: Optional[IndexCheckpoint] = None,
+    ):
+        self._indexer = indexer
+        self._config = config
+        self._entries = {}
+        self._occurrences = {}
+        self._resumed = set(checkpoint.written) if checkpoint is not None else set()
+        self._written = list(self._resumed)
+        self._lock = threading.Lock()
+        self._checkpoint_lock = threading.Lock()
+        self._last_checkpoint_at = time.monotonic()
+        self._in_flight = threading.Semaphore(config.embedding_workers * 2)
+        self._vectorstore_executor = ThreadPoolExecutor(
+            max_workers=config.embedding_workers, thread_name_prefix="index-vectorstore"
+        )
+        self._docstore_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="index-docstore"
+        )
+        self._pending_documents = []
+        self._futures = []
+        self._started_at = None
+        self._committed = False
+        self.stats = IndexWriteStats()
+        if len(self._resumed) > 0:
+            logger.info(
+                f"中断した前回の索引作成を再開します: 格納済みのチャンク {len(self._resumed)}件"
+            )
+
+        # LocalVectorStoreは書き込みのたびにファイル全体を書き直すため、チェックポイントとcommitの時にまとめて書き出す
+        self._exit_stack = ExitStack()
+        vectorstore = indexer._retriever.vectorstore
+        if isinstance(vectorstore, LocalVectorStore):
+            self._exit_stack.enter_context(vectorstore.deferred_writes())
+
+    def __enter__(self) -> "IndexingSession":
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+    def add(self, documents: Sequence[Document]) -> int:
+        """
+        チャンクを今回の索引作成の対象に加え、追加・変更されたチャンクの書き込みを開始します
+
+        書き込みは非同期に行われ、失敗した場合は以降のadd・flush・commitの呼び出しで例外を送出します。
+
+        Args:
+            documents (Sequence[Document]): 追加するチャンク。indexにまとめて渡す場合と同じ順序で渡す
+
+        Returns:
+            int: 書き込みを開始したチャンクの数
+        """
+        self._raise_if_failed()
+        if self._started_at is None:
+            self._started_at = time.perf_counter()
+
+        assigned = assign_doc_ids(documents, self._occurrences)
+        self._entries.update(assigned)
+        previous = self._indexer._manifest.entries
+        id_doc_pairs = [
+            (doc_id, doc)
+            for (doc_id, _), doc in zip(assigned, documents)
+            if doc_id not in previous
+        ]
+        if len(id_doc_pairs) == 0:
+            return 0
+
+        # 語彙検索用のインデックスはcommitの時に保存するため、再開した場合も格納済みのチャンクを追加する
+        self._indexer._add_lexical(id_doc_pairs)
+        pending = [
+            (doc_id, doc) for doc_id, doc in id_doc_pairs if doc_id not in self._resumed
+        ]
+        self.stats.resumed += len(id_doc_pairs) - len(pending)
+
+        for i in range(0, len(pending), self._config.batch_size):
+            batch = pending[i : i + self._config.batch_size]
+            self._in_flight.acquire()
+            future = self._vectorstore_executor.submit(self._write_vectors, batch)
+            with self._lock:
+                self._futures.append(future)
+        return len(pending)
+
+    def flush(self) -> None:
+        """
+        書き込み中のバッチがすべて完了するまで待ち、溜めているチャンクをドキュメントストアに書き込んで、
+        チェックポイントを保存します
+        """
+        try:
+            while True:
+                with self._lock:
+                    futures = [future for future in self._futures if not future.done()]
+                if len(futures) == 0:
+                    break
+                wait(futures)
+            self._docstore_executor.submit(self._write_documents).result()
+        finally:
+            self._save_checkpoint(blocking=True)
+            if self._started_at is not None:
+                self.stats.elapsed_seconds = time.perf_counter() - self._started_at
+        self._raise_if_failed()
+
+    def commit(self, keep_urls: Sequence[str] = ()) -> IndexingDiff:
+        """
+        書き込みの完了を待ってなくなったチャンクを削除し、今回のマニフェストを保存します
+
+        Args:
+            keep_urls (Sequence[str]): 一時的に取得できなかったページなど、追加したチャンクに含まれなくても
+                前回のチャンクを削除せずに残すURL
+
+        Returns:
+            IndexingDiff: 前回の索引作成時からの差分
+        """
+        self.flush()
+        logger.info(
+            f"チャンクの格納が完了しました: {self.stats.written}件 "
+            f"(再開により省略 {self.stats.resumed}件), "
+            f"{self.stats.chunks_per_second:.1f}件/秒"
+        )
+        stale_ids = [doc_id for doc_id in self._resumed if doc_id not in self._entries]
+        diff = self._indexer._commit(self._entries, keep_urls, stale_ids)
+        self._committed = True
+        return diff
+
+    def close(self) -> None:
+        """
+        書き込み中のバッチの完了を待ち、スレッドプールを終了します
+
+        commitせずに終了した場合は、次回の実行で再開できるようチェックポイントを保存します。
+        """
+        self._vectorstore_executor.shutdown()
+        self._docstore_executor.shutdown()
+        if not self._committed:
+            self._save_checkpoint(blocking=True)
+        self._exit_stack.close()
+
+    def _write_vectors(self, batch: list[tuple[str, Document]]) -> None:
+        try:
+            start = time.perf_counter()
+            self._indexer._write_vectors(batch)
+            with self._lock:
+                self.stats.vectorstore_seconds += time.perf_counter() - start
+                self.stats.batches += 1
+                # このスレッドが次のバッチを埋め込む間に、ドキュメントストアの書き込みを待つチャンクに加える
+                self._futures.append(
+                    self._docstore_executor.submit(self._buffer_documents, batch)
+                )
+        except BaseException:
+            self._in_flight.release()
+            raise
+
+    def _buffer_documents(self, batch: list[tuple[str, Document]]) -> None:
+        # NOTE: ドキュメントストアのスレッドで実行するため、ドキュメントストアへの書き込みと並行しない
+        try:
+            self._pending_documents.extend(batch)
+        finally:
+            # 溜めたチャンクの数はdocstore_batch_sizeで抑えられるため、書き込み中のバッチの数には含めない
+            self._in_flight.release()
+        if len(self._pending_documents) >= self._config.docstore_batch_size:
+            self._write_documents()
+
+    def _write_documents(self) -> None:
+        # NOTE: ドキュメントストアのスレッドで実行する
+        pending, self._pending_documents = self._pending_documents, []
+        if len(pending) == 0:
+            return
+        start = time.perf_counter()
+        self._indexer._write_documents(pending)
+        with self._lock:
+            self.stats.docstore_seconds += time.perf_counter() - start
+            self.stats.written += len(pending)
+            self.stats.docstore_writes += 1
+            self._written.extend(doc_id for doc_id, _ in pending)
+            due = (
+                time.monotonic() - self._last_checkpoint_at
+                >= self._config.checkpoint_interval_seconds
+            )
+        if due:
+            self._save_checkpoint()
+
+    def _save_checkpoint(self, blocking: bool = False) -> None:
+        # 定期的な保存は、他のスレッドが保存している場合はそのチェックポイントに任せる
+        if not self._checkpoint_lock.acquire(blocking=blocking):
+            return
+        try:
+            with self._lock:
+                written = list(self._written)
+                self._last_checkpoint_at = time.monotonic()
+            if len(written) == len(self._resumed):
+                return
+            # チェックポイントに記録するチャンクは、ベクトルストアにも書き出し済みでなければならない
+            vectorstore = self._indexer._retriever.vectorstore
+            if isinstance(vectorstore, LocalVectorStore):
+                vectorstore.flush()
+            self._indexer._save_checkpoint(written)
+        finally:
+            self._checkpoint_lock.release()
+
+    def _raise_if_failed(self) -> None:
+        with self._lock:
+            # 成功したバッチは以降確認する必要がないため取り除く
+            self._futures = [
+                future
+                for future in self._futures
+                if not future.done() or future.exception() is not None
+            ]
+            failed = [future for future in self._futures if future.done()]
+        if len(failed) > 0:
+            raise failed[0].exception()  # type: ignore
@@ -1,51 +1,197 @@
-from typing import Sequence
+from typing import Iterable, Iterator, Optional, Sequence, TypeVar
 
-from langchain_community.document_loaders import (
-    MergedDataLoader,
-    RecursiveUrlLoader,
-)
 from langchain_community.document_transformers import (
     MarkdownifyTransformer,
 )
 from langchain_core.documents.base import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+from pydantic import BaseModel
 
+from server.rag.ingestion.document_transform_pool import (
+    DocumentTransformConfig,
+    DocumentTransformPool,
+)
 from server.rag.ingestion.extract_image_converter import ExtractImageConvertor
-from server.rag.ingestion.image_describer import describe_images
+from server.rag.ingestion.image_describer import (
+    ImageDescriber,
+    ImageDescriptionCache,
+    ImageDescriptionStats,
+)
+from server.rag.ingestion.image_fetcher import (
+    ImageFetchCache,
+    ImageFetcher,
+    ImageFetchStats,
+)
+from server.rag.ingestion.image_normalizer import (
+    ImageNormalizationConfig,
+    ImageNormalizationStats,
+    ImageNormalizer,
+)
 from server.rag.ingestion.model import DocumentMetadataFactory, _ImageMetadata
-from server.rag.model import MetadataTypedDocument
+from server.rag.ingestion.model_call_scheduler import ModelCallScheduler
+from server.rag.ingestion.web_crawler import (
+    AsyncWebCrawler,
+    CrawlerConfig,
+    CrawlStats,
+)
 
 
 class DocumentPreprocessor:
-    _document_loader: MergedDataLoader
+    _crawler: AsyncWebCrawler
+    _image_fetcher: ImageFetcher
+    _image_normalizer: ImageNormalizer
+    _image_describer: ImageDescriber
+    _image_convertor: ExtractImageConvertor
+    _transformer: MarkdownifyTransformer
     _text_splitter: RecursiveCharacterTextSplitter
+    _transform_pool: DocumentTransformPool
 
-    def __init__(self, crawling_root_urls: list[str]):
-        recursive_url_loaders = [
-            RecursiveUrlLoader(
-                url=url,
-                max_depth=5,
-                prevent_outside=True,
-            )
-            for url in crawling_root_urls
-        ]
-        self._document_loader = MergedDataLoader(
-            loaders=recursive_url_loaders,
+    _image_fetch_stats: ImageFetchStats
+    _image_normalization_stats: ImageNormalizationStats
+    _image_description_stats: ImageDescriptionStats
+
+    def __init__(
+        self,
+        crawling_root_urls: list[str],
+        crawler_config: Optional[CrawlerConfig] = None,
+        image_fetch_cache: Optional[ImageFetchCache] = None,
+        image_description_cache: Optional[ImageDescriptionCache] = None,
+        model_call_scheduler: Optional[ModelCallScheduler] = None,
+        image_normalization_config: Optional[ImageNormalizationConfig] = None,
+        transform_config: Optional[DocumentTransformConfig] = None,
+    ):
+        """
+        DocumentPreprocessorを初期化します。
+
+        Args:
+            crawling_root_urls (list[str]): クローリングを開始するURL
+            crawler_config (Optional[CrawlerConfig]): クローラーの設定。Noneの場合はHTTPキャッシュを使用しない
+            image_fetch_cache (Optional[ImageFetchCache]): ダウンロードした画像のキャッシュ。Noneの場合はキャッシュしない
+            image_description_cache (Optional[ImageDescriptionCache]): 画像の説明のキャッシュ。Noneの場合はキャッシュしない
+            model_call_scheduler (Optional[ModelCallScheduler]): 画像の説明の生成に使用するスケジューラ。Noneの場合はデフォルトの設定で作成する
+            image_normalization_config (Optional[ImageNormalizationConfig]): 画像の正規化の設定。Noneの場合はデフォルトの設定を使用する
+            transform_config (Optional[DocumentTransformConfig]): Markdownへの変換・画像URLの抽出・チャンクへの分割を並列に行う設定。
+                Noneの場合はデフォルトの設定を使用する
+        """
+        self._crawler = AsyncWebCrawler(crawling_root_urls, crawler_config)
+        self._image_fetcher = ImageFetcher(cache=image_fetch_cache)
+        self._image_normalizer = ImageNormalizer(image_normalization_config)
+        self._image_describer = ImageDescriber(
+            cache=image_description_cache, scheduler=model_call_scheduler
         )
 
+        self._image_convertor = ExtractImageConvertor(image_fetcher=self._image_fetcher)
+
+        self._transformer = MarkdownifyTransformer()
         self._text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000, chunk_overlap=200
+            chunk_size=1000, chunk_overlap=200, add_start_index=True
         )
+        self._transform_pool = DocumentTransformPool(
+            self._transformer, self._text_splitter, transform_config
+        )
+
+        self._image_fetch_stats = ImageFetchStats()
+        self._image_normalization_stats = ImageNormalizationStats()
+        self._image_description_stats = ImageDescriptionStats()
+
+    @property
+    def crawl_stats(self) -> CrawlStats:
+        """直近のクローリングの統計"""
+        return self._crawler.stats
+
+    @property
+    def image_fetch_stats(self) -> ImageFetchStats:
+        """直近のクローリングで取得したページに含まれる画像のダウンロードの統計"""
+        return self._image_fetch_stats
+
+    @property
+    def image_normalization_stats(self) -> ImageNormalizationStats:
+        """直近のクローリングで取得したページに含まれる画像の正規化の統計"""
+        return self._image_normalization_stats
+
+    @property
+    def image_description_stats(self) -> ImageDescriptionStats:
+        """直近のクローリングで取得したページに含まれる画像の説明の生成の統計"""
+        return self._image_description_stats
+
+    def __enter__(self) -> "DocumentPreprocessor":
+        """withブロックを抜けるまで、ドキュメントの変換と画像の正規化に使用するプロセスプールを使い回します"""
+        self._transform_pool.__enter__()
+        self._image_normalizer.__enter__()
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self._image_normalizer.__exit__(*args)
+        self._transform_pool.__exit__(*args)
 
     def preprocess(self) -> list[Document]:
-        html_docs = self._document_loader.load()
+        """
+        すべてのページを取得し、チャンクに分割して返します
+
+        各段階をすべてのページについて順に行うため、サイト全体のページとチャンクをメモリに保持します。
+        大きなサイトではIngestionPipelineで各段階を並行に実行してください。
+        """
+        # クローラーは取得できたページから順に返すため、残りのページの取得と並行してMarkdownに変換する
+        markdown_docs = self.to_markdown(self.crawl())
+        pages, images = self.extract_images(markdown_docs)
+        return self.split(pages + self.describe_images(images))
+
+    def crawl(self) -> Iterator[Document]:
+        """
+        ページを取得できた順に、HTMLのドキュメントを返します
 
-        transformer = MarkdownifyTransformer()
-        markdown_docs = transformer.transform_documents(html_docs)
+        画像の統計と、処理済みの画像の記録はクローリングを開始した時点でリセットします。
+        """
+        self._image_convertor.reset()
+        self._image_fetch_stats = ImageFetchStats()
+        self._image_normalization_stats = ImageNormalizationStats()
+        self._image_description_stats = ImageDescriptionStats()
+        yield from self._crawler.lazy_load()
 
-        image_docs = self._extract_image_descriptions(markdown_docs)
+    def to_markdown(self, docs: Iterable[Document]) -> list[Document]:
+        """
+        HTMLのドキュメントを、プロセスプールで並列にMarkdownに変換します
 
-        markdown_docs_with_converted_metadata = [
+        Args:
+            docs (Iterable[Document]): HTMLのドキュメント。crawlのジェネレーターを渡すと取得と並行して変換する
+
+        Returns:
+            list[Document]: docsと同じ順序の、Markdownに変換したドキュメント
+        """
+        return self._transform_pool.to_markdown(docs)
+
+    def extract_images(
+        self, docs: Sequence[Document]
+    ) -> tuple[list[Document], list[_ImageMetadata]]:
+        """
+        Markdownのドキュメントに含まれる画像をダウンロードして正規化します
+
+        Args:
+            docs (Sequence[Document]): Markdownに変換したページ
+
+        Returns:
+            tuple[list[Document], list[_ImageMetadata]]: メタデータを変換したページと、
+                今回のクローリングで初めて現れた画像
+        """
+        image_docs = self._image_convertor.convert_documents(
+            docs, self._transform_pool.extract_image_urls(docs)
+        )
+        # 以降のページに同じ画像が含まれていても、ダウンロードや説明の生成を繰り返さない
+        self._image_convertor.release_images()
+        self._image_fetch_stats = _add_stats(
+            self._image_fetch_stats, self._image_fetcher.stats
+        )
+        image_metadata_set: set[_ImageMetadata] = set()
+        for doc in image_docs:
+            image_metadata_set.update(doc.images)
+
+        # 説明の生成と検索時のプロンプトの両方で、正規化した画像を使用する
+        images = self._image_normalizer.normalize_all(list(image_metadata_set))
+        self._image_normalization_stats = _add_stats(
+            self._image_normalization_stats, self._image_normalizer.stats
+        )
+
+        pages = [
             doc.model_copy(
                 update={
                     "metadata": DocumentMetadataFactory.from_web_page(
@@ -53,9 +199,25 @@ class DocumentPreprocessor:
                     ).model_dump()
                 }
             )
-            for doc in markdown_docs
+            for doc in docs
         ]
-        image_docs_with_converted_metadata = [
+        return pages, images
+
+    def describe_images(self, images: list[_ImageMetadata]) -> list[Document]:
+        """
+        画像の説明を生成し、説明を本文とするドキュメントを返します
+
+        Args:
+            images (list[_ImageMetadata]): extract_imagesで正規化した画像
+
+        Returns:
+            list[Document]: 説明を生成できた画像のドキュメント
+        """
+        image_docs = self._image_describer.describe(images)
+        self._image_description_stats = _add_stats(
+            self._image_description_stats, self._image_describer.stats
+        )
+        return [
             Document(
                 page_content=doc.page_content,
                 metadata=DocumentMetadataFactory.from_image(
@@ -65,26 +227,30 @@ class DocumentPreprocessor:
             for doc in image_docs
         ]
 
-        all_docs = (
-            markdown_docs_with_converted_metadata + image_docs_with_converted_metadata
-        )
+    def split(self, docs: Sequence[Document]) -> list[Document]:
+        """
+        ページと画像のドキュメントを、プロセスプールで並列にチャンクに分割します
 
-        splitted_docs = self._text_splitter.split_documents(all_docs)
+        検索時にプロンプトの大きさを見積もれるよう、チャンクごとのトークン数をメタデータに記録します。
 
-        return splitted_docs
+        Args:
+            docs (Sequence[Document]): extract_imagesとdescribe_imagesで作成したドキュメント
 
-    def _extract_image_descriptions(
-        self, docs: Sequence[Document]
-    ) -> list[MetadataTypedDocument[_ImageMetadata]]:
-        image_convertor = ExtractImageConvertor()
-        image_docs = image_convertor.convert_documents(docs)
-        image_metadata_set: set[_ImageMetadata] = set()
+        Returns:
+            list[Document]: docsと同じ順序のチャンク
+        """
+        return self._transform_pool.split(docs)
 
-        for doc in image_docs:
-            images = doc.images
-            image_metadata_set.update(images)
 
-        image_metadata = list(image_metadata_set)
-        image_descriptions = describe_images(image_metadata)
+_StatsT = TypeVar("_StatsT", bound=BaseModel)
+
 
-        return image_descriptions
+def _add_stats(total: _StatsT, stats: _StatsT) -> _StatsT:
+    """数値の項目ごとに合計した統計を返す"""
+    return total.model_copy(
+        update={
+            name: getattr(total, name) + value
+            for name, value in stats
+            if isinstance(value, (int, float))
+        }
+    )
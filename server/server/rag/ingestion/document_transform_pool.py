@@ -0,0 +1,203 @@
+import copy
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Any, Callable, Iterable, Iterator, Optional, Sequence, TypeVar
+
+from langchain_community.document_transformers import MarkdownifyTransformer
+from langchain_core.documents.base import Document
+from langchain_text_splitters import TextSplitter
+from pydantic import BaseModel
+
+from server.rag.context_packer import estimate_tokens
+from server.rag.ingestion.extract_image_converter import extract_image_urls
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class DocumentTransformConfig(BaseModel):
+    """DocumentTransformPoolの設定"""
+
+    max_workers: Optional[int] = None
+    """変換を行うプロセスの数。Noneの場合はCPU数"""
+
+    chunk_size: int = 8
+    """1回に子プロセスへ送るドキュメントの数の上限。ドキュメントが少ない場合は、各プロセスに均等に分ける"""
+
+
+def _to_markdown(transformer: MarkdownifyTransformer, html: str) -> str:
+    """
+    HTMLをMarkdownに変換します
+
+    NOTE: プロセスプールの子プロセスで実行するため、モジュールのトップレベルに定義している
+    """
+    [markdown_doc] = transformer.transform_documents([Document(page_content=html)])
+    return markdown_doc.page_content
+
+
+def _split_text(
+    text_splitter: TextSplitter, text: str
+) -> list[tuple[str, dict[str, Any], int]]:
+    """
+    テキストをチャンクに分割し、チャンクごとに本文・分割時に付与されたメタデータ・トークン数を返します
+
+    NOTE: プロセスプールの子プロセスで実行するため、モジュールのトップレベルに定義している
+    """
+    return [
+        (chunk.page_content, chunk.metadata, estimate_tokens(chunk.page_content))
+        for chunk in text_splitter.create_documents([text])
+    ]
+
+
+class DocumentTransformPool:
+    """
+    HTMLからMarkdownへの変換・画像のURLの抽出・チャンクへの分割を、プロセスプールで並列に実行する
+
+    いずれもCPUを使用する処理のため、大きなサイトではページの取得よりも時間がかかる。
+    子プロセスにはドキュメントの本文のみを数件ずつまとめて送り、メタデータは親プロセスで付け直すことで、
+    プロセス間の受け渡しを小さく保つ。結果は1プロセスで順に変換した場合と同一である。
+    """
+
+    _transformer: MarkdownifyTransformer
+    _text_splitter: TextSplitter
+    _config: DocumentTransformConfig
+    _executor: Optional[ProcessPoolExecutor]
+
+    def __init__(
+        self,
+        transformer: MarkdownifyTransformer,
+        text_splitter: TextSplitter,
+        config: Optional[DocumentTransformConfig] = None,
+    ):
+        """
+        DocumentTransformPoolを初期化します。
+
+        Args:
+            transformer (MarkdownifyTransformer): HTMLをMarkdownに変換するMarkdownifyTransformer
+            text_splitter (TextSplitter): ドキュメントをチャンクに分割するTextSplitter
+            config (Optional[DocumentTransformConfig]): 変換の設定。Noneの場合はデフォルトの設定を使用する
+        """
+        self._transformer = transformer
+        self._text_splitter = text_splitter
+        self._config = config or DocumentTransformConfig()
+        self._executor = None
+
+    def __enter__(self) -> "DocumentTransformPool":
+        """
+        プロセスプールを作成し、withブロックを抜けるまで変換の呼び出しをまたいで使い回します
+
+        子プロセスはここでまとめて作成するため、他のスレッドを開始する前に呼び出します。
+        """
+        if self._max_workers > 1:
+            self._executor = self._create_executor()
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    @property
+    def _max_workers(self) -> int:
+        return self._config.max_workers or os.cpu_count() or 1
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        # NOTE: ImageNormalizerと同じく、spawnでは__main__のモジュールが読み込み直されるためforkを使用する
+        executor = ProcessPoolExecutor(
+            max_workers=self._max_workers,
+            mp_context=multiprocessing.get_context("fork"),
+        )
+        # 子プロセスは最初のタスクを投入した時点で作成されるため、ここで作成させておく
+        executor.submit(int).result()
+        return executor
+
+    def to_markdown(self, docs: Iterable[Document]) -> list[Document]:
+        """
+        HTMLのドキュメントをMarkdownに変換します
+
+        docsはプロセスプールに順に投入するため、クローラーのジェネレーターを渡すと取得と並行して変換します。
+
+        Args:
+            docs (Iterable[Document]): HTMLのドキュメント
+
+        Returns:
+            list[Document]: docsと同じ順序の、Markdownに変換したドキュメント
+        """
+        html_docs: list[Document] = []
+
+        def contents() -> Iterator[str]:
+            for doc in docs:
+                html_docs.append(doc)
+                yield doc.page_content
+
+        markdown_contents = self._map(
+            partial(_to_markdown, self._transformer),
+            contents(),
+            len(docs) if isinstance(docs, Sequence) else None,
+        )
+        return [
+            Document(page_content=content, metadata=doc.metadata)
+            for doc, content in zip(html_docs, markdown_contents)
+        ]
+
+    def extract_image_urls(self, docs: Sequence[Document]) -> list[list[str]]:
+        """
+        Markdownのドキュメントに含まれる画像のURLを抽出します
+
+        Args:
+            docs (Sequence[Document]): Markdownに変換したドキュメント
+
+        Returns:
+            list[list[str]]: docsと同じ順序の、ドキュメントごとの画像のURL
+        """
+        return self._map(
+            extract_image_urls, (doc.page_content for doc in docs), len(docs)
+        )
+
+    def split(self, docs: Sequence[Document]) -> list[Document]:
+        """
+        ドキュメントをチャンクに分割し、チャンクごとのトークン数をメタデータのtoken_countに記録します
+
+        Args:
+            docs (Sequence[Document]): 分割するドキュメント
+
+        Returns:
+            list[Document]: docsと同じ順序のチャンク
+        """
+        results = self._map(
+            partial(_split_text, self._text_splitter),
+            (doc.page_content for doc in docs),
+            len(docs),
+        )
+        # TextSplitter.split_documentsと同じく、元のドキュメントのメタデータを複製してから分割時のメタデータを加える
+        return [
+            Document(
+                page_content=content,
+                metadata={
+                    **copy.deepcopy(doc.metadata),
+                    **chunk_metadata,
+                    "token_count": token_count,
+                },
+            )
+            for doc, chunks in zip(docs, results)
+            for content, chunk_metadata, token_count in chunks
+        ]
+
+    def _map(
+        self, fn: Callable[[T], R], items: Iterable[T], count: Optional[int]
+    ) -> list[R]:
+        # 1プロセスで足りる場合は、プロセスの起動と本文の受け渡しを省く
+        if self._max_workers <= 1 or (count is not None and count <= 1):
+            return list(map(fn, items))
+
+        # 件数がわかる場合は、すべてのプロセスに行き渡るようまとめる件数を減らす
+        chunk_size = self._config.chunk_size
+        if count is not None:
+            chunk_size = max(1, min(chunk_size, math.ceil(count / self._max_workers)))
+        if self._executor is not None:
+            return list(self._executor.map(fn, items, chunksize=chunk_size))
+        with self._create_executor() as executor:
+            return list(executor.map(fn, items, chunksize=chunk_size))
@@ -4,10 +4,9 @@ import mimetypes
 import re
 from typing import Optional, Sequence
 
-import requests
 from langchain_core.documents.base import Document
-from tenacity import retry, stop_after_attempt, wait_exponential
 
+from server.rag.ingestion.image_fetcher import ImageFetcher
 from server.rag.ingestion.model import _ImageMetadata
 
 
@@ -15,6 +14,27 @@ class DocumentWithImages(Document):
     images: list[_ImageMetadata]
 
 
+# Markdown形式の画像リンク文字列にマッチする正規表現パターン
+_IMAGE_LINK_PATTERN = re.compile(
+    r"!\[.*?\]\((https://[^)]+?\.(?:png|jpg|jpeg|gif|webp))\)"
+)
+
+
+def extract_image_urls(text: str) -> list[str]:
+    """
+    ドキュメント内の画像URLを抽出する
+
+    NOTE: DocumentTransformPoolの子プロセスでも実行するため、モジュールのトップレベルに定義している
+
+    Args:
+        text (str): ドキュメントの内容
+
+    Returns:
+        list[str]: 抽出された画像URLのリスト
+    """
+    return _IMAGE_LINK_PATTERN.findall(text)
+
+
 class ExtractImageConvertor:
     """
     Markdown形式のドキュメントから画像情報を抽出してDocumentWithImagesに変換する
@@ -24,11 +44,23 @@ class ExtractImageConvertor:
     型付けを厳密に行うために独自に実装している
     """
 
-    _image_cache: dict[str, _ImageMetadata]
+    _image_cache: dict[str, Optional[_ImageMetadata]]
+    """画像のURL -> 画像データ。release_imagesで破棄した画像はNone"""
+    _image_fetcher: ImageFetcher
     _logger: logging.Logger
 
-    def __init__(self, logger: Optional[logging.Logger] = None):
+    def __init__(
+        self,
+        logger: Optional[logging.Logger] = None,
+        image_fetcher: Optional[ImageFetcher] = None,
+    ):
+        """
+        Args:
+            logger (Optional[logging.Logger]): ロガー
+            image_fetcher (Optional[ImageFetcher]): 画像をダウンロードするImageFetcher。Noneの場合はキャッシュを使用しないものを作成する
+        """
         self._image_cache = {}
+        self._image_fetcher = image_fetcher or ImageFetcher()
 
         if logger is None:
             self._logger = logging.getLogger(__name__)
@@ -43,51 +75,85 @@ class ExtractImageConvertor:
             self._logger = logger
 
     def convert_documents(
-        self, documents: Sequence[Document], **kwargs
+        self,
+        documents: Sequence[Document],
+        image_urls: Optional[Sequence[list[str]]] = None,
+        **kwargs,
     ) -> Sequence[DocumentWithImages]:
-        return [self._convert_document(doc) for doc in documents]
+        """
+        Args:
+            documents (Sequence[Document]): Markdown形式のドキュメント
+            image_urls (Optional[Sequence[list[str]]]): documentsと同じ順序の、抽出済みの画像URL。
+                Noneの場合はここで抽出する
+        """
+        if image_urls is None:
+            image_urls = [
+                self._extract_image_urls(doc.page_content) for doc in documents
+            ]
+
+        # すべてのドキュメントの画像URLを先に集め、重複を除いてまとめて並行にダウンロードする
+        new_image_urls = [
+            image_url
+            for urls in image_urls
+            for image_url in urls
+            if image_url not in self._image_cache
+        ]
+        for image_url, image_data in self._image_fetcher.fetch_all(
+            new_image_urls
+        ).items():
+            if image_data is None:
+                continue
+            image_mime_type = mimetypes.guess_type(image_url)[0]
+            if image_mime_type is None:
+                self._logger.warning(f"画像のMIMEタイプが不明です: {image_url}")
+                continue
+            self._image_cache[image_url] = _ImageMetadata(
+                url=image_url,
+                base64=base64.b64encode(image_data).decode("utf-8"),
+                mime_type=image_mime_type,
+            )
 
-    def _convert_document(self, doc: Document) -> DocumentWithImages:
+        return [
+            self._convert_document(doc, urls)
+            for doc, urls in zip(documents, image_urls)
+        ]
+
+    def release_images(self) -> None:
+        """
+        これまでにダウンロードした画像のデータを破棄します
+
+        URLは記録しておき、以降のドキュメントに同じ画像が含まれていてもダウンロードし直さず、imagesにも含めない。
+        ドキュメントを少しずつ変換する場合に、変換済みの画像のデータをメモリに保持し続けないために使用する。
         """
-        ドキュメント内の画像URLを抽出し、その画像情報を格納したDocumentWithImagesを返す
+        for image_url in self._image_cache:
+            self._image_cache[image_url] = None
+
+    def reset(self) -> None:
+        """ダウンロードした画像の記録をすべて消去します"""
+        self._image_cache = {}
+
+    def _convert_document(
+        self, doc: Document, image_urls: list[str]
+    ) -> DocumentWithImages:
+        """
+        ドキュメント内の画像URLに対応する画像情報を格納したDocumentWithImagesを返す
 
         Args:
-            doc (Document): 画像URLを抽出する対象のドキュメント
+            doc (Document): 変換する対象のドキュメント
+            image_urls (list[str]): ドキュメントから抽出した画像URL
 
         Returns:
             DocumentWithImages: 画像URLを抽出し、その画像情報を格納したDocumentWithImages
         """
 
-        image_urls = self._extract_image_urls(doc.page_content)
         self._logger.debug(f"抽出された画像URL: {image_urls}")
 
-        images = []
-        for image_url in image_urls:
-            if image_url in self._image_cache:
-                self._logger.debug(f"キャッシュから画像情報を取得: {image_url}")
-                images.append(self._image_cache[image_url])
-                continue
-
-            try:
-                self._logger.debug(f"画像の処理を開始します: {image_url}")
-                image_base64 = self._get_image_base64(image_url)
-                image_mime_type = mimetypes.guess_type(image_url)[0]
-
-                if image_mime_type is None:
-                    self._logger.warning(f"画像のMIMEタイプが不明です: {image_url}")
-                    continue
-
-                image_metadata = _ImageMetadata(
-                    url=image_url,
-                    base64=image_base64,
-                    mime_type=image_mime_type,
-                )
-                images.append(image_metadata)
-                self._image_cache[image_url] = image_metadata  # キャッシュに追加
-            except Exception:
-                self._logger.exception(
-                    f"画像 {image_url} の処理中にエラーが発生しました"
-                )
+        # ダウンロードできなかった画像と、release_imagesで破棄した画像は含めない
+        images = [
+            image
+            for image_url in image_urls
+            if (image := self._image_cache.get(image_url)) is not None
+        ]
 
         transformed_doc = DocumentWithImages(
             page_content=doc.page_content,
@@ -107,44 +173,4 @@ class ExtractImageConvertor:
         Returns:
             list[str]: 抽出された画像URLのリスト
         """
-        # Markdown形式の画像リンク文字列にマッチする正規表現パターン
-        image_link_regex = r"!\[.*?\]\((https://[^)]+?\.(?:png|jpg|jpeg|gif|webp))\)"
-
-        return re.findall(image_link_regex, text)
-
-    @retry(
-        stop=stop_after_attempt(3),
-        wait=wait_exponential(multiplier=1, min=4, max=10),
-    )
-    def _get_image_base64(self, image_url: str) -> str:
-        """
-        画像URLを受け取り、その画像のBase64エンコードされた文字列を返す
-
-        Args:
-            image_url (str): 画像のURL
-
-        Returns:
-            str: Base64エンコードされた画像データ
-        """
-        try:
-            self._logger.debug(f"画像のダウンロードを試みています: {image_url}")
-            response = requests.get(image_url, timeout=10)
-            response.raise_for_status()
-            image_data = response.content
-            base64_encoded = base64.b64encode(image_data).decode("utf-8")
-            self._logger.debug(f"画像のダウンロードに成功しました: {image_url}")
-            return base64_encoded
-        except requests.exceptions.ConnectionError as e:
-            self._logger.error(f"接続エラーが発生しました: {e}", exc_info=True)
-            raise
-        except requests.exceptions.Timeout as e:
-            self._logger.error(f"タイムアウトが発生しました: {e}", exc_info=True)
-            raise
-        except requests.exceptions.RequestException as e:
-            self._logger.error(
-                f"リクエスト中にエラーが発生しました: {e}", exc_info=True
-            )
-            raise
-        except Exception as e:
-            self._logger.error(f"予期せぬエラーが発生しました: {e}", exc_info=True)
-            raise
+        return extract_image_urls(text)
@@ -0,0 +1,414 @@
+import asyncio
+import base64
+import hashlib
+import io
+import logging
+import threading
+from collections import OrderedDict
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+from langchain_core.documents import Document
+from langchain_core.stores import BaseStore, ByteStore
+from PIL import Image, UnidentifiedImageError
+
+from server.rag.ingestion.s3_store import S3ByteStore
+
+IMAGE_BLOB_PREFIX = "blobs/"
+"""ドキュメントストアと同じバケット内で画像の実データを格納するプレフィックス"""
+
+DEFAULT_VARIANT_LONG_EDGE = 1092
+"""縮小版の画像の長辺のピクセル数のデフォルト値。Claude 3が縮小せずに扱える約1.15メガピクセルに収まる"""
+
+_VARIANT_CACHE_SIZE = 64
+_INLINE_BLOB_CACHE_SIZE = 64
+
+logger = logging.getLogger(__name__)
+
+
+def downscale_image(data: bytes, max_long_edge: int) -> bytes:
+    """
+    画像の長辺がmax_long_edge以下になるよう、元の形式のまま縮小します
+
+    既に十分小さい画像や、Pillowで読み込めない画像はそのまま返します。
+
+    Args:
+        data (bytes): 画像データ
+        max_long_edge (int): 縮小後の長辺のピクセル数の上限
+
+    Returns:
+        bytes: 縮小した画像データ
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if max(image.size) <= max_long_edge or image.format is None:
+                return data
+            image_format = image.format
+            image.thumbnail((max_long_edge, max_long_edge))
+            buffer = io.BytesIO()
+            image.save(buffer, format=image_format)
+    except (UnidentifiedImageError, OSError, ValueError):
+        logger.warning("画像を読み込めなかったため、縮小せずに使用します")
+        return data
+
+    downscaled = buffer.getvalue()
+    return downscaled if len(downscaled) < len(data) else data
+
+
+class ImageBlobStore:
+    """
+    画像の実データを内容のハッシュ値をキーとして格納するストア
+
+    同じ画像は何度保存されても1つのオブジェクトとして格納される。
+    プロンプトに添付するための縮小版は variants/{長辺のピクセル数}/{元のキー} に格納する。
+    縮小版は保存時にvariant_long_edgesの大きさで作成し、それ以外の大きさや
+    縮小版がない古い画像は読み込み時に作成してストアとメモリにキャッシュする。
+    検索時のLambdaのようにストアへの書き込み権限がない場合は、メモリにのみキャッシュする。
+    """
+
+    _store: ByteStore
+    _variant_long_edges: tuple[int, ...]
+    _known_keys: set[str]
+    """保存が完了した画像データのキー"""
+
+    _pending_puts: dict[str, threading.Event]
+    """他のスレッドが保存している最中の画像データのキーと、保存の終了を通知するイベント"""
+
+    _variant_cache: OrderedDict[str, bytes]
+    _inline_blobs: OrderedDict[str, bytes]
+    """旧形式のドキュメントから読み込み時に取り出した、ストアに保存していない画像データ"""
+
+    _lock: threading.Lock
+
+    def __init__(self, store: ByteStore, variant_long_edges: Sequence[int] = ()):
+        """
+        ImageBlobStoreを初期化します。
+
+        Args:
+            store (ByteStore): 画像の実データを格納するストア
+            variant_long_edges (Sequence[int]): 保存時に作成する縮小版の長辺のピクセル数
+        """
+        self._store = store
+        self._variant_long_edges = tuple(variant_long_edges)
+        self._known_keys = set()
+        self._pending_puts = {}
+        self._variant_cache = OrderedDict()
+        self._inline_blobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def blob_key(data: bytes) -> str:
+        """画像データの内容から決まるキーを返します"""
+        return f"sha256/{hashlib.sha256(data).hexdigest()}"
+
+    def put(self, data: bytes) -> str:
+        """
+        画像データを保存し、そのキーを返します
+
+        同じ画像を他のスレッドが保存している最中の場合は、その終了を待ちます。
+        保存に失敗した場合は保存済みとして扱わないため、次の呼び出しで保存し直します。
+
+        Args:
+            data (bytes): 画像データ
+
+        Returns:
+            str: 画像データのキー
+        """
+        key = self.blob_key(data)
+        while True:
+            with self._lock:
+                if key in self._known_keys:
+                    return key
+                pending = self._pending_puts.get(key)
+                if pending is None:
+                    pending = threading.Event()
+                    self._pending_puts[key] = pending
+                    break
+            # 保存に失敗した場合は、待っていたスレッドのいずれかが保存し直す
+            pending.wait()
+
+        stored = False
+        try:
+            self._store.mset(
+                [
+                    (key, data),
+                    *(
+                        (self._variant_key(key, edge), downscale_image(data, edge))
+                        for edge in self._variant_long_edges
+                    ),
+                ]
+            )
+            stored = True
+        finally:
+            with self._lock:
+                if stored:
+                    self._known_keys.add(key)
+                del self._pending_puts[key]
+            pending.set()
+        return key
+
+    def mget(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        """指定されたキーの画像データを取得します。存在しない場合はNoneを返します"""
+        return self._fill_inline_blobs(keys, self._store.mget(keys))
+
+    async def amget(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        """指定されたキーの画像データを非同期に取得します"""
+        return self._fill_inline_blobs(keys, await self._store.amget(keys))
+
+    def mget_base64(self, keys: Sequence[str]) -> List[Optional[str]]:
+        """
+        指定されたキーの画像データをBase64エンコードした文字列で取得します
+
+        Args:
+            keys (Sequence[str]): 画像データのキー
+
+        Returns:
+            List[Optional[str]]: Base64エンコードされた画像データ。存在しない場合はNone
+        """
+        return self._encode_base64s(self.mget(keys))
+
+    async def amget_base64(self, keys: Sequence[str]) -> List[Optional[str]]:
+        """指定されたキーの画像データをBase64エンコードした文字列で非同期に取得します"""
+        return self._encode_base64s(await self.amget(keys))
+
+    def mget_variants(
+        self, keys: Sequence[str], max_long_edge: int
+    ) -> List[Optional[bytes]]:
+        """
+        指定されたキーの画像の縮小版を取得します。縮小版がない場合は元の画像から作成して保存します
+
+        縮小版の保存に失敗した場合も、作成した縮小版を返します。
+
+        Args:
+            keys (Sequence[str]): 元の画像データのキー
+            max_long_edge (int): 縮小版の長辺のピクセル数の上限
+
+        Returns:
+            List[Optional[bytes]]: 縮小版の画像データ。元の画像が存在しない場合はNone
+        """
+        variant_keys = [self._variant_key(key, max_long_edge) for key in keys]
+        variants = self._get_cached_variants(variant_keys)
+        missed = [i for i, variant in enumerate(variants) if variant is None]
+        if len(missed) > 0:
+            stored = self._store.mget([variant_keys[i] for i in missed])
+            self._fill_variants(variants, missed, stored)
+
+        missed = [i for i, variant in enumerate(variants) if variant is None]
+        if len(missed) > 0:
+            originals = self.mget([keys[i] for i in missed])
+            created = self._create_variants(
+                variants, variant_keys, missed, originals, max_long_edge
+            )
+            if len(created) > 0:
+                self._save_variants(created)
+
+        self._cache_variants(variant_keys, variants)
+        return variants
+
+    async def amget_variants(
+        self, keys: Sequence[str], max_long_edge: int
+    ) -> List[Optional[bytes]]:
+        """mget_variantsの非同期版"""
+        variant_keys = [self._variant_key(key, max_long_edge) for key in keys]
+        variants = self._get_cached_variants(variant_keys)
+        missed = [i for i, variant in enumerate(variants) if variant is None]
+        if len(missed) > 0:
+            stored = await self._store.amget([variant_keys[i] for i in missed])
+            self._fill_variants(variants, missed, stored)
+
+        missed = [i for i, variant in enumerate(variants) if variant is None]
+        if len(missed) > 0:
+            originals = await self.amget([keys[i] for i in missed])
+            # NOTE: 画像の縮小はCPUを使用するため、イベントループを止めないようスレッドで実行する
+            created = await asyncio.to_thread(
+                self._create_variants,
+                variants,
+                variant_keys,
+                missed,
+                originals,
+                max_long_edge,
+            )
+            if len(created) > 0:
+                await self._asave_variants(created)
+
+        self._cache_variants(variant_keys, variants)
+        return variants
+
+    def _save_variants(self, created: list[tuple[str, bytes]]) -> None:
+        # 縮小版はキャッシュにすぎないため、保存できなくても回答は続ける
+        try:
+            self._store.mset(created)
+        except Exception:
+            logger.warning(
+                "画像の縮小版を保存できなかったため、メモリにのみキャッシュします",
+                exc_info=True,
+            )
+
+    async def _asave_variants(self, created: list[tuple[str, bytes]]) -> None:
+        try:
+            await self._store.amset(created)
+        except Exception:
+            logger.warning(
+                "画像の縮小版を保存できなかったため、メモリにのみキャッシュします",
+                exc_info=True,
+            )
+
+    def _variant_key(self, key: str, max_long_edge: int) -> str:
+        return f"variants/{max_long_edge}/{key}"
+
+    def _get_cached_variants(self, variant_keys: list[str]) -> List[Optional[bytes]]:
+        with self._lock:
+            return [self._variant_cache.get(key) for key in variant_keys]
+
+    def _cache_variants(
+        self, variant_keys: list[str], variants: List[Optional[bytes]]
+    ) -> None:
+        with self._lock:
+            for key, variant in zip(variant_keys, variants):
+                if variant is None:
+                    continue
+                self._variant_cache[key] = variant
+                self._variant_cache.move_to_end(key)
+            while len(self._variant_cache) > _VARIANT_CACHE_SIZE:
+                self._variant_cache.popitem(last=False)
+
+    def _fill_inline_blobs(
+        self, keys: Sequence[str], data: Sequence[Optional[bytes]]
+    ) -> List[Optional[bytes]]:
+        with self._lock:
+            return [
+                d if d is not None else self._inline_blobs.get(key)
+                for key, d in zip(keys, data)
+            ]
+
+    def _fill_variants(
+        self,
+        variants: List[Optional[bytes]],
+        positions: list[int],
+        stored: Sequence[Optional[bytes]],
+    ) -> None:
+        for i, data in zip(positions, stored):
+            variants[i] = data
+
+    def _create_variants(
+        self,
+        variants: List[Optional[bytes]],
+        variant_keys: list[str],
+        positions: list[int],
+        originals: Sequence[Optional[bytes]],
+        max_long_edge: int,
+    ) -> list[tuple[str, bytes]]:
+        """元の画像から縮小版を作成してvariantsを埋め、ストアに保存すべきペアを返します"""
+        created: list[tuple[str, bytes]] = []
+        for i, data in zip(positions, originals):
+            if data is None:
+                continue
+            variants[i] = downscale_image(data, max_long_edge)
+            created.append((variant_keys[i], variants[i]))
+        return created
+
+    def _encode_base64s(self, data: Sequence[Optional[bytes]]) -> List[Optional[str]]:
+        return [
+            base64.b64encode(d).decode("utf-8") if d is not None else None for d in data
+        ]
+
+    def offload(self, doc: Document, persist: bool = True) -> Document:
+        """
+        画像ドキュメントのメタデータに含まれるBase64の画像データをストアへ移し、
+        メタデータにはそのキーのみを残したドキュメントを返します
+
+        Args:
+            doc (Document): 対象のドキュメント
+            persist (bool): Falseの場合はストアに保存せず、画像データをメモリにのみ保持する。
+                書き込み権限のない読み込み時に使用する
+
+        Returns:
+            Document: 画像データをキーで参照するドキュメント。画像データを持たない場合はそのまま返す
+        """
+        image_base64 = doc.metadata.get("base64")
+        if image_base64 is None:
+            return doc
+
+        data = base64.b64decode(image_base64)
+        if persist:
+            key = self.put(data)
+        else:
+            key = self.blob_key(data)
+            with self._lock:
+                self._inline_blobs[key] = data
+                self._inline_blobs.move_to_end(key)
+                while len(self._inline_blobs) > _INLINE_BLOB_CACHE_SIZE:
+                    self._inline_blobs.popitem(last=False)
+        metadata = {k: v for k, v in doc.metadata.items() if k != "base64"}
+        return doc.model_copy(update={"metadata": {**metadata, "blob_key": key}})
+
+
+class ImageBlobOffloadingStore(BaseStore[str, Document]):
+    """
+    書き込み時に画像データをImageBlobStoreへ移してから元のストアに保存するBaseStore
+
+    読み込み時はキーのみを持つドキュメントを返し、画像データは必要になった時点で
+    ImageBlobStoreから取得する。画像データを埋め込んだ旧形式のドキュメントも、
+    読み込み時に画像データをImageBlobStoreのメモリに移してからキーのみを持つドキュメントとして返す。
+    検索時のLambdaには書き込み権限がないため、読み込み時にはストアに保存しない。
+    旧形式のドキュメントの移行はscripts/migrate_image_blobs.pyで行う。
+    """
+
+    _store: BaseStore[str, Document]
+    _image_blob_store: ImageBlobStore
+
+    def __init__(
+        self, store: BaseStore[str, Document], image_blob_store: ImageBlobStore
+    ):
+        self._store = store
+        self._image_blob_store = image_blob_store
+
+    def mget(self, keys: Sequence[str]) -> List[Optional[Document]]:
+        return self._offload_all(self._store.mget(keys))
+
+    async def amget(self, keys: Sequence[str]) -> List[Optional[Document]]:
+        return self._offload_all(await self._store.amget(keys))
+
+    def _offload_all(self, docs: List[Optional[Document]]) -> List[Optional[Document]]:
+        # 旧形式のドキュメントを移行するまでの間も、後段に大きな画像データを持ち回らないようにする
+        return [
+            self._image_blob_store.offload(doc, persist=False)
+            if doc is not None
+            else None
+            for doc in docs
+        ]
+
+    def mset(self, key_value_pairs: Sequence[Tuple[str, Document]]) -> None:
+        self._store.mset(
+            [(key, self._image_blob_store.offload(doc)) for key, doc in key_value_pairs]
+        )
+
+    async def amset(self, key_value_pairs: Sequence[Tuple[str, Document]]) -> None:
+        # NOTE: 画像データのアップロードはブロッキングI/Oであるため、スレッドで実行する
+        offloaded_pairs = await asyncio.to_thread(
+            lambda: [
+                (key, self._image_blob_store.offload(doc))
+                for key, doc in key_value_pairs
+            ]
+        )
+        await self._store.amset(offloaded_pairs)
+
+    def mdelete(self, keys: Sequence[str]) -> None:
+        # NOTE: 画像データは他のドキュメントから参照されている可能性があるため削除しない
+        self._store.mdelete(keys)
+
+    async def amdelete(self, keys: Sequence[str]) -> None:
+        await self._store.amdelete(keys)
+
+    def yield_keys(self, *, prefix: Optional[str] = None) -> Iterator[str]:
+        return self._store.yield_keys(prefix=prefix)
+
+
+def create_image_blob_store(
+    bucket_name: str,
+    variant_long_edges: Sequence[int] = (DEFAULT_VARIANT_LONG_EDGE,),
+) -> ImageBlobStore:
+    """ドキュメントストアのバケットに画像データを格納するImageBlobStoreを作成します"""
+    return ImageBlobStore(
+        S3ByteStore(bucket_name=bucket_name, prefix=IMAGE_BLOB_PREFIX),
+        variant_long_edges=variant_long_edges,
+    )
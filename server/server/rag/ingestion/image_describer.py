@@ -1,11 +1,37 @@
+import base64
+import hashlib
+import logging
+import re
+from typing import Optional
+
 from langchain_aws.chat_models.bedrock import ChatBedrock
+from langchain_core.language_models import BaseChatModel
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnableLambda
+from langchain_core.runnables import Runnable, RunnableLambda
+from langchain_core.stores import ByteStore
+from pydantic import BaseModel
 
+from server.rag.ingestion.image_normalizer import MAX_MODEL_IMAGE_BASE64_SIZE
 from server.rag.ingestion.model import _ImageMetadata
+from server.rag.ingestion.model_call_scheduler import ModelCallScheduler
+from server.rag.ingestion.s3_store import S3ByteStore
 from server.rag.model import MetadataTypedDocument
 
+logger = logging.getLogger(__name__)
+
+IMAGE_DESCRIPTION_CACHE_PREFIX = "image_descriptions/"
+"""ドキュメントストアと同じバケット内で画像の説明のキャッシュを格納するプレフィックス"""
+
+_MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+
+PROMPT_VERSION = "1"
+"""
+画像の説明を生成するプロンプトの版
+
+NOTE: プロンプトを変更した場合は、以前のプロンプトで生成した説明がキャッシュから使用されないよう、この値を更新すること
+"""
+
 _prompt = ChatPromptTemplate.from_messages(
     [
         (
@@ -26,57 +52,206 @@ _prompt = ChatPromptTemplate.from_messages(
     ]
 )
 
-_model = ChatBedrock(
-    model="anthropic.claude-3-haiku-20240307-v1:0",
-    client=None,
-    region="us-east-1",
-)
-
 
 def _image_to_dict(image: _ImageMetadata) -> dict[str, str]:
     return {"image_base64": image.base64, "mime_type": image.mime_type}
 
 
-_describe_image_chain = (
-    RunnableLambda(_image_to_dict) | _prompt | _model | StrOutputParser()
-)
+class ImageDescriptionStats(BaseModel):
+    """ImageDescriberの1回の実行で説明を生成した画像の数と、省略できたモデルの呼び出し回数"""
+
+    requested: int = 0
+    """説明を要求された画像の数(5MBを超えるため除外した画像を除く)"""
+
+    duplicates: int = 0
+    """内容が他の画像と同じため、まとめて説明を生成した画像の数"""
 
+    hits: int = 0
+    """キャッシュから説明を取得できた画像の数(重複を除く)"""
 
-def describe_images(
-    images: list[_ImageMetadata],
-) -> list[MetadataTypedDocument[_ImageMetadata]]:
+    described: int = 0
+    """モデルを呼び出して説明を生成した画像の数"""
+
+    failed: int = 0
+    """リトライしても説明を生成できず、除外した画像の数(重複を除く)"""
+
+    @property
+    def saved_calls(self) -> int:
+        """キャッシュと重複排除によって省略できたモデルの呼び出し回数"""
+        return self.requested - self.described - self.failed
+
+
+class ImageDescriptionCache:
+    """
+    画像の説明を、(モデルID, プロンプトの版, 画像データのSHA-256)をキーとして保存するキャッシュ
+
+    ByteStoreに保存するため、ローカルディスク(LocalFileStore)にもS3(S3ByteStore)にも保存できる。
     """
-    与えられた画像の説明を含むドキュメントを生成する。
 
-    NOTE: 5MBを超える画像は説明を生成できないため、そのような画像は除外される。
+    _store: ByteStore
+
+    def __init__(self, store: ByteStore):
+        self._store = store
+
+    def mget(self, model_id: str, digests: list[str]) -> list[Optional[str]]:
+        values = self._store.mget([self._key(model_id, digest) for digest in digests])
+        return [
+            value.decode("utf-8") if value is not None else None for value in values
+        ]
+
+    def mset(self, model_id: str, descriptions: dict[str, str]) -> None:
+        self._store.mset(
+            [
+                (self._key(model_id, digest), description.encode("utf-8"))
+                for digest, description in descriptions.items()
+            ]
+        )
+
+    def _key(self, model_id: str, digest: str) -> str:
+        # LocalFileStoreではキーに使用できる文字が制限されているため、モデルIDの記号を置き換える
+        model_id = re.sub(r"[^a-zA-Z0-9_.\-]", "_", model_id)
+        return f"{model_id}/{PROMPT_VERSION}/{digest}"
+
 
-    Args:
-        images (list[_ImageMetadata]): 画像データ
+class ImageDescriber:
+    """
+    画像の説明をマルチモーダルモデルで生成する
 
-    Returns:
-        list[MetadataTypedDocument[_ImageMetadata]]: 画像データとその説明を含むドキュメント
+    内容が同じ画像(異なるURLで配信されている同じ画像を含む)は1回だけ説明を生成し、
+    cacheを指定した場合は前回までに生成した説明を再利用して、キャッシュにない画像のみモデルを呼び出す。
+    モデルの呼び出しはModelCallSchedulerでスロットリングに応じた並列数で行い、
+    説明を生成できなかった画像は他の画像に影響させずに除外する。
     """
-    # NOTE: 画像サイズが5MBを超えると以下のようなエラーが発生するため除外する
-    # File "/path/to/repo/server/.venv/lib/python3.12/site-packages/langchain_aws/llms/bedrock.py", line 726, in _prepare_input_and_invoke
-    # raise ValueError(f"Error raised by bedrock service: {e}")
-    # ValueError: Error raised by bedrock service: An error occurred (ValidationException) when calling the InvokeModel operation: messages.0.content.1.image.source.base64: image exceeds 5 MB maximum: 7850880 bytes > 5242880 bytes
-    #
-    # Claudeにおける画像ファイルサイズの制限に関しては公式ドキュメントに以下の記載がある:
-    # > アップロードできる画像ファイルのサイズに制限はありますか？
-    # > はい、以下の制限があります。
-    # > API: 画像1枚あたり最大5MB
-    # > claude.ai: 画像1枚あたり最大10MB
-    # > これらの制限を超える画像は拒否され、APIを使用する際にエラーが返されます。
-    # ref: https://docs.anthropic.com/ja/docs/build-with-claude/vision
-    filtered_images = [image for image in images if len(image.base64) < 5 * 1024 * 1024]
-
-    image_descriptions = _describe_image_chain.batch(filtered_images)
-    image_description_docs = [
-        MetadataTypedDocument(
-            page_content=description,
-            metadata=image,
+
+    _chain: Runnable[_ImageMetadata, str]
+    _model_id: str
+    _cache: Optional[ImageDescriptionCache]
+    _scheduler: ModelCallScheduler
+    stats: ImageDescriptionStats
+
+    def __init__(
+        self,
+        cache: Optional[ImageDescriptionCache] = None,
+        llm: Optional[BaseChatModel] = None,
+        model_id: str = _MODEL_ID,
+        scheduler: Optional[ModelCallScheduler] = None,
+    ):
+        """
+        ImageDescriberを初期化します。
+
+        Args:
+            cache (Optional[ImageDescriptionCache]): 画像の説明のキャッシュ。Noneの場合はキャッシュしない
+            llm (Optional[BaseChatModel]): 説明を生成するモデル。Noneの場合はBedrockのClaude 3 Haikuを使用する
+            model_id (str): キャッシュのキーに含めるモデルのID。llmを指定した場合はそのモデルのIDを指定すること
+            scheduler (Optional[ModelCallScheduler]): モデルの呼び出しに使用するスケジューラ。Noneの場合はデフォルトの設定で作成する
+        """
+        if llm is None:
+            llm = ChatBedrock(model=_MODEL_ID, client=None, region="us-east-1")
+        self._chain = RunnableLambda(_image_to_dict) | _prompt | llm | StrOutputParser()
+        self._model_id = model_id
+        self._cache = cache
+        self._scheduler = scheduler or ModelCallScheduler()
+        self.stats = ImageDescriptionStats()
+
+    def describe(
+        self, images: list[_ImageMetadata]
+    ) -> list[MetadataTypedDocument[_ImageMetadata]]:
+        """
+        与えられた画像の説明を含むドキュメントを生成する。
+
+        NOTE: 5MBを超える画像は説明を生成できないため、そのような画像は除外される。
+
+        Args:
+            images (list[_ImageMetadata]): 画像データ
+
+        Returns:
+            list[MetadataTypedDocument[_ImageMetadata]]: 画像データとその説明を含むドキュメント
+        """
+        # NOTE: 画像サイズが5MBを超えると以下のようなエラーが発生するため除外する
+        # File "/path/to/repo/server/.venv/lib/python3.12/site-packages/langchain_aws/llms/bedrock.py", line 726, in _prepare_input_and_invoke
+        # raise ValueError(f"Error raised by bedrock service: {e}")
+        # ValueError: Error raised by bedrock service: An error occurred (ValidationException) when calling the InvokeModel operation: messages.0.content.1.image.source.base64: image exceeds 5 MB maximum: 7850880 bytes > 5242880 bytes
+        #
+        # Claudeにおける画像ファイルサイズの制限に関しては公式ドキュメントに以下の記載がある:
+        # > アップロードできる画像ファイルのサイズに制限はありますか？
+        # > はい、以下の制限があります。
+        # > API: 画像1枚あたり最大5MB
+        # > claude.ai: 画像1枚あたり最大10MB
+        # > これらの制限を超える画像は拒否され、APIを使用する際にエラーが返されます。
+        # ref: https://docs.anthropic.com/ja/docs/build-with-claude/vision
+        # 大きな画像は事前にImageNormalizerで縮小しておくことで、除外されずに済む
+        filtered_images = [
+            image for image in images if len(image.base64) < MAX_MODEL_IMAGE_BASE64_SIZE
+        ]
+        for image in images:
+            if len(image.base64) >= MAX_MODEL_IMAGE_BASE64_SIZE:
+                logger.warning(f"画像が大きすぎるため説明を生成しません: {image.url}")
+
+        # 内容が同じ画像はURLが異なっても同じ説明となるため、最初の1枚のみ説明を生成する
+        digests = [_image_digest(image) for image in filtered_images]
+        unique_images: dict[str, _ImageMetadata] = {}
+        for digest, image in zip(digests, filtered_images):
+            unique_images.setdefault(digest, image)
+
+        unique_digests = list(unique_images.keys())
+        cached = (
+            self._cache.mget(self._model_id, unique_digests)
+            if self._cache is not None
+            else [None] * len(unique_digests)
         )
-        for image, description in zip(filtered_images, image_descriptions)
-    ]
+        descriptions = {
+            digest: description
+            for digest, description in zip(unique_digests, cached)
+            if description is not None
+        }
+
+        missed_digests = [
+            digest for digest in unique_digests if digest not in descriptions
+        ]
+        generated = self._scheduler.map(
+            self._chain.invoke,
+            [unique_images[digest] for digest in missed_digests],
+            label="画像の説明",
+        )
+        generated_descriptions = {
+            digest: description
+            for digest, description in zip(missed_digests, generated)
+            if description is not None
+        }
+        if self._cache is not None and len(generated_descriptions) > 0:
+            self._cache.mset(self._model_id, generated_descriptions)
+        descriptions.update(generated_descriptions)
+
+        self.stats = ImageDescriptionStats(
+            requested=len(filtered_images),
+            duplicates=len(filtered_images) - len(unique_digests),
+            hits=len(unique_digests) - len(missed_digests),
+            described=len(generated_descriptions),
+            failed=len(missed_digests) - len(generated_descriptions),
+        )
+        logger.info(
+            f"画像の説明の生成が完了しました: {self.stats.requested}件 "
+            f"(重複 {self.stats.duplicates}, キャッシュ {self.stats.hits}, "
+            f"生成 {self.stats.described}, 失敗 {self.stats.failed}), "
+            f"省略したモデルの呼び出し {self.stats.saved_calls}回"
+        )
+
+        return [
+            MetadataTypedDocument(
+                page_content=descriptions[digest],
+                metadata=image,
+            )
+            for image, digest in zip(filtered_images, digests)
+            if digest in descriptions
+        ]
+
+
+def _image_digest(image: _ImageMetadata) -> str:
+    return hashlib.sha256(base64.b64decode(image.base64)).hexdigest()
+
 
-    return image_description_docs
+def create_image_description_cache(bucket_name: str) -> ImageDescriptionCache:
+    """ドキュメントストアのバケットに画像の説明を格納するImageDescriptionCacheを作成します"""
+    return ImageDescriptionCache(
+        S3ByteStore(bucket_name=bucket_name, prefix=IMAGE_DESCRIPTION_CACHE_PREFIX)
+    )
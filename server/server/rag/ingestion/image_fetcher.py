@@ -0,0 +1,270 @@
+import hashlib
+import logging
+import threading
+import time
+from typing import Optional, Sequence
+from urllib.parse import urlparse
+
+import requests
+from langchain_core.stores import ByteStore
+from pydantic import BaseModel
+from requests.adapters import HTTPAdapter
+from tenacity import (
+    RetryCallState,
+    Retrying,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_exponential,
+)
+
+from server.rag.ingestion.s3_store import S3ByteStore
+from server.utils.concurrency import map_concurrently
+
+logger = logging.getLogger(__name__)
+
+IMAGE_FETCH_CACHE_PREFIX = "image_fetch_cache/"
+"""ドキュメントストアと同じバケット内で、ダウンロードした画像のキャッシュを格納するプレフィックス"""
+
+
+class ImageFetchConfig(BaseModel):
+    """ImageFetcherの設定"""
+
+    max_concurrency: int = 16
+    """全体で同時にダウンロードする画像の数"""
+
+    per_host_concurrency: int = 4
+    """同じホストから同時にダウンロードする画像の数"""
+
+    timeout_seconds: float = 10
+    """1回のリクエストのタイムアウト(秒)"""
+
+    max_attempts: int = 3
+    """通信エラー・タイムアウト・429・5xxの場合の最大試行回数"""
+
+    retry_wait_min_seconds: float = 1
+    retry_wait_max_seconds: float = 10
+
+
+class ImageFetchStats(BaseModel):
+    """ImageFetcherの1回の実行でダウンロードした画像の数とバイト数"""
+
+    requested: int = 0
+    """重複を除いた画像のURLの数"""
+
+    downloaded: int = 0
+    not_modified: int = 0
+    """条件付きリクエストで未更新(304)と判定され、キャッシュを使用した画像の数"""
+
+    failed: int = 0
+    retries: int = 0
+    bytes_downloaded: int = 0
+    elapsed_seconds: float = 0.0
+
+    @property
+    def images_per_second(self) -> float:
+        return (
+            self.requested / self.elapsed_seconds if self.elapsed_seconds > 0 else 0.0
+        )
+
+
+class _CacheEntry(BaseModel):
+    url: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+class ImageFetchCache:
+    """
+    URLごとにダウンロードした画像と、その検証子(ETag・Last-Modified)を保存するキャッシュ
+
+    ByteStoreに保存するため、ローカルディスク(LocalFileStore)にもS3(S3ByteStore)にも保存できる。
+    """
+
+    _store: ByteStore
+
+    def __init__(self, store: ByteStore):
+        self._store = store
+
+    def get(self, url: str) -> tuple[Optional[_CacheEntry], Optional[bytes]]:
+        key = self._key(url)
+        meta, data = self._store.mget([f"{key}.json", f"{key}.bin"])
+        if meta is None or data is None:
+            return None, None
+        try:
+            return _CacheEntry.model_validate_json(meta), data
+        except ValueError:
+            return None, None
+
+    def set(self, entry: _CacheEntry, data: bytes) -> None:
+        key = self._key(entry.url)
+        # 検証子が画像データより先に更新されないよう、画像データ、検証子の順に保存する
+        self._store.mset([(f"{key}.bin", data)])
+        self._store.mset([(f"{key}.json", entry.model_dump_json().encode("utf-8"))])
+
+    def _key(self, url: str) -> str:
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+class _RetryableStatusError(Exception):
+    pass
+
+
+def _is_retryable(e: BaseException) -> bool:
+    return isinstance(
+        e,
+        (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            _RetryableStatusError,
+        ),
+    )
+
+
+class ImageFetcher:
+    """
+    画像のURLの一覧をまとめて受け取り、接続を再利用するセッションで並行にダウンロードする
+
+    ホストごとに同時リクエスト数を制限し、一時的なエラーの場合は指数バックオフでリトライする。
+    cacheを指定した場合は、前回ダウンロードした画像を条件付きリクエストで再検証し、
+    未更新であればダウンロードせずにキャッシュの画像を返す。
+    """
+
+    _config: ImageFetchConfig
+    _cache: Optional[ImageFetchCache]
+    _session: requests.Session
+    _host_semaphores: dict[str, threading.Semaphore]
+    _lock: threading.Lock
+    stats: ImageFetchStats
+
+    def __init__(
+        self,
+        config: Optional[ImageFetchConfig] = None,
+        cache: Optional[ImageFetchCache] = None,
+    ):
+        """
+        ImageFetcherを初期化します。
+
+        Args:
+            config (Optional[ImageFetchConfig]): ダウンロードの設定。Noneの場合はデフォルトの設定を使用する
+            cache (Optional[ImageFetchCache]): ダウンロードした画像のキャッシュ。Noneの場合はキャッシュしない
+        """
+        self._config = config or ImageFetchConfig()
+        self._cache = cache
+        self._session = requests.Session()
+        # 並列数の分だけ接続をプールし、同じホストへの接続を使い回す
+        adapter = HTTPAdapter(
+            pool_connections=self._config.max_concurrency,
+            pool_maxsize=self._config.max_concurrency,
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._host_semaphores = {}
+        self._lock = threading.Lock()
+        self.stats = ImageFetchStats()
+
+    def fetch_all(self, urls: Sequence[str]) -> dict[str, Optional[bytes]]:
+        """
+        画像をまとめてダウンロードします
+
+        Args:
+            urls (Sequence[str]): 画像のURL。重複していてもよい
+
+        Returns:
+            dict[str, Optional[bytes]]: URL -> 画像データ。ダウンロードできなかった画像はNone
+        """
+        unique_urls = list(dict.fromkeys(urls))
+        self.stats = ImageFetchStats(requested=len(unique_urls))
+        start = time.perf_counter()
+        results = map_concurrently(
+            self._fetch, unique_urls, self._config.max_concurrency
+        )
+        self.stats.elapsed_seconds = time.perf_counter() - start
+        logger.info(
+            f"画像のダウンロードが完了しました: {self.stats.requested}件 "
+            f"(ダウンロード {self.stats.downloaded}, 未更新 {self.stats.not_modified}, "
+            f"失敗 {self.stats.failed}, リトライ {self.stats.retries}回), "
+            f"{self.stats.bytes_downloaded}バイト, "
+            f"{self.stats.images_per_second:.1f}件/秒"
+        )
+        return dict(zip(unique_urls, results))
+
+    def _fetch(self, url: str) -> Optional[bytes]:
+        cached_entry, cached_data = (
+            self._cache.get(url) if self._cache is not None else (None, None)
+        )
+        headers = {}
+        if cached_entry is not None and cached_entry.etag is not None:
+            headers["If-None-Match"] = cached_entry.etag
+        if cached_entry is not None and cached_entry.last_modified is not None:
+            headers["If-Modified-Since"] = cached_entry.last_modified
+
+        try:
+            for attempt in Retrying(
+                stop=stop_after_attempt(self._config.max_attempts),
+                wait=wait_exponential(
+                    multiplier=1,
+                    min=self._config.retry_wait_min_seconds,
+                    max=self._config.retry_wait_max_seconds,
+                ),
+                retry=retry_if_exception(_is_retryable),
+                before_sleep=self._count_retry,
+                reraise=True,
+            ):
+                with attempt:
+                    with self._host_semaphore(url):
+                        response = self._session.get(
+                            url, headers=headers, timeout=self._config.timeout_seconds
+                        )
+                    if response.status_code == 429 or response.status_code >= 500:
+                        raise _RetryableStatusError(
+                            f"Received HTTP status {response.status_code}"
+                        )
+        except Exception as e:
+            logger.warning(f"画像をダウンロードできません: {url} ({e})")
+            self._increment("failed")
+            return None
+
+        if response.status_code == 304 and cached_data is not None:
+            self._increment("not_modified")
+            return cached_data
+        if not response.ok:
+            logger.warning(
+                f"画像をダウンロードできません: {url} (HTTP {response.status_code})"
+            )
+            self._increment("failed")
+            return None
+
+        data = response.content
+        self._increment("downloaded")
+        self._increment("bytes_downloaded", len(data))
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        # 検証子のないレスポンスは再検証できないため保存しない
+        if self._cache is not None and (etag is not None or last_modified is not None):
+            self._cache.set(
+                _CacheEntry(url=url, etag=etag, last_modified=last_modified), data
+            )
+        return data
+
+    def _host_semaphore(self, url: str) -> threading.Semaphore:
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.Semaphore(
+                    self._config.per_host_concurrency
+                )
+            return self._host_semaphores[host]
+
+    def _count_retry(self, retry_state: RetryCallState) -> None:
+        self._increment("retries")
+
+    def _increment(self, field: str, value: int = 1) -> None:
+        with self._lock:
+            setattr(self.stats, field, getattr(self.stats, field) + value)
+
+
+def create_image_fetch_cache(bucket_name: str) -> ImageFetchCache:
+    """ドキュメントストアのバケットに画像を格納するImageFetchCacheを作成します"""
+    return ImageFetchCache(
+        S3ByteStore(bucket_name=bucket_name, prefix=IMAGE_FETCH_CACHE_PREFIX)
+    )
@@ -0,0 +1,236 @@
+import base64
+import io
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import Literal, NamedTuple, Optional
+
+from PIL import Image, UnidentifiedImageError
+from pydantic import BaseModel
+
+from server.rag.ingestion.model import _ImageMetadata
+
+logger = logging.getLogger(__name__)
+
+MAX_MODEL_IMAGE_BASE64_SIZE = 5 * 1024 * 1024
+"""Claudeに送信できる画像1枚あたりのBase64エンコード後のサイズの上限"""
+
+
+class ImageNormalizationConfig(BaseModel):
+    """ImageNormalizerの設定"""
+
+    max_long_edge: int = 1568
+    """正規化後の長辺のピクセル数の上限。Claudeはこれより大きい画像を縮小してから扱う"""
+
+    max_bytes: int = 3 * 1024 * 1024
+    """正規化後のバイト数の上限。Base64エンコード後もMAX_MODEL_IMAGE_BASE64_SIZEに収まる"""
+
+    format: Literal["WEBP", "JPEG"] = "WEBP"
+    """再エンコードする形式"""
+
+    quality: int = 85
+    min_quality: int = 50
+    """max_bytesに収まらない場合に品質を下げる下限。これでも収まらない場合は長辺を縮める"""
+
+    max_workers: Optional[int] = None
+    """正規化を行うプロセスの数。Noneの場合はCPU数"""
+
+
+class ImageNormalizationStats(BaseModel):
+    """ImageNormalizerの1回の実行で正規化した画像の数とバイト数"""
+
+    images: int = 0
+    normalized: int = 0
+    """縮小・再エンコードした画像の数"""
+
+    rescued: int = 0
+    """元の大きさではClaudeに送信できず除外されていたが、正規化によって送信できるようになった画像の数"""
+
+    failed: int = 0
+    """読み込めなかった、または上限に収まらなかったため、元の画像のまま使用する画像の数"""
+
+    bytes_before: int = 0
+    bytes_after: int = 0
+    elapsed_seconds: float = 0.0
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.bytes_before - self.bytes_after
+
+
+_PASSTHROUGH_FORMATS = ("JPEG", "PNG", "GIF", "WEBP")
+"""Claudeがそのまま扱える画像の形式"""
+
+
+class _NormalizedImage(NamedTuple):
+    data: bytes
+    mime_type: str
+    normalized: bool
+    """縮小・再エンコードしたかどうか"""
+
+    failed: bool
+    """読み込めなかった、または上限に収まらなかったため、元の画像のまま返したかどうか"""
+
+
+def _normalize_image(
+    data: bytes, mime_type: str, config: ImageNormalizationConfig
+) -> _NormalizedImage:
+    """
+    画像を長辺がmax_long_edge以下、バイト数がmax_bytes以下になるよう縮小・再エンコードします
+
+    既に上限に収まっているClaudeが扱える形式の画像は、画質を落とさないようそのまま返します。
+    Pillowで読み込めない画像もそのまま返します。
+
+    NOTE: プロセスプールの子プロセスで実行するため、モジュールのトップレベルに定義している
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if (
+                image.format in _PASSTHROUGH_FORMATS
+                and max(image.size) <= config.max_long_edge
+                and len(data) <= config.max_bytes
+            ):
+                return _NormalizedImage(data, mime_type, normalized=False, failed=False)
+
+            # アニメーションは最初のフレームのみを使用する
+            image.seek(0)
+            has_alpha = image.mode in ("RGBA", "LA") or "transparency" in image.info
+            frame = image.convert(
+                "RGBA" if has_alpha and config.format == "WEBP" else "RGB"
+            )
+    except (UnidentifiedImageError, OSError, ValueError):
+        return _NormalizedImage(data, mime_type, normalized=False, failed=True)
+
+    long_edge = min(config.max_long_edge, max(frame.size))
+    while long_edge > 0:
+        resized = frame.copy()
+        resized.thumbnail((long_edge, long_edge))
+        for quality in range(config.quality, config.min_quality - 1, -10):
+            buffer = io.BytesIO()
+            resized.save(buffer, format=config.format, quality=quality)
+            if buffer.tell() <= config.max_bytes:
+                return _NormalizedImage(
+                    buffer.getvalue(),
+                    f"image/{config.format.lower()}",
+                    normalized=True,
+                    failed=False,
+                )
+        long_edge = int(long_edge * 0.75)
+
+    return _NormalizedImage(data, mime_type, normalized=False, failed=True)
+
+
+class ImageNormalizer:
+    """
+    ダウンロードした画像を、Claudeに送信できる大きさと形式に正規化する
+
+    5MBを超える画像もここで縮小・再エンコードすることで、説明の生成から除外されずに済む。
+    正規化した画像は画像の説明の生成に使用し、そのままImageBlobStoreに格納されて検索時のプロンプトにも使用される。
+    画像の縮小・再エンコードはCPUを使用するため、プロセスプールで並列に実行する。
+    """
+
+    _config: ImageNormalizationConfig
+    _executor: Optional[ProcessPoolExecutor]
+    stats: ImageNormalizationStats
+
+    def __init__(self, config: Optional[ImageNormalizationConfig] = None):
+        """
+        ImageNormalizerを初期化します。
+
+        Args:
+            config (Optional[ImageNormalizationConfig]): 正規化の設定。Noneの場合はデフォルトの設定を使用する
+        """
+        self._config = config or ImageNormalizationConfig()
+        self._executor = None
+        self.stats = ImageNormalizationStats()
+
+    def __enter__(self) -> "ImageNormalizer":
+        """
+        プロセスプールを作成し、withブロックを抜けるまでnormalize_allの呼び出しをまたいで使い回します
+
+        子プロセスはここでまとめて作成するため、他のスレッドを開始する前に呼び出します。
+        """
+        if self._max_workers > 1:
+            self._executor = self._create_executor()
+            # 子プロセスは最初のタスクを投入した時点で作成されるため、ここで作成させておく
+            self._executor.submit(int).result()
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    @property
+    def _max_workers(self) -> int:
+        return self._config.max_workers or os.cpu_count() or 1
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        # NOTE: spawnでは子プロセスが__main__のモジュールを読み込み直すため、
+        # index_documents.pyのようにトップレベルで処理を行うスクリプトから呼び出すと処理が再実行されてしまう
+        # forkはスレッドを実行中のプロセスから行うとデッドロックのおそれがあるため、
+        # クローラーなどのスレッドの開始前(withブロック)か、終了後に作成する
+        return ProcessPoolExecutor(
+            max_workers=self._max_workers,
+            mp_context=multiprocessing.get_context("fork"),
+        )
+
+    def normalize_all(self, images: list[_ImageMetadata]) -> list[_ImageMetadata]:
+        """
+        画像をまとめて正規化します
+
+        Args:
+            images (list[_ImageMetadata]): 画像データ
+
+        Returns:
+            list[_ImageMetadata]: imagesと同じ順序の、正規化した画像データ
+        """
+        start = time.perf_counter()
+        data = [base64.b64decode(image.base64) for image in images]
+        args = (data, [image.mime_type for image in images], repeat(self._config))
+        # 1プロセスで足りる場合は、プロセスの起動と画像データの受け渡しを省く
+        if len(images) <= 1 or self._max_workers <= 1:
+            results = list(map(_normalize_image, *args))
+        elif self._executor is not None:
+            results = list(self._executor.map(_normalize_image, *args, chunksize=4))
+        else:
+            with self._create_executor() as executor:
+                results = list(executor.map(_normalize_image, *args, chunksize=4))
+
+        normalized_images: list[_ImageMetadata] = []
+        stats = ImageNormalizationStats(images=len(images))
+        for image, original, result in zip(images, data, results):
+            stats.bytes_before += len(original)
+            stats.bytes_after += len(result.data)
+            stats.failed += result.failed
+            if not result.normalized:
+                normalized_images.append(image)
+                continue
+
+            normalized_base64 = base64.b64encode(result.data).decode("utf-8")
+            stats.normalized += 1
+            stats.rescued += (
+                len(image.base64) >= MAX_MODEL_IMAGE_BASE64_SIZE
+                and len(normalized_base64) < MAX_MODEL_IMAGE_BASE64_SIZE
+            )
+            normalized_images.append(
+                _ImageMetadata(
+                    url=image.url,
+                    mime_type=result.mime_type,
+                    base64=normalized_base64,
+                )
+            )
+        stats.elapsed_seconds = time.perf_counter() - start
+        self.stats = stats
+
+        logger.info(
+            f"画像の正規化が完了しました: {stats.images}件 "
+            f"(正規化 {stats.normalized}, 送信可能になった画像 {stats.rescued}, "
+            f"失敗 {stats.failed}), "
+            f"{stats.bytes_before}バイト -> {stats.bytes_after}バイト, "
+            f"{stats.elapsed_seconds:.1f}秒"
+        )
+        return normalized_images
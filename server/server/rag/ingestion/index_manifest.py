@@ -0,0 +1,179 @@
+import hashlib
+import json
+import uuid
+from typing import Optional, Sequence
+
+from langchain_core.documents import Document
+from langchain_core.stores import ByteStore
+from pydantic import BaseModel
+
+from server.rag.ingestion.index_version import INDEX_METADATA_PREFIX
+from server.rag.ingestion.s3_store import S3ByteStore
+
+_MANIFEST_KEY = "manifest.json"
+_CHECKPOINT_KEY = "checkpoint.json"
+
+_DOC_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "rag-document-chunk")
+"""チャンクのIDを決定的に作成するためのUUIDv5の名前空間"""
+
+
+class ManifestEntry(BaseModel):
+    """インデックスに格納したチャンク"""
+
+    url: str
+    chunk_hash: str
+    """チャンクの本文とメタデータのSHA-256"""
+
+
+class IndexManifest(BaseModel):
+    """インデックスに格納したチャンクの一覧"""
+
+    entries: dict[str, ManifestEntry] = {}
+    """チャンクのID -> チャンク"""
+
+
+class IndexCheckpoint(BaseModel):
+    """中断した索引作成を再開するための、格納済みのチャンクの記録"""
+
+    base_manifest: str
+    """索引作成を開始した時点のマニフェストのダイジェスト。マニフェストが変わった場合は使用しない"""
+
+    written: list[str] = []
+    """ベクトルストアとドキュメントストアの両方に格納したチャンクのID"""
+
+
+class IndexingDiff(BaseModel):
+    """前回の索引作成時からの差分"""
+
+    added: list[str] = []
+    """新しく追加した(内容が変わったものを含む)チャンクのID"""
+
+    removed: list[str] = []
+    """削除した(内容が変わったものを含む)チャンクのID"""
+
+    unchanged: int = 0
+    """変わっていないため、埋め込みや書き込みを省略したチャンクの数"""
+
+    added_urls: list[str] = []
+    changed_urls: list[str] = []
+    removed_urls: list[str] = []
+
+    @property
+    def has_changes(self) -> bool:
+        return len(self.added) > 0 or len(self.removed) > 0
+
+    def summary(self) -> str:
+        return (
+            f"チャンク: 追加 {len(self.added)}, 削除 {len(self.removed)}, 変更なし {self.unchanged} / "
+            f"ページ: 追加 {len(self.added_urls)}, 変更 {len(self.changed_urls)}, "
+            f"削除 {len(self.removed_urls)}"
+        )
+
+
+def chunk_hash(doc: Document) -> str:
+    """チャンクの本文とメタデータのハッシュ値を返します。いずれかが変わればハッシュ値も変わります"""
+    payload = json.dumps(
+        {"page_content": doc.page_content, "metadata": doc.metadata},
+        ensure_ascii=False,
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def assign_doc_ids(
+    documents: Sequence[Document],
+    occurrences: Optional[dict[tuple[str, str], int]] = None,
+) -> list[tuple[str, ManifestEntry]]:
+    """
+    チャンクごとに、出典のURLと内容から決定的にIDを割り当てます
+
+    同じ内容のチャンクは実行ごとに同じIDとなるため、前回のマニフェストと比較して差分のみを更新できます。
+    同じページに同じ内容のチャンクが複数ある場合は、出現順の番号で区別します。
+
+    Args:
+        documents (Sequence[Document]): IDを割り当てるチャンク
+        occurrences (Optional[dict[tuple[str, str], int]]): (URL, ハッシュ値)ごとの出現回数。
+            チャンクを複数回に分けて渡す場合に同じdictを渡すと、まとめて渡した場合と同じIDとなる
+
+    Returns:
+        list[tuple[str, ManifestEntry]]: documentsと同じ順序の、チャンクのIDとマニフェストのエントリ
+    """
+    if occurrences is None:
+        occurrences = {}
+    assigned = []
+    for doc in documents:
+        entry = ManifestEntry(
+            url=doc.metadata.get("url", ""), chunk_hash=chunk_hash(doc)
+        )
+        occurrence = occurrences.get((entry.url, entry.chunk_hash), 0)
+        occurrences[(entry.url, entry.chunk_hash)] = occurrence + 1
+        doc_id = uuid.uuid5(
+            _DOC_ID_NAMESPACE, f"{entry.url}\n{entry.chunk_hash}\n{occurrence}"
+        )
+        assigned.append((str(doc_id), entry))
+    return assigned
+
+
+def manifest_digest(manifest: IndexManifest) -> str:
+    """マニフェストに含まれるチャンクのIDのダイジェストを返します"""
+    return hashlib.sha256(
+        "\n".join(sorted(manifest.entries)).encode("utf-8")
+    ).hexdigest()
+
+
+def diff_manifest(previous: IndexManifest, current: IndexManifest) -> IndexingDiff:
+    """前回のマニフェストと今回のマニフェストの差分を返します"""
+    added = [id_ for id_ in current.entries if id_ not in previous.entries]
+    removed = [id_ for id_ in previous.entries if id_ not in current.entries]
+
+    previous_urls = {entry.url for entry in previous.entries.values()}
+    current_urls = {entry.url for entry in current.entries.values()}
+    touched_urls = {current.entries[id_].url for id_ in added} | {
+        previous.entries[id_].url for id_ in removed
+    }
+    return IndexingDiff(
+        added=added,
+        removed=removed,
+        unchanged=len(current.entries) - len(added),
+        added_urls=sorted(current_urls - previous_urls),
+        changed_urls=sorted(touched_urls & previous_urls & current_urls),
+        removed_urls=sorted(previous_urls - current_urls),
+    )
+
+
+class IndexManifestStore:
+    """IndexManifestと、索引作成のチェックポイントをByteStoreに保存・読み込みするストア"""
+
+    _store: ByteStore
+
+    def __init__(self, store: ByteStore):
+        self._store = store
+
+    def load(self) -> Optional[IndexManifest]:
+        """保存されたマニフェストを読み込みます。存在しない場合はNoneを返します"""
+        [data] = self._store.mget([_MANIFEST_KEY])
+        return IndexManifest.model_validate_json(data) if data is not None else None
+
+    def save(self, manifest: IndexManifest) -> None:
+        self._store.mset([(_MANIFEST_KEY, manifest.model_dump_json().encode("utf-8"))])
+
+    def load_checkpoint(self) -> Optional[IndexCheckpoint]:
+        """中断した索引作成のチェックポイントを読み込みます。存在しない場合はNoneを返します"""
+        [data] = self._store.mget([_CHECKPOINT_KEY])
+        return IndexCheckpoint.model_validate_json(data) if data is not None else None
+
+    def save_checkpoint(self, checkpoint: IndexCheckpoint) -> None:
+        self._store.mset(
+            [(_CHECKPOINT_KEY, checkpoint.model_dump_json().encode("utf-8"))]
+        )
+
+    def delete_checkpoint(self) -> None:
+        self._store.mdelete([_CHECKPOINT_KEY])
+
+
+def create_index_manifest_store(bucket_name: str) -> IndexManifestStore:
+    """ドキュメントストアのバケットにマニフェストを格納するIndexManifestStoreを作成します"""
+    return IndexManifestStore(
+        S3ByteStore(bucket_name=bucket_name, prefix=INDEX_METADATA_PREFIX)
+    )
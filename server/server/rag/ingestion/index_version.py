@@ -0,0 +1,76 @@
+import threading
+import time
+import uuid
+from typing import Optional
+
+from langchain_core.stores import ByteStore
+
+from server.rag.ingestion.s3_store import S3ByteStore
+
+INDEX_METADATA_PREFIX = "_meta/"
+"""ドキュメントストアと同じバケット内でインデックスのメタデータを格納するプレフィックス"""
+
+
+class IndexVersionStore:
+    """
+    インデックスのバージョンを管理するストア
+
+    インデックスを作成・更新するたびに新しいバージョンを発行し、
+    検索結果に依存するキャッシュはバージョンが変わった時点で無効とみなす。
+    """
+
+    _store: ByteStore
+    _key: str
+    _refresh_seconds: float
+    _version: Optional[str]
+    _loaded_at: Optional[float]
+    _lock: threading.Lock
+
+    def __init__(
+        self,
+        store: ByteStore,
+        key: str = "index_version",
+        refresh_seconds: float = 60,
+    ):
+        """
+        IndexVersionStoreを初期化します。
+
+        Args:
+            store (ByteStore): バージョンを格納するストア
+            key (str): バージョンを格納するキー
+            refresh_seconds (float): バージョンを読み込み直す間隔(秒)
+        """
+        self._store = store
+        self._key = key
+        self._refresh_seconds = refresh_seconds
+        self._version = None
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def get(self) -> str:
+        """現在のバージョンを返します。一度もインデックスが作成されていない場合は空文字を返します"""
+        with self._lock:
+            if (
+                self._loaded_at is None
+                or time.time() - self._loaded_at >= self._refresh_seconds
+            ):
+                [data] = self._store.mget([self._key])
+                self._version = data.decode("utf-8") if data is not None else ""
+                self._loaded_at = time.time()
+            return self._version or ""
+
+    def bump(self) -> str:
+        """新しいバージョンを発行して保存し、そのバージョンを返します"""
+        version = f"{int(time.time())}-{uuid.uuid4().hex[:8]}"
+        self._store.mset([(self._key, version.encode("utf-8"))])
+        with self._lock:
+            self._version = version
+            self._loaded_at = time.time()
+        return version
+
+
+def create_index_version_store(bucket_name: str) -> IndexVersionStore:
+    """ドキュメントストアのバケットにバージョンを格納するIndexVersionStoreを作成します"""
+    return IndexVersionStore(
+        S3ByteStore(bucket_name=bucket_name, prefix=INDEX_METADATA_PREFIX)
+    )
@@ -0,0 +1,321 @@
+import logging
+import queue
+import sys
+import threading
+import time
+from functools import partial
+from typing import Any, Callable, Iterable, Iterator, Optional, TypeVar
+
+from langchain_core.documents import Document
+from pydantic import BaseModel
+
+from server.rag.ingestion.document_indexer import (
+    DocumentIndexer,
+    IndexingSession,
+    IndexWriteStats,
+)
+from server.rag.ingestion.document_preprocessor import DocumentPreprocessor
+from server.rag.ingestion.index_manifest import IndexingDiff
+from server.rag.ingestion.model import _ImageMetadata
+
+try:
+    import resource
+except ImportError:  # Windowsにはresourceモジュールがない
+    resource = None  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class PipelineConfig(BaseModel):
+    """IngestionPipelineの設定"""
+
+    queue_size: int = 8
+    """段階の間のキューに置けるバッチの数の上限。後段が遅い場合、前段はキューが空くまで待つ"""
+
+    page_batch_size: int = 16
+    """画像の抽出と説明の生成をまとめて行うページの数"""
+
+    chunk_batch_size: int = 256
+    """まとめて埋め込んで格納するチャンクの数"""
+
+
+class StageStats(BaseModel):
+    """IngestionPipelineの1つの段階で処理したドキュメントの数と所要時間"""
+
+    name: str
+    items_in: int = 0
+    """前段から受け取ったドキュメント(ページ・画像・チャンク)の数"""
+
+    items_out: int = 0
+    """後段に渡したドキュメントの数。最後の段階では書き込んだ(追加・変更された)チャンクの数"""
+
+    input_wait_seconds: float = 0.0
+    """前段からの入力を待っていた時間(秒)"""
+
+    output_wait_seconds: float = 0.0
+    """後段のキューが空くのを待っていた時間(秒)。長い段階の後段がボトルネックとなっている"""
+
+    busy_seconds: float = 0.0
+    """入出力を待たずに処理していた時間(秒)"""
+
+    @property
+    def items_per_second(self) -> float:
+        """処理していた時間あたりに後段に渡したドキュメントの数"""
+        return self.items_out / self.busy_seconds if self.busy_seconds > 0 else 0.0
+
+
+class PipelineStats(BaseModel):
+    """IngestionPipelineの1回の実行の統計"""
+
+    stages: list[StageStats] = []
+    write: IndexWriteStats = IndexWriteStats()
+    """最後の段階で埋め込んで格納したチャンクの統計"""
+
+    elapsed_seconds: float = 0.0
+    peak_rss_bytes: Optional[int] = None
+    """プロセスの最大常駐メモリ(バイト)。取得できない環境ではNone"""
+
+
+class _PipelineStopped(Exception):
+    """他の段階でエラーが発生したため、この段階の処理を中断する"""
+
+
+_END = object()
+"""前段の処理がすべて完了したことを表す、キューの終端"""
+
+_POLL_INTERVAL_SECONDS = 0.1
+
+
+class IngestionPipeline:
+    """
+    クローリングから索引の作成までを、段階ごとのスレッドで並行に実行するパイプライン
+
+    クローリング → Markdownへの変換 → 画像の抽出 → 画像の説明の生成 → チャンクへの分割 → 埋め込みと格納
+    の各段階を上限のあるキューでつなぐため、後段が遅い場合は前段が待ち、
+    メモリの使用量はサイトの大きさによらずキューの大きさとバッチの大きさで決まる。
+    ページを取得している間にも、取得済みのページの画像の説明の生成やチャンクの埋め込みが進む。
+
+    いずれかの段階でエラーが発生した場合は、すべての段階を中断して例外を送出し、マニフェストを更新しない。
+    それまでに格納したチャンクはチェックポイントに記録され、次回の実行では書き込み直さない。
+    """
+
+    _preprocessor: DocumentPreprocessor
+    _indexer: DocumentIndexer
+    _config: PipelineConfig
+    _stop: threading.Event
+    _errors: list[BaseException]
+    stats: PipelineStats
+
+    def __init__(
+        self,
+        preprocessor: DocumentPreprocessor,
+        indexer: DocumentIndexer,
+        config: Optional[PipelineConfig] = None,
+    ):
+        """
+        IngestionPipelineを初期化します。
+
+        Args:
+            preprocessor (DocumentPreprocessor): ページの取得からチャンクへの分割までを行うDocumentPreprocessor
+            indexer (DocumentIndexer): チャンクを格納するDocumentIndexer
+            config (Optional[PipelineConfig]): パイプラインの設定。Noneの場合はデフォルトの設定を使用する
+        """
+        self._preprocessor = preprocessor
+        self._indexer = indexer
+        self._config = config or PipelineConfig()
+        self._stop = threading.Event()
+        self._errors = []
+        self.stats = PipelineStats()
+
+    def run(self) -> IndexingDiff:
+        """
+        サイトをクローリングし、前回の索引作成時との差分をインデックスに反映します
+
+        取得に失敗したページは一時的なエラーの可能性があるため、前回のチャンクを残します。
+
+        Returns:
+            IndexingDiff: 前回の索引作成時からの差分
+        """
+        start = time.perf_counter()
+        self._stop = threading.Event()
+        self._errors = []
+        with self._indexer.begin() as session:
+            diff = self._run(session)
+        self.stats.elapsed_seconds = time.perf_counter() - start
+        self.stats.peak_rss_bytes = _peak_rss_bytes()
+        logger.info(
+            f"パイプラインが完了しました: {self.stats.elapsed_seconds:.1f}秒, "
+            + ", ".join(
+                f"{stats.name} {stats.items_out}件 ({stats.items_per_second:.1f}件/秒)"
+                for stats in self.stats.stages
+            )
+        )
+        return diff
+
+    def _run(self, session: IndexingSession) -> IndexingDiff:
+        stages: list[tuple[str, Callable[[Iterator[Any]], Iterable[Any]]]] = [
+            ("crawl", lambda _: self._preprocessor.crawl()),
+            ("markdown", self._to_markdown),
+            ("images", self._extract_images),
+            ("describe", self._describe_images),
+            ("split", self._split),
+            ("index", partial(self._index, session)),
+        ]
+        # クローラーはページを1件ずつ出力するため、最初のキューのみページの数で上限を設ける
+        queues: list[queue.Queue] = [
+            queue.Queue(maxsize=self._config.page_batch_size)
+        ] + [
+            queue.Queue(maxsize=self._config.queue_size) for _ in range(len(stages) - 2)
+        ]
+        stage_stats = [StageStats(name=name) for name, _ in stages]
+
+        # 画像の正規化のプロセスプールは、各段階のスレッドを開始する前に作成する
+        with self._preprocessor:
+            threads = [
+                threading.Thread(
+                    target=self._run_stage,
+                    args=(
+                        transform,
+                        stats,
+                        queues[i - 1] if i > 0 else None,
+                        queues[i] if i < len(queues) else None,
+                    ),
+                    name=f"ingestion-{name}",
+                    daemon=True,
+                )
+                for i, ((name, transform), stats) in enumerate(zip(stages, stage_stats))
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        if len(self._errors) > 0:
+            raise self._errors[0]
+
+        self.stats = PipelineStats(stages=stage_stats, write=session.stats)
+        return session.commit(keep_urls=self._preprocessor.crawl_stats.failed_urls)
+
+    def _run_stage(
+        self,
+        transform: Callable[[Iterator[Any]], Iterable[Any]],
+        stats: StageStats,
+        input: Optional[queue.Queue],
+        output: Optional[queue.Queue],
+    ) -> None:
+        start = time.perf_counter()
+        try:
+            items = self._receive(input, stats) if input is not None else iter(())
+            for item in transform(items):
+                if output is None:
+                    stats.items_out += item
+                    continue
+                self._send(output, item, stats)
+                stats.items_out += _count(item)
+            if output is not None:
+                self._send(output, _END, stats)
+        except _PipelineStopped:
+            pass
+        except BaseException as e:
+            logger.exception(f"パイプラインの{stats.name}の段階でエラーが発生しました")
+            self._errors.append(e)
+            self._stop.set()
+        finally:
+            stats.busy_seconds = (
+                time.perf_counter()
+                - start
+                - stats.input_wait_seconds
+                - stats.output_wait_seconds
+            )
+
+    def _receive(self, input: queue.Queue, stats: StageStats) -> Iterator[Any]:
+        while True:
+            start = time.perf_counter()
+            while True:
+                try:
+                    item = input.get(timeout=_POLL_INTERVAL_SECONDS)
+                    break
+                except queue.Empty:
+                    if self._stop.is_set():
+                        raise _PipelineStopped()
+            stats.input_wait_seconds += time.perf_counter() - start
+            if item is _END:
+                return
+            stats.items_in += _count(item)
+            yield item
+
+    def _send(self, output: queue.Queue, item: Any, stats: StageStats) -> None:
+        start = time.perf_counter()
+        while True:
+            try:
+                output.put(item, timeout=_POLL_INTERVAL_SECONDS)
+                break
+            except queue.Full:
+                if self._stop.is_set():
+                    raise _PipelineStopped()
+        stats.output_wait_seconds += time.perf_counter() - start
+
+    def _to_markdown(self, docs: Iterator[Document]) -> Iterator[list[Document]]:
+        # ページをまとめてプロセスプールに渡し、並列に変換する
+        for pages in _batched(docs, self._config.page_batch_size):
+            yield self._preprocessor.to_markdown(pages)
+
+    def _extract_images(
+        self, batches: Iterator[list[Document]]
+    ) -> Iterator[tuple[list[Document], list[_ImageMetadata]]]:
+        for pages in batches:
+            yield self._preprocessor.extract_images(pages)
+
+    def _describe_images(
+        self, batches: Iterator[tuple[list[Document], list[_ImageMetadata]]]
+    ) -> Iterator[list[Document]]:
+        for pages, images in batches:
+            if len(images) == 0:
+                yield pages
+                continue
+            yield pages + self._preprocessor.describe_images(images)
+
+    def _split(self, batches: Iterator[list[Document]]) -> Iterator[list[Document]]:
+        return _batched(
+            (chunk for docs in batches for chunk in self._preprocessor.split(docs)),
+            self._config.chunk_batch_size,
+        )
+
+    def _index(
+        self, session: IndexingSession, batches: Iterator[list[Document]]
+    ) -> Iterator[int]:
+        for chunks in batches:
+            yield session.add(chunks)
+        # 書き込み中のバッチの完了までをこの段階の処理時間に含める
+        session.flush()
+
+
+def _batched(items: Iterable[T], size: int) -> Iterator[list[T]]:
+    """itemsをsize件ずつのリストにまとめる"""
+    batch: list[T] = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def _count(item: Any) -> int:
+    """キューに置いたバッチに含まれるドキュメントの数"""
+    if isinstance(item, tuple):
+        return sum(len(part) for part in item)
+    if isinstance(item, list):
+        return len(item)
+    return 1
+
+
+def _peak_rss_bytes() -> Optional[int]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrssの単位はLinuxではキロバイト、macOSではバイトである
+    return peak if sys.platform == "darwin" else peak * 1024
@@ -0,0 +1,342 @@
+import io
+import math
+import re
+import threading
+import time
+import unicodedata
+import uuid
+from collections import Counter
+from typing import Optional, Sequence
+
+import numpy as np
+from langchain_core.stores import ByteStore
+
+from server.rag.ingestion.s3_store import S3ByteStore
+
+LEXICAL_INDEX_PREFIX = "lexical/"
+"""ドキュメントストアと同じバケット内で語彙インデックスを格納するプレフィックス"""
+
+_LEXICAL_INDEX_KEY = "index.npz"
+_LEXICAL_INDEX_VERSION_KEY = "index.version"
+
+
+def tokenize_ngrams(text: str, ngram_size: int = 2) -> list[str]:
+    """テキストを正規化し、単語文字の連続ごとに文字n-gramへ分割します"""
+    normalized = unicodedata.normalize("NFKC", text).lower()
+    tokens: list[str] = []
+    for run in re.findall(r"\w+", normalized):
+        if len(run) <= ngram_size:
+            tokens.append(run)
+            continue
+        tokens.extend(run[i : i + ngram_size] for i in range(len(run) - ngram_size + 1))
+    return tokens
+
+
+class LexicalIndex:
+    """
+    文字n-gramに対するBM25の転置インデックス
+
+    日本語を外部の形態素解析器なしで扱えるよう、テキストを正規化して単語文字の連続ごとに区切り、
+    その中の文字n-gramを語として扱う。製品名やカタカナ語のように、埋め込みベクトルでは
+    取りこぼしやすい完全一致の語を拾うことを目的とする。
+
+    転置インデックスはCSR形式のNumPy配列として保持し、npz形式で保存する。
+    追加・削除したドキュメントはcommitするまで保留し、CSR形式の配列はcommit時にまとめて作り直す。
+    検索やシリアライズの前には保留中の変更を自動的にcommitする。
+    """
+
+    _ngram_size: int
+    _k1: float
+    _b: float
+
+    _doc_ids: list[str]
+    _sources: list[str]  # 各ドキュメントの出典(URL)
+    _positions: dict[str, int]  # ドキュメントのID -> 位置
+    _doc_lengths: np.ndarray  # (ドキュメント数,)
+    _terms: dict[str, int]  # 語 -> 転置リストの番号
+    _indptr: np.ndarray  # (語数 + 1,) 各語の転置リストの開始位置
+    _postings: np.ndarray  # 転置リスト中のドキュメントの位置
+    _frequencies: np.ndarray  # 転置リスト中の語の出現回数
+
+    _pending: dict[str, tuple[str, Counter[str]]]
+    """commitしていない追加ドキュメントのID -> (出典, 語の出現回数)"""
+
+    _deleted: set[str]
+    """commitしていない、削除または置き換えるドキュメントのID(tombstone)"""
+
+    def __init__(self, ngram_size: int = 2, k1: float = 1.2, b: float = 0.75):
+        """
+        空のLexicalIndexを初期化します。
+
+        Args:
+            ngram_size (int): 語として扱う文字n-gramの長さ
+            k1 (float): BM25の語の出現回数に対する飽和パラメータ
+            b (float): BM25の文書長による正規化の強さ
+        """
+        self._ngram_size = ngram_size
+        self._k1 = k1
+        self._b = b
+        self._doc_ids = []
+        self._sources = []
+        self._positions = {}
+        self._doc_lengths = np.empty(0, dtype=np.int32)
+        self._terms = {}
+        self._indptr = np.zeros(1, dtype=np.int64)
+        self._postings = np.empty(0, dtype=np.int32)
+        self._frequencies = np.empty(0, dtype=np.uint16)
+        self._pending = {}
+        self._deleted = set()
+
+    def __len__(self) -> int:
+        self.commit()
+        return len(self._doc_ids)
+
+    def add(
+        self,
+        doc_ids: Sequence[str],
+        texts: Sequence[str],
+        sources: Optional[Sequence[str]] = None,
+    ) -> None:
+        """
+        ドキュメントを追加します。既に存在するIDのドキュメントは置き換えます
+
+        追加したドキュメントはcommitするまで検索結果に反映されません。
+
+        Args:
+            doc_ids (Sequence[str]): ドキュメントのID
+            texts (Sequence[str]): ドキュメントのテキスト
+            sources (Optional[Sequence[str]]): ドキュメントの出典(URL)。省略した場合はドキュメントのIDを使用する
+        """
+        for doc_id, text, source in zip(doc_ids, texts, sources or doc_ids):
+            if doc_id in self._positions:
+                self._deleted.add(doc_id)
+            # 置き換えたドキュメントは、最後に追加したものとして末尾に並べる
+            self._pending.pop(doc_id, None)
+            self._pending[doc_id] = (source, Counter(self._tokenize(text)))
+
+    def delete(self, doc_ids: Sequence[str]) -> None:
+        """指定したIDのドキュメントを削除します。存在しないIDは無視します"""
+        for doc_id in doc_ids:
+            self._pending.pop(doc_id, None)
+            if doc_id in self._positions:
+                self._deleted.add(doc_id)
+
+    def commit(self) -> None:
+        """保留中の追加・削除を反映した転置インデックスを作り直します"""
+        if len(self._pending) == 0 and len(self._deleted) == 0:
+            return
+
+        # 既存の転置リストから、削除・置き換え対象のドキュメントを除く
+        kept = np.asarray(
+            [id_ not in self._deleted for id_ in self._doc_ids], dtype=bool
+        )
+        kept_entries = kept[self._postings]
+        old_terms = sorted(self._terms, key=self._terms.__getitem__)
+        old_rows = np.repeat(np.arange(len(old_terms)), np.diff(self._indptr))
+        old_docs = (np.cumsum(kept) - 1)[self._postings[kept_entries]]
+        old_frequencies = self._frequencies[kept_entries]
+
+        doc_ids = [id_ for id_, k in zip(self._doc_ids, kept) if k]
+        sources = [source for source, k in zip(self._sources, kept) if k]
+        doc_lengths = self._doc_lengths[kept].tolist()
+        new_terms: list[str] = []
+        new_docs: list[int] = []
+        new_frequencies: list[int] = []
+        for doc_id, (source, counts) in self._pending.items():
+            new_terms.extend(counts.keys())
+            new_docs.extend([len(doc_ids)] * len(counts))
+            new_frequencies.extend(counts.values())
+            doc_ids.append(doc_id)
+            sources.append(source)
+            doc_lengths.append(sum(counts.values()))
+
+        vocabulary = sorted(set(old_terms).union(new_terms))
+        term_rows = {term: i for i, term in enumerate(vocabulary)}
+        old_to_new = np.asarray([term_rows[term] for term in old_terms], dtype=np.int64)
+        rows = np.concatenate(
+            [
+                old_to_new[old_rows[kept_entries]],
+                np.asarray([term_rows[term] for term in new_terms], dtype=np.int64),
+            ]
+        )
+        docs = np.concatenate([old_docs, np.asarray(new_docs, dtype=np.int64)])
+        frequencies = np.concatenate(
+            [old_frequencies, np.asarray(new_frequencies, dtype=np.int64)]
+        )
+        # 転置リストは語ごとに、ドキュメントの位置の順に並べる
+        order = np.lexsort((docs, rows))
+
+        # どのドキュメントにも出現しなくなった語を除く
+        term_counts = np.bincount(rows, minlength=len(vocabulary))
+        used = term_counts > 0
+        terms = [term for term, u in zip(vocabulary, used) if u]
+
+        self._doc_ids = doc_ids
+        self._sources = sources
+        self._positions = {id_: i for i, id_ in enumerate(doc_ids)}
+        self._doc_lengths = np.asarray(doc_lengths, dtype=np.int32)
+        self._terms = {term: i for i, term in enumerate(terms)}
+        self._indptr = np.concatenate(
+            [[0], np.cumsum(term_counts[used], dtype=np.int64)]
+        )
+        self._postings = docs[order].astype(np.int32)
+        # 出現回数はuint16で保持するため、上限で切り詰める(BM25では出現回数の影響は飽和するため問題ない)
+        self._frequencies = np.minimum(frequencies[order], 65535).astype(np.uint16)
+        self._pending = {}
+        self._deleted = set()
+
+    def search(self, query: str, k: int = 20) -> list[tuple[str, float]]:
+        """
+        BM25のスコアが高い順にドキュメントのIDとスコアを返します
+
+        Args:
+            query (str): 検索クエリ
+            k (int): 返すドキュメントの最大数
+
+        Returns:
+            list[tuple[str, float]]: ドキュメントのIDとスコアのリスト。スコアが0のものは含まない
+        """
+        self.commit()
+        doc_count = len(self._doc_ids)
+        if doc_count == 0:
+            return []
+
+        average_length = max(float(self._doc_lengths.mean()), 1.0)
+        length_norm = self._k1 * (
+            1 - self._b + self._b * self._doc_lengths / average_length
+        )
+
+        scores = np.zeros(doc_count, dtype=np.float32)
+        for term, query_freq in Counter(self._tokenize(query)).items():
+            row = self._terms.get(term)
+            if row is None:
+                continue
+            start, end = self._indptr[row], self._indptr[row + 1]
+            docs = self._postings[start:end]
+            freqs = self._frequencies[start:end].astype(np.float32)
+            idf = math.log(1 + (doc_count - len(docs) + 0.5) / (len(docs) + 0.5))
+            scores[docs] += (
+                query_freq * idf * freqs * (self._k1 + 1) / (freqs + length_norm[docs])
+            )
+
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        return [(self._doc_ids[i], float(scores[i])) for i in candidates]
+
+    def source(self, doc_id: str) -> Optional[str]:
+        """ドキュメントの出典(URL)を返します"""
+        self.commit()
+        position = self._positions.get(doc_id)
+        return self._sources[position] if position is not None else None
+
+    def to_bytes(self) -> bytes:
+        """npz形式にシリアライズします"""
+        self.commit()
+        terms = sorted(self._terms, key=self._terms.__getitem__)
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            params=np.asarray([self._ngram_size, self._k1, self._b], dtype=np.float64),
+            doc_ids=np.asarray(self._doc_ids, dtype=str),
+            sources=np.asarray(self._sources, dtype=str),
+            doc_lengths=self._doc_lengths,
+            terms=np.asarray(terms, dtype=str),
+            indptr=self._indptr,
+            postings=self._postings,
+            frequencies=self._frequencies,
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "LexicalIndex":
+        """to_bytesでシリアライズしたデータから復元します"""
+        with np.load(io.BytesIO(data)) as npz:
+            ngram_size, k1, b = npz["params"].tolist()
+            index = cls(ngram_size=int(ngram_size), k1=k1, b=b)
+            index._doc_ids = npz["doc_ids"].tolist()
+            # 出典を保持する前に作成されたインデックスではドキュメントのIDで代用する
+            index._sources = (
+                npz["sources"].tolist() if "sources" in npz.files else index._doc_ids
+            )
+            index._positions = {id_: i for i, id_ in enumerate(index._doc_ids)}
+            index._doc_lengths = npz["doc_lengths"]
+            index._terms = {term: i for i, term in enumerate(npz["terms"].tolist())}
+            index._indptr = npz["indptr"]
+            index._postings = npz["postings"]
+            index._frequencies = npz["frequencies"]
+        return index
+
+    def _tokenize(self, text: str) -> list[str]:
+        return tokenize_ngrams(text, self._ngram_size)
+
+
+class LexicalIndexStore:
+    """
+    LexicalIndexをByteStoreに保存・読み込みするストア
+
+    保存のたびにインデックスの後でバージョンを書き込む。currentでは、refresh_secondsごとに
+    バージョンのみを確認し、変わっていた場合に限りインデックスを読み込み直す。
+    """
+
+    _store: ByteStore
+    _refresh_seconds: float
+    _index: Optional[LexicalIndex]
+    _version: Optional[bytes]
+    _checked_at: Optional[float]
+    _lock: threading.Lock
+
+    def __init__(self, store: ByteStore, refresh_seconds: float = 5 * 60):
+        """
+        LexicalIndexStoreを初期化します。
+
+        Args:
+            store (ByteStore): LexicalIndexを格納するストア
+            refresh_seconds (float): currentでインデックスの更新を確認する間隔(秒)
+        """
+        self._store = store
+        self._refresh_seconds = refresh_seconds
+        self._index = None
+        self._version = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def load(self) -> Optional[LexicalIndex]:
+        """保存されたLexicalIndexを読み込みます。存在しない場合はNoneを返します"""
+        [data] = self._store.mget([_LEXICAL_INDEX_KEY])
+        return LexicalIndex.from_bytes(data) if data is not None else None
+
+    def current(self) -> Optional[LexicalIndex]:
+        """
+        読み込み済みのLexicalIndexを返します
+
+        前回の確認からrefresh_secondsが経過している場合は、バージョンが変わっていれば読み込み直します。
+        存在しない場合はNoneを返します。
+        """
+        with self._lock:
+            if (
+                self._checked_at is not None
+                and time.time() - self._checked_at < self._refresh_seconds
+            ):
+                return self._index
+
+            [version] = self._store.mget([_LEXICAL_INDEX_VERSION_KEY])
+            # バージョンを記録する前に保存されたインデックスは、確認のたびに読み込み直す
+            if self._checked_at is None or version is None or version != self._version:
+                self._index = self.load()
+                self._version = version
+            self._checked_at = time.time()
+            return self._index
+
+    def save(self, index: LexicalIndex) -> None:
+        self._store.mset([(_LEXICAL_INDEX_KEY, index.to_bytes())])
+        # バージョンはインデックスの後に書き込み、読み込み側が新しいバージョンで古いインデックスを読まないようにする
+        self._store.mset([(_LEXICAL_INDEX_VERSION_KEY, uuid.uuid4().hex.encode())])
+
+
+def create_lexical_index_store(bucket_name: str) -> LexicalIndexStore:
+    """ドキュメントストアのバケットにLexicalIndexを格納するLexicalIndexStoreを作成します"""
+    return LexicalIndexStore(
+        S3ByteStore(bucket_name=bucket_name, prefix=LEXICAL_INDEX_PREFIX)
+    )
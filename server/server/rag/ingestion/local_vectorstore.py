@@ -0,0 +1,540 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Iterable, Iterator, Literal, NamedTuple, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.stores import ByteStore
+from langchain_core.vectorstores import VectorStore
+
+from server.rag.ingestion.s3_store import S3ByteStore
+
+logger = logging.getLogger(__name__)
+
+LOCAL_VECTORSTORE_PREFIX = "vectorstore/"
+"""ドキュメントストアと同じバケット内でLocalVectorStoreのファイルを格納するプレフィックス"""
+
+VectorDType = Literal["float16", "float32"]
+
+_MANIFEST_FILE = "manifest.json"
+_VECTORS_FILE = "vectors.npy"
+_RECORDS_FILE = "records.json"
+_IVF_FILE = "ivf.npz"
+
+# float16の行列積は遅いため、この行数ずつfloat32に変換してから計算する
+_SEARCH_BLOCK_ROWS = 16384
+
+# ダウンロード中にアップロードが行われ、マニフェストとファイルが一致しなかった場合に試行する回数
+_DOWNLOAD_ATTEMPTS = 3
+
+
+class _IvfIndex(NamedTuple):
+    centroids: np.ndarray  # (リスト数, 次元数)
+    order: np.ndarray  # リストごとに並べたベクトルの位置
+    offsets: np.ndarray  # 各リストのorder内での開始位置(末尾に全体の件数を含む)
+
+
+class _LocalIndex(NamedTuple):
+    vectors: np.ndarray  # 正規化済みのベクトル(メモリマップ)
+    ids: list[str]
+    texts: list[str]
+    metadatas: list[dict[str, Any]]
+    ivf: Optional[_IvfIndex]
+
+
+class LocalVectorStore(VectorStore):
+    """
+    正規化したベクトルをメモリマップファイルに保持し、NumPyでコサイン類似度の上位k件を検索するVectorStore
+
+    ディレクトリ上のレイアウトは以下のとおり。
+    - manifest.json: バージョン・件数・次元数・型・各ファイルのSHA-256
+    - vectors.npy: ベクトルの行列(float16またはfloat32)
+    - records.json: 各ベクトルのID・テキスト・メタデータ
+    - ivf.npz: 近似最近傍探索(IVF)用のクラスタ。ann_listsを指定した場合のみ作成する
+
+    remote_storeを指定した場合、書き込みのたびにファイルをアップロードし、
+    初期化時とrefresh_secondsごとの検索時に、手元のファイルとバージョンが異なればダウンロードし直す。
+    ダウンロードしたファイルはマニフェストのSHA-256と照合し、アップロード途中のファイルは使用しない。
+    既に存在するIDのテキストを追加した場合は、古いベクトルを置き換える。
+
+    NOTE: 書き込みはファイル全体を書き直すため、数万件程度までのコーパスを想定している
+    """
+
+    _embedding: Embeddings
+    _directory: str
+    _dtype: VectorDType
+    _ann_lists: Optional[int]
+    _ann_probes: int
+    _remote_store: Optional[ByteStore]
+    _refresh_seconds: float
+
+    _index: _LocalIndex
+    _checked_at: float
+    """remote_storeの更新を最後に確認した時刻"""
+
+    _lock: threading.Lock
+    _pending: Optional[list[tuple[np.ndarray, list[str], list[str], list[dict]]]]
+    """deferred_writesの中で追加し、まだ書き出していないベクトル・ID・テキスト・メタデータ"""
+
+    def __init__(
+        self,
+        embedding: Embeddings,
+        directory: str,
+        *,
+        dtype: VectorDType = "float32",
+        ann_lists: Optional[int] = None,
+        ann_probes: int = 8,
+        remote_store: Optional[ByteStore] = None,
+        refresh_seconds: float = 5 * 60,
+    ):
+        """
+        LocalVectorStoreを初期化します。
+
+        Args:
+            embedding (Embeddings): 埋め込みモデル
+            directory (str): ファイルを配置するディレクトリ
+            dtype (VectorDType): ベクトルを保持する型。float16にするとファイルサイズとメモリ使用量が半分になるが、
+                検索時にfloat32へ変換するため全件検索は遅くなる。float16は近似最近傍探索と組み合わせて使用するとよい
+            ann_lists (Optional[int]): 近似最近傍探索に使用するクラスタ数。Noneの場合は全件を検索する
+            ann_probes (int): 近似最近傍探索で検索するクラスタ数
+            remote_store (Optional[ByteStore]): ファイルを永続化するストア
+            refresh_seconds (float): remote_storeの更新を確認する間隔(秒)
+        """
+        self._embedding = embedding
+        self._directory = directory
+        self._dtype = dtype
+        self._ann_lists = ann_lists
+        self._ann_probes = ann_probes
+        self._remote_store = remote_store
+        self._refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self._pending = None
+
+        os.makedirs(directory, exist_ok=True)
+        if remote_store is not None:
+            self._download_if_stale()
+        self._checked_at = time.time()
+        self._index = self._load()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    def __len__(self) -> int:
+        return len(self._index.ids)
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: list[str],
+        embedding: Embeddings,
+        metadatas: Optional[list[dict]] = None,
+        *,
+        directory: Optional[str] = None,
+        **kwargs: Any,
+    ) -> "LocalVectorStore":
+        store = cls(embedding, directory or tempfile.mkdtemp(), **kwargs)
+        store.add_texts(texts, metadatas)
+        return store
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[list[dict]] = None,
+        *,
+        ids: Optional[list[str]] = None,
+        **kwargs: Any,
+    ) -> list[str]:
+        """テキストを埋め込んで追加し、ファイルに書き出します。既に存在するIDのベクトルは置き換えます"""
+        texts = list(texts)
+        if len(texts) == 0:
+            return []
+
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        vectors = self._normalize(
+            np.asarray(self._embedding.embed_documents(texts), dtype=np.float32)
+        )
+
+        with self._lock:
+            index = self._index
+            if len(index.ids) > 0 and index.vectors.shape[1] != vectors.shape[1]:
+                raise ValueError(
+                    f"ベクトルの次元数が一致しません: {index.vectors.shape[1]} != {vectors.shape[1]}"
+                )
+            if self._pending is not None:
+                self._pending.append((vectors, ids, texts, metadatas))
+            else:
+                self._append([(vectors, ids, texts, metadatas)])
+        return ids
+
+    @contextmanager
+    def deferred_writes(self) -> Iterator[None]:
+        """
+        withブロックの中で追加したベクトルをメモリに溜めておき、flushの呼び出し時とブロックを抜ける時にまとめて書き出します
+
+        書き込みのたびにファイル全体を書き直すため、少しずつ追加する場合に使用します。
+        書き出すまでは検索の対象になりません。
+        """
+        with self._lock:
+            self._pending = []
+        try:
+            yield
+        finally:
+            self.flush()
+            with self._lock:
+                self._pending = None
+
+    def flush(self) -> None:
+        """deferred_writesの中で追加したベクトルを書き出します"""
+        with self._lock:
+            if self._pending:
+                self._append(self._pending)
+                self._pending = []
+
+    def _append(
+        self, batches: list[tuple[np.ndarray, list[str], list[str], list[dict]]]
+    ) -> None:
+        index = self._index
+        vectors = np.concatenate(
+            ([np.asarray(index.vectors)] if len(index.ids) > 0 else [])
+            + [vectors for vectors, _, _, _ in batches]
+        )
+        ids = [*index.ids, *(id_ for _, ids, _, _ in batches for id_ in ids)]
+        texts = [*index.texts, *(text for _, _, texts, _ in batches for text in texts)]
+        metadatas = [
+            *index.metadatas,
+            *(metadata for _, _, _, metadatas in batches for metadata in metadatas),
+        ]
+
+        # 同じIDが複数ある場合は、最後に追加したもののみを残す
+        last_positions = {id_: i for i, id_ in enumerate(ids)}
+        if len(last_positions) < len(ids):
+            keep = sorted(last_positions.values())
+            vectors = vectors[keep]
+            ids = [ids[i] for i in keep]
+            texts = [texts[i] for i in keep]
+            metadatas = [metadatas[i] for i in keep]
+
+        self._index = self._save(
+            vectors=vectors, ids=ids, texts=texts, metadatas=metadatas
+        )
+
+    def delete(self, ids: Optional[list[str]] = None, **kwargs: Any) -> Optional[bool]:
+        """指定されたIDのベクトルを削除します。IDを省略した場合は全て削除します"""
+        with self._lock:
+            index = self._index
+            targets = set(ids) if ids is not None else set(index.ids)
+            keep = [i for i, id_ in enumerate(index.ids) if id_ not in targets]
+            self._index = self._save(
+                vectors=np.asarray(index.vectors)[keep],
+                ids=[index.ids[i] for i in keep],
+                texts=[index.texts[i] for i in keep],
+                metadatas=[index.metadatas[i] for i in keep],
+            )
+        return True
+
+    def similarity_search(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> list[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> list[tuple[Document, float]]:
+        """質問とのコサイン類似度が高い順にドキュメントとその類似度を返します"""
+        return self.similarity_search_by_vector_with_score(
+            self._embedding.embed_query(query), k, **kwargs
+        )
+
+    def similarity_search_by_vector(
+        self, embedding: list[float], k: int = 4, **kwargs: Any
+    ) -> list[Document]:
+        return [
+            doc
+            for doc, _ in self.similarity_search_by_vector_with_score(
+                embedding, k, **kwargs
+            )
+        ]
+
+    def similarity_search_by_vector_with_score(
+        self, embedding: list[float], k: int = 4, **kwargs: Any
+    ) -> list[tuple[Document, float]]:
+        self._refresh_if_due()
+        index = self._index
+        if len(index.ids) == 0:
+            return []
+
+        query = self._normalize(np.asarray(embedding, dtype=np.float32))
+        if index.ivf is not None:
+            candidates = self._ivf_candidates(index.ivf, query)
+            scores = self._scores(index.vectors, query, candidates)
+        else:
+            candidates = None
+            scores = self._scores(index.vectors, query)
+
+        top = self._top_k(scores, k)
+        positions = candidates[top] if candidates is not None else top
+        return [
+            (
+                Document(
+                    id=index.ids[i],
+                    page_content=index.texts[i],
+                    metadata=index.metadatas[i],
+                ),
+                float(scores[j]),
+            )
+            for i, j in zip(positions, top)
+        ]
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        # コサイン類似度[-1, 1]を[0, 1]に変換する
+        return lambda score: (score + 1) / 2
+
+    def _scores(
+        self,
+        vectors: np.ndarray,
+        query: np.ndarray,
+        candidates: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        rows = len(candidates) if candidates is not None else len(vectors)
+        scores = np.empty(rows, dtype=np.float32)
+        for start in range(0, rows, _SEARCH_BLOCK_ROWS):
+            end = min(start + _SEARCH_BLOCK_ROWS, rows)
+            block = (
+                vectors[candidates[start:end]]
+                if candidates is not None
+                else vectors[start:end]
+            )
+            scores[start:end] = np.asarray(block, dtype=np.float32) @ query
+        return scores
+
+    def _top_k(self, scores: np.ndarray, k: int) -> np.ndarray:
+        if k >= len(scores):
+            return np.argsort(-scores)
+        top = np.argpartition(-scores, k)[:k]
+        return top[np.argsort(-scores[top])]
+
+    def _ivf_candidates(self, ivf: _IvfIndex, query: np.ndarray) -> np.ndarray:
+        """質問に近いクラスタに属するベクトルの位置を返します"""
+        probes = min(self._ann_probes, len(ivf.centroids))
+        nearest_lists = self._top_k(ivf.centroids @ query, probes)
+        return np.concatenate(
+            [ivf.order[ivf.offsets[i] : ivf.offsets[i + 1]] for i in nearest_lists]
+        )
+
+    def _build_ivf(self, vectors: np.ndarray) -> Optional[_IvfIndex]:
+        """球面k-meansでベクトルをクラスタに分割します"""
+        if self._ann_lists is None or len(vectors) < self._ann_lists * 4:
+            return None
+
+        data = np.asarray(vectors, dtype=np.float32)
+        rng = np.random.default_rng(0)
+        centroids = data[rng.choice(len(data), self._ann_lists, replace=False)]
+        for _ in range(10):
+            assignments = np.argmax(data @ centroids.T, axis=1)
+            for i in range(self._ann_lists):
+                members = data[assignments == i]
+                if len(members) > 0:
+                    centroids[i] = members.mean(axis=0)
+            centroids = self._normalize(centroids)
+
+        assignments = np.argmax(data @ centroids.T, axis=1)
+        order = np.argsort(assignments, kind="stable")
+        offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(assignments, minlength=self._ann_lists))]
+        )
+        return _IvfIndex(centroids, order, offsets)
+
+    def _normalize(self, vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1)
+
+    def _save(
+        self,
+        *,
+        vectors: np.ndarray,
+        ids: list[str],
+        texts: list[str],
+        metadatas: list[dict[str, Any]],
+    ) -> _LocalIndex:
+        """ファイルを書き出し(remote_storeがあればアップロードし)、書き出したファイルを読み込み直します"""
+        ivf = self._build_ivf(vectors)
+        self._write_file(
+            _VECTORS_FILE,
+            lambda f: np.save(f, np.asarray(vectors, dtype=self._dtype)),
+        )
+        self._write_file(
+            _RECORDS_FILE,
+            lambda f: f.write(
+                json.dumps(
+                    {"ids": ids, "texts": texts, "metadatas": metadatas},
+                    ensure_ascii=False,
+                ).encode("utf-8")
+            ),
+        )
+        if ivf is not None:
+            self._write_file(_IVF_FILE, lambda f: np.savez(f, **ivf._asdict()))
+        elif os.path.exists(self._path(_IVF_FILE)):
+            os.remove(self._path(_IVF_FILE))
+
+        files = [
+            _VECTORS_FILE,
+            _RECORDS_FILE,
+            *([_IVF_FILE] if ivf is not None else []),
+        ]
+        manifest = {
+            "version": uuid.uuid4().hex,
+            "count": len(ids),
+            "dimension": int(vectors.shape[1]) if len(ids) > 0 else 0,
+            "dtype": self._dtype,
+            "files": {name: self._file_digest(name) for name in files},
+        }
+        # マニフェストは最後に書き出し、読み込み側が書き込み途中のファイルを使わないようにする
+        self._write_file(
+            _MANIFEST_FILE, lambda f: f.write(json.dumps(manifest).encode("utf-8"))
+        )
+
+        if self._remote_store is not None:
+            self._upload(has_ivf=ivf is not None)
+        return self._load()
+
+    def _load(self) -> _LocalIndex:
+        if not os.path.exists(self._path(_MANIFEST_FILE)):
+            return _LocalIndex(np.empty((0, 0), dtype=self._dtype), [], [], [], None)
+
+        with open(self._path(_RECORDS_FILE), "rb") as f:
+            records = json.load(f)
+
+        ivf: Optional[_IvfIndex] = None
+        if os.path.exists(self._path(_IVF_FILE)):
+            with np.load(self._path(_IVF_FILE)) as data:
+                ivf = _IvfIndex(data["centroids"], data["order"], data["offsets"])
+
+        return _LocalIndex(
+            vectors=np.load(self._path(_VECTORS_FILE), mmap_mode="r"),
+            ids=records["ids"],
+            texts=records["texts"],
+            metadatas=records["metadatas"],
+            ivf=ivf,
+        )
+
+    def _upload(self, has_ivf: bool) -> None:
+        assert self._remote_store is not None
+        files = [_VECTORS_FILE, _RECORDS_FILE, *([_IVF_FILE] if has_ivf else [])]
+        pairs = []
+        for name in files:
+            with open(self._path(name), "rb") as f:
+                pairs.append((name, f.read()))
+        self._remote_store.mset(pairs)
+        if not has_ivf:
+            self._remote_store.mdelete([_IVF_FILE])
+        # マニフェストは最後にアップロードし、ダウンロード側が不完全なファイルを使わないようにする
+        with open(self._path(_MANIFEST_FILE), "rb") as f:
+            self._remote_store.mset([(_MANIFEST_FILE, f.read())])
+
+    def _refresh_if_due(self) -> None:
+        """前回の確認からrefresh_secondsが経過していれば、remote_storeの更新を確認して読み込み直します"""
+        if (
+            self._remote_store is None
+            or time.time() - self._checked_at < self._refresh_seconds
+        ):
+            return
+        # 他のスレッドが確認している間は、待たずに手元のファイルで検索する
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._checked_at = time.time()
+            # 書き込み中(deferred_writesの中)は、手元のファイルを正とする
+            if self._pending is None and self._download_if_stale():
+                self._index = self._load()
+        finally:
+            self._lock.release()
+
+    def _download_if_stale(self) -> bool:
+        """
+        remote_storeのマニフェストが手元のものと異なる場合のみファイルをダウンロードします
+
+        ダウンロードしたファイルがマニフェストのSHA-256と一致しない場合は、アップロード中とみなして
+        マニフェストから読み込み直します。一致しないままの場合は手元のファイルを使い続けます。
+
+        Returns:
+            bool: ファイルをダウンロードして置き換えたかどうか
+        """
+        assert self._remote_store is not None
+        for _ in range(_DOWNLOAD_ATTEMPTS):
+            [remote_manifest] = self._remote_store.mget([_MANIFEST_FILE])
+            if remote_manifest is None:
+                return False
+
+            local_manifest_path = self._path(_MANIFEST_FILE)
+            if os.path.exists(local_manifest_path):
+                with open(local_manifest_path, "rb") as f:
+                    if f.read() == remote_manifest:
+                        return False
+
+            names = [_VECTORS_FILE, _RECORDS_FILE, _IVF_FILE]
+            files = dict(zip(names, self._remote_store.mget(names)))
+            expected = json.loads(remote_manifest).get("files")
+            # ファイルのSHA-256を記録する前に作成されたマニフェストは照合せずに使用する
+            if expected is not None:
+                if any(
+                    files.get(name) is None
+                    or hashlib.sha256(files[name]).hexdigest() != digest
+                    for name, digest in expected.items()
+                ):
+                    continue
+                files = {name: files[name] for name in expected}
+
+            for name in names:
+                data = files.get(name)
+                if data is not None:
+                    self._write_file(name, lambda f, data=data: f.write(data))
+                elif os.path.exists(self._path(name)):
+                    os.remove(self._path(name))
+            self._write_file(_MANIFEST_FILE, lambda f: f.write(remote_manifest))
+            return True
+
+        logger.warning(
+            "ダウンロードしたファイルがマニフェストと一致しないため、手元のファイルを使用します"
+        )
+        return False
+
+    def _file_digest(self, name: str) -> str:
+        with open(self._path(name), "rb") as f:
+            return hashlib.file_digest(f, "sha256").hexdigest()
+
+    def _write_file(self, name: str, write: Callable[[Any], Any]) -> None:
+        # 読み込み中のメモリマップを壊さないよう、一時ファイルに書き込んでから置き換える
+        fd, tmp_path = tempfile.mkstemp(dir=self._directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, self._path(name))
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self._directory, name)
+
+
+def create_local_vectorstore(
+    embedding: Embeddings,
+    bucket_name: str,
+    directory: str = "/tmp/rag-vectorstore",
+    **kwargs: Any,
+) -> LocalVectorStore:
+    """ドキュメントストアのバケットにファイルを永続化するLocalVectorStoreを作成します"""
+    return LocalVectorStore(
+        embedding,
+        directory,
+        remote_store=S3ByteStore(
+            bucket_name=bucket_name, prefix=LOCAL_VECTORSTORE_PREFIX
+        ),
+        **kwargs,
+    )
@@ -22,6 +22,13 @@ class TextDocumentMetadata(BaseModel):
     title: str
     modality: Literal["text"] = "text"
 
+    # NOTE:
+    # 以下はチャンク分割時に設定される
+    # start_indexは分割前のページ内でのチャンクの開始位置で、同じページの隣接するチャンクをまとめるために使用する
+    # token_countはチャンクのトークン数の見積もりで、プロンプトに含めるチャンクを予算内に収めるために使用する
+    start_index: Optional[int] = None
+    token_count: Optional[int] = None
+
 
 class ImageDocumentMetadata(BaseModel):
     url: str
@@ -37,7 +44,15 @@ class ImageDocumentMetadata(BaseModel):
     # - string[]
 
     mime_type: str
-    base64: str
+
+    # NOTE:
+    # 画像データはImageBlobStoreに格納され、ドキュメントはそのキー(blob_key)のみを持つ
+    # base64は画像データをドキュメントに直接埋め込んでいた旧形式のデータとの互換性のために残している
+    blob_key: Optional[str] = None
+    base64: Optional[str] = None
+
+    start_index: Optional[int] = None
+    token_count: Optional[int] = None
 
 
 DocumentMetadata = Union[TextDocumentMetadata, ImageDocumentMetadata]
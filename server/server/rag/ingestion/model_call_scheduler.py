@@ -0,0 +1,405 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional, Sequence, TypeVar
+
+from botocore.exceptions import ClientError, HTTPClientError
+from botocore.exceptions import ConnectionError as BotocoreConnectionError
+from langchain_core.embeddings import Embeddings
+from pydantic import BaseModel
+from tenacity import (
+    RetryCallState,
+    Retrying,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_exponential,
+    wait_random,
+)
+
+logger = logging.getLogger(__name__)
+
+_T = TypeVar("_T")
+_R = TypeVar("_R")
+
+_THROTTLING_ERROR_CODES = (
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceQuotaExceededException",
+)
+_TRANSIENT_ERROR_CODES = (
+    "ServiceUnavailableException",
+    "ModelTimeoutException",
+    "ModelNotReadyException",
+    "InternalServerException",
+)
+
+
+class ModelCallSchedulerConfig(BaseModel):
+    """ModelCallSchedulerの設定"""
+
+    initial_concurrency: int = 4
+    """開始時の同時呼び出し数"""
+
+    min_concurrency: int = 1
+    max_concurrency: int = 16
+
+    concurrency_increase: float = 1.0
+    """同時呼び出し数の分だけ呼び出しが成功するごとに増やす同時呼び出し数"""
+
+    concurrency_decrease_factor: float = 0.5
+    """スロットリングされた場合に同時呼び出し数に掛ける係数"""
+
+    requests_per_second: Optional[float] = None
+    """1秒あたりの呼び出し回数の上限。Noneの場合は制限しない"""
+
+    burst: int = 1
+    """requests_per_secondを指定した場合に、連続して呼び出せる回数"""
+
+    max_attempts: int = 5
+    """スロットリング・一時的なエラーの場合の最大試行回数"""
+
+    retry_wait_initial_seconds: float = 1
+    retry_wait_max_seconds: float = 30
+
+    retry_wait_jitter_seconds: float = 1
+    """リトライの待機時間に加える、ランダムな時間の上限(秒)"""
+
+    progress_interval_seconds: float = 10
+    """進捗をログに出力する間隔(秒)"""
+
+
+class ModelCallSchedulerStats(BaseModel):
+    """ModelCallSchedulerの呼び出し回数と、スロットリングの状況"""
+
+    completed: int = 0
+    """成功・失敗にかかわらず処理を終えた要素の数"""
+
+    failed: int = 0
+    """リトライしても成功しなかった、またはリトライできないエラーとなった要素の数"""
+
+    calls: int = 0
+    """リトライを含むモデルの呼び出し回数"""
+
+    throttled: int = 0
+    retries: int = 0
+
+    concurrency_limit: float = 0.0
+    """現在の同時呼び出し数の上限"""
+
+    peak_in_flight: int = 0
+    """実際の同時呼び出し数の最大値"""
+
+    elapsed_seconds: float = 0.0
+
+    @property
+    def items_per_second(self) -> float:
+        return (
+            self.completed / self.elapsed_seconds if self.elapsed_seconds > 0 else 0.0
+        )
+
+
+def _error_code(e: BaseException) -> Optional[str]:
+    if isinstance(e, ClientError):
+        return e.response.get("Error", {}).get("Code")
+    # langchain_awsはBedrockのエラーをValueErrorに包んで送出するため、メッセージからエラーコードを探す
+    message = str(e)
+    for code in _THROTTLING_ERROR_CODES + _TRANSIENT_ERROR_CODES:
+        if code in message:
+            return code
+    return None
+
+
+def _is_throttling(e: BaseException) -> bool:
+    return _error_code(e) in _THROTTLING_ERROR_CODES
+
+
+def _is_retryable(e: BaseException) -> bool:
+    return (
+        isinstance(e, (BotocoreConnectionError, HTTPClientError))
+        or _error_code(e) in _THROTTLING_ERROR_CODES + _TRANSIENT_ERROR_CODES
+    )
+
+
+class _TokenBucket:
+    """1秒あたりrate回まで、最大burst回まで連続して通過させるトークンバケット"""
+
+    _rate: float
+    _burst: int
+    _tokens: float
+    _updated_at: float
+    _lock: threading.Lock
+
+    def __init__(self, rate: float, burst: int):
+        self._rate = rate
+        self._burst = max(1, burst)
+        self._tokens = float(self._burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self._burst, self._tokens + (now - self._updated_at) * self._rate
+                )
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_seconds = (1 - self._tokens) / self._rate
+            time.sleep(wait_seconds)
+
+
+class ModelCallScheduler:
+    """
+    索引作成時のモデルの呼び出し(画像の説明の生成や埋め込み)を、スロットリングに応じた並列数で実行する
+
+    同時呼び出し数はAIMD(加算増加・乗算減少)で調整する。
+    呼び出しが成功するたびに少しずつ増やし、スロットリングされた場合は半分に減らしてから指数バックオフでリトライする。
+    同じ時点で始まった呼び出しがまとめてスロットリングされた場合に何度も減らさないよう、
+    直前に減らした時点より後に始まった呼び出しのスロットリングのみを数える。
+    requests_per_secondを指定した場合は、トークンバケットで1秒あたりの呼び出し回数も制限する。
+
+    要素ごとの失敗は他の要素に影響せず、失敗した要素の結果はNoneとなる。
+    複数のmapから同時に呼び出した場合も、同時呼び出し数の上限は共有される。
+    """
+
+    _config: ModelCallSchedulerConfig
+    _token_bucket: Optional[_TokenBucket]
+    _condition: threading.Condition
+    _concurrency_limit: float
+    _in_flight: int
+    _last_decreased_at: float
+    _stats: ModelCallSchedulerStats
+
+    def __init__(self, config: Optional[ModelCallSchedulerConfig] = None):
+        """
+        ModelCallSchedulerを初期化します。
+
+        Args:
+            config (Optional[ModelCallSchedulerConfig]): スケジューラの設定。Noneの場合はデフォルトの設定を使用する
+        """
+        self._config = config or ModelCallSchedulerConfig()
+        self._token_bucket = (
+            _TokenBucket(self._config.requests_per_second, self._config.burst)
+            if self._config.requests_per_second is not None
+            else None
+        )
+        self._condition = threading.Condition()
+        self._concurrency_limit = float(
+            min(
+                max(self._config.initial_concurrency, self._config.min_concurrency),
+                self._config.max_concurrency,
+            )
+        )
+        self._in_flight = 0
+        self._last_decreased_at = 0.0
+        self._stats = ModelCallSchedulerStats(concurrency_limit=self._concurrency_limit)
+
+    @property
+    def stats(self) -> ModelCallSchedulerStats:
+        """これまでのすべてのmapでの呼び出し回数とスロットリングの状況を返します"""
+        with self._condition:
+            return self._stats.model_copy()
+
+    def map(
+        self,
+        fn: Callable[[_T], _R],
+        items: Sequence[_T],
+        *,
+        label: str = "モデルの呼び出し",
+        raise_on_error: bool = False,
+    ) -> list[Optional[_R]]:
+        """
+        itemsの各要素にfnを適用し、入力と同じ順序で結果を返します
+
+        Args:
+            fn (Callable[[_T], _R]): 各要素に適用する、モデルを呼び出す関数
+            items (Sequence[_T]): 入力
+            label (str): 進捗のログに出力する処理の名前
+            raise_on_error (bool): Trueの場合は、すべての要素を処理した後に最初のエラーを送出する
+
+        Returns:
+            list[Optional[_R]]: 入力と同じ順序の結果。失敗した要素はNone
+        """
+        if len(items) == 0:
+            return []
+
+        results: list[Optional[_R]] = [None] * len(items)
+        errors: list[Exception] = []
+        start = time.perf_counter()
+        logged_at = start
+        completed = 0
+        with ThreadPoolExecutor(
+            max_workers=min(self._config.max_concurrency, len(items)),
+            thread_name_prefix="model-call",
+        ) as executor:
+            futures = {
+                executor.submit(self._call, fn, item): i for i, item in enumerate(items)
+            }
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    logger.warning(
+                        f"{label}: {futures[future] + 1}件目の処理に失敗しました ({e})"
+                    )
+                    errors.append(e)
+                completed += 1
+
+                now = time.perf_counter()
+                if now - logged_at >= self._config.progress_interval_seconds:
+                    logged_at = now
+                    self._log_progress(label, completed, len(items), now - start)
+
+        elapsed = time.perf_counter() - start
+        with self._condition:
+            self._stats.completed += len(items)
+            self._stats.failed += len(errors)
+            self._stats.elapsed_seconds += elapsed
+        self._log_progress(label, completed, len(items), elapsed, failed=len(errors))
+
+        if raise_on_error and len(errors) > 0:
+            raise errors[0]
+        return results
+
+    def _call(self, fn: Callable[[_T], _R], item: _T) -> _R:
+        for attempt in Retrying(
+            stop=stop_after_attempt(self._config.max_attempts),
+            # NOTE: wait_exponential_jitterのinitialは非推奨となったため、同じ待機時間を組み合わせて作る
+            wait=wait_exponential(
+                multiplier=self._config.retry_wait_initial_seconds,
+                max=self._config.retry_wait_max_seconds,
+            )
+            + wait_random(0, self._config.retry_wait_jitter_seconds),
+            retry=retry_if_exception(_is_retryable),
+            before_sleep=self._count_retry,
+            reraise=True,
+        ):
+            with attempt:
+                if self._token_bucket is not None:
+                    self._token_bucket.acquire()
+                with self._slot() as started_at:
+                    try:
+                        result = fn(item)
+                    except Exception as e:
+                        if _is_throttling(e):
+                            self._on_throttled(started_at)
+                        raise
+                self._on_success()
+        return result
+
+    @contextmanager
+    def _slot(self) -> Iterator[float]:
+        """同時呼び出し数の上限に空きができるまで待ち、呼び出しを始めた時刻を返します"""
+        with self._condition:
+            while self._in_flight >= int(self._concurrency_limit):
+                self._condition.wait()
+            self._in_flight += 1
+            self._stats.calls += 1
+            self._stats.peak_in_flight = max(
+                self._stats.peak_in_flight, self._in_flight
+            )
+        try:
+            yield time.monotonic()
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def _on_success(self) -> None:
+        with self._condition:
+            # 同時呼び出し数の分だけ成功すると、concurrency_increaseだけ増える
+            self._concurrency_limit = min(
+                float(self._config.max_concurrency),
+                self._concurrency_limit
+                + self._config.concurrency_increase / self._concurrency_limit,
+            )
+            self._stats.concurrency_limit = self._concurrency_limit
+            self._condition.notify_all()
+
+    def _on_throttled(self, started_at: float) -> None:
+        with self._condition:
+            self._stats.throttled += 1
+            if started_at < self._last_decreased_at:
+                return
+            self._concurrency_limit = max(
+                float(self._config.min_concurrency),
+                self._concurrency_limit * self._config.concurrency_decrease_factor,
+            )
+            self._last_decreased_at = time.monotonic()
+            self._stats.concurrency_limit = self._concurrency_limit
+
+    def _count_retry(self, retry_state: RetryCallState) -> None:
+        with self._condition:
+            self._stats.retries += 1
+
+    def _log_progress(
+        self,
+        label: str,
+        completed: int,
+        total: int,
+        elapsed_seconds: float,
+        failed: Optional[int] = None,
+    ) -> None:
+        stats = self.stats
+        logger.info(
+            f"{label}: {completed}/{total}件"
+            + (f" (失敗 {failed}件)" if failed is not None else "")
+            + f", {completed / elapsed_seconds if elapsed_seconds > 0 else 0.0:.1f}件/秒, "
+            f"同時呼び出し数 {int(stats.concurrency_limit)}, "
+            f"スロットリング {stats.throttled}回, リトライ {stats.retries}回"
+        )
+
+
+class ScheduledEmbeddings(Embeddings):
+    """
+    ドキュメントの埋め込みをModelCallSchedulerで並行に実行するEmbeddings
+
+    BedrockEmbeddingsは1回の呼び出しで1件のテキストのみを埋め込み、複数のテキストを順に埋め込むため、
+    batch_size件ずつに分けてスケジューラで並行に埋め込む。
+    埋め込めなかったテキストがある場合は、ベクトルが欠けたまま格納しないようエラーを送出する。
+    """
+
+    _embedding: Embeddings
+    _scheduler: ModelCallScheduler
+    _batch_size: int
+
+    def __init__(
+        self,
+        embedding: Embeddings,
+        scheduler: ModelCallScheduler,
+        batch_size: int = 1,
+    ):
+        """
+        ScheduledEmbeddingsを初期化します。
+
+        Args:
+            embedding (Embeddings): 埋め込みモデル
+            scheduler (ModelCallScheduler): 埋め込みモデルの呼び出しに使用するスケジューラ
+            batch_size (int): 1回の呼び出しで埋め込むテキストの数
+        """
+        self._embedding = embedding
+        self._scheduler = scheduler
+        self._batch_size = batch_size
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        batches = [
+            texts[i : i + self._batch_size]
+            for i in range(0, len(texts), self._batch_size)
+        ]
+        results = self._scheduler.map(
+            self._embedding.embed_documents,
+            batches,
+            label="埋め込み",
+            raise_on_error=True,
+        )
+        return [
+            vector for vectors in results if vectors is not None for vector in vectors
+        ]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embedding.embed_query(text)
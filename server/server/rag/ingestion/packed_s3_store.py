@@ -0,0 +1,409 @@
+import asyncio
+import gzip
+import json
+import threading
+import time
+import uuid
+from typing import (
+    TYPE_CHECKING,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from langchain_core.documents import Document
+from langchain_core.stores import BaseStore
+
+from server.utils.aws import create_s3_client
+from server.utils.concurrency import amap_concurrently, map_concurrently
+
+if TYPE_CHECKING:
+    from mypy_boto3_s3 import S3Client
+
+
+PACKED_STORE_PREFIX = "packed/"
+"""ドキュメントストアと同じバケット内でシャードとインデックスを格納するプレフィックスのデフォルト値"""
+
+
+class _IndexEntry(NamedTuple):
+    shard: str
+    offset: int
+    length: int
+
+
+class _RangeRequest(NamedTuple):
+    shard: str
+    start: int
+    end: int  # 終端を含まない
+    entries: list[Tuple[int, str, _IndexEntry]]  # (mgetの入力中の位置, キー, エントリ)
+
+
+class PackedS3Store(BaseStore[str, Document]):
+    """
+    複数のドキュメントを大きなシャードオブジェクトにまとめて格納するBaseStore
+
+    S3上のレイアウトは以下のとおり。
+    - {prefix}shards/{shard_id}: ドキュメントのJSONを連結したオブジェクト
+    - {prefix}index.json.gz: キーから(シャード, オフセット, 長さ)へのインデックスと、
+      参照されなくなったシャードとその時刻
+
+    mgetでは同じシャード内で近接するドキュメントを1つのRange GETにまとめて取得するため、
+    上位k件の取得が1〜2回のリクエストで済む。
+    mdeleteではインデックスからエントリを削除する。参照されなくなったシャードは、
+    他のプロセスが古いインデックスから読み込んでいる可能性があるため、shard_grace_seconds経過後に削除する。
+    それでも削除済みのシャードを読み込もうとした場合は、インデックスを読み込み直して一度だけ再試行する。
+
+    NOTE: インデックスの更新は読み込み・変更・書き込みで行うため、書き込みは単一のプロセス(インデックス作成処理)から行う前提である
+    プロセス内ではmsetとmdeleteを_write_lockで直列化し、書き込み中のシャードが他の書き込みで削除されないようにする
+    """
+
+    _s3: "S3Client"
+    _bucket_name: str
+    _prefix: str
+    _max_concurrency: int
+    _shard_max_bytes: int
+    _max_gap_bytes: int
+    _index_refresh_seconds: float
+    _shard_grace_seconds: float
+
+    _index: dict[str, _IndexEntry]
+    _retired_shards: dict[str, float]
+    """インデックスから参照されなくなったシャードのIDと、参照されなくなった時刻(UNIX時間)"""
+
+    _index_etag: Optional[str]
+    _index_loaded_at: Optional[float]
+    _lock: threading.Lock
+    _write_lock: threading.Lock
+
+    def __init__(
+        self,
+        bucket_name: str,
+        prefix: str = PACKED_STORE_PREFIX,
+        *,
+        max_concurrency: int = 16,
+        shard_max_bytes: int = 16 * 1024 * 1024,
+        max_gap_bytes: int = 256 * 1024,
+        index_refresh_seconds: float = 5 * 60,
+        shard_grace_seconds: Optional[float] = None,
+        client: Optional["S3Client"] = None,
+        endpoint_url: Optional[str] = None,
+    ):
+        """
+        PackedS3Storeを初期化します。
+
+        Args:
+            bucket_name (str): S3バケットの名前
+            prefix (str): シャードとインデックスを格納するキーのプレフィックス
+            max_concurrency (int): S3へ同時に発行するリクエストの最大数
+            shard_max_bytes (int): 1つのシャードの最大バイト数
+            max_gap_bytes (int): この間隔以内にあるドキュメント同士は1つのRange GETにまとめて取得する
+            index_refresh_seconds (float): インデックスの更新を確認する間隔(秒)
+            shard_grace_seconds (Optional[float]): 参照されなくなったシャードを削除するまでの猶予(秒)。
+                読み込み側が古いインデックスを使い続ける間は削除しないよう、index_refresh_seconds以上とする。
+                Noneの場合はindex_refresh_secondsの2倍
+            client (Optional[S3Client]): 使用するS3クライアント。省略時は共有クライアントを使用する
+            endpoint_url (Optional[str]): S3互換のエンドポイントURL。clientを省略した場合のみ使用される
+        """
+        if shard_grace_seconds is None:
+            shard_grace_seconds = 2 * index_refresh_seconds
+        if shard_grace_seconds < index_refresh_seconds:
+            raise ValueError(
+                "shard_grace_secondsはindex_refresh_seconds以上である必要があります"
+            )
+
+        self._s3 = client or create_s3_client(
+            max_pool_connections=max_concurrency, endpoint_url=endpoint_url
+        )
+        self._bucket_name = bucket_name
+        self._prefix = prefix
+        self._max_concurrency = max_concurrency
+        self._shard_max_bytes = shard_max_bytes
+        self._max_gap_bytes = max_gap_bytes
+        self._index_refresh_seconds = index_refresh_seconds
+        self._shard_grace_seconds = shard_grace_seconds
+
+        self._index = {}
+        self._retired_shards = {}
+        self._index_etag = None
+        self._index_loaded_at = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def mget(self, keys: Sequence[str]) -> List[Optional[Document]]:
+        """指定されたキーに関連付けられた値を取得します"""
+        requests = self._coalesce(keys, self._get_index())
+        fetched = map_concurrently(self._fetch, requests, self._max_concurrency)
+        return self._collect(len(keys), fetched)
+
+    async def amget(self, keys: Sequence[str]) -> List[Optional[Document]]:
+        """指定されたキーに関連付けられた値を非同期に取得します"""
+        index = await asyncio.to_thread(self._get_index)
+        requests = self._coalesce(keys, index)
+        fetched = await amap_concurrently(self._fetch, requests, self._max_concurrency)
+        return self._collect(len(keys), fetched)
+
+    def mset(self, key_value_pairs: Sequence[Tuple[str, Document]]) -> None:
+        """指定されたキーと値のペアを新しいシャードにまとめて設定します"""
+        if len(key_value_pairs) == 0:
+            return
+
+        with self._write_lock:
+            self._mset(key_value_pairs)
+
+    def _mset(self, key_value_pairs: Sequence[Tuple[str, Document]]) -> None:
+        shards: list[Tuple[str, bytearray]] = []
+        new_entries: dict[str, _IndexEntry] = {}
+        for key, doc in key_value_pairs:
+            data = self._encode(doc)
+            if len(shards) == 0 or len(shards[-1][1]) + len(data) > (
+                self._shard_max_bytes
+            ):
+                shards.append((uuid.uuid4().hex, bytearray()))
+
+            shard_id, buffer = shards[-1]
+            new_entries[key] = _IndexEntry(shard_id, len(buffer), len(data))
+            buffer.extend(data)
+
+        map_concurrently(
+            lambda shard: self._s3.put_object(
+                Bucket=self._bucket_name,
+                Key=self._shard_key(shard[0]),
+                Body=bytes(shard[1]),
+            ),
+            shards,
+            self._max_concurrency,
+        )
+
+        # シャードの書き込みが完了してからインデックスを更新する
+        index = {**self._get_index(force_reload=True), **new_entries}
+        self._save_index_and_collect_shards(index)
+
+    def mdelete(self, keys: Sequence[str]) -> None:
+        """指定されたキーをインデックスから削除し、不要になったシャードを削除します"""
+        if len(keys) == 0:
+            return
+
+        with self._write_lock:
+            index = dict(self._get_index(force_reload=True))
+            for key in keys:
+                index.pop(key, None)
+
+            self._save_index_and_collect_shards(index)
+
+    def yield_keys(self, *, prefix: Optional[str] = None) -> Iterator[str]:
+        """指定されたプレフィックスに一致するキーのイテレータを取得します"""
+        # NOTE: インデックスのみを参照するため、S3のリスト操作は発生しない
+        for key in list(self._get_index()):
+            if prefix is None or key.startswith(prefix):
+                yield key
+
+    def _coalesce(
+        self, keys: Sequence[str], index: dict[str, _IndexEntry]
+    ) -> list[_RangeRequest]:
+        """同じシャード内で近接するエントリを1つのRange GETにまとめます"""
+        located = [(i, key, index[key]) for i, key in enumerate(keys) if key in index]
+
+        requests: list[_RangeRequest] = []
+        for i, key, entry in sorted(located, key=lambda x: (x[2].shard, x[2].offset)):
+            end = entry.offset + entry.length
+            last = requests[-1] if len(requests) > 0 else None
+            if (
+                last is not None
+                and last.shard == entry.shard
+                and entry.offset - last.end <= self._max_gap_bytes
+            ):
+                requests[-1] = _RangeRequest(
+                    last.shard,
+                    last.start,
+                    max(last.end, end),
+                    [*last.entries, (i, key, entry)],
+                )
+            else:
+                requests.append(
+                    _RangeRequest(entry.shard, entry.offset, end, [(i, key, entry)])
+                )
+        return requests
+
+    def _fetch(
+        self, request: _RangeRequest, retry: bool = True
+    ) -> list[Tuple[int, Document]]:
+        """
+        1回のRange GETで取得したデータから各ドキュメントを切り出します
+
+        シャードが削除されていた場合は、インデックスを読み込み直して一度だけ再試行します
+        """
+        try:
+            response = self._s3.get_object(
+                Bucket=self._bucket_name,
+                Key=self._shard_key(request.shard),
+                Range=f"bytes={request.start}-{request.end - 1}",
+            )
+        except self._s3.exceptions.NoSuchKey:
+            if not retry:
+                raise
+            # 他のプロセスが更新したインデックスでは、キーが別のシャードに移っているか削除されている
+            positions = [i for i, _, _ in request.entries]
+            keys = [key for _, key, _ in request.entries]
+            index = self._get_index(force_reload=True)
+            return [
+                (positions[j], doc)
+                for retry_request in self._coalesce(keys, index)
+                for j, doc in self._fetch(retry_request, retry=False)
+            ]
+        data = response["Body"].read()
+
+        fetched: list[Tuple[int, Document]] = []
+        for i, _, entry in request.entries:
+            start = entry.offset - request.start
+            fetched.append((i, self._decode(data[start : start + entry.length])))
+        return fetched
+
+    def _collect(
+        self, size: int, fetched: list[list[Tuple[int, Document]]]
+    ) -> List[Optional[Document]]:
+        """取得したドキュメントを入力のキーと同じ順序に並べます"""
+        results: List[Optional[Document]] = [None] * size
+        for docs in fetched:
+            for i, doc in docs:
+                results[i] = doc
+        return results
+
+    def _get_index(self, force_reload: bool = False) -> dict[str, _IndexEntry]:
+        """
+        インデックスを返します
+
+        前回の読み込みからindex_refresh_secondsが経過している場合は、
+        ETagを用いた条件付きGETで更新されている場合のみ読み込み直します
+        """
+        with self._lock:
+            is_fresh = (
+                self._index_loaded_at is not None
+                and time.time() - self._index_loaded_at < self._index_refresh_seconds
+            )
+            if is_fresh and not force_reload:
+                return self._index
+
+            request_kwargs = {}
+            if self._index_etag is not None:
+                request_kwargs["IfNoneMatch"] = self._index_etag
+
+            try:
+                response = self._s3.get_object(
+                    Bucket=self._bucket_name,
+                    Key=self._index_key(),
+                    **request_kwargs,
+                )
+            except self._s3.exceptions.NoSuchKey:
+                self._index, self._retired_shards, self._index_etag = {}, {}, None
+            except self._s3.exceptions.ClientError as e:
+                if e.response.get("Error", {}).get("Code") != "304":
+                    raise
+                # 304 Not Modified: 手元のインデックスが最新である
+            else:
+                raw_index = json.loads(gzip.decompress(response["Body"].read()))
+                shards: list[str] = raw_index["shards"]
+                self._index = {
+                    key: _IndexEntry(shards[shard_no], offset, length)
+                    for key, (shard_no, offset, length) in raw_index["entries"].items()
+                }
+                # 参照されなくなったシャードを記録する前に作成されたインデックスには含まれない
+                self._retired_shards = raw_index.get("retired", {})
+                self._index_etag = response.get("ETag")
+
+            self._index_loaded_at = time.time()
+            return self._index
+
+    def _save_index(
+        self, index: dict[str, _IndexEntry], retired_shards: dict[str, float]
+    ) -> None:
+        # シャードIDを番号に置き換えてインデックスを小さくする
+        shards = sorted({entry.shard for entry in index.values()})
+        shard_numbers = {shard: i for i, shard in enumerate(shards)}
+        raw_index = {
+            "shards": shards,
+            "entries": {
+                key: [shard_numbers[entry.shard], entry.offset, entry.length]
+                for key, entry in index.items()
+            },
+            "retired": retired_shards,
+        }
+        body = gzip.compress(
+            json.dumps(raw_index, separators=(",", ":")).encode("utf-8")
+        )
+        response = self._s3.put_object(
+            Bucket=self._bucket_name, Key=self._index_key(), Body=body
+        )
+
+        with self._lock:
+            self._index = index
+            self._retired_shards = retired_shards
+            self._index_etag = response.get("ETag")
+            self._index_loaded_at = time.time()
+
+    def _save_index_and_collect_shards(self, index: dict[str, _IndexEntry]) -> None:
+        """
+        インデックスを保存し、参照されなくなってからshard_grace_secondsが経過したシャードを削除します
+
+        参照されなくなったシャードは、その時刻とともにインデックスに記録しておく。
+        読み込み側はindex_refresh_secondsの間は古いインデックスを使い続けるため、
+        その間に参照される可能性のあるシャードは削除しない。
+        """
+        now = time.time()
+        referenced_shards = {entry.shard for entry in index.values()}
+        retired_shards = {
+            shard: retired_at
+            for shard, retired_at in self._retired_shards.items()
+            if shard not in referenced_shards
+        }
+        # 以前のインデックスが参照していたシャードや、書き込みが中断して参照されずに残ったシャード
+        for shard in self._list_shards():
+            if shard not in referenced_shards:
+                retired_shards.setdefault(shard, now)
+
+        expired_shards = [
+            shard
+            for shard, retired_at in retired_shards.items()
+            if now - retired_at >= self._shard_grace_seconds
+        ]
+        for shard in expired_shards:
+            del retired_shards[shard]
+
+        # シャードはインデックスの保存後に削除する。削除に失敗したシャードは次回の書き込みで再び記録される
+        self._save_index(index, retired_shards)
+        self._delete_shards(expired_shards)
+
+    def _list_shards(self) -> list[str]:
+        shard_prefix = self._shard_key("")
+        paginator = self._s3.get_paginator("list_objects_v2")
+
+        shards: list[str] = []
+        for page in paginator.paginate(Bucket=self._bucket_name, Prefix=shard_prefix):
+            for obj in page.get("Contents", []):
+                if "Key" in obj:
+                    shards.append(obj["Key"][len(shard_prefix) :])
+        return shards
+
+    def _delete_shards(self, shards: list[str]) -> None:
+        # DeleteObjectsで一度に削除できるオブジェクトは1000個までであるため分割する
+        for i in range(0, len(shards), 1000):
+            objects: Sequence = [
+                {"Key": self._shard_key(shard)} for shard in shards[i : i + 1000]
+            ]
+            self._s3.delete_objects(
+                Bucket=self._bucket_name, Delete={"Objects": objects}
+            )
+
+    def _shard_key(self, shard_id: str) -> str:
+        return f"{self._prefix}shards/{shard_id}"
+
+    def _index_key(self) -> str:
+        return f"{self._prefix}index.json.gz"
+
+    def _encode(self, doc: Document) -> bytes:
+        return doc.json().encode("utf-8")
+
+    def _decode(self, data: bytes) -> Document:
+        return Document(**json.loads(data.decode("utf-8")))
@@ -0,0 +1,243 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from pinecone import Pinecone, ServerlessSpec  # type: ignore
+from pinecone.exceptions import NotFoundException  # type: ignore
+from pydantic import BaseModel, ValidationError
+
+from server.rag.index_config import IndexConfig
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DESCRIPTOR_CACHE_PATH = "/tmp/rag-pinecone-index.json"
+
+
+class PineconeIndexDescriptor(BaseModel):
+    """データプレーンへの接続に必要な、インデックスの情報"""
+
+    name: str
+    host: str
+    dimension: int
+    metric: str
+    resolved_at: float
+    """コントロールプレーンから取得した日時(UNIX時間)"""
+
+    def matches(self, config: IndexConfig) -> bool:
+        return (
+            self.name == config.name
+            and self.dimension == config.dimension
+            and self.metric == config.metric
+        )
+
+
+class PineconeIndexResolverStats(BaseModel):
+    """PineconeIndexResolverのキャッシュのヒット数とコントロールプレーンの呼び出し回数"""
+
+    memory_hits: int = 0
+    disk_hits: int = 0
+    control_plane_calls: int = 0
+
+
+class PineconeIndexResolver:
+    """
+    インデックス名からデータプレーンのホストを解決し、その結果をメモリとローカルファイルにキャッシュする
+
+    PineconeVectorStore.from_existing_index は作成のたびにコントロールプレーン
+    (list_indexes, describe_index)を呼び出すため、Lambdaのコールドスタートのたびに待ち時間が発生する。
+    一度解決したホストは/tmpのファイルに保存し、同じ実行環境では以降の作成でコントロールプレーンを呼び出さない。
+    サーバーレスインデックスのホストはインデックス名とプロジェクトから決まるため、
+    同じ名前で作り直した場合もキャッシュしたホストをそのまま使用できる。
+    設定が変わった場合や明示的に要求された場合(refresh=True)のみ解決し直す。
+    """
+
+    _client_factory: Callable[[], Any]
+    _client: Optional[Any]
+    _cache_path: Optional[str]
+    _descriptors: dict[str, PineconeIndexDescriptor]
+    _lock: threading.Lock
+    stats: PineconeIndexResolverStats
+
+    def __init__(
+        self,
+        client_factory: Callable[[], Any] = Pinecone,
+        cache_path: Optional[str] = DEFAULT_DESCRIPTOR_CACHE_PATH,
+    ):
+        """
+        PineconeIndexResolverを初期化します。
+
+        Args:
+            client_factory (Callable[[], Any]): Pineconeのクライアントを作成する関数。テストではローカルのスタンドインを渡す
+            cache_path (Optional[str]): 解決結果を保存するファイルのパス。Noneの場合はメモリにのみキャッシュする
+        """
+        self._client_factory = client_factory
+        self._client = None
+        self._cache_path = cache_path
+        self._descriptors = {}
+        self._lock = threading.Lock()
+        self.stats = PineconeIndexResolverStats()
+
+    @property
+    def client(self) -> Any:
+        if self._client is None:
+            self._client = self._client_factory()
+        return self._client
+
+    def resolve(
+        self,
+        config: IndexConfig,
+        refresh: bool = False,
+        force_create: bool = False,
+    ) -> PineconeIndexDescriptor:
+        """
+        インデックスの接続先を返します
+
+        Args:
+            config (IndexConfig): インデックスの設定
+            refresh (bool): キャッシュを使用せず、コントロールプレーンから取得し直すかどうか
+            force_create (bool): インデックスが存在しない場合に作成するかどうか
+
+        Returns:
+            PineconeIndexDescriptor: インデックスの接続先
+        """
+        with self._lock:
+            if not refresh:
+                descriptor = self._get_cached(config)
+                if descriptor is not None:
+                    return descriptor
+
+            descriptor = self._describe(config)
+            if descriptor is None:
+                if not force_create:
+                    raise ValueError(
+                        f"インデックス {config.name} は存在しません。作成したい場合は、force_create_index を True に設定してください。"
+                    )
+                self._create(config)
+                descriptor = self._describe(config)
+                assert descriptor is not None
+            self._validate(config, descriptor)
+            self._set_cached(descriptor)
+            return descriptor
+
+    def recreate(self, config: IndexConfig) -> PineconeIndexDescriptor:
+        """インデックスを削除して作り直し、その接続先を返します"""
+        with self._lock:
+            self._descriptors.pop(config.name, None)
+            self.stats.control_plane_calls += 1
+            try:
+                self.client.delete_index(config.name)
+            except NotFoundException:
+                pass
+            self._create(config)
+            descriptor = self._describe(config)
+            assert descriptor is not None
+            self._set_cached(descriptor)
+            return descriptor
+
+    def open_index(self, descriptor: PineconeIndexDescriptor) -> Any:
+        """ホストを指定してデータプレーンのクライアントを作成します。コントロールプレーンは呼び出しません"""
+        return self.client.Index(host=descriptor.host)
+
+    def invalidate(self, name: Optional[str] = None) -> None:
+        """キャッシュを削除します。nameを省略した場合はすべてのインデックスのキャッシュを削除します"""
+        with self._lock:
+            entries = self._read_disk()
+            if name is None:
+                self._descriptors.clear()
+                entries.clear()
+            else:
+                self._descriptors.pop(name, None)
+                entries.pop(name, None)
+            self._write_disk(entries)
+
+    def _get_cached(self, config: IndexConfig) -> Optional[PineconeIndexDescriptor]:
+        descriptor = self._descriptors.get(config.name)
+        if descriptor is not None and descriptor.matches(config):
+            self.stats.memory_hits += 1
+            return descriptor
+
+        descriptor = self._read_disk().get(config.name)
+        if descriptor is not None and descriptor.matches(config):
+            self.stats.disk_hits += 1
+            self._descriptors[config.name] = descriptor
+            return descriptor
+        return None
+
+    def _set_cached(self, descriptor: PineconeIndexDescriptor) -> None:
+        self._descriptors[descriptor.name] = descriptor
+        # 他のインデックスの解決結果を失わないよう、ファイルの内容に追記する
+        entries = self._read_disk()
+        entries[descriptor.name] = descriptor
+        self._write_disk(entries)
+
+    def _describe(self, config: IndexConfig) -> Optional[PineconeIndexDescriptor]:
+        self.stats.control_plane_calls += 1
+        try:
+            description = self.client.describe_index(config.name)
+        except NotFoundException:
+            return None
+        logger.info(f"インデックス {config.name} の接続先を取得しました")
+        return PineconeIndexDescriptor(
+            name=config.name,
+            host=description.host,
+            dimension=description.dimension,
+            metric=str(description.metric),
+            resolved_at=time.time(),
+        )
+
+    def _create(self, config: IndexConfig) -> None:
+        self.stats.control_plane_calls += 1
+        self.client.create_index(
+            name=config.name,
+            dimension=config.dimension,
+            metric=config.metric,
+            spec=ServerlessSpec(cloud=config.cloud, region=config.region),
+        )
+        logger.info(f"インデックス {config.name} を作成しました")
+
+    def _validate(
+        self, config: IndexConfig, descriptor: PineconeIndexDescriptor
+    ) -> None:
+        if not descriptor.matches(config):
+            raise ValueError(
+                f"インデックス {config.name} の設定が一致しません: "
+                f"dimension={descriptor.dimension}, metric={descriptor.metric} "
+                f"(期待値: dimension={config.dimension}, metric={config.metric})"
+            )
+
+    def _read_disk(self) -> dict[str, PineconeIndexDescriptor]:
+        if self._cache_path is None:
+            return {}
+        try:
+            with open(self._cache_path, encoding="utf-8") as f:
+                entries = json.load(f)
+            return {
+                name: PineconeIndexDescriptor.model_validate(entry)
+                for name, entry in entries.items()
+            }
+        except FileNotFoundError:
+            return {}
+        except (ValueError, ValidationError, AttributeError):
+            # 壊れたファイルはキャッシュがないものとして扱い、次の書き込みで上書きする
+            logger.warning(
+                f"インデックスの接続先のキャッシュを読み込めません: {self._cache_path}"
+            )
+            return {}
+
+    def _write_disk(self, entries: dict[str, PineconeIndexDescriptor]) -> None:
+        if self._cache_path is None:
+            return
+        directory = os.path.dirname(self._cache_path) or "."
+        os.makedirs(directory, exist_ok=True)
+        # 同じファイルを読み込む別のプロセスが書き込み途中の内容を読まないよう、一時ファイルから置き換える
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(
+                {name: descriptor.model_dump() for name, descriptor in entries.items()},
+                f,
+            )
+        os.replace(tmp_path, self._cache_path)
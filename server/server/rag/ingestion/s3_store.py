@@ -1,71 +1,100 @@
+import abc
 import json
-from typing import Iterator, List, Optional, Sequence, Tuple
+from typing import (
+    TYPE_CHECKING,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
 
 from langchain_core.documents import Document
 from langchain_core.stores import BaseStore
 
+from server.utils.aws import create_s3_client
+from server.utils.concurrency import amap_concurrently, map_concurrently
 
-class S3Store(BaseStore[str, Document]):
-    """AWS S3バケットを使用したBaseStore"""
+if TYPE_CHECKING:
+    from mypy_boto3_s3 import S3Client
+
+V = TypeVar("V")
+
+
+class _BaseS3Store(BaseStore[str, V], abc.ABC):
+    """AWS S3バケットを使用したBaseStoreの共通実装"""
+
+    _s3: "S3Client"
+    _bucket_name: str
+    _prefix: str
+    _max_concurrency: int
 
-    def __init__(self, bucket_name: str, prefix: str = ""):
+    def __init__(
+        self,
+        bucket_name: str,
+        prefix: str = "",
+        *,
+        max_concurrency: int = 16,
+        client: Optional["S3Client"] = None,
+        endpoint_url: Optional[str] = None,
+    ):
         """
         S3Storeを初期化します。
 
         Args:
             bucket_name (str): S3バケットの名前
             prefix (str): オプションのキープレフィックス
+            max_concurrency (int): mget/msetでS3へ同時に発行するリクエストの最大数
+            client (Optional[S3Client]): 使用するS3クライアント。省略時は共有クライアントを使用する
+            endpoint_url (Optional[str]): S3互換のエンドポイントURL。clientを省略した場合のみ使用される
         """
-        try:
-            import boto3
-        except ImportError:
-            raise ImportError(
-                "boto3ライブラリがインストールされていません。"
-                "boto3 をインストールしてください。"
-            )
-
-        self._s3 = boto3.client("s3")
+        self._s3 = client or create_s3_client(
+            max_pool_connections=max_concurrency, endpoint_url=endpoint_url
+        )
         self._bucket_name = bucket_name
         self._prefix = prefix
+        self._max_concurrency = max_concurrency
 
     def _full_key(self, key: str) -> str:
         """プレフィックス付きの完全なキーを返します"""
         return f"{self._prefix}{key}"
 
-    def mget(self, keys: Sequence[str]) -> List[Optional[Document]]:
+    @abc.abstractmethod
+    def _encode(self, value: V) -> bytes:
+        """値をS3に保存するバイト列に変換します"""
+
+    @abc.abstractmethod
+    def _decode(self, data: bytes) -> V:
+        """S3から取得したバイト列を値に変換します"""
+
+    def mget(self, keys: Sequence[str]) -> List[Optional[V]]:
         """指定されたキーに関連付けられた値を取得します"""
-        results: List[Optional[Document]] = []
-        for key in keys:
-            try:
-                response = self._s3.get_object(
-                    Bucket=self._bucket_name, Key=self._full_key(key)
-                )
-                json_data = json.loads(response["Body"].read().decode("utf-8"))
-                results.append(Document(**json_data))
-            except self._s3.exceptions.NoSuchKey:
-                results.append(None)
-        return results
-
-    def mset(self, key_value_pairs: Sequence[Tuple[str, Document]]) -> None:
+        # NOTE: map_concurrentlyは入力と同じ順序で結果を返すため、キーの順序が保たれる
+        return map_concurrently(self._get, keys, self._max_concurrency)
+
+    def mset(self, key_value_pairs: Sequence[Tuple[str, V]]) -> None:
         """指定されたキーと値のペアを設定します"""
-        for key, doc in key_value_pairs:
-            json_data = doc.json()
-            self._s3.put_object(
-                Bucket=self._bucket_name,
-                Key=self._full_key(key),
-                Body=json_data.encode("utf-8"),
-            )
+        map_concurrently(self._put, key_value_pairs, self._max_concurrency)
 
     def mdelete(self, keys: Sequence[str]) -> None:
         """指定されたキーを削除します"""
+        for batch in self._delete_batches(keys):
+            self._delete(batch)
 
-        # 削除対象が空の場合、以下のエラーが発生するため、空の場合は何もしない
-        # botocore.exceptions.ClientError: An error occurred (MalformedXML) when calling the DeleteObjects operation: The XML you provided was not well-formed or did not validate against our published schema
-        if len(keys) == 0:
-            return
+    async def amget(self, keys: Sequence[str]) -> List[Optional[V]]:
+        """指定されたキーに関連付けられた値を非同期に取得します"""
+        return await amap_concurrently(self._get, keys, self._max_concurrency)
 
-        objects: Sequence = [{"Key": self._full_key(key)} for key in keys]
-        self._s3.delete_objects(Bucket=self._bucket_name, Delete={"Objects": objects})
+    async def amset(self, key_value_pairs: Sequence[Tuple[str, V]]) -> None:
+        """指定されたキーと値のペアを非同期に設定します"""
+        await amap_concurrently(self._put, key_value_pairs, self._max_concurrency)
+
+    async def amdelete(self, keys: Sequence[str]) -> None:
+        """指定されたキーを非同期に削除します"""
+        await amap_concurrently(
+            self._delete, self._delete_batches(keys), self._max_concurrency
+        )
 
     def yield_keys(self, *, prefix: Optional[str] = None) -> Iterator[str]:
         """指定されたプレフィックスに一致するキーのイテレータを取得します"""
@@ -79,3 +108,57 @@ class S3Store(BaseStore[str, Document]):
                 yield obj["Key"][
                     len(self._prefix) :
                 ]  # プレフィックスを除去して元のキーを返す
+
+    def _get(self, key: str) -> Optional[V]:
+        """1件の値を取得します。存在しない場合はNoneを返します"""
+        try:
+            response = self._s3.get_object(
+                Bucket=self._bucket_name, Key=self._full_key(key)
+            )
+        except self._s3.exceptions.NoSuchKey:
+            return None
+
+        return self._decode(response["Body"].read())
+
+    def _delete_batches(self, keys: Sequence[str]) -> list[Sequence[str]]:
+        """DeleteObjectsで一度に削除できる単位にキーを分割します"""
+        # 削除対象が空の場合、以下のエラーが発生するため、空の場合は何もしない
+        # botocore.exceptions.ClientError: An error occurred (MalformedXML) when calling the DeleteObjects operation: The XML you provided was not well-formed or did not validate against our published schema
+        # また、DeleteObjectsで一度に削除できるオブジェクトは1000個までであるため分割する
+        # ref: https://docs.aws.amazon.com/AmazonS3/latest/API/API_DeleteObjects.html
+        return [keys[i : i + 1000] for i in range(0, len(keys), 1000)]
+
+    def _delete(self, keys: Sequence[str]) -> None:
+        """1000個以下のキーをまとめて削除します"""
+        objects: Sequence = [{"Key": self._full_key(key)} for key in keys]
+        self._s3.delete_objects(Bucket=self._bucket_name, Delete={"Objects": objects})
+
+    def _put(self, key_value_pair: Tuple[str, V]) -> None:
+        """1件の値を保存します"""
+        key, value = key_value_pair
+        self._s3.put_object(
+            Bucket=self._bucket_name,
+            Key=self._full_key(key),
+            Body=self._encode(value),
+        )
+
+
+class S3Store(_BaseS3Store[Document]):
+    """AWS S3バケットを使用したBaseStore"""
+
+    def _encode(self, value: Document) -> bytes:
+        return value.json().encode("utf-8")
+
+    def _decode(self, data: bytes) -> Document:
+        json_data = json.loads(data.decode("utf-8"))
+        return Document(**json_data)
+
+
+class S3ByteStore(_BaseS3Store[bytes]):
+    """AWS S3バケットを使用したByteStore"""
+
+    def _encode(self, value: bytes) -> bytes:
+        return value
+
+    def _decode(self, data: bytes) -> bytes:
+        return data
@@ -0,0 +1,430 @@
+import asyncio
+import hashlib
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+from typing import AsyncIterator, Iterator, Optional, Union
+from urllib.parse import urldefrag, urlparse
+
+import aiohttp
+from bs4 import BeautifulSoup
+from langchain_core.document_loaders import BaseLoader
+from langchain_core.documents import Document
+from langchain_core.utils.html import extract_sub_links
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+
+class CrawlerConfig(BaseModel):
+    """AsyncWebCrawlerの設定"""
+
+    max_depth: int = 5
+    """ルートのURLからたどるリンクの深さの上限。ルートのURLの深さを0とし、max_depth未満のページを取得する"""
+
+    max_concurrency: int = 16
+    """全体で同時に取得するページの数"""
+
+    per_host_concurrency: int = 4
+    """同じホストから同時に取得するページの数"""
+
+    politeness_delay_seconds: float = 0.2
+    """同じホストへのリクエストを開始する最小の間隔(秒)"""
+
+    timeout_seconds: float = 30
+    """1回のリクエストのタイムアウト(秒)"""
+
+    max_retries: int = 2
+    """429・5xxのレスポンスや通信エラーの場合にリトライする回数"""
+
+    cache_dir: Optional[str] = None
+    """
+    HTTPキャッシュを配置するディレクトリ。Noneの場合はキャッシュを使用しない
+
+    ETag・Last-Modifiedを返したページを保存し、次回の実行時は条件付きリクエストで再検証する
+    """
+
+    user_agent: str = "rag-document-crawler/1.0"
+
+    max_buffered_pages: int = 64
+    """
+    取得したが呼び出し側がまだ受け取っていないページの数の上限
+
+    上限に達するとページの取得を一時停止するため、後段の処理が遅くてもメモリの使用量がサイトの大きさに比例して増えない
+    """
+
+
+class CrawlStats(BaseModel):
+    """AsyncWebCrawlerが取得したページ数とダウンロードしたバイト数"""
+
+    pages: int = 0
+    """ドキュメントとして出力したページの数(未更新のページを含む)"""
+
+    not_modified: int = 0
+    """条件付きリクエストで未更新(304)と判定され、キャッシュを使用したページの数"""
+
+    errors: int = 0
+    failed_urls: list[str] = []
+    """エラーのため取得できなかったページのURL"""
+
+    bytes_downloaded: int = 0
+    """レスポンスのボディのバイト数の合計"""
+
+    elapsed_seconds: float = 0.0
+
+    @property
+    def pages_per_second(self) -> float:
+        return self.pages / self.elapsed_seconds if self.elapsed_seconds > 0 else 0.0
+
+
+class _CachedResponse(BaseModel):
+    url: str
+    body: str
+    content_type: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+class _HttpCache:
+    """URLごとのレスポンスをローカルディスクに保存するキャッシュ"""
+
+    _dir: str
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self._dir = directory
+
+    def get(self, url: str) -> Optional[_CachedResponse]:
+        try:
+            with open(self._path(url), encoding="utf-8") as f:
+                return _CachedResponse.model_validate_json(f.read())
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            logger.warning(f"HTTPキャッシュを読み込めません: {url}")
+            return None
+
+    def set(self, entry: _CachedResponse) -> None:
+        # 書き込み途中のファイルを読み込まないよう、一時ファイルに書き込んでから置き換える
+        fd, tmp_path = tempfile.mkstemp(dir=self._dir, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(entry.model_dump_json())
+        os.replace(tmp_path, self._path(entry.url))
+
+    def _path(self, url: str) -> str:
+        return os.path.join(
+            self._dir, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json"
+        )
+
+
+class _HostLimiter:
+    """ホストごとの同時リクエスト数と、リクエストの間隔を制限する"""
+
+    _semaphore: asyncio.Semaphore
+    _lock: asyncio.Lock
+    _delay_seconds: float
+    _next_request_at: float
+
+    def __init__(self, concurrency: int, delay_seconds: float):
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._lock = asyncio.Lock()
+        self._delay_seconds = delay_seconds
+        self._next_request_at = 0.0
+
+    async def __aenter__(self) -> None:
+        await self._semaphore.acquire()
+        async with self._lock:
+            now = time.monotonic()
+            wait_seconds = self._next_request_at - now
+            self._next_request_at = max(now, self._next_request_at) + (
+                self._delay_seconds
+            )
+        if wait_seconds > 0:
+            await asyncio.sleep(wait_seconds)
+
+    async def __aexit__(self, *args: object) -> None:
+        self._semaphore.release()
+
+
+class _Page(BaseModel):
+    url: str
+    body: str
+    content_type: str
+    not_modified: bool
+
+
+class _RetryableStatusError(Exception):
+    pass
+
+
+class AsyncWebCrawler(BaseLoader):
+    """
+    ルートのURLから同じサイト内のリンクを並行にたどり、各ページのHTMLをドキュメントとして出力するローダー
+
+    RecursiveUrlLoaderと同じ形式(page_contentはHTML、metadataはsource・content_type・title・description・language)の
+    ドキュメントを、取得できた順に逐次出力する。
+    ホストごとに同時リクエスト数とリクエストの間隔を制限し、cache_dirを指定した場合は
+    ETag・Last-Modifiedによる条件付きリクエストで、未更新のページをダウンロードし直さない。
+    """
+
+    _root_urls: list[str]
+    _config: CrawlerConfig
+    _cache: Optional[_HttpCache]
+    stats: CrawlStats
+
+    def __init__(self, root_urls: list[str], config: Optional[CrawlerConfig] = None):
+        """
+        AsyncWebCrawlerを初期化します。
+
+        Args:
+            root_urls (list[str]): クローリングを開始するURL。各URLのサイト外へのリンクはたどらない
+            config (Optional[CrawlerConfig]): クローラーの設定。Noneの場合はデフォルトの設定を使用する
+        """
+        self._root_urls = root_urls
+        self._config = config or CrawlerConfig()
+        self._cache = (
+            _HttpCache(self._config.cache_dir)
+            if self._config.cache_dir is not None
+            else None
+        )
+        self.stats = CrawlStats()
+
+    def lazy_load(self) -> Iterator[Document]:
+        """
+        ページを取得できた順にドキュメントを返します
+
+        クローリングは別スレッドのイベントループで行うため、
+        呼び出し側がドキュメントを処理している間も次のページの取得が進みます。
+        受け取られていないページがmax_buffered_pages件に達した場合は、クローリングを一時停止します。
+        """
+        output: queue.Queue[Union[Document, BaseException, None]] = queue.Queue(
+            maxsize=self._config.max_buffered_pages
+        )
+        closed = threading.Event()
+
+        def put(item: Union[Document, BaseException, None]) -> None:
+            # 呼び出し側がイテレーションを中断した場合は、キューが空かないため破棄する
+            while not closed.is_set():
+                try:
+                    output.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        async def produce() -> None:
+            async for doc in self.alazy_load():
+                if closed.is_set():
+                    break
+                # キューが一杯の間もイベントループを止めないよう、別スレッドで待つ
+                await asyncio.to_thread(put, doc)
+
+        def run() -> None:
+            try:
+                asyncio.run(produce())
+            except BaseException as e:
+                put(e)
+            finally:
+                put(None)
+
+        thread = threading.Thread(target=run, name="web-crawler", daemon=True)
+        thread.start()
+        try:
+            while (item := output.get()) is not None:
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            closed.set()
+        thread.join()
+
+    async def alazy_load(self) -> AsyncIterator[Document]:
+        """lazy_loadの非同期版"""
+        output: asyncio.Queue[Optional[Document]] = asyncio.Queue(
+            maxsize=self._config.max_buffered_pages
+        )
+        crawl_task = asyncio.create_task(self._crawl(output))
+        try:
+            while (doc := await output.get()) is not None:
+                yield doc
+            await crawl_task
+        finally:
+            # 呼び出し側がイテレーションを中断した場合は、残りのページを取得しない
+            crawl_task.cancel()
+
+    async def _crawl(self, output: "asyncio.Queue[Optional[Document]]") -> None:
+        self.stats = CrawlStats()
+        start = time.perf_counter()
+        frontier: asyncio.Queue[tuple[str, str, int]] = asyncio.Queue()
+        visited: set[str] = set()
+        limiters: dict[str, _HostLimiter] = {}
+        for root_url in self._root_urls:
+            url = urldefrag(root_url).url
+            if url not in visited:
+                visited.add(url)
+                frontier.put_nowait((url, self._base_url(url), 0))
+
+        try:
+            async with aiohttp.ClientSession(
+                headers={"User-Agent": self._config.user_agent},
+                timeout=aiohttp.ClientTimeout(total=self._config.timeout_seconds),
+            ) as session:
+
+                async def worker() -> None:
+                    while True:
+                        url, base_url, depth = await frontier.get()
+                        try:
+                            await visit(url, base_url, depth)
+                        except Exception as e:
+                            logger.warning(f"ページを処理できません: {url} ({e})")
+                            self._record_failure(url)
+                        finally:
+                            frontier.task_done()
+
+                async def visit(url: str, base_url: str, depth: int) -> None:
+                    host = urlparse(url).netloc
+                    if host not in limiters:
+                        limiters[host] = _HostLimiter(
+                            self._config.per_host_concurrency,
+                            self._config.politeness_delay_seconds,
+                        )
+                    page = await self._fetch(session, limiters[host], url)
+                    if page is None:
+                        return
+                    self.stats.pages += 1
+                    await output.put(self._to_document(page))
+
+                    if depth + 1 >= self._config.max_depth:
+                        return
+                    for link in extract_sub_links(
+                        page.body,
+                        url,
+                        base_url=base_url,
+                        prevent_outside=True,
+                        continue_on_failure=True,
+                    ):
+                        link = urldefrag(link).url
+                        if link not in visited:
+                            visited.add(link)
+                            frontier.put_nowait((link, base_url, depth + 1))
+
+                workers = [
+                    asyncio.create_task(worker())
+                    for _ in range(self._config.max_concurrency)
+                ]
+                try:
+                    await frontier.join()
+                finally:
+                    for task in workers:
+                        task.cancel()
+                    await asyncio.gather(*workers, return_exceptions=True)
+        finally:
+            self.stats.elapsed_seconds = time.perf_counter() - start
+            logger.info(
+                f"クローリングが完了しました: {self.stats.pages}ページ "
+                f"(未更新 {self.stats.not_modified}, エラー {self.stats.errors}), "
+                f"{self.stats.bytes_downloaded}バイト, "
+                f"{self.stats.pages_per_second:.1f}ページ/秒"
+            )
+            await output.put(None)
+
+    async def _fetch(
+        self, session: aiohttp.ClientSession, limiter: _HostLimiter, url: str
+    ) -> Optional[_Page]:
+        cached = self._cache.get(url) if self._cache is not None else None
+        headers = {}
+        if cached is not None and cached.etag is not None:
+            headers["If-None-Match"] = cached.etag
+        if cached is not None and cached.last_modified is not None:
+            headers["If-Modified-Since"] = cached.last_modified
+
+        for attempt in range(self._config.max_retries + 1):
+            try:
+                async with limiter:
+                    async with session.get(url, headers=headers) as response:
+                        if response.status == 304 and cached is not None:
+                            self.stats.not_modified += 1
+                            return _Page(
+                                url=url,
+                                body=cached.body,
+                                content_type=cached.content_type,
+                                not_modified=True,
+                            )
+                        if response.status == 429 or response.status >= 500:
+                            raise _RetryableStatusError(
+                                f"Received HTTP status {response.status}"
+                            )
+                        if response.status >= 400:
+                            logger.warning(
+                                f"ページを取得できません: {url} (HTTP {response.status})"
+                            )
+                            self._record_failure(url)
+                            return None
+
+                        data = await response.read()
+                        self.stats.bytes_downloaded += len(data)
+                        page = _Page(
+                            url=url,
+                            body=data.decode(response.get_encoding(), errors="replace"),
+                            content_type=response.headers.get("Content-Type", ""),
+                            not_modified=False,
+                        )
+                        self._store_cache(page, response)
+                        return page
+            except (
+                aiohttp.ClientError,
+                asyncio.TimeoutError,
+                _RetryableStatusError,
+            ) as e:
+                if attempt == self._config.max_retries:
+                    logger.warning(f"ページを取得できません: {url} ({e})")
+                    self._record_failure(url)
+                    return None
+                await asyncio.sleep(2**attempt)
+        return None
+
+    def _record_failure(self, url: str) -> None:
+        self.stats.errors += 1
+        self.stats.failed_urls.append(url)
+
+    def _store_cache(self, page: _Page, response: aiohttp.ClientResponse) -> None:
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        # 検証子のないレスポンスは再検証できないため保存しない
+        if self._cache is None or (etag is None and last_modified is None):
+            return
+        self._cache.set(
+            _CachedResponse(
+                url=page.url,
+                body=page.body,
+                content_type=page.content_type,
+                etag=etag,
+                last_modified=last_modified,
+            )
+        )
+
+    def _to_document(self, page: _Page) -> Document:
+        return Document(
+            page_content=page.body,
+            metadata=_extract_metadata(page.body, page.url, page.content_type),
+        )
+
+    def _base_url(self, url: str) -> str:
+        # RecursiveUrlLoaderと同じく、スキームとホストのみをサイトの範囲とする
+        parsed_url = urlparse(url)
+        return f"{parsed_url.scheme}://{parsed_url.netloc}/"
+
+
+def _extract_metadata(raw_html: str, url: str, content_type: str) -> dict:
+    """RecursiveUrlLoaderと同じ形式のメタデータをHTMLから抽出する"""
+    metadata = {"source": url, "content_type": content_type}
+    soup = BeautifulSoup(raw_html, "html.parser")
+    if title := soup.find("title"):
+        metadata["title"] = title.get_text()
+    if description := soup.find("meta", attrs={"name": "description"}):
+        metadata["description"] = description.get("content", None)  # type: ignore
+    if html := soup.find("html"):
+        metadata["language"] = html.get("lang", None)  # type: ignore
+    return metadata
@@ -1,21 +1,49 @@
+import asyncio
+import logging
+from typing import Any, Iterator, Optional, Union
+
 from langchain_core.documents import Document as LangChainDocument
 from langchain_core.embeddings import Embeddings
 from langchain_core.language_models import BaseChatModel
+from langchain_core.output_parsers.openai_tools import JsonOutputKeyToolsParser
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.retrievers import BaseRetriever
 from langchain_core.runnables import (
     Runnable,
     RunnableLambda,
     RunnablePassthrough,
 )
 from langfuse.callback import CallbackHandler  # type: ignore
+from pydantic import ValidationError
 
+from server.rag.context_packer import ContextBudget, ContextPacker
+from server.rag.image_selector import ImageBudget, ImageSelection, ImageSelector
+from server.rag.index_config import IndexConfig
+from server.rag.ingestion.cached_store import DocstoreCacheConfig
+from server.rag.ingestion.image_blob_store import (
+    ImageBlobStore,
+    create_image_blob_store,
+)
 from server.rag.ingestion.model import (
     DocumentMetadata,
     ImageDocumentMetadata,
     TextDocumentMetadata,
 )
-from server.rag.model import CitedAnswer, MetadataTypedDocument, RagResult
-from server.rag.retriever import create_retriever
+from server.rag.ingestion.pinecone_index import PineconeIndexResolver
+from server.rag.model import (
+    AnswerStatement,
+    CitedAnswer,
+    MetadataTypedDocument,
+    RagResult,
+)
+from server.rag.retriever import (
+    DocstoreBackend,
+    VectorstoreBackend,
+    create_retriever,
+)
+from server.rag.semantic_cache import SemanticCache
+
+logger = logging.getLogger(__name__)
 
 # 以下を参考にした
 # ref: https://smith.langchain.com/hub/rlm/rag-prompt
@@ -35,69 +63,292 @@ Answer:
 
 class Rag:
     _langfuse_handler: CallbackHandler
+    _image_blob_store: ImageBlobStore
+    _semantic_cache: Optional[SemanticCache]
     _rag_chain: Runnable[str, RagResult]
+    _rag_stream_chain: Runnable[str, dict[str, Any]]
 
     def __init__(
         self,
-        index_name: str,
+        index_config: IndexConfig,
         bucket_name: str,
         llm: BaseChatModel,
         embedding: Embeddings,
         langfuse_secret_key: str,
         langfuse_public_key: str,
         langfuse_host: str,
+        docstore_cache_config: Optional[DocstoreCacheConfig] = None,
+        docstore_backend: DocstoreBackend = "s3",
+        vectorstore_backend: VectorstoreBackend = "pinecone",
+        hybrid_search: bool = False,
+        retriever: Optional[BaseRetriever] = None,
+        langfuse_enabled: bool = True,
+        semantic_cache: Optional[SemanticCache] = None,
+        context_budget: Optional[ContextBudget] = None,
+        image_budget: Optional[ImageBudget] = None,
+        index_resolver: Optional[PineconeIndexResolver] = None,
     ):
+        """
+        Args:
+            hybrid_search (bool): ベクトル検索に加えて語彙検索を行い、結果を統合するかどうか
+            retriever (Optional[BaseRetriever]): 検索に使用するRetriever。省略時はcreate_retrieverで作成する
+            langfuse_enabled (bool): Langfuseへトレースを送信するかどうか
+            semantic_cache (Optional[SemanticCache]): 類似する質問に対する回答を再利用するためのキャッシュ
+            context_budget (Optional[ContextBudget]): プロンプトに含める検索結果の予算。Noneの場合は検索結果をすべて含める
+            image_budget (Optional[ImageBudget]): プロンプトに添付する画像の予算。Noneの場合はデフォルトの予算を使用する
+            index_resolver (Optional[PineconeIndexResolver]): Pineconeのインデックスの接続先を解決する。Noneの場合は/tmpにキャッシュするものを使用する
+        """
         self._langfuse_handler = CallbackHandler(
             secret_key=langfuse_secret_key,
             public_key=langfuse_public_key,
             host=langfuse_host,
+            enabled=langfuse_enabled,
         )
 
-        retriever = create_retriever(
-            index_name=index_name,
-            bucket_name=bucket_name,
-            embedding=embedding,
+        self._image_blob_store = create_image_blob_store(bucket_name)
+        self._semantic_cache = semantic_cache
+        if retriever is None:
+            retriever = create_retriever(
+                index_config=index_config,
+                bucket_name=bucket_name,
+                embedding=embedding,
+                docstore_cache_config=docstore_cache_config,
+                image_blob_store=self._image_blob_store,
+                docstore_backend=docstore_backend,
+                vectorstore_backend=vectorstore_backend,
+                hybrid_search=hybrid_search,
+                index_resolver=index_resolver,
+            )
+        # 予算内に詰め直した検索結果を回答の生成と出典の表示の両方に使用し、Source IDの対応を保つ
+        packed_retriever: Runnable[str, list[LangChainDocument]] = (
+            retriever
+            if context_budget is None
+            else retriever | ContextPacker(context_budget).pack
+        )
+        # 検索結果はここで一度だけ型付きのドキュメントに変換し、以降のステップと結果で使い回す
+        # 画像データは含まれず、プロンプトに添付する画像のみImageSelectorが取得する
+        retrieve_docs_chain = packed_retriever | self._parse_documents
+        image_selector = ImageSelector(
+            self._image_blob_store, image_budget or ImageBudget()
         )
         format_context_chain = (
             RunnableLambda(lambda x: x["retrieved_docs"]) | self._format_docs
         )
 
         structured_llm = llm.with_structured_output(CitedAnswer)
-        generate_answer_chain = self._build_prompt | structured_llm
+        generate_answer_chain = RunnableLambda(self._build_prompt) | structured_llm
 
-        self._rag_chain: Runnable[str, RagResult] = {
-            "retrieved_docs": retriever,
+        retrieve_chain = {
+            "retrieved_docs": retrieve_docs_chain,
             "question": RunnablePassthrough(),
-        } | RunnablePassthrough.assign(context=format_context_chain).assign(
+        } | RunnablePassthrough.assign(
+            context=format_context_chain,
+            # 添付した画像と添付しなかった画像(とその理由)がトレースに残るよう、独立したステップとして実行する
+            image_selection=(
+                RunnableLambda(lambda x: x["retrieved_docs"])
+                | RunnableLambda(image_selector.select, afunc=image_selector.aselect)
+            ).with_config(run_name="select_images"),
+        )
+
+        self._rag_chain: Runnable[str, RagResult] = retrieve_chain.assign(
             answer=generate_answer_chain
-        ).pick(["retrieved_docs", "answer"]).assign(
-            retrieved_docs=(
-                lambda x: [self._parse_document(doc) for doc in x["retrieved_docs"]]
+        ).pick(["retrieved_docs", "answer"])
+
+        # ストリーミング用のチェーン
+        # with_structured_outputはPydanticモデルへの変換のため出力が完了するまで結果を返さないので、
+        # ツール呼び出しの引数を部分的なJSONのままストリーミングで受け取る
+        # ref: https://python.langchain.com/docs/how_to/tool_streaming/
+        streaming_llm = llm.bind_tools(  # type: ignore[attr-defined]
+            [CitedAnswer], tool_choice=CitedAnswer.__name__
+        )
+        generate_partial_answer_chain = (
+            RunnableLambda(self._build_prompt)
+            | streaming_llm
+            | JsonOutputKeyToolsParser(
+                key_name=CitedAnswer.__name__, first_tool_only=True
             )
         )
+        self._rag_stream_chain = retrieve_chain.assign(
+            answer=generate_partial_answer_chain
+        )
 
     def invoke(self, question: str) -> RagResult:
-        return self._rag_chain.invoke(
+        if self._semantic_cache is not None:
+            cached_result = self._semantic_cache.lookup(question)
+            if cached_result is not None:
+                return cached_result
+
+        result = self._rag_chain.invoke(
             question, config={"callbacks": [self._langfuse_handler]}
         )
 
-    def _build_prompt(self, input_dict: dict) -> ChatPromptTemplate:
-        docs = input_dict["retrieved_docs"]
-        parsed_docs: list[MetadataTypedDocument[DocumentMetadata]] = [
-            self._parse_document(doc) for doc in docs
+        if self._semantic_cache is not None:
+            self._semantic_cache.update(question, result)
+        return result
+
+    def stream(self, question: str) -> Iterator[Union[AnswerStatement, RagResult]]:
+        """
+        回答文を生成された順にストリーミングで返す
+
+        各AnswerStatementは、その回答文の出力が完了した時点で返される。
+        最後に、検索したドキュメントと回答全体を含むRagResultを返す。
+        モデルが回答を1文も出力しなかった場合は、invokeと同じくストリーミングせずに回答を生成する。
+
+        Args:
+            question (str): 質問
+
+        Yields:
+            Union[AnswerStatement, RagResult]: 回答文。最後の要素のみRagResult
+        """
+        if self._semantic_cache is not None:
+            cached_result = self._semantic_cache.lookup(question)
+            if cached_result is not None:
+                yield from cached_result["answer"].statements
+                yield cached_result
+                return
+
+        retrieved_docs: list[MetadataTypedDocument[DocumentMetadata]] = []
+        partial_answer: dict[str, Any] = {}
+        statements: list[AnswerStatement] = []
+
+        for chunk in self._rag_stream_chain.stream(
+            question, config={"callbacks": [self._langfuse_handler]}
+        ):
+            if "retrieved_docs" in chunk:
+                retrieved_docs = chunk["retrieved_docs"]
+            if "answer" not in chunk or chunk["answer"] is None:
+                continue
+
+            # 部分的なJSONでは末尾の回答文が出力途中である可能性があるため、
+            # 後続の回答文が現れた時点でその前の回答文を完了したものとみなす
+            partial_answer = chunk["answer"]
+            partial_statements = partial_answer.get("statements") or []
+            for raw_statement in partial_statements[len(statements) : -1]:
+                statement = AnswerStatement.model_validate(raw_statement)
+                statements.append(statement)
+                yield statement
+
+        if not statements and not partial_answer.get("statements"):
+            # ツール呼び出しが1つも出力されなかった場合は、ストリーミングせずに回答を生成し直す
+            logger.warning(
+                "ストリーミングで回答が出力されなかったため、ストリーミングせずに回答を生成します"
+            )
+            result = self._rag_chain.invoke(
+                question, config={"callbacks": [self._langfuse_handler]}
+            )
+            yield from result["answer"].statements
+            if self._semantic_cache is not None:
+                self._semantic_cache.update(question, result)
+            yield result
+            return
+
+        try:
+            answer = CitedAnswer.model_validate(partial_answer)
+        except ValidationError as e:
+            # 回答文をすでに返しているため生成し直さず、原因がわかるエラーとして送出する
+            raise ValueError(
+                f"ストリーミングで出力された回答の形式が不正です: {partial_answer}"
+            ) from e
+        for statement in answer.statements[len(statements) :]:
+            yield statement
+
+        result = RagResult(
+            retrieved_docs=retrieved_docs,
+            answer=answer,
+        )
+        if self._semantic_cache is not None:
+            self._semantic_cache.update(question, result)
+        yield result
+
+    async def ainvoke(self, question: str) -> RagResult:
+        """
+        invokeの非同期版
+
+        検索・ドキュメントストアからの取得・画像データの取得・回答の生成を
+        イベントループ上で実行するため、1プロセスで複数の質問を並行して処理できる。
+        """
+        if self._semantic_cache is not None:
+            cached_result = await asyncio.to_thread(
+                self._semantic_cache.lookup, question
+            )
+            if cached_result is not None:
+                return cached_result
+
+        result = await self._rag_chain.ainvoke(
+            question, config={"callbacks": [self._langfuse_handler]}
+        )
+
+        if self._semantic_cache is not None:
+            await asyncio.to_thread(self._semantic_cache.update, question, result)
+        return result
+
+    async def abatch(
+        self, questions: list[str], max_concurrency: Optional[int] = None
+    ) -> list[RagResult]:
+        """
+        複数の質問を並行して処理する
+
+        Args:
+            questions (list[str]): 質問のリスト
+            max_concurrency (Optional[int]): 同時に処理する質問の最大数。Noneの場合は無制限
+
+        Returns:
+            list[RagResult]: 質問と同じ順序の回答
+        """
+        if self._semantic_cache is None:
+            return await self._rag_chain.abatch(
+                questions,
+                config={
+                    "callbacks": [self._langfuse_handler],
+                    "max_concurrency": max_concurrency,
+                },
+            )
+
+        # キャッシュにヒットしなかった質問のみチェーンを実行する
+        cached_results = await asyncio.gather(
+            *(
+                asyncio.to_thread(self._semantic_cache.lookup, question)
+                for question in questions
+            )
+        )
+        missed_questions = [
+            question
+            for question, cached_result in zip(questions, cached_results)
+            if cached_result is None
         ]
+        generated_results = iter(
+            await self._rag_chain.abatch(
+                missed_questions,
+                config={
+                    "callbacks": [self._langfuse_handler],
+                    "max_concurrency": max_concurrency,
+                },
+            )
+        )
+
+        results: list[RagResult] = []
+        for question, cached_result in zip(questions, cached_results):
+            if cached_result is None:
+                cached_result = next(generated_results)
+                await asyncio.to_thread(
+                    self._semantic_cache.update, question, cached_result
+                )
+            results.append(cached_result)
+        return results
+
+    def _build_prompt(self, input_dict: dict) -> ChatPromptTemplate:
+        image_selection: ImageSelection = input_dict["image_selection"]
         image_messages = [
             {
                 "type": "image_url",
                 "image_url": {
                     "url": self._build_image_data_url(
-                        mime_type=doc.metadata.mime_type,
-                        image_base64=doc.metadata.base64,
+                        mime_type=image.mime_type,
+                        image_base64=image.base64,
                     ),
                 },
             }
-            for doc in parsed_docs
-            if doc.metadata.modality == "image"
+            for image in image_selection.included
         ]
         prompt = ChatPromptTemplate.from_messages(
             [
@@ -134,9 +385,14 @@ class Rag:
     def _build_image_data_url(self, *, mime_type: str, image_base64: str) -> str:
         return f"data:{mime_type};base64,{image_base64}"
 
-    def _format_docs(self, docs: list[LangChainDocument]) -> str:
+    def _parse_documents(
+        self, docs: list[LangChainDocument]
+    ) -> list[MetadataTypedDocument[DocumentMetadata]]:
+        return [self._parse_document(doc) for doc in docs]
+
+    def _format_docs(self, docs: list[MetadataTypedDocument[DocumentMetadata]]) -> str:
         formatted = [
-            f"Source ID: {i}\nArticle Title: {doc.metadata['title']}\nArticle Snippet: {doc.page_content}"
+            f"Source ID: {i}\nArticle Title: {doc.metadata.title}\nArticle Snippet: {doc.page_content}"
             for i, doc in enumerate(docs)
         ]
         return "\n\n" + "\n\n".join(formatted)
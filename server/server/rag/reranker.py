@@ -0,0 +1,92 @@
+from typing import Optional
+
+from pydantic import BaseModel
+
+from server.rag.ingestion.lexical_index import tokenize_ngrams
+
+
+class RetrievalCandidate(BaseModel):
+    """再ランキングの対象となる検索結果の候補"""
+
+    doc_id: str
+    """ドキュメントストアのキー"""
+
+    source: str
+    """出典(URL)。同じ出典の候補は1つにまとめられる"""
+
+    text: Optional[str] = None
+    """チャンクのテキスト。ベクトルストアから取得した候補のみが持つ"""
+
+    first_stage_score: float
+    """1段目の検索での順位に基づくスコア(0〜1)"""
+
+    lexical_score: Optional[float] = None
+    """語彙検索のスコアを最大値で割ったもの(0〜1)。語彙検索でヒットした候補のみが持つ"""
+
+
+class LocalReranker:
+    """
+    外部のモデルを呼び出さずに検索結果の候補を並べ替える再ランキング
+
+    1段目の検索での順位と、質問の文字n-gramのうちチャンクに含まれるものの割合(被覆率)を
+    重み付きで足し合わせたスコアで並べ替え、同じ出典の候補は最もスコアの高いもののみを残す。
+    テキストを持たない候補(語彙検索のみでヒットしたもの)は、語彙検索のスコアを被覆率の代わりに用いる。
+    """
+
+    _first_stage_weight: float
+    _ngram_size: int
+
+    def __init__(self, first_stage_weight: float = 0.5, ngram_size: int = 2):
+        """
+        LocalRerankerを初期化します。
+
+        Args:
+            first_stage_weight (float): 1段目の検索での順位に対する重み(0〜1)。残りが被覆率に対する重みになる
+            ngram_size (int): 被覆率の計算に用いる文字n-gramの長さ
+        """
+        self._first_stage_weight = first_stage_weight
+        self._ngram_size = ngram_size
+
+    def rerank(
+        self, query: str, candidates: list[RetrievalCandidate], top_n: int
+    ) -> list[RetrievalCandidate]:
+        """
+        候補を並べ替え、出典が異なる上位top_n件を返します
+
+        Args:
+            query (str): 質問
+            candidates (list[RetrievalCandidate]): 検索結果の候補
+            top_n (int): 返す候補の最大数
+
+        Returns:
+            list[RetrievalCandidate]: スコアの高い順に並べた、出典が重複しない候補
+        """
+        query_terms = set(tokenize_ngrams(query, self._ngram_size))
+        scored = sorted(
+            candidates,
+            key=lambda candidate: self._score(query_terms, candidate),
+            reverse=True,
+        )
+
+        selected: list[RetrievalCandidate] = []
+        seen_sources: set[str] = set()
+        for candidate in scored:
+            if candidate.source in seen_sources:
+                continue
+            seen_sources.add(candidate.source)
+            selected.append(candidate)
+            if len(selected) >= top_n:
+                break
+        return selected
+
+    def _score(self, query_terms: set[str], candidate: RetrievalCandidate) -> float:
+        if candidate.text is not None and len(query_terms) > 0:
+            text_terms = set(tokenize_ngrams(candidate.text, self._ngram_size))
+            lexical_match = len(query_terms & text_terms) / len(query_terms)
+        else:
+            lexical_match = candidate.lexical_score or 0.0
+
+        return (
+            self._first_stage_weight * candidate.first_stage_score
+            + (1 - self._first_stage_weight) * lexical_match
+        )
@@ -0,0 +1,87 @@
+from langchain.retrievers.multi_vector import MultiVectorRetriever
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.documents import Document
+from pydantic import ConfigDict, Field
+
+from server.rag.reranker import LocalReranker, RetrievalCandidate
+
+
+class RerankingRetriever(MultiVectorRetriever):
+    """
+    ベクトルストアから多めに候補を取得し、再ランキングしてから上位のみをドキュメントストアから取得するRetriever
+
+    同じページから作られた複数のチャンクが上位を占めないよう、候補を出典(URL)ごとにまとめ、
+    出典が異なる上位k件(search_kwargsのk)のみをドキュメントストアから取得する。
+    これにより、ドキュメントストアへの読み込みとプロンプトに含めるトークン数を抑える。
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    candidate_k: int = 30
+    """1段目の検索で取得する候補の数"""
+    reranker: LocalReranker = Field(default_factory=LocalReranker)
+
+    def _get_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: CallbackManagerForRetrieverRun,
+    ) -> list[Document]:
+        candidates = self._search_candidates(query)
+        selected = self.reranker.rerank(query, candidates, self._top_n())
+        docs = self.docstore.mget([candidate.doc_id for candidate in selected])
+        return [d for d in docs if d is not None]
+
+    async def _aget_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: AsyncCallbackManagerForRetrieverRun,
+    ) -> list[Document]:
+        candidates = await self._asearch_candidates(query)
+        selected = self.reranker.rerank(query, candidates, self._top_n())
+        docs = await self.docstore.amget([candidate.doc_id for candidate in selected])
+        return [d for d in docs if d is not None]
+
+    def _search_candidates(self, query: str) -> list[RetrievalCandidate]:
+        sub_docs = self.vectorstore.similarity_search(query, **self._search_kwargs())
+        return self._to_candidates(sub_docs)
+
+    async def _asearch_candidates(self, query: str) -> list[RetrievalCandidate]:
+        sub_docs = await self.vectorstore.asimilarity_search(
+            query, **self._search_kwargs()
+        )
+        return self._to_candidates(sub_docs)
+
+    def _search_kwargs(self) -> dict:
+        return {**self.search_kwargs, "k": self.candidate_k}
+
+    def _top_n(self) -> int:
+        return self.search_kwargs.get("k", 4)
+
+    def _rank_score(self, rank: int, count: int) -> float:
+        """0始まりの順位を、1位が1.0、最下位が1/countとなるスコアに変換します"""
+        return 1 - rank / count
+
+    def _unique_sub_docs(self, sub_docs: list[Document]) -> dict[str, Document]:
+        """ドキュメントストアのキーごとに、最も順位の高いチャンクを順位の順に返します"""
+        unique: dict[str, Document] = {}
+        for d in sub_docs:
+            if self.id_key in d.metadata and d.metadata[self.id_key] not in unique:
+                unique[d.metadata[self.id_key]] = d
+        return unique
+
+    def _to_candidates(self, sub_docs: list[Document]) -> list[RetrievalCandidate]:
+        unique = self._unique_sub_docs(sub_docs)
+        return [
+            RetrievalCandidate(
+                doc_id=doc_id,
+                source=d.metadata.get("url", doc_id),
+                text=d.page_content,
+                first_stage_score=self._rank_score(rank, len(unique)),
+            )
+            for rank, (doc_id, d) in enumerate(unique.items())
+        ]
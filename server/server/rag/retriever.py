@@ -1,57 +1,176 @@
+from typing import Literal, Optional
+
 from langchain.retrievers.multi_vector import MultiVectorRetriever
+from langchain_core.documents import Document
 from langchain_core.embeddings import Embeddings
+from langchain_core.stores import BaseStore
+from langchain_core.vectorstores import VectorStore
 from langchain_pinecone import PineconeVectorStore
-from pinecone import Pinecone, ServerlessSpec  # type: ignore
 
+from server.rag.cached_embeddings import EMBEDDING_CACHE_PREFIX
+from server.rag.hybrid_retriever import HybridRetriever
+from server.rag.index_config import IndexConfig
+from server.rag.ingestion.cached_store import CachedStore, DocstoreCacheConfig
+from server.rag.ingestion.image_blob_store import (
+    IMAGE_BLOB_PREFIX,
+    ImageBlobOffloadingStore,
+    ImageBlobStore,
+)
+from server.rag.ingestion.image_describer import IMAGE_DESCRIPTION_CACHE_PREFIX
+from server.rag.ingestion.image_fetcher import IMAGE_FETCH_CACHE_PREFIX
+from server.rag.ingestion.index_version import INDEX_METADATA_PREFIX
+from server.rag.ingestion.lexical_index import (
+    LEXICAL_INDEX_PREFIX,
+    LexicalIndex,
+    create_lexical_index_store,
+)
+from server.rag.ingestion.local_vectorstore import (
+    LOCAL_VECTORSTORE_PREFIX,
+    create_local_vectorstore,
+)
+from server.rag.ingestion.packed_s3_store import PACKED_STORE_PREFIX, PackedS3Store
+from server.rag.ingestion.pinecone_index import PineconeIndexResolver
 from server.rag.ingestion.s3_store import S3Store
+from server.rag.reranking_retriever import RerankingRetriever
+
+DocstoreBackend = Literal["s3", "packed"]
+"""
+ドキュメントストアの格納形式
+- s3: 1チャンクを1つのS3オブジェクトとして格納する(S3Store)
+- packed: 複数のチャンクをシャードにまとめて格納する(PackedS3Store)
+"""
+
+VectorstoreBackend = Literal["pinecone", "local"]
+"""
+ベクトルストアの種類
+- pinecone: Pineconeのサーバーレスインデックス(PineconeVectorStore)
+- local: ドキュメントストアのバケットに永続化し、/tmpのメモリマップファイルで検索する(LocalVectorStore)
+"""
+
+NON_DOCUMENT_PREFIXES = (
+    IMAGE_BLOB_PREFIX,
+    IMAGE_FETCH_CACHE_PREFIX,
+    IMAGE_DESCRIPTION_CACHE_PREFIX,
+    INDEX_METADATA_PREFIX,
+    EMBEDDING_CACHE_PREFIX,
+    LOCAL_VECTORSTORE_PREFIX,
+    LEXICAL_INDEX_PREFIX,
+    PACKED_STORE_PREFIX,
+)
+"""ドキュメントストアのバケットに同居している、ドキュメント以外のデータのプレフィックス"""
+
+
+def create_docstore(
+    bucket_name: str, backend: DocstoreBackend = "s3"
+) -> BaseStore[str, Document]:
+    if backend == "s3":
+        return S3Store(bucket_name=bucket_name)
+    elif backend == "packed":
+        return PackedS3Store(bucket_name=bucket_name)
+    else:
+        raise ValueError(f"サポートされていないドキュメントストアです: {backend}")
 
 
 def create_retriever(
-    index_name: str,
+    index_config: IndexConfig,
     bucket_name: str,
     embedding: Embeddings,
     id_key: str = "doc_id",
     refresh: bool = False,
     force_create_index: bool = False,
+    docstore_cache_config: Optional[DocstoreCacheConfig] = None,
+    image_blob_store: Optional[ImageBlobStore] = None,
+    docstore_backend: DocstoreBackend = "s3",
+    vectorstore_backend: VectorstoreBackend = "pinecone",
+    hybrid_search: bool = False,
+    index_resolver: Optional[PineconeIndexResolver] = None,
 ) -> MultiVectorRetriever:
-    docstore = S3Store(bucket_name=bucket_name)
+    """
+    ベクトルストアとドキュメントストアを組み合わせたRetrieverを作成します
 
-    pinecone_client = Pinecone()
-    existing_index_names = [
-        index_info["name"] for index_info in pinecone_client.list_indexes()
-    ]
-    is_index_exists = index_name in existing_index_names
+    ベクトルストアから多めに取得した候補を出典ごとにまとめて再ランキングし、
+    上位index_config.k件のみをドキュメントストアから取得するRerankingRetrieverを返します。
+    hybrid_searchがTrueの場合は、DocumentIndexerが作成したLexicalIndexによる語彙検索を併用する
+    HybridRetrieverを返します。
+    Pineconeのインデックスの接続先はindex_resolverがキャッシュしたものを使用し、
+    refreshやforce_create_indexを指定しない限りコントロールプレーンを呼び出しません。
+    """
+    docstore = create_docstore(bucket_name, docstore_backend)
+    if docstore_cache_config is not None:
+        docstore = CachedStore(docstore, docstore_cache_config)
+    if image_blob_store is not None:
+        # NOTE: キャッシュに画像データが載らないよう、キャッシュより外側で画像データを分離する
+        docstore = ImageBlobOffloadingStore(docstore, image_blob_store)
 
     if refresh:
-        doc_keys = docstore.yield_keys()
-        docstore.mdelete(list(doc_keys))
-
-        pinecone_client.delete_index(index_name)
-        pinecone_client.create_index(
-            name=index_name,
-            dimension=1024,
-            metric="cosine",
-            spec=ServerlessSpec(cloud="aws", region="us-east-1"),
-        )
-    elif not is_index_exists and force_create_index:
-        pinecone_client.create_index(
-            name=index_name,
-            dimension=1024,
-            metric="cosine",
-            spec=ServerlessSpec(cloud="aws", region="us-east-1"),
+        # 画像データや埋め込みベクトルのキャッシュは再利用するため削除しない
+        doc_keys = [
+            key
+            for key in docstore.yield_keys()
+            if not key.startswith(NON_DOCUMENT_PREFIXES)
+        ]
+        docstore.mdelete(doc_keys)
+
+    vectorstore: VectorStore
+    if vectorstore_backend == "pinecone":
+        vectorstore = _create_pinecone_vectorstore(
+            index_config=index_config,
+            embedding=embedding,
+            refresh=refresh,
+            force_create_index=force_create_index,
+            index_resolver=index_resolver or PineconeIndexResolver(),
         )
-    elif not is_index_exists:
+    elif vectorstore_backend == "local":
+        # NOTE: インデックス名と名前空間は使用せず、ドキュメントストアのバケットにファイルを格納する
+        vectorstore = create_local_vectorstore(embedding, bucket_name)
+        if refresh:
+            vectorstore.delete()
+    else:
         raise ValueError(
-            f"インデックス {index_name} は存在しません。作成したい場合は、force_create_index を True に設定してください。"
+            f"サポートされていないベクトルストアです: {vectorstore_backend}"
         )
 
-    vectorstore = PineconeVectorStore.from_existing_index(
-        index_name=index_name,
-        embedding=embedding,
-    )
-    return MultiVectorRetriever(
+    if hybrid_search:
+        # インデックスを作り直す場合は、古いLexicalIndexを読み込まない
+        lexical_index_store = (
+            None if refresh else create_lexical_index_store(bucket_name)
+        )
+        if lexical_index_store is not None:
+            # 最初の質問で読み込みを待たないよう、作成時に読み込んでおく
+            lexical_index_store.current()
+        return HybridRetriever(
+            vectorstore=vectorstore,
+            docstore=docstore,
+            id_key=id_key,
+            search_kwargs={"k": index_config.k},
+            lexical_index=LexicalIndex(),
+            lexical_index_store=lexical_index_store,
+        )
+
+    return RerankingRetriever(
         vectorstore=vectorstore,
         docstore=docstore,
         id_key=id_key,
-        search_kwargs={"k": 5},
+        search_kwargs={"k": index_config.k},
+    )
+
+
+def _create_pinecone_vectorstore(
+    index_config: IndexConfig,
+    embedding: Embeddings,
+    refresh: bool,
+    force_create_index: bool,
+    index_resolver: PineconeIndexResolver,
+) -> PineconeVectorStore:
+    if refresh:
+        descriptor = index_resolver.recreate(index_config)
+    else:
+        descriptor = index_resolver.resolve(
+            index_config, force_create=force_create_index
+        )
+
+    return PineconeVectorStore(
+        index=index_resolver.open_index(descriptor),
+        embedding=embedding,
+        namespace=index_config.namespace,
     )
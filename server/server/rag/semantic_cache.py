@@ -0,0 +1,362 @@
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from pydantic import BaseModel
+
+from server.rag.ingestion.index_version import IndexVersionStore
+from server.rag.ingestion.model import DocumentMetadata
+from server.rag.model import CitedAnswer, MetadataTypedDocument, RagResult
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticCacheConfig(BaseModel):
+    """SemanticCacheの設定"""
+
+    similarity_threshold: float = 0.95
+    """キャッシュヒットとみなす質問の埋め込みベクトル同士のコサイン類似度の下限"""
+
+    ttl_seconds: Optional[float] = 24 * 60 * 60
+    """キャッシュの有効期間(秒)。Noneの場合は無期限"""
+
+
+class SemanticCacheEntry(BaseModel):
+    question: str
+    embedding: list[float]
+    result: str  # RagResultをJSONにシリアライズしたもの
+    index_version: str
+    created_at: float
+
+
+class SemanticCacheStats(BaseModel):
+    """SemanticCacheのヒット・ミスの回数"""
+
+    hits: int = 0
+    misses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+
+class SemanticCacheBackend(ABC):
+    """SemanticCacheのエントリを永続化するバックエンド"""
+
+    @abstractmethod
+    def load(
+        self, index_version: str, created_after: float
+    ) -> list[SemanticCacheEntry]:
+        """指定されたバージョンのインデックスに対する、指定日時以降に作成されたエントリを返す"""
+
+    @abstractmethod
+    def add(self, entry: SemanticCacheEntry) -> None:
+        """エントリを追加する"""
+
+    @abstractmethod
+    def delete_stale(self, index_version: str, created_before: float) -> None:
+        """指定されたバージョン以外のインデックスに対するエントリと、指定日時より前に作成されたエントリを削除する"""
+
+    @abstractmethod
+    def clear(self) -> None:
+        """全てのエントリを削除する"""
+
+
+class SQLiteSemanticCacheBackend(SemanticCacheBackend):
+    """SQLiteのファイル(Lambdaの/tmpなど)にエントリを保存するバックエンド"""
+
+    _connection: sqlite3.Connection
+    _lock: threading.Lock
+
+    def __init__(self, path: str):
+        """
+        SQLiteSemanticCacheBackendを初期化します。
+
+        Args:
+            path (str): SQLiteのデータベースファイルのパス。":memory:"を指定するとメモリ上に作成する
+        """
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS semantic_cache (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    question TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    result TEXT NOT NULL,
+                    index_version TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+
+    def load(
+        self, index_version: str, created_after: float
+    ) -> list[SemanticCacheEntry]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT question, embedding, result, index_version, created_at"
+                " FROM semantic_cache WHERE index_version = ? AND created_at >= ?"
+                " ORDER BY id",
+                (index_version, created_after),
+            ).fetchall()
+
+        return [
+            SemanticCacheEntry(
+                question=question,
+                embedding=np.frombuffer(embedding, dtype=np.float32).tolist(),
+                result=result,
+                index_version=version,
+                created_at=created_at,
+            )
+            for question, embedding, result, version, created_at in rows
+        ]
+
+    def add(self, entry: SemanticCacheEntry) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO semantic_cache"
+                " (question, embedding, result, index_version, created_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (
+                    entry.question,
+                    np.asarray(entry.embedding, dtype=np.float32).tobytes(),
+                    entry.result,
+                    entry.index_version,
+                    entry.created_at,
+                ),
+            )
+
+    def delete_stale(self, index_version: str, created_before: float) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM semantic_cache WHERE index_version != ? OR created_at < ?",
+                (index_version, created_before),
+            )
+
+    def clear(self) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM semantic_cache")
+
+
+class SemanticCache:
+    """
+    質問の埋め込みベクトルの類似度に基づいてRagResultをキャッシュする
+
+    正規化した質問を埋め込み、過去の質問とのコサイン類似度がしきい値以上であれば、
+    その質問に対するRagResultを返す。
+    インデックスが更新された場合(IndexVersionStoreのバージョンが変わった場合)、それ以前のエントリは使用しない。
+    """
+
+    _embedding: Embeddings
+    _backend: SemanticCacheBackend
+    _config: SemanticCacheConfig
+    _index_version_store: Optional[IndexVersionStore]
+
+    _loaded_index_version: Optional[str]
+    _entries: list[SemanticCacheEntry]
+    _matrix: np.ndarray  # 先頭のlen(_entries)行が各エントリの正規化済み埋め込みベクトルである行列。残りの行は追加用の余白
+    _query_embeddings: "OrderedDict[str, np.ndarray]"
+    _stats: SemanticCacheStats
+    _lock: threading.Lock
+
+    def __init__(
+        self,
+        embedding: Embeddings,
+        backend: SemanticCacheBackend,
+        config: Optional[SemanticCacheConfig] = None,
+        index_version_store: Optional[IndexVersionStore] = None,
+    ):
+        """
+        SemanticCacheを初期化します。
+
+        Args:
+            embedding (Embeddings): 質問を埋め込むモデル
+            backend (SemanticCacheBackend): エントリを永続化するバックエンド
+            config (Optional[SemanticCacheConfig]): キャッシュの設定
+            index_version_store (Optional[IndexVersionStore]): インデックスのバージョン。
+                省略した場合はインデックスの更新によってキャッシュが無効にならないため、invalidateを呼び出す必要がある
+        """
+        self._embedding = embedding
+        self._backend = backend
+        self._config = config or SemanticCacheConfig()
+        self._index_version_store = index_version_store
+
+        self._loaded_index_version = None
+        self._clear_entries()
+        self._query_embeddings = OrderedDict()
+        self._stats = SemanticCacheStats()
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self) -> SemanticCacheStats:
+        """キャッシュのヒット・ミスの回数を返します"""
+        with self._lock:
+            return self._stats.model_copy()
+
+    def lookup(self, question: str) -> Optional[RagResult]:
+        """
+        類似する過去の質問に対するRagResultを返します
+
+        Args:
+            question (str): 質問
+
+        Returns:
+            Optional[RagResult]: キャッシュされたRagResult。ヒットしなかった場合はNone
+        """
+        query = self._embed(self._normalize(question))
+        index_version = self._current_index_version()
+
+        with self._lock:
+            self._load_entries(index_version)
+            min_created_at = self._min_created_at()
+
+            best_entry: Optional[SemanticCacheEntry] = None
+            if len(self._entries) > 0:
+                similarities = self._matrix[: len(self._entries)] @ query
+                for i in np.argsort(-similarities):
+                    if similarities[i] < self._config.similarity_threshold:
+                        break
+                    if self._entries[i].created_at >= min_created_at:
+                        best_entry = self._entries[i]
+                        break
+
+            if best_entry is None:
+                self._stats.misses += 1
+            else:
+                self._stats.hits += 1
+
+        if best_entry is None:
+            logger.info(
+                f"セマンティックキャッシュにヒットしませんでした: {self._stats}"
+            )
+            return None
+
+        logger.info(
+            f"セマンティックキャッシュにヒットしました: {best_entry.question} {self._stats}"
+        )
+        return self._deserialize(best_entry.result)
+
+    def update(self, question: str, result: RagResult) -> None:
+        """
+        質問とそのRagResultをキャッシュに追加します
+
+        Args:
+            question (str): 質問
+            result (RagResult): 質問に対するRagResult
+        """
+        normalized_question = self._normalize(question)
+        entry = SemanticCacheEntry(
+            question=normalized_question,
+            embedding=self._embed(normalized_question).tolist(),
+            result=self._serialize(result),
+            index_version=self._current_index_version(),
+            created_at=time.time(),
+        )
+        self._backend.add(entry)
+
+        with self._lock:
+            if entry.index_version == self._loaded_index_version:
+                self._append_entry(entry)
+
+    def invalidate(self) -> None:
+        """全てのエントリを削除します"""
+        self._backend.clear()
+        with self._lock:
+            self._loaded_index_version = None
+            self._clear_entries()
+
+    def _current_index_version(self) -> str:
+        if self._index_version_store is None:
+            return ""
+        return self._index_version_store.get()
+
+    def _load_entries(self, index_version: str) -> None:
+        """インデックスのバージョンが変わった場合のみ、バックエンドからエントリを読み込み直す"""
+        if index_version == self._loaded_index_version:
+            return
+
+        min_created_at = self._min_created_at()
+        self._backend.delete_stale(index_version, created_before=min_created_at)
+        self._clear_entries()
+        for entry in self._backend.load(index_version, created_after=min_created_at):
+            self._append_entry(entry)
+        self._loaded_index_version = index_version
+
+    def _clear_entries(self) -> None:
+        self._entries = []
+        self._matrix = np.empty((0, 0), dtype=np.float32)
+
+    def _append_entry(self, entry: SemanticCacheEntry) -> None:
+        vector = self._to_unit_vector(entry.embedding)
+        count = len(self._entries)
+        # 追加のたびに行列全体を複製しないよう、行が足りなくなった場合のみ2倍の行数の行列に移す
+        if count == len(self._matrix):
+            matrix = np.empty((max(16, count * 2), len(vector)), dtype=np.float32)
+            if count > 0:
+                matrix[:count] = self._matrix[:count]
+            self._matrix = matrix
+        self._matrix[count] = vector
+        self._entries.append(entry)
+
+    def _min_created_at(self) -> float:
+        if self._config.ttl_seconds is None:
+            return 0.0
+        return time.time() - self._config.ttl_seconds
+
+    def _embed(self, normalized_question: str) -> np.ndarray:
+        # lookupとupdateで同じ質問を2回埋め込まないよう、直近の結果を保持しておく
+        with self._lock:
+            cached = self._query_embeddings.get(normalized_question)
+        if cached is not None:
+            return cached
+
+        vector = self._to_unit_vector(self._embedding.embed_query(normalized_question))
+        with self._lock:
+            self._query_embeddings[normalized_question] = vector
+            while len(self._query_embeddings) > 128:
+                self._query_embeddings.popitem(last=False)
+        return vector
+
+    def _to_unit_vector(self, embedding: list[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _normalize(self, question: str) -> str:
+        """表記ゆれによる違いを吸収するため、質問を正規化する"""
+        normalized = unicodedata.normalize("NFKC", question).lower()
+        normalized = re.sub(r"\s+", " ", normalized).strip()
+        return normalized.rstrip("?？。.!！ ")
+
+    def _serialize(self, result: RagResult) -> str:
+        return json.dumps(
+            {
+                "retrieved_docs": [
+                    doc.model_dump() for doc in result["retrieved_docs"]
+                ],
+                "answer": result["answer"].model_dump(),
+            },
+            ensure_ascii=False,
+        )
+
+    def _deserialize(self, data: str) -> RagResult:
+        raw = json.loads(data)
+        return RagResult(
+            retrieved_docs=[
+                MetadataTypedDocument[DocumentMetadata].model_validate(doc)
+                for doc in raw["retrieved_docs"]
+            ],
+            answer=CitedAnswer.model_validate(raw["answer"]),
+        )
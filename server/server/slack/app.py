@@ -1,45 +1,118 @@
 import logging
 import os
-from typing import Callable, Sequence
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Optional, Sequence, cast
 
-from langchain_aws import BedrockEmbeddings, ChatBedrock
 from slack_bolt import App, BoltRequest, Say
 from slack_bolt.adapter.aws_lambda import SlackRequestHandler
+from slack_sdk import WebClient
 
-from server.rag import Rag
-from server.slack.utils import format_rag_result, remove_mention
 from server.utils.env import getenv_or_raise
 
+if TYPE_CHECKING:
+    from server.rag import Rag
+
 SlackRequestHandler.clear_all_log_handlers()  # NOTE: このメソッド呼び出し以前に記述されたlogger呼び出しはログ出力されない模様
 logging.basicConfig(format="%(asctime)s %(message)s", level=logging.DEBUG)
 
 # ボットトークンと署名シークレットを使ってアプリを初期化する
+# NOTE: トークンの検証(auth.test)はコールドスタートのたびにSlack APIを呼び出すため無効にする
+# 不正なトークンの場合は、最初にSlack APIを呼び出した時点でエラーになる
 app = App(
     token=os.environ.get("SLACK_BOT_TOKEN"),
     signing_secret=os.environ.get("SLACK_SIGNING_SECRET"),
     process_before_response=True,
+    token_verification_enabled=False,
 )
 
-llm = ChatBedrock(
-    model="anthropic.claude-3-haiku-20240307-v1:0",
-    region="us-east-1",
-    client=None,
-    model_kwargs={
-        "temperature": 0,
-    },
-)
-embedding = BedrockEmbeddings(
-    model_id="amazon.titan-embed-text-v2:0", region_name="us-east-1", client=None
-)
-rag = Rag(
-    llm=llm,
-    embedding=embedding,
-    index_name=getenv_or_raise("PINECONE_INDEX_NAME"),
-    bucket_name=getenv_or_raise("RAG_DOCSTORE_BUCKET_NAME"),
-    langfuse_secret_key=getenv_or_raise("LANGFUSE_SECRET_KEY"),
-    langfuse_public_key=getenv_or_raise("LANGFUSE_PUBLIC_KEY"),
-    langfuse_host=getenv_or_raise("LANGFUSE_HOST"),
-)
+_rag: Optional["Rag"] = None
+_rag_lock = threading.Lock()
+
+
+def get_rag() -> "Rag":
+    """
+    Ragを初回の呼び出し時に作成して返す
+
+    Slackへの応答(ack)の経路でLangChainやBedrock・Pinecone・S3のクライアントを読み込まないよう、
+    回答を生成するLazyリスナーかウォームアップの呼び出し時まで作成を遅らせる。
+    """
+    global _rag
+    with _rag_lock:
+        if _rag is None:
+            _rag = _create_rag()
+        return _rag
+
+
+def warm_up() -> None:
+    """コールドスタート後の最初の質問が遅くならないよう、Ragと各種クライアントを作成しておく"""
+    start = time.perf_counter()
+    get_rag()
+    logging.info(f"ウォームアップが完了しました: {time.perf_counter() - start:.2f}s")
+
+
+def _create_rag() -> "Rag":
+    # NOTE: 読み込みに時間がかかるモジュールは、ackの経路で読み込まないよう関数内でインポートする
+    from langchain.storage import LocalFileStore
+    from langchain_aws import BedrockEmbeddings, ChatBedrock
+
+    from server.rag import Rag
+    from server.rag.cached_embeddings import create_cached_bedrock_embeddings
+    from server.rag.context_packer import ContextBudget
+    from server.rag.index_config import IndexConfig
+    from server.rag.ingestion.cached_store import DocstoreCacheConfig
+    from server.rag.ingestion.index_version import create_index_version_store
+    from server.rag.retriever import DocstoreBackend, VectorstoreBackend
+    from server.rag.semantic_cache import SemanticCache, SQLiteSemanticCacheBackend
+
+    llm = ChatBedrock(
+        model="anthropic.claude-3-haiku-20240307-v1:0",
+        region="us-east-1",
+        client=None,
+        model_kwargs={
+            "temperature": 0,
+        },
+    )
+    # ウォームスタート時に同じ質問を埋め込み直さないよう、/tmpにキャッシュする
+    embedding = create_cached_bedrock_embeddings(
+        BedrockEmbeddings(
+            model_id="amazon.titan-embed-text-v2:0",
+            region_name="us-east-1",
+            client=None,
+        ),
+        LocalFileStore("/tmp/rag-embedding-cache"),
+    )
+    bucket_name = getenv_or_raise("RAG_DOCSTORE_BUCKET_NAME")
+    # 同じ質問が繰り返されることが多いため、類似する質問に対してはLLMを呼び出さずに過去の回答を返す
+    # インデックスが更新された場合は、DocumentIndexerが発行したバージョンの変化を検知して無効にする
+    semantic_cache = SemanticCache(
+        embedding=embedding,
+        backend=SQLiteSemanticCacheBackend("/tmp/rag-semantic-cache.sqlite3"),
+        index_version_store=create_index_version_store(bucket_name),
+    )
+    return Rag(
+        llm=llm,
+        embedding=embedding,
+        # DocumentIndexerと同じ環境変数から作成し、次元数や名前空間を揃える
+        index_config=IndexConfig.from_env(),
+        bucket_name=bucket_name,
+        langfuse_secret_key=getenv_or_raise("LANGFUSE_SECRET_KEY"),
+        langfuse_public_key=getenv_or_raise("LANGFUSE_PUBLIC_KEY"),
+        langfuse_host=getenv_or_raise("LANGFUSE_HOST"),
+        # ウォームスタート時に同じチャンクをS3から取得し直さないよう、メモリと/tmpにキャッシュする
+        docstore_cache_config=DocstoreCacheConfig(disk_dir="/tmp/rag-docstore-cache"),
+        docstore_backend=cast(
+            DocstoreBackend, os.environ.get("RAG_DOCSTORE_BACKEND", "s3")
+        ),
+        vectorstore_backend=cast(
+            VectorstoreBackend, os.environ.get("RAG_VECTORSTORE_BACKEND", "pinecone")
+        ),
+        # 製品名やカタカナ語の完全一致を拾えるよう、語彙検索を併用する
+        hybrid_search=os.environ.get("RAG_HYBRID_SEARCH", "true").lower() == "true",
+        semantic_cache=semantic_cache,
+        # 質問によってプロンプトの大きさと応答時間がばらつかないよう、検索結果をモデルごとの予算内に収める
+        context_budget=ContextBudget.for_model(llm.model_id),
+    )
 
 
 # タイムアウトによるリトライをスキップするためのミドルウェア
@@ -72,27 +145,67 @@ def is_timeout_retry(*, retry_num: Sequence[str], retry_reason: Sequence[str]) -
     return False
 
 
+# chat.updateのレート制限(Tier 3: 50回/分程度)を超えないよう、メッセージの更新間隔を空ける
+# ref: https://api.slack.com/methods/chat.update
+MESSAGE_UPDATE_INTERVAL_SECONDS = 1.5
+
+
 # ボットへのメンションに対するイベントリスナー
-def handle_app_mention(event, say: Say, logger: logging.Logger):
+def handle_app_mention(event, say: Say, client: WebClient, logger: logging.Logger):
+    from server.rag import AnswerStatement, RagResult
+    from server.slack.utils import (
+        format_partial_answer,
+        format_rag_result,
+        remove_mention,
+    )
+
     logger.debug(f"app_mention event: {event}")
 
     text = event["text"]
     channel = event["channel"]
     thread_ts = event.get("thread_ts") or event["ts"]
 
-    say(channel=channel, thread_ts=thread_ts, text="考え中です...少々お待ちください...")
+    placeholder = say(
+        channel=channel, thread_ts=thread_ts, text="考え中です...少々お待ちください..."
+    )
+    placeholder_ts = placeholder["ts"]
 
     payload = remove_mention(text)
     logger.debug(f"payload: {payload}")
 
     try:
-        rag_result = rag.invoke(payload)
+        # 回答文が生成されるたびにプレースホルダーのメッセージを更新し、最後に参照ドキュメントを追記する
+        answer_statements: list[AnswerStatement] = []
+        rag_result: Optional[RagResult] = None
+        last_updated_at = 0.0
+
+        for chunk in get_rag().stream(payload):
+            if not isinstance(chunk, AnswerStatement):
+                rag_result = chunk
+                continue
+
+            answer_statements.append(chunk)
+            now = time.monotonic()
+            if now - last_updated_at >= MESSAGE_UPDATE_INTERVAL_SECONDS:
+                client.chat_update(
+                    channel=channel,
+                    ts=placeholder_ts,
+                    text=format_partial_answer(answer_statements),
+                )
+                last_updated_at = now
+
         logger.debug(f"rag_result: {rag_result}")
+        if rag_result is None:
+            raise Exception("回答を生成できませんでした")
 
-        say(channel=channel, thread_ts=thread_ts, text=format_rag_result(rag_result))
+        client.chat_update(
+            channel=channel, ts=placeholder_ts, text=format_rag_result(rag_result)
+        )
     except Exception as e:
         logger.exception("エラーが発生しました")
-        say(channel=channel, thread_ts=thread_ts, text=f"エラーが発生しました: {e}")
+        client.chat_update(
+            channel=channel, ts=placeholder_ts, text=f"エラーが発生しました: {e}"
+        )
 
 
 def noop_ack():
@@ -100,7 +213,7 @@ def noop_ack():
 
 
 # 3秒以内にレスポンスを返さないとリトライが発生してしまうため、それを防ぐためにLazyリスナーとして登録する
-# この対応を行っても、コールドスタート時には3秒を超えてしまうようでリトライが発生する
+# コールドスタート時も3秒以内に応答できるよう、ackの経路ではRagの作成や重いモジュールの読み込みを行わない
 # ref:
 # - https://api.slack.com/apis/events-api#retries
 # - https://slack.dev/bolt-python/ja-jp/concepts#lazy-listeners
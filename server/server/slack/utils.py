@@ -10,12 +10,23 @@ def remove_mention(text: str) -> str:
     return re.sub(mention_regex, "", text).strip()
 
 
+def format_partial_answer(answer_statements: list[AnswerStatement]) -> str:
+    """生成途中の回答を、それまでに生成された回答文のみでフォーマットする"""
+    answer_text = "".join(
+        [
+            f"{_format_answer_statement(answer_statement)}\n"
+            for answer_statement in answer_statements
+        ]
+    )
+    return f"{answer_text}\n(回答を生成中です...)"
+
+
 def format_rag_result(rag_result: RagResult) -> str:
     answer_text = ""
     cited_source_ids = set[int]()
 
     for answer_statement in rag_result["answer"].statements:
-        # TODO: チャンク化されたドキュメントから引用しているため、大本のドキュメントが同一でも複数の引用番号に分かれてしまう場合があるのを修正する
+        # NOTE: 検索結果は出典(URL)ごとに1つのチャンクにまとめられているため、同じドキュメントが複数の引用番号に分かれることはない
         answer_text += f"{_format_answer_statement(answer_statement)}\n"
         cited_source_ids.update(answer_statement.citations)
 
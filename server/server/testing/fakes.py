@@ -0,0 +1,744 @@
+"""
+テストとベンチマークスクリプトで使用する、外部サービスを呼び出さないローカルのスタンドイン
+
+テストのパッケージに依存せずにベンチマークスクリプトから使用できるよう、serverパッケージに置いている。
+"""
+
+import hashlib
+import io
+import json
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Any, Iterator, List, Optional
+
+import numpy as np
+from botocore.exceptions import ClientError
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.retrievers import BaseRetriever
+from pinecone.exceptions import NotFoundException  # type: ignore
+from pydantic import BaseModel, PrivateAttr
+
+
+class FakeToolCallingChatModel(BaseChatModel):
+    """
+    決められた構造化出力を、ツール呼び出しの引数として少しずつ出力するチャットモデル
+
+    ストリーミング時は引数のJSONをchunk_size文字ずつ、seconds_per_chunk秒間隔で出力する。
+    非ストリーミング時は同じ時間だけ待ってから全体を返す。
+    """
+
+    output: BaseModel
+    first_token_latency_seconds: float = 0.5
+    seconds_per_chunk: float = 0.02
+    chunk_size: int = 4
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-tool-calling-chat-model"
+
+    def bind_tools(self, tools: Any, **kwargs: Any) -> "FakeToolCallingChatModel":
+        return self
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        time.sleep(
+            self.first_token_latency_seconds
+            + self.seconds_per_chunk * len(self._arg_chunks())
+        )
+        message = AIMessage(
+            content="",
+            tool_calls=[
+                {
+                    "name": type(self.output).__name__,
+                    "args": self.output.model_dump(),
+                    "id": "call_0",
+                }
+            ],
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.first_token_latency_seconds)
+        for i, args in enumerate(self._arg_chunks()):
+            time.sleep(self.seconds_per_chunk)
+            yield ChatGenerationChunk(
+                message=AIMessageChunk(
+                    content="",
+                    tool_call_chunks=[
+                        {
+                            "name": type(self.output).__name__ if i == 0 else None,
+                            "args": args,
+                            "id": "call_0" if i == 0 else None,
+                            "index": 0,
+                        }
+                    ],
+                )
+            )
+
+    def _arg_chunks(self) -> list[str]:
+        args = json.dumps(self.output.model_dump(), ensure_ascii=False)
+        return [
+            args[i : i + self.chunk_size] for i in range(0, len(args), self.chunk_size)
+        ]
+
+
+class FakeBedrockQuota:
+    """
+    同時にmax_concurrency件までの呼び出しを受け付け、それを超えるとThrottlingExceptionを送出するBedrockのクォータ
+
+    スロットリングされた呼び出しもlatency_seconds秒待ってから失敗する。
+    """
+
+    max_concurrency: int
+    latency_seconds: float
+    in_flight: int
+    accepted: int
+    throttled: int
+    _lock: threading.Lock
+
+    def __init__(self, max_concurrency: int, latency_seconds: float = 0.02):
+        self.max_concurrency = max_concurrency
+        self.latency_seconds = latency_seconds
+        self.in_flight = 0
+        self.accepted = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def call(self) -> Iterator[None]:
+        with self._lock:
+            throttled = self.in_flight >= self.max_concurrency
+            if throttled:
+                self.throttled += 1
+            else:
+                self.in_flight += 1
+                self.accepted += 1
+        if throttled:
+            time.sleep(self.latency_seconds)
+            raise ClientError(
+                {
+                    "Error": {
+                        "Code": "ThrottlingException",
+                        "Message": "Too many requests",
+                    }
+                },
+                "InvokeModel",
+            )
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+class FakeVisionChatModel(BaseChatModel):
+    """
+    画像の説明を模したテキストを、latency_seconds秒待ってから返すチャットモデル
+
+    呼び出された回数をcallsに記録する。
+    quotaを指定した場合はその同時呼び出し数を超えるとスロットリングされ、
+    invalid_rateの割合の画像(内容から決定的に選ぶ)ではリトライしても成功しないエラーとなる。
+    """
+
+    latency_seconds: float = 0.2
+    quota: Optional[Any] = None
+    """FakeBedrockQuota"""
+
+    invalid_rate: float = 0.0
+    calls: int = 0
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-vision-chat-model"
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        with self._lock:
+            self.calls += 1
+        digest = hashlib.sha256(str(messages[-1].content).encode()).hexdigest()
+        if int(digest[:8], 16) / 0xFFFFFFFF < self.invalid_rate:
+            raise ValueError(
+                "Error raised by bedrock service: ValidationException: "
+                "Could not process image"
+            )
+        if self.quota is not None:
+            with self.quota.call():
+                time.sleep(self.latency_seconds)
+        else:
+            time.sleep(self.latency_seconds)
+        message = AIMessage(content=f"画像{digest[:8]}の説明")
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+class FakeRetriever(BaseRetriever):
+    """決められたドキュメントを返すRetriever"""
+
+    docs: list[Document]
+    latency_seconds: float = 0.0
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        time.sleep(self.latency_seconds)
+        return self.docs
+
+
+class ClusteredFakeEmbeddings(Embeddings):
+    """
+    テキストのハッシュ値から、いくつかのクラスタのまわりに分布する埋め込みベクトルを決定的に生成するEmbeddings
+
+    一様乱数のベクトルと異なり実際の埋め込みベクトルのように偏りがあるため、
+    近似最近傍探索の再現率の評価にも使用できる。
+    """
+
+    _size: int
+    _centers: np.ndarray
+    _noise: float
+    _latency_seconds: float
+    _quota: Optional[FakeBedrockQuota]
+    _lock: threading.Lock
+    embedded_texts: int
+    """embed_documentsで埋め込んだテキストの数"""
+
+    def __init__(
+        self,
+        size: int = 1024,
+        clusters: int = 32,
+        noise: float = 0.5,
+        latency_seconds: float = 0.0,
+        quota: Optional[FakeBedrockQuota] = None,
+    ):
+        self._size = size
+        self._centers = np.random.default_rng(0).standard_normal((clusters, size))
+        self._noise = noise
+        self._latency_seconds = latency_seconds
+        self._quota = quota
+        self._lock = threading.Lock()
+        self.embedded_texts = 0
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if self._quota is not None:
+            with self._quota.call():
+                time.sleep(self._latency_seconds)
+        else:
+            time.sleep(self._latency_seconds)
+        with self._lock:
+            self.embedded_texts += len(texts)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        time.sleep(self._latency_seconds)
+        return self._embed(text)
+
+    def _embed(self, text: str) -> list[float]:
+        seed = int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:16], 16)
+        rng = np.random.default_rng(seed)
+        center = self._centers[seed % len(self._centers)]
+        return (center + self._noise * rng.standard_normal(self._size)).tolist()
+
+
+class _FakeApplyResult:
+    """async_req=Trueで呼び出した場合の戻り値(multiprocessing.pool.ApplyResult相当)"""
+
+    def __init__(self, future: "Future[Any]"):
+        self._future = future
+
+    def get(self) -> Any:
+        return self._future.result()
+
+
+class FakePineconeIndex:
+    """メモリ上でベクトルを保持する、Pineconeのインデックス(データプレーン)のスタンドイン"""
+
+    def __init__(
+        self,
+        host: str,
+        namespaces: dict[str, dict[str, tuple]],
+        keep_metadata: bool = True,
+        latency_seconds: float = 0.0,
+        pool: Optional[ThreadPoolExecutor] = None,
+    ):
+        self.config = SimpleNamespace(host=host, api_key="fake-api-key")
+        self._namespaces = namespaces
+        self._keep_metadata = keep_metadata
+        self._latency_seconds = latency_seconds
+        self._pool = pool or ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+
+    def upsert(
+        self,
+        vectors: list[tuple],
+        namespace: Optional[str] = None,
+        async_req: bool = False,
+        **kwargs: Any,
+    ) -> Any:
+        # async_req=Trueの場合は、Pineconeのクライアントと同じくスレッドプールで実行する
+        if async_req:
+            return _FakeApplyResult(
+                self._pool.submit(self.upsert, vectors, namespace, False)
+            )
+        time.sleep(self._latency_seconds)
+        with self._lock:
+            records = self._namespaces.setdefault(namespace or "", {})
+            for vector_id, values, metadata in vectors:
+                records[vector_id] = (
+                    np.asarray(values, dtype=np.float32),
+                    metadata if self._keep_metadata else {},
+                )
+        return {"upserted_count": len(vectors)}
+
+    def query(
+        self,
+        vector: list[float],
+        top_k: int,
+        namespace: Optional[str] = None,
+        include_values: bool = False,
+        include_metadata: bool = True,
+        **kwargs: Any,
+    ) -> dict[str, Any]:
+        records = self._namespaces.get(namespace or "", {})
+        if len(records) == 0:
+            return {"matches": []}
+        ids = list(records)
+        matrix = np.stack([records[vector_id][0] for vector_id in ids])
+        query = np.asarray(vector, dtype=np.float32)
+        scores = (
+            matrix
+            @ query
+            / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query) + 1e-12)
+        )
+        return {
+            "matches": [
+                {
+                    "id": ids[i],
+                    "score": float(scores[i]),
+                    # NOTE: PineconeVectorStoreは結果のメタデータを書き換えるため、コピーを返す
+                    "metadata": dict(records[ids[i]][1]) if include_metadata else None,
+                    "values": records[ids[i]][0].tolist() if include_values else [],
+                }
+                for i in np.argsort(-scores)[:top_k]
+            ]
+        }
+
+    def delete(
+        self,
+        ids: Optional[list[str]] = None,
+        delete_all: Optional[bool] = None,
+        namespace: Optional[str] = None,
+        **kwargs: Any,
+    ) -> None:
+        records = self._namespaces.setdefault(namespace or "", {})
+        if delete_all:
+            records.clear()
+        for vector_id in ids or []:
+            records.pop(vector_id, None)
+
+
+class FakePinecone:
+    """
+    Pineconeのクライアントのスタンドイン
+
+    コントロールプレーン(list_indexes, describe_index, create_index, delete_index と
+    名前を指定したIndex)の呼び出しにcontrol_plane_latency_seconds秒の遅延を入れ、呼び出し回数を数える。
+    ホストを指定したIndexはデータプレーンのみを使用するため、遅延も回数の加算もない。
+    keep_metadata=Falseの場合はベクトルのみを保持し、メタデータ(チャンクの本文を含む)を保持しない。
+    upsertはdata_plane_latency_seconds秒の遅延の後に反映し、async_req=Trueの場合はpool_threadsのスレッドで並行に実行する。
+    """
+
+    control_plane_calls: int
+
+    def __init__(
+        self,
+        control_plane_latency_seconds: float = 0.3,
+        keep_metadata: bool = True,
+        data_plane_latency_seconds: float = 0.0,
+        pool_threads: int = 5,
+    ):
+        self.control_plane_calls = 0
+        self._latency_seconds = control_plane_latency_seconds
+        self._keep_metadata = keep_metadata
+        self._data_plane_latency_seconds = data_plane_latency_seconds
+        self._pool = ThreadPoolExecutor(max_workers=pool_threads)
+        self._indexes: dict[str, SimpleNamespace] = {}
+        self._data: dict[str, dict[str, dict[str, tuple]]] = {}
+        self._lock = threading.Lock()
+
+    def list_indexes(self) -> list[dict[str, Any]]:
+        self._control_plane()
+        return [vars(index) for index in self._indexes.values()]
+
+    def describe_index(self, name: str) -> SimpleNamespace:
+        self._control_plane()
+        if name not in self._indexes:
+            raise NotFoundException()
+        return self._indexes[name]
+
+    def create_index(
+        self,
+        name: str,
+        spec: Any,
+        dimension: int,
+        metric: str = "cosine",
+        **kwargs: Any,
+    ) -> SimpleNamespace:
+        self._control_plane()
+        host = f"{name}-fakeproject.svc.local.pinecone.io"
+        self._indexes[name] = SimpleNamespace(
+            name=name,
+            host=host,
+            dimension=dimension,
+            metric=metric,
+            status={"ready": True},
+        )
+        self._data[host] = {}
+        return self._indexes[name]
+
+    def delete_index(self, name: str) -> None:
+        self._control_plane()
+        if name not in self._indexes:
+            raise NotFoundException()
+        index = self._indexes.pop(name)
+        self._data.pop(index.host, None)
+
+    def Index(self, name: str = "", host: str = "", **kwargs: Any) -> FakePineconeIndex:
+        if host == "":
+            host = self.describe_index(name).host
+        return FakePineconeIndex(
+            host,
+            self._data.setdefault(host, {}),
+            keep_metadata=self._keep_metadata,
+            latency_seconds=self._data_plane_latency_seconds,
+            pool=self._pool,
+        )
+
+    def vector_ids(self, name: str, namespace: Optional[str] = None) -> set[str]:
+        """インデックスの名前空間に格納されているベクトルのIDを返す(コントロールプレーンの呼び出しに数えない)"""
+        host = self._indexes[name].host
+        return set(self._data.get(host, {}).get(namespace or "", {}))
+
+    def _control_plane(self) -> None:
+        with self._lock:
+            self.control_plane_calls += 1
+        time.sleep(self._latency_seconds)
+
+
+class _FakeNoSuchKey(ClientError):
+    def __init__(self, key: str):
+        super().__init__(
+            {"Error": {"Code": "NoSuchKey", "Message": f"{key} does not exist"}},
+            "GetObject",
+        )
+
+
+class FakeS3Client:
+    """
+    オブジェクトをメモリ上に保持する、S3のクライアントのスタンドイン
+
+    S3Store・S3ByteStore・PackedS3Storeが使用するAPI(Range・IfNoneMatchを指定したget_objectを含む)のみを実装する。
+    APIごとの呼び出し回数をcallsに記録する。
+
+    例:
+        store = S3Store(bucket_name="bucket", client=FakeS3Client())
+    """
+
+    objects: dict[tuple[str, str], bytes]
+    calls: Counter
+
+    def __init__(self):
+        self.objects = {}
+        self.calls = Counter()
+        self.exceptions = SimpleNamespace(
+            NoSuchKey=_FakeNoSuchKey, ClientError=ClientError
+        )
+        self._lock = threading.Lock()
+
+    def get_object(
+        self,
+        Bucket: str,
+        Key: str,
+        Range: Optional[str] = None,
+        IfNoneMatch: Optional[str] = None,
+        **kwargs: Any,
+    ) -> dict[str, Any]:
+        with self._lock:
+            self.calls["get_object"] += 1
+            data = self.objects.get((Bucket, Key))
+        if data is None:
+            raise _FakeNoSuchKey(Key)
+        etag = self._etag(data)
+        if IfNoneMatch == etag:
+            raise ClientError(
+                {"Error": {"Code": "304", "Message": "Not Modified"}}, "GetObject"
+            )
+        if Range is not None:
+            start, end = Range.removeprefix("bytes=").split("-")
+            data = data[int(start) : int(end) + 1]
+        return {"Body": io.BytesIO(data), "ETag": etag, "ContentLength": len(data)}
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes, **kwargs: Any) -> dict:
+        with self._lock:
+            self.calls["put_object"] += 1
+            self.objects[(Bucket, Key)] = bytes(Body)
+        return {"ETag": self._etag(bytes(Body))}
+
+    def delete_objects(self, Bucket: str, Delete: dict[str, Any]) -> dict:
+        with self._lock:
+            self.calls["delete_objects"] += 1
+            for obj in Delete["Objects"]:
+                self.objects.pop((Bucket, obj["Key"]), None)
+        return {"Deleted": Delete["Objects"]}
+
+    def get_paginator(self, operation_name: str) -> SimpleNamespace:
+        assert operation_name == "list_objects_v2"
+        return SimpleNamespace(paginate=self._list_objects)
+
+    def _list_objects(self, Bucket: str, Prefix: str = "") -> Iterator[dict]:
+        with self._lock:
+            self.calls["list_objects_v2"] += 1
+            keys = sorted(
+                key
+                for bucket, key in self.objects
+                if bucket == Bucket and key.startswith(Prefix)
+            )
+        # list_objects_v2と同じく、1ページに1000件ずつ返す
+        for i in range(0, max(len(keys), 1), 1000):
+            yield {"Contents": [{"Key": key} for key in keys[i : i + 1000]]}
+
+    def _etag(self, data: bytes) -> str:
+        return '"' + hashlib.md5(data).hexdigest() + '"'
+
+
+class LocalSiteServer:
+    """
+    リンクでつながったHTMLページと画像を配信する、ローカルのHTTPサーバー
+
+    ページiはページ2i+1と2i+2(と、いくつかの既出のページ)へのリンクを持つ。
+    各ページと画像はETagとLast-Modifiedを返し、If-None-Matchが一致する場合は304を返す。
+    画像のうちfailure_rateの割合は、最初のリクエストに503を返す。
+    各ページの本文はparagraphs個の段落からなる。
+    HTTP/1.1のKeep-Aliveに対応し、1リクエストごとにlatency_seconds秒待ってから応答する。
+    リクエスト数・接続数・同時リクエスト数の最大値を記録する。
+
+    例:
+        with LocalSiteServer(pages=100) as server:
+            loader = AsyncWebCrawler([server.root_url])
+    """
+
+    requests: int
+    connections: int
+    not_modified: int
+    max_in_flight: int
+
+    def __init__(
+        self,
+        pages: int = 100,
+        latency_seconds: float = 0.05,
+        images: int = 0,
+        image_bytes: int = 50_000,
+        failure_rate: float = 0.0,
+        paragraphs: int = 200,
+        port: int = 0,
+    ):
+        self._pages = pages
+        self._paragraphs = paragraphs
+        self._latency_seconds = latency_seconds
+        self._revisions = [0] * pages
+        self._image_revisions = [0] * images
+        self._image_bytes = image_bytes
+        self._failure_rate = failure_rate
+        self._requested_paths: set[str] = set()
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self.requests = 0
+        self.connections = 0
+        self.not_modified = 0
+        self.max_in_flight = 0
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler_class())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    @property
+    def root_url(self) -> str:
+        return f"{self.base_url}/pages/0.html"
+
+    def image_url(self, image: int) -> str:
+        return f"{self.base_url}/images/{image}.png"
+
+    def modify(self, page: int) -> None:
+        """ページの内容を更新する(ETagとLast-Modifiedが変わる)"""
+        self._revisions[page] += 1
+
+    def modify_image(self, image: int) -> None:
+        """画像の内容を更新する(ETagとLast-Modifiedが変わる)"""
+        self._image_revisions[image] += 1
+
+    def reset_counters(self) -> None:
+        with self._lock:
+            self.requests = 0
+            self.connections = 0
+            self.not_modified = 0
+            self.max_in_flight = 0
+            # 一時的なエラーも再び発生させる
+            self._requested_paths.clear()
+
+    def __enter__(self) -> "LocalSiteServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _render(self, page: int) -> bytes:
+        links = [i for i in (2 * page + 1, 2 * page + 2, page // 3) if i < self._pages]
+        body = "".join(
+            f'<p><a href="/pages/{i}.html">ページ{i}へ</a></p>' for i in links
+        )
+        text = (
+            f"<p>ページ{page}の本文です(版{self._revisions[page]})。</p>"
+            * self._paragraphs
+        )
+        return (
+            f'<html lang="ja"><head><title>ページ{page}</title>'
+            f'<meta name="description" content="ページ{page}の説明"></head>'
+            f"<body>{text}{body}</body></html>"
+        ).encode("utf-8")
+
+    def _render_image(self, image: int) -> bytes:
+        seed = hashlib.sha256(
+            f"{image}-{self._image_revisions[image]}".encode()
+        ).digest()
+        return (seed * (self._image_bytes // len(seed) + 1))[: self._image_bytes]
+
+    def _resolve(self, path: str) -> Optional[tuple[bytes, str, int]]:
+        """パスに対応する内容・Content-Type・版を返す"""
+        for prefix, suffix, count in [
+            ("/pages/", ".html", self._pages),
+            ("/images/", ".png", len(self._image_revisions)),
+        ]:
+            name = path.removeprefix(prefix).removesuffix(suffix)
+            if not path.startswith(prefix) or not name.isdigit() or int(name) >= count:
+                continue
+            if prefix == "/pages/":
+                return (
+                    self._render(int(name)),
+                    "text/html; charset=utf-8",
+                    self._revisions[int(name)],
+                )
+            return (
+                self._render_image(int(name)),
+                "image/png",
+                self._image_revisions[int(name)],
+            )
+        return None
+
+    def _should_fail(self, path: str) -> bool:
+        if not path.startswith("/images/"):
+            return False
+        with self._lock:
+            if path in self._requested_paths:
+                return False
+            self._requested_paths.add(path)
+        ratio = int(hashlib.sha256(path.encode()).hexdigest()[:8], 16) / 0xFFFFFFFF
+        return ratio < self._failure_rate
+
+    def _handler_class(self) -> type[BaseHTTPRequestHandler]:
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self) -> None:
+                super().setup()
+                with site._lock:
+                    site.connections += 1
+
+            def do_GET(self) -> None:
+                with site._lock:
+                    site.requests += 1
+                    site._in_flight += 1
+                    site.max_in_flight = max(site.max_in_flight, site._in_flight)
+                try:
+                    time.sleep(site._latency_seconds)
+                    self._respond()
+                finally:
+                    with site._lock:
+                        site._in_flight -= 1
+
+            def _respond(self) -> None:
+                resolved = site._resolve(self.path)
+                if resolved is None:
+                    self.send_error(404)
+                    return
+                if site._should_fail(self.path):
+                    self.send_error(503)
+                    return
+                data, content_type, revision = resolved
+                etag = '"' + hashlib.sha256(data).hexdigest()[:16] + '"'
+                last_modified = time.strftime(
+                    "%a, %d %b %Y %H:%M:%S GMT",
+                    time.gmtime(1_700_000_000 + revision),
+                )
+                if self.headers.get("If-None-Match") == etag:
+                    with site._lock:
+                        site.not_modified += 1
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", last_modified)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        return Handler
+
+
+def create_text_documents(count: int, size: int = 500) -> list[Document]:
+    return [
+        Document(
+            page_content=f"ドキュメント{i}の本文です。" * (size // 12),
+            metadata={
+                "url": f"https://example.com/{i}",
+                "title": f"ドキュメント{i}",
+                "modality": "text",
+            },
+        )
+        for i in range(count)
+    ]
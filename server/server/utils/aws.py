@@ -0,0 +1,41 @@
+from functools import lru_cache
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    from mypy_boto3_s3 import S3Client
+
+
+@lru_cache(maxsize=None)
+def create_s3_client(
+    max_pool_connections: int = 10, endpoint_url: Optional[str] = None
+) -> "S3Client":
+    """
+    並行アクセス向けにチューニングしたS3クライアントを返す
+
+    同じ引数で呼び出された場合は同一のクライアントを返すため、
+    Lambdaのウォームスタート時やストア間でコネクションプールが共有される。
+
+    Args:
+        max_pool_connections (int): コネクションプールの最大接続数。並行数と同じ値を指定する
+        endpoint_url (Optional[str]): S3互換のエンドポイントURL。ローカルのS3互換サーバーを使う場合に指定する
+
+    Returns:
+        S3Client: S3クライアント
+    """
+    try:
+        import boto3
+        from botocore.config import Config
+    except ImportError:
+        raise ImportError(
+            "boto3ライブラリがインストールされていません。"
+            "boto3 をインストールしてください。"
+        )
+
+    config = Config(
+        max_pool_connections=max_pool_connections,
+        # スロットリング時にクライアント側で送信レートを調整する
+        # ref: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/retries.html#adaptive-retry-mode
+        retries={"mode": "adaptive", "max_attempts": 5},
+        tcp_keepalive=True,
+    )
+    return boto3.client("s3", config=config, endpoint_url=endpoint_url)
@@ -0,0 +1,76 @@
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Callable, Sequence, TypeVar
+
+_T = TypeVar("_T")
+_R = TypeVar("_R")
+
+
+def map_concurrently(
+    fn: Callable[[_T], _R], items: Sequence[_T], max_concurrency: int
+) -> list[_R]:
+    """
+    itemsの各要素にfnを最大max_concurrency並列で適用し、入力と同じ順序で結果を返す
+
+    Args:
+        fn (Callable[[_T], _R]): 各要素に適用する関数
+        items (Sequence[_T]): 入力
+        max_concurrency (int): 最大並列数
+
+    Returns:
+        list[_R]: 入力と同じ順序の結果
+    """
+    if len(items) <= 1 or max_concurrency <= 1:
+        return [fn(item) for item in items]
+
+    max_workers = min(max_concurrency, len(items))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(fn, items))
+
+
+@lru_cache(maxsize=None)
+def _shared_executor(max_workers: int) -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(
+        max_workers=max_workers, thread_name_prefix=f"io-{max_workers}"
+    )
+
+
+async def amap_concurrently(
+    fn: Callable[[_T], _R], items: Sequence[_T], max_concurrency: int
+) -> list[_R]:
+    """
+    ブロッキングI/Oを行うfnをitemsの各要素に最大max_concurrency並列で適用し、入力と同じ順序で結果を返す
+
+    asyncioのデフォルトのexecutorはCPU数に応じてスレッド数が制限されるため、
+    並列数に合わせたスレッドプールをプロセス内で共有して使用する。
+    S3へのリクエストは同期版と非同期版で同じboto3クライアント(接続プール)を共有するため、
+    aiobotocoreのクライアントを別に持たずにスレッドプールで並行させている。
+
+    Args:
+        fn (Callable[[_T], _R]): 各要素に適用する関数
+        items (Sequence[_T]): 入力
+        max_concurrency (int): 最大並列数
+
+    Returns:
+        list[_R]: 入力と同じ順序の結果
+    """
+    if len(items) == 0:
+        return []
+
+    loop = asyncio.get_running_loop()
+    executor = _shared_executor(max(1, max_concurrency))
+    return list(
+        await asyncio.gather(
+            *(loop.run_in_executor(executor, fn, item) for item in items)
+        )
+    )
+
+
+def submit_in_background(fn: Callable[..., _R], *args: Any) -> "Future[_R]":
+    """
+    fnをプロセス内で共有するスレッドプールで実行し、そのFutureを返す
+
+    呼び出し元のスレッドで別の処理を行っている間に、ブロッキングする処理を並行して進めるために使用する。
+    """
+    return _shared_executor(4).submit(fn, *args)
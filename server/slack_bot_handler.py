@@ -3,14 +3,30 @@ from typing import Any
 
 from slack_bolt.adapter.aws_lambda import SlackRequestHandler
 
-from server.slack.app import app
+from server.slack.app import app, warm_up
 
 logger = logging.getLogger()
 
 
+def is_warm_up_event(event: dict[str, Any]) -> bool:
+    """
+    ウォームアップ用のイベントかどうかを判定する
+
+    EventBridgeのスケジュールによる呼び出しと、{"warmup": true} を渡した手動の呼び出しを対象とする
+    """
+    return event.get("warmup") is True or (
+        event.get("source") == "aws.events"
+        and event.get("detail-type") == "Scheduled Event"
+    )
+
+
 def handler(event: dict[str, Any], context: Any) -> dict[str, Any]:
     logger.info(f"Received event: {event}")
 
+    if is_warm_up_event(event):
+        warm_up()
+        return {"statusCode": 200, "body": "warmed up"}
+
     # Lambada関数でSlack Boltアプリを実行するためのアダプター
     # ref: https://github.com/slackapi/bolt-python/tree/main/examples/aws_lambda
     slack_handler = SlackRequestHandler(app=app)
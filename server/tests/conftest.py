@@ -0,0 +1,36 @@
+from typing import Any, Callable, Iterator
+
+import pytest
+
+from server.rag.ingestion import packed_s3_store, s3_store
+from server.testing.fakes import FakeS3Client, LocalSiteServer
+
+
+@pytest.fixture
+def local_site() -> Iterator[Callable[..., LocalSiteServer]]:
+    """
+    LocalSiteServerを起動する関数を返し、テストの終了時に起動したサーバーを停止する
+
+    引数はLocalSiteServerと同じ。デフォルトではテストが遅くならないよう、応答の遅延をなくし本文を短くする。
+    """
+    servers: list[LocalSiteServer] = []
+
+    def start(**kwargs: Any) -> LocalSiteServer:
+        kwargs.setdefault("latency_seconds", 0.0)
+        kwargs.setdefault("paragraphs", 5)
+        server = LocalSiteServer(**kwargs).__enter__()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.__exit__()
+
+
+@pytest.fixture
+def fake_s3(monkeypatch: pytest.MonkeyPatch) -> FakeS3Client:
+    """S3のクライアントを指定せずに作成したストアが、共有のクライアントの代わりに使用するFakeS3Client"""
+    client = FakeS3Client()
+    for module in [s3_store, packed_s3_store]:
+        monkeypatch.setattr(module, "create_s3_client", lambda **kwargs: client)
+    return client
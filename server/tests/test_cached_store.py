@@ -0,0 +1,145 @@
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Tuple
+
+import pytest
+from langchain.storage import InMemoryStore
+from langchain_core.documents import Document
+
+from server.rag.ingestion import cached_store
+from server.rag.ingestion.cached_store import CachedStore, DocstoreCacheConfig
+
+
+class CountingStore(InMemoryStore):
+    """mgetで要求されたキーを記録するInMemoryStore"""
+
+    def __init__(self):
+        super().__init__()
+        self.requested_keys: list[str] = []
+
+    def mget(self, keys):
+        self.requested_keys.extend(keys)
+        return super().mget(keys)
+
+
+def create_docs(count: int, length: int = 10) -> list[tuple[str, Document]]:
+    return [(f"key-{i}", Document(page_content=f"{i}" * length)) for i in range(count)]
+
+
+def contents(docs: list) -> list:
+    return [doc.page_content if doc is not None else None for doc in docs]
+
+
+def test_memory_hit_and_disk_hit_after_restart(tmp_path: Path):
+    store = CountingStore()
+    config = DocstoreCacheConfig(disk_dir=str(tmp_path))
+    docs = create_docs(3)
+    store.mset(docs)
+
+    cached = CachedStore(store, config)
+    assert contents(cached.mget(["key-0", "missing"])) == ["0" * 10, None]
+    assert contents(cached.mget(["key-0", "key-1"])) == ["0" * 10, "1" * 10]
+    assert cached.stats.memory_hits == 1
+    assert cached.stats.misses == 3
+
+    # ウォームスタートを想定し、別のインスタンスでもディスクキャッシュから取得する
+    store.requested_keys.clear()
+    restarted = CachedStore(store, config)
+    assert contents(restarted.mget(["key-0", "key-1"])) == ["0" * 10, "1" * 10]
+    assert store.requested_keys == []
+    assert restarted.stats.disk_hits == 2
+    assert contents(restarted.mget(["key-0"])) == ["0" * 10]
+    assert restarted.stats.memory_hits == 1
+
+
+def test_expired_entries_are_fetched_again(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    store = CountingStore()
+    store.mset(create_docs(1))
+    cached = CachedStore(
+        store, DocstoreCacheConfig(disk_dir=str(tmp_path), ttl_seconds=60)
+    )
+    cached.mget(["key-0"])
+
+    now = time.time() + 120
+    monkeypatch.setattr(cached_store.time, "time", lambda: now)
+    store.requested_keys.clear()
+    assert contents(cached.mget(["key-0"])) == ["0" * 10]
+    assert store.requested_keys == ["key-0"]
+    assert cached.stats.expirations == 1
+
+
+def test_disk_cache_evicts_oldest_files(tmp_path: Path):
+    store = InMemoryStore()
+    docs = create_docs(10, length=1000)
+    entry_bytes = len(CachedStore(store)._serialize(docs[0][1]))
+    cached = CachedStore(
+        store,
+        DocstoreCacheConfig(
+            memory_max_bytes=0,
+            disk_dir=str(tmp_path),
+            disk_max_bytes=entry_bytes * 3,
+            ttl_seconds=None,
+        ),
+    )
+
+    for i, pair in enumerate(docs):
+        cached.mset([pair])
+        # 更新日時で古い順に追い出すため、書き込みごとに日時をずらす
+        path = cached._disk_cache._path(pair[0])
+        os.utime(path, (1_000_000 + i, 1_000_000 + i))
+
+    assert len(os.listdir(tmp_path)) == 3
+    assert cached.stats.disk_evictions == 7
+    assert contents(cached.mget(["key-9", "key-0"])) == ["9" * 1000, "0" * 1000]
+    assert cached.stats.disk_hits == 1
+
+
+def test_mdelete_removes_cached_entries(tmp_path: Path):
+    store = InMemoryStore()
+    cached = CachedStore(store, DocstoreCacheConfig(disk_dir=str(tmp_path)))
+    cached.mset(create_docs(2))
+
+    cached.mdelete(["key-0"])
+
+    assert contents(cached.mget(["key-0", "key-1"])) == [None, "1" * 10]
+    assert len(os.listdir(tmp_path)) == 1
+
+
+def test_disk_reads_do_not_block_memory_hits(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    store = InMemoryStore()
+    store.mset(create_docs(2))
+    cached = CachedStore(store, DocstoreCacheConfig(disk_dir=str(tmp_path)))
+    cached.mget(["key-0", "key-1"])
+    # key-1のみディスクに残し、遅いディスクからの読み込みを再現する
+    cached._memory_cache.delete("key-1")
+
+    reading = threading.Event()
+    release = threading.Event()
+    original_get = cached_store._DiskCache.get
+
+    def slow_get(self, key: str) -> Optional[Tuple[bytes, float]]:
+        reading.set()
+        release.wait(timeout=5)
+        return original_get(self, key)
+
+    monkeypatch.setattr(cached_store._DiskCache, "get", slow_get)
+    results: list = []
+    reader = threading.Thread(target=lambda: results.extend(cached.mget(["key-1"])))
+    reader.start()
+    try:
+        assert reading.wait(timeout=5)
+        # ディスクから読み込んでいる間も、メモリ上のエントリはロックを待たずに取得できる
+        start = time.perf_counter()
+        assert contents(cached.mget(["key-0"])) == ["0" * 10]
+        assert time.perf_counter() - start < 1
+    finally:
+        release.set()
+        reader.join()
+    assert contents(results) == ["1" * 10]
+    assert cached.stats.disk_hits == 1
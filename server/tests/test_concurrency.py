@@ -0,0 +1,77 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from server.utils.concurrency import amap_concurrently, map_concurrently
+
+
+class InFlightCounter:
+    """同時に実行中の呼び出し数の最大値を記録する"""
+
+    def __init__(self, latency_seconds: float):
+        self.latency_seconds = latency_seconds
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, item: int) -> int:
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.latency_seconds)
+        with self._lock:
+            self.in_flight -= 1
+        return item * 2
+
+
+def test_map_concurrently_keeps_order_and_limits_concurrency():
+    fn = InFlightCounter(latency_seconds=0.01)
+
+    assert map_concurrently(fn, list(range(20)), 4) == [i * 2 for i in range(20)]
+    assert 1 < fn.max_in_flight <= 4
+    assert map_concurrently(fn, [], 4) == []
+
+
+def test_amap_concurrently_keeps_order_and_limits_concurrency():
+    fn = InFlightCounter(latency_seconds=0.01)
+
+    assert asyncio.run(amap_concurrently(fn, list(range(20)), 3)) == [
+        i * 2 for i in range(20)
+    ]
+    assert 1 < fn.max_in_flight <= 3
+    assert asyncio.run(amap_concurrently(fn, [], 3)) == []
+
+
+def test_amap_concurrently_does_not_block_event_loop():
+    async def run() -> tuple[list[int], int]:
+        ticks = 0
+
+        async def tick() -> None:
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.005)
+
+        ticker = asyncio.create_task(tick())
+        results = await amap_concurrently(
+            InFlightCounter(latency_seconds=0.05), list(range(8)), 8
+        )
+        ticker.cancel()
+        return results, ticks
+
+    # ブロッキングする処理の実行中も、イベントループは他のタスクを進められる
+    results, ticks = asyncio.run(run())
+    assert results == [i * 2 for i in range(8)]
+    assert ticks >= 3
+
+
+def test_amap_concurrently_propagates_errors():
+    def fail_on_odd(item: int) -> int:
+        if item % 2 == 1:
+            raise ValueError(item)
+        return item
+
+    with pytest.raises(ValueError, match="1"):
+        asyncio.run(amap_concurrently(fail_on_odd, [0, 1, 2], 2))
@@ -0,0 +1,70 @@
+import tempfile
+
+from langchain.storage import InMemoryStore
+from langchain_core.documents import Document
+
+from server.rag.context_packer import ContextBudget, ContextPacker, estimate_tokens
+from server.rag.ingestion.local_vectorstore import LocalVectorStore
+from server.rag.reranking_retriever import RerankingRetriever
+from server.testing.fakes import ClusteredFakeEmbeddings
+
+
+def create_doc(page: int, chunk: int, length: int, modality: str = "text") -> Document:
+    content = f"ページ{page}の{chunk}番目のチャンク。" + "設定手順" * length
+    return Document(
+        page_content=content,
+        metadata={
+            "doc_id": f"{page}-{chunk}",
+            "url": f"https://example.com/{page}",
+            "modality": modality,
+            "start_index": chunk * 100,
+            "token_count": estimate_tokens(content),
+        },
+    )
+
+
+def test_pack_keeps_rank_order_within_budget():
+    docs = [create_doc(page, 0, 100) for page in range(5)]
+    budget = ContextBudget(max_tokens=1000, min_truncated_tokens=100)
+
+    packed, stats = ContextPacker(budget).pack_with_stats(docs)
+
+    # 上位2件はそのまま含め、3件目は残りの予算に切り詰め、残りは除外する
+    assert [doc.metadata["doc_id"] for doc in packed] == ["0-0", "1-0", "2-0"]
+    assert packed[:2] == docs[:2]
+    assert docs[2].page_content.startswith(packed[2].page_content)
+    assert stats.truncated_docs == 1 and stats.dropped_docs == 2
+    assert stats.output_tokens <= budget.max_tokens
+    assert sum(estimate_tokens(doc.page_content) for doc in packed) <= 1000
+
+
+def test_images_are_dropped_instead_of_truncated():
+    image = create_doc(1, 0, 10, modality="image")
+    budget = ContextBudget(max_tokens=1000, image_tokens=1600)
+
+    packed, stats = ContextPacker(budget).pack_with_stats([image, create_doc(2, 0, 10)])
+
+    assert [doc.metadata["doc_id"] for doc in packed] == ["2-0"]
+    assert stats.dropped_docs == 1 and stats.truncated_docs == 0
+
+
+def test_pack_after_reranking_retriever():
+    # 同じページの隣接するチャンクを含むコーパスでも、RerankingRetrieverは出典ごとに1件のみ返す
+    chunks = [create_doc(page, chunk, 50) for page in range(10) for chunk in range(3)]
+    vectorstore = LocalVectorStore(ClusteredFakeEmbeddings(size=16), tempfile.mkdtemp())
+    vectorstore.add_documents(chunks, ids=[doc.metadata["doc_id"] for doc in chunks])
+    docstore = InMemoryStore()
+    docstore.mset([(doc.metadata["doc_id"], doc) for doc in chunks])
+    retriever = RerankingRetriever(
+        vectorstore=vectorstore, docstore=docstore, search_kwargs={"k": 6}
+    )
+    packer = ContextPacker(ContextBudget(max_tokens=300, min_truncated_tokens=50))
+
+    docs = retriever.invoke("ページ3の設定手順")
+    packed = (retriever | packer.pack).invoke("ページ3の設定手順")
+
+    assert len({doc.metadata["url"] for doc in docs}) == len(docs) == 6
+    assert [doc.metadata["doc_id"] for doc in packed] == [
+        doc.metadata["doc_id"] for doc in docs[: len(packed)]
+    ]
+    assert sum(estimate_tokens(doc.page_content) for doc in packed) <= 300
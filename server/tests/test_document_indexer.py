@@ -0,0 +1,157 @@
+from typing import Optional
+
+import pytest
+from langchain_core.documents import Document
+
+from server.rag.index_config import IndexConfig
+from server.rag.ingestion.document_indexer import DocumentIndexer, IndexWriteConfig
+from server.rag.ingestion.index_manifest import (
+    assign_doc_ids,
+    create_index_manifest_store,
+)
+from server.rag.ingestion.pinecone_index import PineconeIndexResolver
+from server.rag.retriever import NON_DOCUMENT_PREFIXES, create_docstore
+from server.testing.fakes import ClusteredFakeEmbeddings, FakePinecone, FakeS3Client
+
+BUCKET_NAME = "test-bucket"
+INDEX_CONFIG = IndexConfig(name="test-index", dimension=8)
+
+
+def create_page(page: int, chunks: int = 3, revision: int = 0) -> list[Document]:
+    return [
+        Document(
+            page_content=f"ページ{page}の{chunk}番目のチャンク(版{revision})",
+            metadata={
+                "url": f"https://example.com/{page}",
+                "title": f"ページ{page}",
+                "modality": "text",
+                "start_index": chunk * 100,
+            },
+        )
+        for chunk in range(chunks)
+    ]
+
+
+def doc_ids(docs: list[Document]) -> list[str]:
+    return [doc_id for doc_id, _ in assign_doc_ids(docs)]
+
+
+class IndexerFactory:
+    """同じS3とPineconeを使用するDocumentIndexerを、埋め込んだテキストを数えるEmbeddingsとともに作成する"""
+
+    def __init__(self, pinecone: FakePinecone):
+        self.pinecone = pinecone
+        self.embedding: Optional[ClusteredFakeEmbeddings] = None
+
+    def __call__(self, refresh: bool = False) -> DocumentIndexer:
+        self.embedding = ClusteredFakeEmbeddings(size=INDEX_CONFIG.dimension)
+        return DocumentIndexer(
+            index_config=INDEX_CONFIG,
+            bucket_name=BUCKET_NAME,
+            embedding=self.embedding,
+            refresh=refresh,
+            force_create_index=True,
+            index_resolver=PineconeIndexResolver(
+                lambda: self.pinecone, cache_path=None
+            ),
+            write_config=IndexWriteConfig(batch_size=2, docstore_batch_size=4),
+        )
+
+    @property
+    def embedded_texts(self) -> int:
+        assert self.embedding is not None
+        return self.embedding.embedded_texts
+
+    def stored_ids(self) -> set[str]:
+        """ベクトルストアに格納されているチャンクのID。ドキュメントストアにも同じチャンクがあることを確認する"""
+        vector_ids = self.pinecone.vector_ids(INDEX_CONFIG.name)
+        docstore_ids = {
+            key
+            for key in create_docstore(BUCKET_NAME).yield_keys()
+            if not key.startswith(NON_DOCUMENT_PREFIXES)
+        }
+        assert vector_ids == docstore_ids
+        return vector_ids
+
+
+@pytest.fixture
+def create_indexer(fake_s3: FakeS3Client) -> IndexerFactory:
+    return IndexerFactory(FakePinecone(control_plane_latency_seconds=0.0))
+
+
+def test_unchanged_rerun_makes_no_embedding_calls(create_indexer: IndexerFactory):
+    docs = create_page(0) + create_page(1)
+
+    diff = create_indexer().index(docs)
+    assert create_indexer.embedded_texts == len(docs)
+    assert sorted(diff.added) == sorted(doc_ids(docs))
+    assert create_indexer.stored_ids() == set(doc_ids(docs))
+
+    indexer = create_indexer()
+    with indexer.begin() as session:
+        assert session.add(docs) == 0
+        diff = session.commit()
+    assert create_indexer.embedded_texts == 0
+    assert session.stats.written == 0
+    assert not diff.has_changes and diff.unchanged == len(docs)
+    assert create_indexer.stored_ids() == set(doc_ids(docs))
+
+
+def test_changed_page_is_reembedded_and_old_chunks_are_deleted(
+    create_indexer: IndexerFactory,
+):
+    before = create_page(0) + create_page(1)
+    create_indexer().index(before)
+
+    after = create_page(0) + create_page(1, revision=1)
+    diff = create_indexer().index(after)
+
+    # 変更されたページのチャンクのみを埋め込み、変更前のチャンクを削除する
+    assert create_indexer.embedded_texts == 3
+    assert diff.changed_urls == ["https://example.com/1"]
+    assert sorted(diff.added) == sorted(doc_ids(create_page(1, revision=1)))
+    assert sorted(diff.removed) == sorted(doc_ids(create_page(1)))
+    assert create_indexer.stored_ids() == set(doc_ids(after))
+
+    stored = create_docstore(BUCKET_NAME).mget(doc_ids(after))
+    assert [doc.page_content for doc in stored if doc is not None] == [
+        doc.page_content for doc in after
+    ]
+
+
+def test_removed_page_is_deleted_unless_kept(create_indexer: IndexerFactory):
+    create_indexer().index(create_page(0) + create_page(1) + create_page(2))
+
+    # 一時的に取得できなかったページは、keep_urlsに指定すると削除しない
+    diff = create_indexer().index(create_page(0), keep_urls=["https://example.com/1"])
+    assert diff.removed_urls == ["https://example.com/2"]
+    assert create_indexer.stored_ids() == set(doc_ids(create_page(0) + create_page(1)))
+
+    diff = create_indexer().index(create_page(0))
+    assert diff.removed_urls == ["https://example.com/1"]
+    assert create_indexer.stored_ids() == set(doc_ids(create_page(0)))
+    assert create_indexer.embedded_texts == 0
+
+
+def test_stale_checkpoint_ids_are_deleted_on_resume(create_indexer: IndexerFactory):
+    docs = create_page(0) + create_page(1)
+
+    # commitせずに終了した索引作成は、格納済みのチャンクをチェックポイントに記録する
+    with create_indexer().begin() as session:
+        session.add(docs)
+        session.flush()
+    checkpoint = create_index_manifest_store(BUCKET_NAME).load_checkpoint()
+    assert checkpoint is not None
+    assert sorted(checkpoint.written) == sorted(doc_ids(docs))
+
+    # 再開した索引作成では格納済みのチャンクを埋め込み直さず、
+    # 今回の対象に含まれないチャンクはマニフェストになくても削除する
+    indexer = create_indexer()
+    with indexer.begin() as session:
+        session.add(create_page(0))
+        diff = session.commit()
+    assert create_indexer.embedded_texts == 0
+    assert session.stats.resumed == 3
+    assert sorted(diff.added) == sorted(doc_ids(create_page(0)))
+    assert create_indexer.stored_ids() == set(doc_ids(create_page(0)))
+    assert create_index_manifest_store(BUCKET_NAME).load_checkpoint() is None
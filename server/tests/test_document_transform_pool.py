@@ -0,0 +1,106 @@
+from contextlib import ExitStack
+
+import pytest
+from langchain_community.document_transformers import MarkdownifyTransformer
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from server.rag.context_packer import estimate_tokens
+from server.rag.ingestion.document_transform_pool import (
+    DocumentTransformConfig,
+    DocumentTransformPool,
+)
+from server.rag.ingestion.extract_image_converter import extract_image_urls
+
+
+def create_html_docs() -> list[Document]:
+    docs = []
+    for page in range(5):
+        sections = "".join(
+            f"<h2>ページ{page}の{section}番目の節</h2>"
+            + f"<p>{section}番目の節では<a href='https://example.com/{section}'>設定手順</a>"
+            + "を<strong>順に</strong>説明します。</p>" * (page + 3)
+            + f"<img src='https://example.com/images/{page}-{section}.png' alt='図'>"
+            for section in range(page + 2)
+        )
+        docs.append(
+            Document(
+                page_content=f"<html><body>{sections}</body></html>",
+                metadata={"source": f"https://example.com/pages/{page}", "page": page},
+            )
+        )
+    return docs
+
+
+def transform_serially(
+    transformer: MarkdownifyTransformer,
+    text_splitter: RecursiveCharacterTextSplitter,
+    html_docs: list[Document],
+) -> tuple[list[Document], list[list[str]], list[Document]]:
+    """DocumentTransformPoolを使用せずに、1プロセスで順に変換する"""
+    markdown_docs = list(transformer.transform_documents(html_docs))
+    image_urls = [extract_image_urls(doc.page_content) for doc in markdown_docs]
+    chunks = text_splitter.split_documents(markdown_docs)
+    for chunk in chunks:
+        chunk.metadata["token_count"] = estimate_tokens(chunk.page_content)
+    return markdown_docs, image_urls, chunks
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+@pytest.mark.parametrize("reuse_pool", [False, True])
+def test_pool_matches_serial_transform(max_workers: int, reuse_pool: bool):
+    transformer = MarkdownifyTransformer()
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=200, chunk_overlap=40, add_start_index=True
+    )
+    html_docs = create_html_docs()
+    expected_markdown, expected_image_urls, expected_chunks = transform_serially(
+        transformer, text_splitter, html_docs
+    )
+    # 比較が自明にならないよう、各ページが複数のチャンクに分かれていることを確認する
+    assert len(expected_chunks) > len(html_docs)
+
+    pool = DocumentTransformPool(
+        transformer,
+        text_splitter,
+        DocumentTransformConfig(max_workers=max_workers, chunk_size=2),
+    )
+    with ExitStack() as stack:
+        # withブロックでプロセスプールを使い回す場合も、呼び出しごとに作成する場合も同じ結果となる
+        if reuse_pool:
+            stack.enter_context(pool)
+        # クローラーと同じくジェネレーターで渡した場合も、入力の順序を保つ
+        markdown_docs = pool.to_markdown(doc for doc in html_docs)
+        image_urls = pool.extract_image_urls(markdown_docs)
+        chunks = pool.split(markdown_docs)
+
+    assert [doc.page_content for doc in markdown_docs] == [
+        doc.page_content for doc in expected_markdown
+    ]
+    assert [doc.metadata for doc in markdown_docs] == [
+        doc.metadata for doc in expected_markdown
+    ]
+    assert image_urls == expected_image_urls
+    assert [chunk.page_content for chunk in chunks] == [
+        chunk.page_content for chunk in expected_chunks
+    ]
+    assert [chunk.metadata for chunk in chunks] == [
+        chunk.metadata for chunk in expected_chunks
+    ]
+    assert all("start_index" in chunk.metadata for chunk in chunks)
+
+
+def test_split_does_not_share_metadata_between_chunks():
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=200, chunk_overlap=0, add_start_index=True
+    )
+    doc = Document(page_content="段落です。" * 100, metadata={"tags": ["a"]})
+
+    with DocumentTransformPool(
+        MarkdownifyTransformer(), text_splitter, DocumentTransformConfig(max_workers=2)
+    ) as pool:
+        chunks = pool.split([doc, doc])
+
+    chunks[0].metadata["tags"].append("b")
+    assert doc.metadata["tags"] == ["a"]
+    assert all(chunk.metadata["tags"] == ["a"] for chunk in chunks[1:])
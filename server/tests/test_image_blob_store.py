@@ -0,0 +1,111 @@
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Sequence
+
+import pytest
+from langchain_core.stores import InMemoryByteStore
+from PIL import Image
+
+from server.rag.ingestion.image_blob_store import ImageBlobStore, downscale_image
+
+
+class FlakyByteStore(InMemoryByteStore):
+    """書き込みに時間がかかり、最初のfailures回の書き込みに失敗するInMemoryByteStore"""
+
+    def __init__(self, failures: int = 0, latency_seconds: float = 0.0):
+        super().__init__()
+        self.failures = failures
+        self.latency_seconds = latency_seconds
+        self.mset_calls = 0
+        self._calls_lock = threading.Lock()
+
+    def mset(self, key_value_pairs: Sequence[tuple[str, bytes]]) -> None:
+        with self._calls_lock:
+            self.mset_calls += 1
+            fail = self.mset_calls <= self.failures
+        time.sleep(self.latency_seconds)
+        if fail:
+            raise ConnectionError("書き込みに失敗しました")
+        super().mset(key_value_pairs)
+
+
+def encode_image(size: tuple[int, int], image_format: str = "PNG") -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", size, "red").save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def image_size(data: bytes) -> tuple[int, int]:
+    with Image.open(io.BytesIO(data)) as image:
+        return image.size
+
+
+def test_downscale_image_keeps_format():
+    data = encode_image((2000, 1000), "JPEG")
+
+    downscaled = downscale_image(data, 500)
+
+    assert image_size(downscaled) == (500, 250)
+    with Image.open(io.BytesIO(downscaled)) as image:
+        assert image.format == "JPEG"
+
+
+def test_downscale_image_returns_small_or_broken_images_as_is():
+    small = encode_image((100, 50))
+    assert downscale_image(small, 500) is small
+    assert downscale_image(b"not an image", 500) == b"not an image"
+
+
+def test_put_stores_variants_and_mget_variants_creates_missing_ones():
+    store = InMemoryByteStore()
+    blob_store = ImageBlobStore(store, variant_long_edges=[500])
+    data = encode_image((2000, 1000))
+
+    key = blob_store.put(data)
+    assert blob_store.mget([key]) == [data]
+    assert image_size(store.mget([f"variants/500/{key}"])[0]) == (500, 250)
+
+    # 保存時に作成しなかった大きさの縮小版は、読み込み時に作成して保存する
+    [variant] = blob_store.mget_variants([key], 200)
+    assert image_size(variant) == (200, 100)
+    assert store.mget([f"variants/200/{key}"]) == [variant]
+    assert blob_store.mget_variants([key, "sha256/missing"], 200) == [variant, None]
+
+
+def test_failed_put_is_retried():
+    store = FlakyByteStore(failures=1)
+    blob_store = ImageBlobStore(store)
+    data = encode_image((100, 50))
+
+    with pytest.raises(ConnectionError):
+        blob_store.put(data)
+
+    # 保存に失敗した画像は保存済みとして扱わず、次の呼び出しで保存し直す
+    key = blob_store.put(data)
+    assert store.mget([key]) == [data]
+    assert blob_store.put(data) == key
+    assert store.mset_calls == 2
+
+
+@pytest.mark.parametrize("failures", [0, 1])
+def test_concurrent_puts_store_image_once(failures: int):
+    store = FlakyByteStore(failures=failures, latency_seconds=0.05)
+    blob_store = ImageBlobStore(store)
+    data = encode_image((100, 50))
+
+    def put() -> str | Exception:
+        try:
+            return blob_store.put(data)
+        except ConnectionError as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: put(), range(8)))
+
+    # 保存中の画像を他のスレッドが重ねて保存せず、失敗した場合は待っていたスレッドが保存し直す
+    key = ImageBlobStore.blob_key(data)
+    assert results.count(key) == 8 - failures
+    assert store.mget([key]) == [data]
+    assert store.mset_calls == 1 + failures
@@ -0,0 +1,111 @@
+import base64
+from pathlib import Path
+
+import pytest
+from langchain.storage import LocalFileStore
+from langchain_core.stores import InMemoryByteStore
+
+from server.rag.ingestion import image_describer
+from server.rag.ingestion.image_describer import ImageDescriber, ImageDescriptionCache
+from server.rag.ingestion.model import _ImageMetadata
+from server.testing.fakes import FakeVisionChatModel
+
+MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+
+
+def create_image(url: str, data: bytes) -> _ImageMetadata:
+    return _ImageMetadata(
+        url=url, mime_type="image/png", base64=base64.b64encode(data).decode("utf-8")
+    )
+
+
+IMAGES = [
+    create_image(f"https://example.com/{i}.png", bytes([i]) * 100) for i in range(3)
+]
+
+
+def describe(
+    cache: ImageDescriptionCache,
+    images: list[_ImageMetadata],
+    model_id: str = MODEL_ID,
+) -> tuple[dict[str, str], ImageDescriber, FakeVisionChatModel]:
+    """新しいモデルで画像の説明を生成し、URLごとの説明・ImageDescriber・モデルを返す"""
+    llm = FakeVisionChatModel(latency_seconds=0.0)
+    describer = ImageDescriber(cache=cache, llm=llm, model_id=model_id)
+    docs = describer.describe(images)
+    return {doc.metadata.url: doc.page_content for doc in docs}, describer, llm
+
+
+def test_cached_descriptions_are_reused():
+    cache = ImageDescriptionCache(InMemoryByteStore())
+
+    first, describer, llm = describe(cache, IMAGES)
+    assert len(first) == 3 and llm.calls == 3
+    assert describer.stats.described == 3 and describer.stats.hits == 0
+
+    # (モデルID, プロンプトの版, SHA-256)が同じ画像はモデルを呼び出さない
+    second, describer, llm = describe(cache, IMAGES)
+    assert second == first
+    assert llm.calls == 0
+    assert describer.stats.hits == 3 and describer.stats.saved_calls == 3
+
+    # 新しい画像のみ説明を生成する
+    new_image = create_image("https://example.com/new.png", b"new" * 100)
+    third, describer, llm = describe(cache, IMAGES + [new_image])
+    assert llm.calls == 1
+    assert describer.stats.hits == 3 and describer.stats.described == 1
+    assert {url: third[url] for url in first} == first
+
+
+def test_cache_is_keyed_by_image_content_not_url():
+    cache = ImageDescriptionCache(InMemoryByteStore())
+    first, _, _ = describe(cache, IMAGES)
+
+    moved = [image.model_copy(update={"url": image.url + "?v=2"}) for image in IMAGES]
+    second, _, llm = describe(cache, moved)
+    assert llm.calls == 0
+    assert [second[image.url] for image in moved] == list(first.values())
+
+
+def test_duplicate_images_are_described_once():
+    cache = ImageDescriptionCache(InMemoryByteStore())
+    duplicates = [
+        create_image(f"https://example.com/copy{i}.png", b"same" * 100)
+        for i in range(4)
+    ]
+
+    descriptions, describer, llm = describe(cache, duplicates + IMAGES)
+
+    assert llm.calls == 4
+    assert describer.stats.requested == 7
+    assert describer.stats.duplicates == 3
+    # 重複した画像にも、それぞれのURLで同じ説明のドキュメントを返す
+    assert len(descriptions) == 7
+    assert len({descriptions[image.url] for image in duplicates}) == 1
+
+
+def test_prompt_version_change_invalidates_cache(monkeypatch: pytest.MonkeyPatch):
+    cache = ImageDescriptionCache(InMemoryByteStore())
+    describe(cache, IMAGES)
+
+    monkeypatch.setattr(image_describer, "PROMPT_VERSION", "test-next")
+    _, describer, llm = describe(cache, IMAGES)
+    assert llm.calls == 3
+    assert describer.stats.hits == 0
+
+
+def test_model_change_invalidates_cache():
+    cache = ImageDescriptionCache(InMemoryByteStore())
+    describe(cache, IMAGES)
+
+    _, _, llm = describe(cache, IMAGES, model_id="anthropic.claude-3-5-sonnet")
+    assert llm.calls == 3
+
+
+def test_cache_can_be_stored_on_local_disk(tmp_path: Path):
+    # モデルIDの":"はLocalFileStoreのキーに使用できないため、置き換えて保存する
+    first, _, _ = describe(ImageDescriptionCache(LocalFileStore(tmp_path)), IMAGES)
+
+    second, _, llm = describe(ImageDescriptionCache(LocalFileStore(tmp_path)), IMAGES)
+    assert second == first
+    assert llm.calls == 0
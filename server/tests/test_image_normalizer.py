@@ -0,0 +1,76 @@
+import base64
+import io
+import os
+
+import pytest
+from PIL import Image
+
+from server.rag.ingestion.image_normalizer import (
+    MAX_MODEL_IMAGE_BASE64_SIZE,
+    ImageNormalizationConfig,
+    ImageNormalizer,
+)
+from server.rag.ingestion.model import _ImageMetadata
+
+
+def encode_image(image: Image.Image, image_format: str) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def create_image(url: str, data: bytes, mime_type: str) -> _ImageMetadata:
+    return _ImageMetadata(
+        url=url, mime_type=mime_type, base64=base64.b64encode(data).decode("utf-8")
+    )
+
+
+def open_image(image: _ImageMetadata) -> Image.Image:
+    return Image.open(io.BytesIO(base64.b64decode(image.base64)))
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_normalize_all_downscales_large_images(max_workers: int):
+    large = create_image(
+        "https://example.com/large.png",
+        encode_image(Image.new("RGB", (3000, 1500), "red"), "PNG"),
+        "image/png",
+    )
+    small_data = encode_image(Image.new("RGB", (200, 100), "blue"), "JPEG")
+    small = create_image("https://example.com/small.jpg", small_data, "image/jpeg")
+    broken = create_image(
+        "https://example.com/broken.png", b"not an image", "image/png"
+    )
+
+    normalizer = ImageNormalizer(ImageNormalizationConfig(max_workers=max_workers))
+    images = normalizer.normalize_all([large, small, broken])
+
+    # 入力と同じ順序で返し、上限を超える画像のみ縮小・再エンコードする
+    assert [image.url for image in images] == [large.url, small.url, broken.url]
+    assert images[0].mime_type == "image/webp"
+    with open_image(images[0]) as image:
+        assert image.format == "WEBP"
+        assert max(image.size) == 1568
+    # 上限に収まる画像と読み込めない画像はそのまま返す
+    assert images[1:] == [small, broken]
+    assert normalizer.stats.images == 3
+    assert normalizer.stats.normalized == 1
+    assert normalizer.stats.failed == 1
+    assert normalizer.stats.bytes_saved > 0
+
+
+def test_normalize_all_rescues_images_too_large_to_send():
+    # 圧縮できないノイズ画像は、Base64エンコード後にClaudeに送信できる上限を超える
+    noise = Image.frombytes("RGB", (1500, 1200), os.urandom(1500 * 1200 * 3))
+    too_large = create_image(
+        "https://example.com/noise.png", encode_image(noise, "PNG"), "image/png"
+    )
+    assert len(too_large.base64) >= MAX_MODEL_IMAGE_BASE64_SIZE
+
+    normalizer = ImageNormalizer(ImageNormalizationConfig(max_workers=1))
+    [image] = normalizer.normalize_all([too_large])
+
+    assert len(image.base64) < MAX_MODEL_IMAGE_BASE64_SIZE
+    assert len(base64.b64decode(image.base64)) <= ImageNormalizationConfig().max_bytes
+    assert normalizer.stats.rescued == 1
+    assert normalizer.stats.failed == 0
@@ -0,0 +1,199 @@
+import threading
+from typing import Callable
+
+import pytest
+from langchain_core.documents import Document
+
+from server.rag.index_config import IndexConfig
+from server.rag.ingestion.document_indexer import DocumentIndexer, IndexWriteConfig
+from server.rag.ingestion.document_preprocessor import DocumentPreprocessor
+from server.rag.ingestion.index_manifest import create_index_manifest_store
+from server.rag.ingestion.ingestion_pipeline import IngestionPipeline, PipelineConfig
+from server.rag.ingestion.pinecone_index import PineconeIndexResolver
+from server.rag.ingestion.web_crawler import CrawlerConfig
+from server.testing.fakes import (
+    ClusteredFakeEmbeddings,
+    FakePinecone,
+    FakeS3Client,
+    LocalSiteServer,
+)
+
+BUCKET_NAME = "test-bucket"
+INDEX_CONFIG = IndexConfig(name="test-index", dimension=8)
+PAGES = 7
+PIPELINE_CONFIG = PipelineConfig(queue_size=1, page_batch_size=2, chunk_batch_size=4)
+
+
+class FailingEmbeddings(ClusteredFakeEmbeddings):
+    """fail_after件のテキストを埋め込んだ後の呼び出しに失敗するClusteredFakeEmbeddings"""
+
+    def __init__(self, fail_after: int):
+        super().__init__(size=INDEX_CONFIG.dimension)
+        self.fail_after = fail_after
+        self._accepted = 0
+        self._accept_lock = threading.Lock()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        # 並行して呼び出された場合も、fail_after件を超えて埋め込まない
+        with self._accept_lock:
+            if self._accepted + len(texts) > self.fail_after:
+                raise ConnectionError("埋め込みに失敗しました")
+            self._accepted += len(texts)
+        return super().embed_documents(texts)
+
+
+@pytest.fixture
+def site(local_site: Callable[..., LocalSiteServer]) -> LocalSiteServer:
+    return local_site(pages=PAGES)
+
+
+@pytest.fixture
+def pinecone(fake_s3: FakeS3Client) -> FakePinecone:
+    return FakePinecone(control_plane_latency_seconds=0.0)
+
+
+def create_indexer(
+    pinecone: FakePinecone, embedding: ClusteredFakeEmbeddings
+) -> DocumentIndexer:
+    return DocumentIndexer(
+        index_config=INDEX_CONFIG,
+        bucket_name=BUCKET_NAME,
+        embedding=embedding,
+        force_create_index=True,
+        index_resolver=PineconeIndexResolver(lambda: pinecone, cache_path=None),
+        write_config=IndexWriteConfig(batch_size=2, docstore_batch_size=4),
+    )
+
+
+def create_preprocessor(site: LocalSiteServer) -> DocumentPreprocessor:
+    return DocumentPreprocessor(
+        [site.root_url],
+        CrawlerConfig(max_depth=PAGES, politeness_delay_seconds=0.0),
+    )
+
+
+def legacy_chunks(site: LocalSiteServer) -> list[Document]:
+    """パイプラインを使わずに前処理したチャンク"""
+    with create_preprocessor(site) as preprocessor:
+        return preprocessor.preprocess()
+
+
+def manifest_ids() -> set[str]:
+    manifest = create_index_manifest_store(BUCKET_NAME).load()
+    assert manifest is not None
+    return set(manifest.entries)
+
+
+def test_pipeline_matches_preprocess_and_index(
+    site: LocalSiteServer, pinecone: FakePinecone
+):
+    chunks = legacy_chunks(site)
+    embedding = ClusteredFakeEmbeddings(size=INDEX_CONFIG.dimension)
+    pipeline = IngestionPipeline(
+        create_preprocessor(site), create_indexer(pinecone, embedding), PIPELINE_CONFIG
+    )
+
+    diff = pipeline.run()
+
+    # 従来の方法と同じチャンクを、1回ずつ埋め込んで格納する
+    assert len(diff.added) == len(chunks) == embedding.embedded_texts
+    assert manifest_ids() == set(diff.added)
+    assert pinecone.vector_ids(INDEX_CONFIG.name) == set(diff.added)
+    stages = {stats.name: stats for stats in pipeline.stats.stages}
+    assert list(stages) == ["crawl", "markdown", "images", "describe", "split", "index"]
+    assert stages["crawl"].items_out == stages["markdown"].items_in == PAGES
+    assert stages["split"].items_out == stages["index"].items_in == len(chunks)
+    assert stages["index"].items_out == pipeline.stats.write.written == len(chunks)
+
+    # 変更のないサイトを再び処理しても、埋め込みと書き込みを行わない
+    embedding = ClusteredFakeEmbeddings(size=INDEX_CONFIG.dimension)
+    pipeline = IngestionPipeline(
+        create_preprocessor(site), create_indexer(pinecone, embedding), PIPELINE_CONFIG
+    )
+    diff = pipeline.run()
+    assert not diff.has_changes and diff.unchanged == len(chunks)
+    assert embedding.embedded_texts == 0
+
+
+def test_failed_index_stage_stops_pipeline_and_resumes_from_checkpoint(
+    site: LocalSiteServer, pinecone: FakePinecone
+):
+    chunks = legacy_chunks(site)
+    embedding = FailingEmbeddings(fail_after=4)
+    pipeline = IngestionPipeline(
+        create_preprocessor(site), create_indexer(pinecone, embedding), PIPELINE_CONFIG
+    )
+
+    # 前段がキューで待っていても、すべての段階を中断して例外を送出する
+    with pytest.raises(ConnectionError, match="埋め込みに失敗しました"):
+        pipeline.run()
+
+    # マニフェストは更新せず、格納済みのチャンクはチェックポイントに記録する
+    manifest_store = create_index_manifest_store(BUCKET_NAME)
+    assert manifest_store.load() is None
+    checkpoint = manifest_store.load_checkpoint()
+    assert checkpoint is not None
+    assert len(checkpoint.written) == embedding.embedded_texts == 4
+
+    # 再開した実行では、格納済みのチャンクを埋め込み直さない
+    embedding = ClusteredFakeEmbeddings(size=INDEX_CONFIG.dimension)
+    pipeline = IngestionPipeline(
+        create_preprocessor(site), create_indexer(pinecone, embedding), PIPELINE_CONFIG
+    )
+    diff = pipeline.run()
+    assert len(diff.added) == len(chunks)
+    assert embedding.embedded_texts == len(chunks) - 4
+    assert pipeline.stats.write.resumed == 4
+    assert manifest_ids() == pinecone.vector_ids(INDEX_CONFIG.name) == set(diff.added)
+    assert manifest_store.load_checkpoint() is None
+
+
+def test_failed_middle_stage_stops_crawling(
+    site: LocalSiteServer, pinecone: FakePinecone, monkeypatch: pytest.MonkeyPatch
+):
+    preprocessor = create_preprocessor(site)
+
+    def fail(docs: list[Document]) -> list[Document]:
+        raise ValueError("分割に失敗しました")
+
+    monkeypatch.setattr(preprocessor, "split", fail)
+    embedding = ClusteredFakeEmbeddings(size=INDEX_CONFIG.dimension)
+    pipeline = IngestionPipeline(
+        preprocessor, create_indexer(pinecone, embedding), PIPELINE_CONFIG
+    )
+
+    with pytest.raises(ValueError, match="分割に失敗しました"):
+        pipeline.run()
+
+    assert embedding.embedded_texts == 0
+    assert create_index_manifest_store(BUCKET_NAME).load() is None
+    assert pinecone.vector_ids(INDEX_CONFIG.name) == set()
+
+
+def test_pages_that_failed_to_load_keep_their_chunks(
+    site: LocalSiteServer, pinecone: FakePinecone, monkeypatch: pytest.MonkeyPatch
+):
+    embedding = ClusteredFakeEmbeddings(size=INDEX_CONFIG.dimension)
+    IngestionPipeline(
+        create_preprocessor(site), create_indexer(pinecone, embedding), PIPELINE_CONFIG
+    ).run()
+    before = manifest_ids()
+
+    # 取得に失敗したページは一時的なエラーとみなし、前回のチャンクを削除しない
+    failed_url = f"{site.base_url}/pages/{PAGES - 1}.html"
+    preprocessor = create_preprocessor(site)
+    crawl = preprocessor.crawl
+
+    def crawl_without_last_page():
+        for doc in crawl():
+            if doc.metadata["source"] != failed_url:
+                yield doc
+        preprocessor.crawl_stats.failed_urls.append(failed_url)
+
+    monkeypatch.setattr(preprocessor, "crawl", crawl_without_last_page)
+    diff = IngestionPipeline(
+        preprocessor, create_indexer(pinecone, embedding), PIPELINE_CONFIG
+    ).run()
+
+    assert diff.removed_urls == []
+    assert manifest_ids() == before
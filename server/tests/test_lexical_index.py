@@ -0,0 +1,128 @@
+import time
+
+import numpy as np
+import pytest
+from langchain_core.stores import InMemoryByteStore
+
+from server.rag.ingestion.lexical_index import LexicalIndex, LexicalIndexStore
+
+QUERIES = ["料金プラン", "ストレージの容量", "ネットワーク", "バックアップ"]
+
+
+def create_texts(count: int, offset: int = 0) -> dict[str, str]:
+    topics = ["料金プラン", "ストレージ容量", "ネットワーク設定", "バックアップ"]
+    return {
+        f"doc-{i}": f"製品{i}の{topics[i % len(topics)]}について説明します。"
+        f"{topics[(i + 1) % len(topics)]}も参照してください。"
+        for i in range(offset, offset + count)
+    }
+
+
+def build(texts: dict[str, str]) -> LexicalIndex:
+    index = LexicalIndex()
+    index.add(
+        list(texts),
+        list(texts.values()),
+        [f"https://example.com/{id_}" for id_ in texts],
+    )
+    return index
+
+
+def assert_same_index(actual: LexicalIndex, expected: LexicalIndex) -> None:
+    assert len(actual) == len(expected)
+    for query in QUERIES:
+        assert actual.search(query, k=100) == pytest.approx(
+            expected.search(query, k=100)
+        )
+    # 転置インデックスの配列も、まとめて作成した場合と一致する
+    assert actual._terms == expected._terms
+    np.testing.assert_array_equal(actual._indptr, expected._indptr)
+    np.testing.assert_array_equal(actual._postings, expected._postings)
+    np.testing.assert_array_equal(actual._frequencies, expected._frequencies)
+
+
+def test_incremental_changes_match_single_build():
+    texts = create_texts(30)
+    index = LexicalIndex()
+    for start in range(0, 30, 7):
+        batch = dict(list(texts.items())[start : start + 7])
+        index.add(
+            list(batch),
+            list(batch.values()),
+            [f"https://example.com/{id_}" for id_ in batch],
+        )
+    index.commit()
+
+    # commit済みのドキュメントと保留中のドキュメントの両方を削除・置き換える
+    index.delete(["doc-3", "doc-4", "missing"])
+    replaced = {"doc-5": "製品5のネットワーク設定を変更しました。"}
+    index.add(list(replaced), list(replaced.values()), ["https://example.com/doc-5"])
+    added = create_texts(5, offset=30)
+    index.add(
+        list(added),
+        list(added.values()),
+        [f"https://example.com/{id_}" for id_ in added],
+    )
+    index.delete(["doc-31"])
+
+    expected = {
+        id_: text
+        for id_, text in texts.items()
+        if id_ not in ("doc-3", "doc-4", "doc-5")
+    }
+    expected.update(replaced)
+    expected.update({id_: text for id_, text in added.items() if id_ != "doc-31"})
+    assert_same_index(index, build(expected))
+    assert index.source("doc-5") == "https://example.com/doc-5"
+    assert index.source("doc-3") is None
+
+
+def test_pending_changes_are_committed_before_serialization():
+    index = build(create_texts(10))
+
+    loaded = LexicalIndex.from_bytes(index.to_bytes())
+    loaded.delete(["doc-0"])
+    restored = LexicalIndex.from_bytes(loaded.to_bytes())
+
+    assert len(restored) == 9
+    assert "doc-0" not in dict(restored.search("料金プラン", k=100))
+    assert_same_index(restored, build(create_texts(9, offset=1)))
+
+
+def test_add_cost_does_not_grow_with_index_size():
+    def add_seconds(index: LexicalIndex, offset: int) -> float:
+        batch = create_texts(10, offset=offset)
+        start = time.perf_counter()
+        index.add(list(batch), list(batch.values()))
+        return time.perf_counter() - start
+
+    small = LexicalIndex()
+    small_seconds = min(add_seconds(small, 10 * i) for i in range(5))
+
+    # 大きなインデックスに追加しても、転置インデックスを作り直さないため1回あたりの時間は変わらない
+    large = build(create_texts(20000))
+    large.commit()
+    large_seconds = min(add_seconds(large, 20000 + 10 * i) for i in range(5))
+
+    assert large_seconds < small_seconds * 5
+    assert len(large) == 20050
+
+
+def test_store_reloads_index_only_when_version_changes():
+    byte_store = InMemoryByteStore()
+    writer = LexicalIndexStore(byte_store)
+    reader = LexicalIndexStore(byte_store, refresh_seconds=0)
+    cached_reader = LexicalIndexStore(byte_store)
+    assert reader.current() is None
+
+    writer.save(build(create_texts(3)))
+    first = reader.current()
+    assert first is not None and len(first) == 3
+    assert len(cached_reader.current() or []) == 3
+    # バージョンが変わっていなければ、読み込み済みのインデックスを使い続ける
+    assert reader.current() is first
+
+    writer.save(build(create_texts(5)))
+    assert len(reader.current() or []) == 5
+    # 更新を確認する間隔が経過するまでは読み込み直さない
+    assert len(cached_reader.current() or []) == 3
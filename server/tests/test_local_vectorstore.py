@@ -0,0 +1,111 @@
+from pathlib import Path
+from typing import Callable, Optional, Sequence
+
+from langchain_core.stores import InMemoryByteStore
+
+from server.rag.ingestion.local_vectorstore import LocalVectorStore
+from server.testing.fakes import ClusteredFakeEmbeddings
+
+
+class HookedByteStore(InMemoryByteStore):
+    """mgetの後にon_mgetを呼び出し、読み込みの途中で行われた書き込みを再現するInMemoryByteStore"""
+
+    on_mget: Optional[Callable[[Sequence[str]], None]] = None
+
+    def mget(self, keys: Sequence[str]) -> list[Optional[bytes]]:
+        values = super().mget(keys)
+        if self.on_mget is not None:
+            self.on_mget(keys)
+        return values
+
+
+def create_store(directory: Path, remote_store=None, **kwargs) -> LocalVectorStore:
+    return LocalVectorStore(
+        ClusteredFakeEmbeddings(size=16),
+        str(directory),
+        remote_store=remote_store,
+        **kwargs,
+    )
+
+
+def stored_texts(store: LocalVectorStore) -> dict[str, str]:
+    return {
+        doc.id: doc.page_content
+        for doc in store.similarity_search("質問", k=100)
+        if doc.id is not None
+    }
+
+
+def test_add_texts_replaces_existing_ids(tmp_path: Path):
+    store = create_store(tmp_path)
+    store.add_texts(["a1", "b1"], ids=["a", "b"])
+    store.add_texts(["a2"], ids=["a"])
+
+    assert len(store) == 2
+    assert stored_texts(store) == {"a": "a2", "b": "b1"}
+
+    # deferred_writesでまとめて書き出す場合も、最後に追加したものを残す
+    with store.deferred_writes():
+        store.add_texts(["b2"], ids=["b"])
+        store.add_texts(["b3", "c1"], ids=["b", "c"])
+    assert len(store) == 3
+    assert stored_texts(store) == {"a": "a2", "b": "b3", "c": "c1"}
+
+    # 置き換えたベクトルも、読み込み直した後に同じ結果となる
+    assert stored_texts(create_store(tmp_path)) == {"a": "a2", "b": "b3", "c": "c1"}
+
+
+def test_reader_picks_up_writes_after_refresh_interval(tmp_path: Path):
+    remote_store = InMemoryByteStore()
+    writer = create_store(tmp_path / "writer", remote_store)
+    writer.add_texts(["a1"], ids=["a"])
+
+    reader = create_store(tmp_path / "reader", remote_store, refresh_seconds=0)
+    cached_reader = create_store(tmp_path / "cached", remote_store)
+    assert stored_texts(reader) == stored_texts(cached_reader) == {"a": "a1"}
+
+    writer.add_texts(["b1"], ids=["b"])
+    assert stored_texts(reader) == {"a": "a1", "b": "b1"}
+    # 更新を確認する間隔が経過するまでは、手元のファイルを使い続ける
+    assert stored_texts(cached_reader) == {"a": "a1"}
+
+
+def test_download_skips_partially_uploaded_files(tmp_path: Path):
+    remote_store = HookedByteStore()
+    writer = create_store(tmp_path / "writer", remote_store)
+    writer.add_texts(["a1"], ids=["a"])
+    old_files = dict(remote_store.store)
+    writer.add_texts(["b1"], ids=["b"])
+    new_files = dict(remote_store.store)
+
+    # 新しいベクトルのみアップロードされ、レコードとマニフェストは古いままの状態を再現する
+    remote_store.mset(
+        [
+            ("records.json", old_files["records.json"]),
+            ("manifest.json", old_files["manifest.json"]),
+        ]
+    )
+
+    def finish_upload(keys: Sequence[str]) -> None:
+        if "records.json" in keys:
+            remote_store.on_mget = None
+            remote_store.mset(list(new_files.items()))
+
+    # ファイルを読み込んだ直後にアップロードが完了しても、マニフェストと照合して読み込み直す
+    remote_store.on_mget = finish_upload
+    reader = create_store(tmp_path / "reader", remote_store)
+    assert stored_texts(reader) == {"a": "a1", "b": "b1"}
+
+
+def test_download_keeps_local_files_when_upload_never_completes(tmp_path: Path):
+    remote_store = InMemoryByteStore()
+    writer = create_store(tmp_path / "writer", remote_store)
+    writer.add_texts(["a1"], ids=["a"])
+    reader = create_store(tmp_path / "reader", remote_store, refresh_seconds=0)
+    old_records = remote_store.mget(["records.json"])[0]
+    assert old_records is not None
+
+    writer.add_texts(["b1"], ids=["b"])
+    remote_store.mset([("records.json", old_records)])
+
+    assert stored_texts(reader) == {"a": "a1"}
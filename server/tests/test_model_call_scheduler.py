@@ -0,0 +1,157 @@
+import threading
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+
+from server.rag.ingestion.model_call_scheduler import (
+    ModelCallScheduler,
+    ModelCallSchedulerConfig,
+    ScheduledEmbeddings,
+)
+from server.testing.fakes import ClusteredFakeEmbeddings, FakeBedrockQuota
+
+# テストが長くならないよう、リトライの待機時間を短くする
+FAST_RETRY = {
+    "retry_wait_initial_seconds": 0.001,
+    "retry_wait_max_seconds": 0.01,
+    "retry_wait_jitter_seconds": 0.001,
+}
+
+
+def throttling_error() -> ClientError:
+    return ClientError(
+        {"Error": {"Code": "ThrottlingException", "Message": "Too many requests"}},
+        "InvokeModel",
+    )
+
+
+class ThrottleFirstCalls:
+    """最初のthrottled_calls回の呼び出しでThrottlingExceptionを送出し、以降は入力をそのまま返す"""
+
+    def __init__(self, throttled_calls: int):
+        self._remaining = throttled_calls
+        self._lock = threading.Lock()
+
+    def __call__(self, item: int) -> int:
+        with self._lock:
+            throttled = self._remaining > 0
+            self._remaining -= 1
+        if throttled:
+            raise throttling_error()
+        return item
+
+
+def test_throttling_halves_concurrency_and_successes_recover_it():
+    scheduler = ModelCallScheduler(
+        ModelCallSchedulerConfig(initial_concurrency=8, max_concurrency=8, **FAST_RETRY)
+    )
+
+    assert scheduler.map(ThrottleFirstCalls(1), [0]) == [0]
+    stats = scheduler.stats
+    assert stats.throttled == 1 and stats.retries == 1
+    # 8から半分の4に減り、成功した1回で1/4だけ増える
+    assert stats.concurrency_limit == pytest.approx(4.25)
+
+    # 同時呼び出し数の分だけ成功するごとに1ずつ増え、max_concurrencyで頭打ちになる
+    assert scheduler.map(lambda item: item, list(range(40))) == list(range(40))
+    assert scheduler.stats.concurrency_limit == 8.0
+
+
+def test_simultaneous_throttles_decrease_concurrency_once():
+    scheduler = ModelCallScheduler(
+        ModelCallSchedulerConfig(initial_concurrency=4, max_concurrency=4, **FAST_RETRY)
+    )
+    barrier = threading.Barrier(4)
+    attempts: set[int] = set()
+    lock = threading.Lock()
+
+    def call(item: int) -> int:
+        with lock:
+            first_attempt = item not in attempts
+            attempts.add(item)
+        if first_attempt:
+            # 4件すべてが呼び出しを始めてから、まとめてスロットリングされる
+            barrier.wait(timeout=5)
+            raise throttling_error()
+        return item
+
+    assert scheduler.map(call, [0, 1, 2, 3]) == [0, 1, 2, 3]
+    stats = scheduler.stats
+    assert stats.throttled == 4
+
+    # 同じ時点で始まった呼び出しのスロットリングでは、1回だけ半分に減る
+    expected = 2.0
+    for _ in range(4):
+        expected += 1 / expected
+    assert stats.concurrency_limit == pytest.approx(expected)
+
+
+def test_concurrency_adapts_to_quota():
+    quota = FakeBedrockQuota(max_concurrency=2, latency_seconds=0.01)
+    embedding = ClusteredFakeEmbeddings(size=8, latency_seconds=0.01, quota=quota)
+    scheduler = ModelCallScheduler(
+        ModelCallSchedulerConfig(
+            initial_concurrency=8, max_concurrency=8, max_attempts=20, **FAST_RETRY
+        )
+    )
+    texts = [f"チャンク{i}" for i in range(40)]
+
+    vectors = ScheduledEmbeddings(embedding, scheduler).embed_documents(texts)
+
+    assert vectors == embedding.embed_documents(texts)
+    stats = scheduler.stats
+    assert stats.failed == 0
+    assert stats.throttled == quota.throttled > 0
+    assert stats.concurrency_limit < 8
+
+
+def test_token_bucket_paces_calls():
+    scheduler = ModelCallScheduler(
+        ModelCallSchedulerConfig(initial_concurrency=4, requests_per_second=20, burst=1)
+    )
+    called_at: list[float] = []
+    lock = threading.Lock()
+
+    def call(item: int) -> int:
+        with lock:
+            called_at.append(time.monotonic())
+        return item
+
+    start = time.monotonic()
+    assert scheduler.map(call, list(range(11))) == list(range(11))
+
+    # 最初の1回を除き、1/20秒に1回ずつ通過する
+    assert time.monotonic() - start >= 10 / 20 * 0.9
+    called_at.sort()
+    assert called_at[-1] - called_at[0] >= 10 / 20 * 0.9
+
+
+def test_failed_item_does_not_fail_others():
+    scheduler = ModelCallScheduler(ModelCallSchedulerConfig(**FAST_RETRY))
+
+    def call(item: int) -> int:
+        if item == 2:
+            raise ValueError("ValidationException: Could not process image")
+        return item * 10
+
+    assert scheduler.map(call, list(range(5))) == [0, 10, None, 30, 40]
+    stats = scheduler.stats
+    assert stats.completed == 5 and stats.failed == 1
+    # リトライできないエラーのため、失敗した要素も1回しか呼び出さない
+    assert stats.calls == 5 and stats.retries == 0
+
+
+def test_raise_on_error_raises_after_processing_all_items():
+    scheduler = ModelCallScheduler(ModelCallSchedulerConfig(**FAST_RETRY))
+    processed: list[int] = []
+
+    def call(item: int) -> int:
+        if item == 0:
+            raise ValueError("失敗")
+        processed.append(item)
+        return item
+
+    with pytest.raises(ValueError, match="失敗"):
+        scheduler.map(call, list(range(5)), raise_on_error=True)
+    assert sorted(processed) == [1, 2, 3, 4]
@@ -0,0 +1,130 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from langchain_core.documents import Document
+
+from server.rag.ingestion import packed_s3_store
+from server.rag.ingestion.packed_s3_store import PackedS3Store
+from server.testing.fakes import FakeS3Client
+
+BUCKET_NAME = "test-bucket"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(packed_s3_store, "time", SimpleNamespace(time=clock.time))
+    return clock
+
+
+def create_docs(keys: range, revision: int = 0) -> list[tuple[str, Document]]:
+    return [
+        (f"key-{i}", Document(page_content=f"ドキュメント{i}(版{revision})"))
+        for i in keys
+    ]
+
+
+def shard_ids(client: FakeS3Client) -> set[str]:
+    prefix = "packed/shards/"
+    return {
+        key.removeprefix(prefix) for _, key in client.objects if key.startswith(prefix)
+    }
+
+
+def contents(docs: list) -> list:
+    return [doc.page_content if doc is not None else None for doc in docs]
+
+
+def test_mget_coalesces_nearby_documents():
+    client = FakeS3Client()
+    store = PackedS3Store(BUCKET_NAME, client=client)
+    store.mset(create_docs(range(10)))
+    client.calls.clear()
+
+    keys = ["key-7", "missing", "key-2", "key-5"]
+    assert contents(store.mget(keys)) == [
+        "ドキュメント7(版0)",
+        None,
+        "ドキュメント2(版0)",
+        "ドキュメント5(版0)",
+    ]
+    # 同じシャード内の近接するドキュメントは1回のRange GETで取得する
+    assert client.calls["get_object"] == 1
+    assert sorted(store.yield_keys(prefix="key-")) == sorted(
+        key for key, _ in create_docs(range(10))
+    )
+
+
+def test_unreferenced_shards_are_kept_for_grace_period(clock: FakeClock):
+    client = FakeS3Client()
+    writer = PackedS3Store(BUCKET_NAME, client=client, index_refresh_seconds=300)
+    reader = PackedS3Store(BUCKET_NAME, client=client, index_refresh_seconds=300)
+    writer.mset(create_docs(range(3)))
+    assert contents(reader.mget(["key-0"])) == ["ドキュメント0(版0)"]
+    [old_shard] = shard_ids(client)
+
+    # 書き込み側が上書きしても、読み込み側が古いインデックスで参照するシャードはすぐには削除しない
+    clock.now += 10
+    writer.mset(create_docs(range(3), revision=1))
+    assert old_shard in shard_ids(client)
+    assert contents(reader.mget(["key-0", "key-2"])) == [
+        "ドキュメント0(版0)",
+        "ドキュメント2(版0)",
+    ]
+
+    # 猶予(デフォルトはindex_refresh_secondsの2倍)が経過した後の書き込みで削除する
+    clock.now += 600
+    writer.mdelete(["key-2"])
+    assert old_shard not in shard_ids(client)
+    assert len(shard_ids(client)) == 1
+    assert contents(reader.mget(["key-0", "key-2"])) == ["ドキュメント0(版1)", None]
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_reader_reloads_index_when_shard_was_deleted(use_async: bool):
+    client = FakeS3Client()
+    # 猶予なしでシャードを削除する書き込み側を使い、古いインデックスで削除済みのシャードを読ませる
+    writer = PackedS3Store(
+        BUCKET_NAME, client=client, index_refresh_seconds=0, shard_grace_seconds=0
+    )
+    reader = PackedS3Store(BUCKET_NAME, client=client, index_refresh_seconds=300)
+    writer.mset(create_docs(range(3)))
+    reader.mget(["key-0"])
+
+    writer.mset(create_docs(range(2), revision=1))
+    writer.mdelete(["key-2"])
+    assert len(shard_ids(client)) == 1
+
+    keys = ["key-1", "key-2", "key-0"]
+    docs = asyncio.run(reader.amget(keys)) if use_async else reader.mget(keys)
+    assert contents(docs) == ["ドキュメント1(版1)", None, "ドキュメント0(版1)"]
+
+
+def test_reader_raises_when_shard_is_still_missing_after_reload():
+    client = FakeS3Client()
+    store = PackedS3Store(BUCKET_NAME, client=client)
+    store.mset(create_docs(range(1)))
+    [shard] = shard_ids(client)
+    del client.objects[(BUCKET_NAME, f"packed/shards/{shard}")]
+
+    with pytest.raises(client.exceptions.NoSuchKey):
+        store.mget(["key-0"])
+
+
+def test_grace_period_must_cover_index_refresh():
+    with pytest.raises(ValueError, match="shard_grace_seconds"):
+        PackedS3Store(
+            BUCKET_NAME,
+            client=FakeS3Client(),
+            index_refresh_seconds=300,
+            shard_grace_seconds=60,
+        )
@@ -0,0 +1,105 @@
+from pathlib import Path
+
+import pytest
+
+from server.rag.index_config import IndexConfig
+from server.rag.ingestion.pinecone_index import PineconeIndexResolver
+from server.testing.fakes import FakePinecone
+
+CONFIG = IndexConfig(name="test-index", dimension=8)
+
+
+@pytest.fixture
+def client() -> FakePinecone:
+    return FakePinecone(control_plane_latency_seconds=0.0)
+
+
+@pytest.fixture
+def cache_path(tmp_path: Path) -> str:
+    return str(tmp_path / "pinecone-index.json")
+
+
+def unused_client() -> FakePinecone:
+    raise AssertionError("キャッシュから解決できる場合はクライアントを作成しない")
+
+
+def test_repeat_resolve_does_not_call_control_plane(
+    client: FakePinecone, cache_path: str
+):
+    resolver = PineconeIndexResolver(lambda: client, cache_path=cache_path)
+    descriptor = resolver.resolve(CONFIG, force_create=True)
+    calls = client.control_plane_calls
+
+    assert resolver.resolve(CONFIG) == descriptor
+    assert client.control_plane_calls == calls
+    assert resolver.stats.memory_hits == 1
+
+
+def test_disk_cache_is_shared_across_instances(client: FakePinecone, cache_path: str):
+    descriptor = PineconeIndexResolver(lambda: client, cache_path=cache_path).resolve(
+        CONFIG, force_create=True
+    )
+
+    # コールドスタートした別の実行環境を模して、新しいインスタンスで解決する
+    resolver = PineconeIndexResolver(unused_client, cache_path=cache_path)
+    assert resolver.resolve(CONFIG) == descriptor
+    assert resolver.stats.disk_hits == 1
+    assert resolver.stats.control_plane_calls == 0
+
+    # 別のインデックスの解決結果を保存しても、先に保存した解決結果は残る
+    other = IndexConfig(name="other-index", dimension=8)
+    PineconeIndexResolver(lambda: client, cache_path=cache_path).resolve(
+        other, force_create=True
+    )
+    resolver = PineconeIndexResolver(unused_client, cache_path=cache_path)
+    assert resolver.resolve(CONFIG) == descriptor
+    assert resolver.resolve(other).name == "other-index"
+
+
+def test_refresh_resolves_again(client: FakePinecone, cache_path: str):
+    resolver = PineconeIndexResolver(lambda: client, cache_path=cache_path)
+    resolver.resolve(CONFIG, force_create=True)
+    calls = client.control_plane_calls
+
+    resolver.resolve(CONFIG, refresh=True)
+    assert client.control_plane_calls == calls + 1
+
+
+def test_config_mismatch_resolves_again(client: FakePinecone, cache_path: str):
+    PineconeIndexResolver(lambda: client, cache_path=cache_path).resolve(
+        CONFIG, force_create=True
+    )
+
+    # 次元数を変えてインデックスを作り直した場合は、キャッシュを使用せずに解決し直す
+    resized = CONFIG.model_copy(update={"dimension": 16})
+    client.delete_index(CONFIG.name)
+    client.create_index(name=CONFIG.name, spec=None, dimension=16)
+    calls = client.control_plane_calls
+
+    resolver = PineconeIndexResolver(lambda: client, cache_path=cache_path)
+    assert resolver.resolve(resized).dimension == 16
+    assert client.control_plane_calls == calls + 1
+    assert resolver.stats.disk_hits == 0
+
+    # 実際のインデックスと設定が一致しない場合はエラーとする
+    with pytest.raises(ValueError, match="設定が一致しません"):
+        resolver.resolve(CONFIG)
+
+
+@pytest.mark.parametrize(
+    "content",
+    ["{not json", '["test-index"]', '{"test-index": {"name": "test-index"}}'],
+)
+def test_corrupt_cache_file_is_ignored(
+    client: FakePinecone, cache_path: str, content: str
+):
+    with open(cache_path, "w", encoding="utf-8") as f:
+        f.write(content)
+
+    resolver = PineconeIndexResolver(lambda: client, cache_path=cache_path)
+    descriptor = resolver.resolve(CONFIG, force_create=True)
+    assert resolver.stats.disk_hits == 0
+
+    # 壊れたファイルは次の書き込みで上書きされ、以降は読み込める
+    resolver = PineconeIndexResolver(unused_client, cache_path=cache_path)
+    assert resolver.resolve(CONFIG) == descriptor
@@ -0,0 +1,88 @@
+import asyncio
+import time
+from typing import Any
+
+import pytest
+from langchain_core.documents import Document
+
+from server.rag.ingestion.s3_store import S3ByteStore, S3Store
+from server.testing.fakes import FakeS3Client
+
+BUCKET_NAME = "test-bucket"
+
+
+class ReversedLatencyS3Client(FakeS3Client):
+    """後のキーほど早く応答し、取得が完了する順序をキーの順序と逆にするFakeS3Client"""
+
+    def get_object(self, Bucket: str, Key: str, **kwargs: Any) -> dict[str, Any]:
+        time.sleep(0.02 * (9 - int(Key.rsplit("-", 1)[-1])))
+        return super().get_object(Bucket=Bucket, Key=Key, **kwargs)
+
+
+@pytest.fixture
+def client() -> FakeS3Client:
+    return ReversedLatencyS3Client()
+
+
+def create_doc(i: int) -> Document:
+    return Document(
+        page_content=f"チャンク{i}", metadata={"url": f"https://example.com/{i}"}
+    )
+
+
+def test_mget_returns_values_in_key_order(client: FakeS3Client):
+    store = S3Store(bucket_name=BUCKET_NAME, prefix="docs/", client=client)
+    store.mset([(f"key-{i}", create_doc(i)) for i in range(0, 10, 2)])
+
+    keys = [f"key-{i}" for i in range(10)]
+    docs = store.mget(keys)
+
+    # 存在しないキーはNoneとなり、結果はキーと同じ順序で並ぶ
+    assert docs == [create_doc(i) if i % 2 == 0 else None for i in range(10)]
+    assert client.calls["get_object"] == 10
+
+
+def test_amget_returns_values_in_key_order(client: FakeS3Client):
+    store = S3Store(bucket_name=BUCKET_NAME, prefix="docs/", client=client)
+    asyncio.run(store.amset([(f"key-{i}", create_doc(i)) for i in range(1, 10, 2)]))
+
+    keys = [f"key-{i}" for i in reversed(range(10))]
+    docs = asyncio.run(store.amget(keys))
+
+    assert docs == [create_doc(i) if i % 2 == 1 else None for i in reversed(range(10))]
+
+
+def test_mget_requests_keys_concurrently(client: FakeS3Client):
+    store = S3ByteStore(bucket_name=BUCKET_NAME, client=client, max_concurrency=10)
+    store.mset([(f"key-{i}", f"値{i}".encode("utf-8")) for i in range(10)])
+
+    start = time.perf_counter()
+    values = store.mget([f"key-{i}" for i in range(10)])
+    elapsed = time.perf_counter() - start
+
+    assert values == [f"値{i}".encode("utf-8") for i in range(10)]
+    # 順に取得すると0.9秒かかるが、並行に取得するため最も遅いキー(0.18秒)程度で完了する
+    assert elapsed < 0.6
+
+
+def test_mget_and_amget_handle_empty_and_duplicate_keys(client: FakeS3Client):
+    store = S3ByteStore(bucket_name=BUCKET_NAME, client=client)
+    store.mset([("key-1", b"1")])
+
+    assert store.mget([]) == []
+    assert asyncio.run(store.amget([])) == []
+    assert store.mget(["key-1", "key-2", "key-1"]) == [b"1", None, b"1"]
+    assert asyncio.run(store.amget(["key-2", "key-1", "key-1"])) == [None, b"1", b"1"]
+
+
+def test_mdelete_and_yield_keys_use_prefix(client: FakeS3Client):
+    store = S3ByteStore(bucket_name=BUCKET_NAME, prefix="docs/", client=client)
+    other = S3ByteStore(bucket_name=BUCKET_NAME, prefix="other/", client=client)
+    store.mset([(f"key-{i}", b"x") for i in range(3)])
+    other.mset([("key-0", b"y")])
+
+    assert sorted(store.yield_keys()) == ["key-0", "key-1", "key-2"]
+    store.mdelete(["key-0", "key-1"])
+    store.mdelete([])
+    assert list(store.yield_keys()) == ["key-2"]
+    assert other.mget(["key-0"]) == [b"y"]
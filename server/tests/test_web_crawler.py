@@ -0,0 +1,95 @@
+import socket
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+from server.rag.ingestion.web_crawler import AsyncWebCrawler, CrawlerConfig
+from server.testing.fakes import LocalSiteServer
+
+StartSite = Callable[..., LocalSiteServer]
+
+
+def crawl(
+    root_urls: list[str], **config: Any
+) -> tuple[dict[str, str], AsyncWebCrawler]:
+    """クローリングし、URLごとの本文とクローラーを返す"""
+    config.setdefault("politeness_delay_seconds", 0.0)
+    crawler = AsyncWebCrawler(root_urls, CrawlerConfig(**config))
+    docs = {doc.metadata["source"]: doc.page_content for doc in crawler.lazy_load()}
+    return docs, crawler
+
+
+def unused_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_unchanged_pages_are_revalidated_from_cache(
+    local_site: StartSite, tmp_path: Path
+):
+    site = local_site(pages=7)
+    cache_dir = str(tmp_path / "http-cache")
+
+    first, crawler = crawl([site.root_url], cache_dir=cache_dir)
+    assert len(first) == 7
+    assert crawler.stats.not_modified == 0
+    assert crawler.stats.bytes_downloaded > 0
+
+    # 2回目は条件付きリクエストで304が返り、キャッシュの本文を出力する
+    site.reset_counters()
+    second, crawler = crawl([site.root_url], cache_dir=cache_dir)
+    assert second == first
+    assert crawler.stats.pages == 7
+    assert crawler.stats.not_modified == site.not_modified == 7
+    assert crawler.stats.bytes_downloaded == 0
+
+    # 更新したページのみをダウンロードし直す
+    site.modify(3)
+    third, crawler = crawl([site.root_url], cache_dir=cache_dir)
+    assert crawler.stats.not_modified == 6
+    updated_url = f"{site.base_url}/pages/3.html"
+    assert "版1" in third[updated_url] and "版1" not in first[updated_url]
+    assert {url: body for url, body in third.items() if url != updated_url} == {
+        url: body for url, body in first.items() if url != updated_url
+    }
+
+
+def test_without_cache_dir_every_page_is_downloaded(local_site: StartSite):
+    site = local_site(pages=7)
+
+    crawl([site.root_url])
+    _, crawler = crawl([site.root_url])
+    assert crawler.stats.not_modified == 0
+    assert site.not_modified == 0
+
+
+def test_per_host_concurrency_is_limited(local_site: StartSite):
+    site = local_site(pages=30, latency_seconds=0.05)
+
+    docs, _ = crawl([site.root_url], max_concurrency=16, per_host_concurrency=2)
+    assert len(docs) == 30
+    assert site.max_in_flight == 2
+
+
+def test_requests_to_a_host_are_spaced_by_politeness_delay(local_site: StartSite):
+    site = local_site(pages=10)
+
+    start = time.perf_counter()
+    docs, _ = crawl([site.root_url], politeness_delay_seconds=0.05)
+    assert len(docs) == 10
+    # 最初のリクエストを除き、0.05秒以上の間隔を空けて開始する
+    assert time.perf_counter() - start >= 9 * 0.05
+
+
+def test_failed_urls_are_reported(local_site: StartSite):
+    site = local_site(pages=3)
+    missing_url = f"{site.base_url}/pages/999.html"
+    unreachable_url = f"http://127.0.0.1:{unused_port()}/"
+
+    docs, crawler = crawl([site.root_url, missing_url, unreachable_url], max_retries=0)
+
+    # 取得できなかったページがあっても、残りのページは出力する
+    assert len(docs) == 3
+    assert sorted(crawler.stats.failed_urls) == sorted([missing_url, unreachable_url])
+    assert crawler.stats.errors == 2